@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+
+"""@package mockelastic
+A local HTTP server implementing enough of the Elasticsearch search, scroll and bulk APIs to test ElasticsearchDataSource and ElasticsearchResultHandler
+"""
+
+from __future__ import print_function
+import json
+import time
+import threading
+import itertools
+import six
+
+class _Server(six.moves.socketserver.ThreadingMixIn, six.moves.BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+class _Handler(six.moves.BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        six.moves.BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.server.mock.connections += 1
+
+    def log_message(self, format, *args):
+        pass
+
+    def _respond(self, body, status = 200):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.send_header("X-Elastic-Product", "Elasticsearch")
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _body(self):
+        length = int(self.headers.get("Content-Length", 0))
+        if (length == 0):
+            return {}
+
+        data = self.rfile.read(length).decode("utf-8")
+        if (self.path.partition("?")[0].endswith("/_bulk")):
+            return [json.loads(line) for line in data.splitlines() if (len(line) > 0)]
+
+        return json.loads(data)
+
+    def _request(self):
+        path, delim, query = self.path.partition("?")
+        body = self._body()
+        self.server.mock.requests.append((path, body))
+        time.sleep(self.server.mock.latency)
+
+        return (path, six.moves.urllib.parse.parse_qs(query), body)
+
+    def do_GET(self):
+        if ("/_mapping/field/" not in self.path):
+            self._body()
+            self._respond({"version":{"number":"7.17.0", "build_flavor":"default"}, "tagline":"You Know, for Search"})
+            return
+
+        path, params, body = self._request()
+        index, delim, fields = path[1:].partition("/_mapping/field/")
+        mappings = dict([(field, {"full_name":field, "mapping":{field.split(".")[-1]:self.server.mock.mappings[field]}}) for field in six.moves.urllib.parse.unquote(fields).split(",") if (field in self.server.mock.mappings)])
+        self._respond({index:{"mappings":mappings}})
+
+    def _aggregate(self, body):
+        composite = body["aggs"]["keys"]["composite"]
+        names = [list(source.keys())[0] for source in composite["sources"]]
+        fields = [list(source.values())[0]["terms"]["field"] for source in composite["sources"]]
+
+        def value(document, field):
+            for name in field.split("."):
+                if ((not isinstance(document, dict)) or (name not in document)):
+                    return None
+
+                document = document[name]
+
+            return document
+
+        # Sort missing values first, as Elasticsearch does
+        keys = sorted(set([tuple([value(document, field) for field in fields]) for document in self.server.mock.documents]), key=lambda key: [(item is not None, item) for item in key])
+        if ("after" in composite):
+            after = [(composite["after"][name] is not None, composite["after"][name]) for name in names]
+            keys = [key for key in keys if ([(item is not None, item) for item in key] > after)]
+
+        buckets = [{"key":dict(zip(names, key)), "doc_count":1} for key in keys[:composite["size"]]]
+        aggregation = {"buckets":buckets}
+        if (len(buckets) > 0):
+            aggregation["after_key"] = buckets[-1]["key"]
+
+        self._respond({"took":1, "timed_out":False, "hits":{"total":{"value":len(self.server.mock.documents), "relation":"eq"}, "hits":[]}, "aggregations":{"keys":aggregation}})
+
+    def do_DELETE(self):
+        path, params, body = self._request()
+        if (path == "/_pit"):
+            self.server.mock.open_pits.discard(body["id"])
+
+        self._respond({"succeeded":True, "num_freed":1})
+
+    def _bulk(self, path, body):
+        mock = self.server.mock
+        index = path[1:].partition("/")[0]
+        items = []
+        for action, document in zip(body[0::2], body[1::2]):
+            with mock.lock:
+                rejected = (mock.bulk_rejections > 0)
+                if (rejected):
+                    mock.bulk_rejections -= 1
+                elif ("invalid" not in document):
+                    mock.indexed.setdefault(index, []).append(document)
+
+            if (rejected):
+                items.append({"index":{"_index":index, "status":429, "error":{"type":"es_rejected_execution_exception", "reason":"rejected execution"}}})
+            elif ("invalid" in document):
+                items.append({"index":{"_index":index, "status":400, "error":{"type":"mapper_parsing_exception", "reason":"failed to parse field [invalid]"}}})
+            else:
+                items.append({"index":{"_index":index, "_id":str(len(mock.indexed[index])), "status":201, "result":"created"}})
+
+        self._respond({"took":1, "errors":any([item["index"]["status"] >= 300 for item in items]), "items":items})
+
+    def do_POST(self):
+        path, params, body = self._request()
+        mock = self.server.mock
+
+        if (path.endswith("/_bulk")):
+            self._bulk(path, body)
+            return
+
+        if (path.endswith("/_pit")):
+            if (not mock.pit):
+                self._respond({"error":{"type":"illegal_argument_exception", "reason":"point in time not supported"}, "status":400}, 400)
+                return
+
+            pit_id = "pit_{0}".format(next(mock.scroll_ids))
+            mock.open_pits.add(pit_id)
+            self._respond({"id":pit_id})
+            return
+
+        if ("aggs" in body):
+            self._aggregate(body)
+            return
+
+        if (path.endswith("/_search/scroll")):
+            hits, size = mock.scrolls[body["scroll_id"]]
+            scroll_id = body["scroll_id"]
+        else:
+            # Hits are (sort value, document) pairs
+            hits = list(enumerate(mock.documents))
+            if ("slice" in body):
+                hits = [hit for hit in hits if (hit[0] % body["slice"]["max"] == body["slice"]["id"])]
+
+            if ("search_after" in body):
+                hits = [hit for hit in hits if (hit[0] > body["search_after"][0])]
+
+            size = int(body.get("size", params.get("size", [10])[0]))
+            scroll_id = "scroll_{0}".format(next(mock.scroll_ids))
+
+        mock.scrolls[scroll_id] = (hits[size:], size)
+
+        response = {"_scroll_id":scroll_id, "took":1, "timed_out":False, "_shards":{"total":1, "successful":1, "skipped":0, "failed":0}, "hits":{"total":{"value":len(hits), "relation":"eq"}, "hits":[]}}
+        if ("pit" in body):
+            del response["_scroll_id"]
+            response["pit_id"] = body["pit"]["id"]
+
+        includes = None
+        if ("_source" in body):
+            includes = [] if (body["_source"] is False) else [field.split(".")[0] for field in body["_source"]["includes"]]
+
+        for sort_value, document in hits[:size]:
+            hit = {"_index":"mock", "_id":str(sort_value), "sort":[sort_value]}
+            if (includes is None):
+                hit["_source"] = document
+            elif (len(includes) > 0):
+                hit["_source"] = dict([(key, value) for key, value in six.iteritems(document) if (key in includes)])
+
+            response["hits"]["hits"].append(hit)
+
+        self._respond(response)
+
+class MockElasticsearch(object):
+    """A mock Elasticsearch node serving a fixed list of documents on a local port
+    """
+
+    def __init__(self, documents, latency = 0.0, pit = True, mappings = None, bulk_rejections = 0):
+        self.documents = documents
+        self.indexed = {}
+        self.bulk_rejections = bulk_rejections
+        self.lock = threading.Lock()
+        self.mappings = {} if (mappings is None) else mappings
+        self.latency = latency
+        self.pit = pit
+        self.open_pits = set()
+        self.requests = []
+        self.connections = 0
+        self.scrolls = {}
+        self.scroll_ids = itertools.count()
+
+        self._server = _Server(("127.0.0.1", 0), _Handler)
+        self._server.mock = self
+        self.host = "127.0.0.1:{0}".format(self._server.server_address[1])
+
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
@@ -4,11 +4,26 @@ from __future__ import print_function
 import logging
 import string
 import sys
+import os
 import time
+import tempfile
+import json
+import multiprocessing
+import gzip
+import sqlite3
 import six
 
-from weaveq.query import WeaveQ
+from weaveq.query import WeaveQ, StepPlan
 from weaveq.relations import F
+from weaveq.datasources import JsonLinesDataSource, JsonDataSource, CsvDataSource, ParquetDataSource, SqliteDataSource, ElasticsearchDataSource
+from weaveq import jsoncodec
+from weaveq import compression
+from weaveq import arrowrecord
+from weaveq import wqexception
+from weaveq import resultformats
+from weaveq import batchmatch
+from weaveq.application import FileOutputResultHandler, BufferedOutputResultHandler, ElasticsearchResultHandler, BackgroundResultHandler
+from tests.mockelastic import MockElasticsearch
 
 class TestResult(object):
     def __init__(self, data):
@@ -122,6 +137,397 @@ def join_only(sizes):
     
     return round(t_end - t_start, 1)
 
+def equality_matching(match_batches, vectorise = False):
+    def logic(sizes):
+        r = TestResultHandler()
+        q1 = MockDataSource("id", sizes[0], "Step 1")
+        q2 = MockDataSource("second_id", sizes[1], "Step 2")
+        q3 = MockDataSource("third_id", sizes[2], "Step 3")
+
+        s = WeaveQ(q1).pivot_to(q2, F("id") == F("second_id")).join_to(q3, F("second_id") == F("third_id"))
+        s.match_batches = match_batches
+        s.vectorise_matching = vectorise
+        s.result_handler(r)
+
+        t_start = time.time()
+        s.execute(stream=False)
+        t_end = time.time()
+
+        return round(t_end - t_start, 1)
+
+    return logic
+
+def write_json_lines(size):
+    tmpfile = tempfile.mkstemp()
+    os.close(tmpfile[0])
+    with open(tmpfile[1], "w") as data_file:
+        for index in six.moves.range(size):
+            data_file.write(json.dumps({"id":index,"name":"name{0}".format(index),"tags":["a","b","c"],"nested":{"value":index * 2,"label":"label{0}".format(index)}}))
+            data_file.write("\n")
+
+    return tmpfile[1]
+
+def json_lines_decode(workers):
+    def logic(sizes):
+        filename = write_json_lines(sizes[0])
+        try:
+            subject = JsonLinesDataSource(filename, None, {"workers":workers, "chunk_size":4 * 1024 * 1024})
+
+            t_start = time.time()
+            subject.batch()
+            t_end = time.time()
+        finally:
+            os.unlink(filename)
+
+        return round(t_end - t_start, 1)
+
+    return logic
+
+def json_lines_pivot(lazy):
+    def logic(sizes):
+        seed_filename = write_json_lines(sizes[0])
+        filename = write_json_lines(sizes[1])
+        try:
+            r = TestResultHandler()
+            s = WeaveQ(JsonLinesDataSource(seed_filename, None)).pivot_to(JsonLinesDataSource(filename, None, {"lazy":lazy}), F("id") == F("id"))
+            s.result_handler(r)
+
+            t_start = time.time()
+            s.execute(stream=False)
+            t_end = time.time()
+        finally:
+            os.unlink(seed_filename)
+            os.unlink(filename)
+
+        return round(t_end - t_start, 1)
+
+    return logic
+
+def write_json_array(size):
+    tmpfile = tempfile.mkstemp()
+    os.close(tmpfile[0])
+    with open(tmpfile[1], "w") as data_file:
+        data_file.write("[")
+        for index in six.moves.range(size):
+            if (index > 0):
+                data_file.write(",\n")
+
+            data_file.write(json.dumps({"id":index,"name":"name{0}".format(index),"tags":["a","b","c"],"nested":{"value":index * 2,"label":"label{0}".format(index)}}))
+
+        data_file.write("]")
+
+    return tmpfile[1]
+
+def json_array_load(stream):
+    def logic(sizes):
+        filename = write_json_array(sizes[0])
+        try:
+            subject = JsonDataSource(filename, None)
+
+            t_start = time.time()
+            for record in (subject.stream() if stream else subject.batch()):
+                pass
+            t_end = time.time()
+        finally:
+            os.unlink(filename)
+
+        return round(t_end - t_start, 1)
+
+    return logic
+
+def gzip_json_lines_decode(read_ahead):
+    def logic(sizes):
+        filename = write_json_lines(sizes[0])
+        compressed_filename = "{0}.gz".format(filename)
+        try:
+            with open(filename, "rb") as source_file:
+                with gzip.open(compressed_filename, "wb") as compressed_file:
+                    compressed_file.write(source_file.read())
+
+            codec = jsoncodec.default_codec()
+
+            t_start = time.time()
+            with compression.open_file(compressed_filename, read_ahead=read_ahead) as data_file:
+                for line in data_file:
+                    codec.decode(line)
+            t_end = time.time()
+        finally:
+            os.unlink(filename)
+            os.unlink(compressed_filename)
+
+        return round(t_end - t_start, 1)
+
+    return logic
+
+def json_codec(codec_name):
+    def logic(sizes):
+        codec = jsoncodec.get_codec(codec_name)
+        documents = [json.dumps({"id":index,"name":"name{0}".format(index),"tags":["a","b","c"],"nested":{"value":index * 2,"label":"label{0}".format(index)}}).encode("utf-8") for index in six.moves.range(sizes[0])]
+
+        t_start = time.time()
+        for document in documents:
+            codec.encode(codec.decode(document))
+        t_end = time.time()
+
+        return round(t_end - t_start, 1)
+
+    return logic
+
+def wide_csv_load(workers):
+    def logic(sizes):
+        return load_wide_csv(sizes, workers)
+
+    return logic
+
+def load_wide_csv(sizes, workers):
+    tmpfile = tempfile.mkstemp()
+    os.close(tmpfile[0])
+    try:
+        with open(tmpfile[1], "w") as data_file:
+            data_file.write(",".join(["field_{0}".format(column) for column in six.moves.range(50)]))
+            data_file.write("\n")
+            for index in six.moves.range(sizes[0]):
+                data_file.write(",".join(["value_{0}_{1}".format(index, column) for column in six.moves.range(50)]))
+                data_file.write("\n")
+
+        subject = CsvDataSource(tmpfile[1], None, {"first_row_names":True, "workers":workers, "chunk_size":4 * 1024 * 1024})
+
+        t_start = time.time()
+        subject.batch()
+        t_end = time.time()
+    finally:
+        os.unlink(tmpfile[1])
+
+    return round(t_end - t_start, 1)
+
+def parquet_pivot(prune):
+    def logic(sizes):
+        import pyarrow
+        import pyarrow.parquet
+
+        tmpfile = tempfile.mkstemp(suffix=".parquet")
+        os.close(tmpfile[0])
+        try:
+            columns = {"id":list(six.moves.range(sizes[1]))}
+            for column in six.moves.range(20):
+                columns["field_{0}".format(column)] = ["value_{0}_{1}".format(column, index % 1000) for index in six.moves.range(sizes[1])]
+
+            pyarrow.parquet.write_table(pyarrow.table(columns), tmpfile[1], row_group_size=50000)
+
+            r = TestResultHandler()
+            q1 = MockDataSource("id", sizes[0], "Step 1")
+            q2 = ParquetDataSource(tmpfile[1], None)
+            if (not prune):
+                q2.lookup = lambda key_values: None
+
+            s = WeaveQ(q1).pivot_to(q2, F("id") == F("id")).select(["field_0"])
+            s.result_handler(r)
+
+            t_start = time.time()
+            s.execute(stream=False)
+            t_end = time.time()
+        finally:
+            os.unlink(tmpfile[1])
+
+        return round(t_end - t_start, 1)
+
+    return logic
+
+def sqlite_pivot(lookup):
+    def logic(sizes):
+        tmpfile = tempfile.mkstemp(suffix=".sqlite")
+        os.close(tmpfile[0])
+        try:
+            connection = sqlite3.connect(tmpfile[1])
+            connection.execute("CREATE TABLE records (id INTEGER, {0})".format(", ".join(["field_{0} TEXT".format(column) for column in six.moves.range(20)])))
+            connection.executemany("INSERT INTO records VALUES ({0})".format(", ".join(["?"] * 21)), ([index] + ["value_{0}_{1}".format(column, index % 1000) for column in six.moves.range(20)] for index in six.moves.range(sizes[1])))
+            connection.execute("CREATE INDEX records_id ON records (id)")
+            connection.commit()
+            connection.close()
+
+            r = TestResultHandler()
+            q1 = MockDataSource("id", sizes[0], "Step 1")
+            q2 = SqliteDataSource("{0}:records".format(tmpfile[1]), None)
+            if (not lookup):
+                q2.lookup = lambda key_values: None
+
+            s = WeaveQ(q1).pivot_to(q2, F("id") == F("id"))
+            s.result_handler(r)
+
+            t_start = time.time()
+            s.execute(stream=False)
+            t_end = time.time()
+        finally:
+            os.unlink(tmpfile[1])
+
+        return round(t_end - t_start, 1)
+
+    return logic
+
+def elasticsearch_scroll(slices):
+    def logic(sizes):
+        # Each search and scroll request takes at least 50ms, as if the node were busy reading shards
+        server = MockElasticsearch([{"id":index, "name":"name_{0}".format(index)} for index in six.moves.range(sizes[0])], latency=0.05)
+        try:
+            subject = ElasticsearchDataSource("records", "*", {"hosts":[server.host], "slices":slices})
+
+            t_start = time.time()
+            for hit in subject.stream():
+                pass
+            t_end = time.time()
+        finally:
+            server.close()
+
+        return round(t_end - t_start, 1)
+
+    return logic
+
+def elasticsearch_source_filtering(filtered):
+    def logic(sizes):
+        server = MockElasticsearch([dict([("id", index)] + [("field_{0}".format(column), "value_{0}_{1}".format(column, index)) for column in six.moves.range(50)]) for index in six.moves.range(sizes[0])])
+        try:
+            subject = ElasticsearchDataSource("records", "*", {"hosts":[server.host]})
+            if (filtered):
+                # As for the seed step of a query that pivots on the id field
+                subject.prepare(StepPlan(ordered=False, key_fields=["id"], output_fields=[]))
+
+            t_start = time.time()
+            for hit in subject.stream():
+                pass
+            t_end = time.time()
+        finally:
+            server.close()
+
+        return round(t_end - t_start, 1)
+
+    return logic
+
+def elasticsearch_retrieval(batch):
+    def logic(sizes):
+        # Each request takes at least 50ms, as if the node were busy reading shards
+        server = MockElasticsearch([dict([("id", index)] + [("field_{0}".format(column), "value_{0}_{1}".format(column, index)) for column in six.moves.range(10)]) for index in six.moves.range(sizes[0])], latency=0.05)
+        try:
+            subject = ElasticsearchDataSource("records", "*", {"hosts":[server.host]})
+
+            t_start = time.time()
+            if (batch):
+                subject.batch()
+            else:
+                list(subject.stream())
+            t_end = time.time()
+        finally:
+            server.close()
+
+        return round(t_end - t_start, 1)
+
+    return logic
+
+def elasticsearch_pivot(aggregate_keys):
+    def logic(sizes):
+        # Every key value appears in many documents
+        server = MockElasticsearch([dict([("id", index % sizes[1])] + [("field_{0}".format(column), "value_{0}_{1}".format(column, index)) for column in six.moves.range(10)]) for index in six.moves.range(sizes[0])], mappings={"id":{"type":"long"}})
+        try:
+            r = TestResultHandler()
+            q1 = ElasticsearchDataSource("records", "*", {"hosts":[server.host], "aggregate_keys":aggregate_keys})
+            q2 = MockDataSource("id", sizes[1], "Step 2")
+
+            s = WeaveQ(q1).pivot_to(q2, F("id") == F("id"))
+            s.result_handler(r)
+
+            t_start = time.time()
+            s.execute(stream=False)
+            t_end = time.time()
+        finally:
+            server.close()
+
+        return round(t_end - t_start, 1)
+
+    return logic
+
+def elasticsearch_bulk(requests):
+    def logic(sizes):
+        # Each request takes at least 50ms, as if the node were busy indexing
+        server = MockElasticsearch([], latency=0.05)
+        try:
+            subject = ElasticsearchResultHandler(ElasticsearchDataSource.connect({"hosts":[server.host]}), "results", batch_size=500, requests=requests)
+
+            t_start = time.time()
+            for index in six.moves.range(sizes[0]):
+                subject(dict([("id", index)] + [("field_{0}".format(column), "value_{0}_{1}".format(column, index)) for column in six.moves.range(10)]), None)
+            subject.flush()
+            t_end = time.time()
+        finally:
+            server.close()
+
+        return round(t_end - t_start, 1)
+
+    return logic
+
+def result_output(buffered, compression_name = None, part_size = None, encoders = None):
+    def logic(sizes):
+        results = [dict([("id", index)] + [("field_{0}".format(column), "value_{0}_{1}".format(column, index)) for column in six.moves.range(10)]) for index in six.moves.range(sizes[0])]
+        directory = tempfile.mkdtemp()
+        filename = os.path.join(directory, "results.jsonl")
+        try:
+            t_start = time.time()
+            if (buffered):
+                subject = BufferedOutputResultHandler(filename, compression=compression_name, part_size=part_size)
+            else:
+                output_file = open(filename, "w")
+                subject = FileOutputResultHandler(output_file)
+
+            output_handler = subject
+            if (encoders is not None):
+                subject = BackgroundResultHandler(output_handler, encoders=encoders)
+
+            for result in results:
+                subject(result, None)
+
+            subject.flush()
+            if (not buffered):
+                output_file.close()
+            t_end = time.time()
+
+            output_size = output_handler.bytes_written if (buffered) else os.path.getsize(filename)
+        finally:
+            for output_filename in os.listdir(directory):
+                os.unlink(os.path.join(directory, output_filename))
+            os.rmdir(directory)
+
+        print("Output: {0:.1f} MB/s".format(output_size / (t_end - t_start) / 1048576.0))
+        return round(t_end - t_start, 1)
+
+    return logic
+
+def table_output(output_format):
+    def logic(sizes):
+        results = [dict([("id", index), ("joined", dict([("field_{0}".format(column), "value_{0}_{1}".format(column, index)) for column in six.moves.range(5)]))] + [("field_{0}".format(column), index * column) for column in six.moves.range(5)]) for index in six.moves.range(sizes[0])]
+        directory = tempfile.mkdtemp()
+        filename = os.path.join(directory, "results.{0}".format(output_format))
+        try:
+            t_start = time.time()
+            if (output_format == "csv"):
+                subject = resultformats.CsvResultHandler(filename)
+            elif (output_format == "parquet"):
+                subject = resultformats.ParquetResultHandler(filename)
+            else:
+                subject = resultformats.SqliteResultHandler(filename)
+
+            for result in results:
+                subject(result, None)
+
+            subject.flush()
+            t_end = time.time()
+        finally:
+            for output_filename in os.listdir(directory):
+                os.unlink(os.path.join(directory, output_filename))
+            os.rmdir(directory)
+
+        print("Output: {0:.0f} row(s)/s".format(subject.rows_written / (t_end - t_start)))
+        return round(t_end - t_start, 1)
+
+    return logic
+
 def run_tc(name, logic, sizes):
     print("=== Test Case: {0} ===".format(name))
 
@@ -145,6 +551,71 @@ def run():
     run_tc("Pivot then join with exponential increase from seed", pivot_and_join, (1000, 10000, 1000000))
     run_tc("Pivot with exponential increase from seed", pivot_only, (1000, 10000, 1000000))
     run_tc("Join with exponential increase from seed", join_only, (1000, 10000, 1000000))
+    run_tc("Pivot then join, matched a record at a time", equality_matching(False), (1000, 100000, 1000000))
+    run_tc("Pivot then join, matched a batch at a time", equality_matching(True), (1000, 100000, 1000000))
+    if (batchmatch.numpy_available()):
+        run_tc("Pivot then join, matched a batch at a time using NumPy", equality_matching(True, True), (1000, 100000, 1000000))
+    else:
+        print("NumPy not installed: skipping vectorised matching")
+
+    run_tc("JSON lines decode, in-process", json_lines_decode(1), (1000000,))
+    run_tc("JSON lines decode, {0} worker processes".format(multiprocessing.cpu_count()), json_lines_decode(0), (1000000,))
+    run_tc("JSON lines pivot discarding most records, eager decoding", json_lines_pivot(False), (1000, 1000000))
+    run_tc("JSON lines pivot discarding most records, lazy decoding", json_lines_pivot(True), (1000, 1000000))
+    run_tc("JSON array, whole document decoded", json_array_load(False), (1000000,))
+    run_tc("JSON array, elements decoded incrementally", json_array_load(True), (1000000,))
+    run_tc("gzip-compressed JSON lines decode, decompressed in line", gzip_json_lines_decode(False), (1000000,))
+    run_tc("gzip-compressed JSON lines decode, decompressed ahead", gzip_json_lines_decode(True), (1000000,))
+    run_tc("CSV load, 50 columns, in-process", wide_csv_load(1), (200000,))
+    run_tc("CSV load, 50 columns, {0} worker processes".format(multiprocessing.cpu_count()), wide_csv_load(0), (200000,))
+
+    if (arrowrecord.available()):
+        run_tc("Parquet pivot, 21 columns, reading every row group", parquet_pivot(False), (1000, 1000000))
+        run_tc("Parquet pivot, 21 columns, reading only row groups that could match", parquet_pivot(True), (1000, 1000000))
+    else:
+        print("pyarrow not installed: skipping Parquet data source cases")
+
+    run_tc("SQLite pivot, 21 columns, reading the whole table", sqlite_pivot(False), (1000, 1000000))
+    run_tc("SQLite pivot, 21 columns, looking up keys using an index", sqlite_pivot(True), (1000, 1000000))
+
+    for slices in [1, 2, 4, 8]:
+        run_tc("Elasticsearch scroll through mock node, {0} slice(s)".format(slices), elasticsearch_scroll(slices), (200000,))
+
+    run_tc("Elasticsearch scroll through mock node, 51 fields, whole _source", elasticsearch_source_filtering(False), (100000,))
+    run_tc("Elasticsearch scroll through mock node, 51 fields, only the key field", elasticsearch_source_filtering(True), (100000,))
+    run_tc("Elasticsearch retrieval from mock node, scroll", elasticsearch_retrieval(False), (200000,))
+    run_tc("Elasticsearch retrieval from mock node, point in time with prefetched pages", elasticsearch_retrieval(True), (200000,))
+    run_tc("Elasticsearch pivot from mock node, retrieving documents", elasticsearch_pivot(False), (200000, 1000))
+    run_tc("Elasticsearch pivot from mock node, aggregating keys", elasticsearch_pivot(True), (200000, 1000))
+
+    for requests in [1, 4]:
+        run_tc("Elasticsearch bulk indexing into mock node, {0} request(s) in flight".format(requests), elasticsearch_bulk(requests), (100000,))
+
+    run_tc("Result output, printed one at a time", result_output(False), (500000,))
+    run_tc("Result output, encoded in batches and buffered", result_output(True), (500000,))
+    run_tc("Result output, buffered and gzip-compressed behind the writer", result_output(True, "gzip"), (500000,))
+    run_tc("Result output, buffered and gzip-compressed into 16MB part files", result_output(True, "gzip", 16 * 1024 * 1024), (500000,))
+    run_tc("Result output, buffered and gzip-compressed on a background thread", result_output(True, "gzip", encoders=0), (500000,))
+    run_tc("Result output, buffered and gzip-compressed on a background thread, encoded by 2 processes", result_output(True, "gzip", encoders=2), (500000,))
+    try:
+        import zstandard
+        run_tc("Result output, buffered and zstd-compressed behind the writer", result_output(True, "zstd"), (500000,))
+    except ImportError:
+        print("zstandard not installed: skipping zstd output case")
+
+    run_tc("Result output, flattened into CSV rows", table_output("csv"), (200000,))
+    run_tc("Result output, flattened into SQLite rows", table_output("sqlite"), (200000,))
+    if (arrowrecord.available()):
+        run_tc("Result output, flattened into Parquet row groups", table_output("parquet"), (200000,))
+
+    for codec_name in jsoncodec.codec_names()[1:]:
+        try:
+            jsoncodec.get_codec(codec_name)
+        except wqexception.ConfigurationError:
+            print("JSON codec {0} not installed: skipping".format(codec_name))
+            continue
+
+        run_tc("JSON decode and encode, {0} codec".format(codec_name), json_codec(codec_name), (1000000,))
 
     return True
 
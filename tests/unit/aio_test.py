@@ -0,0 +1,203 @@
+"""@package aio_test
+Tests for weaveq.aio
+"""
+
+import unittest
+import copy
+import time
+import six
+
+from weaveq.query import WeaveQ, record_batches
+from weaveq.relations import F
+from weaveq import datasources
+from weaveq import wqexception
+from tests.mockelastic import MockElasticsearch
+
+if (six.PY3):
+    import asyncio
+    from weaveq import aio
+
+def run_coroutines(*coroutines):
+    """!
+    Runs coroutines concurrently on a new event loop, closing any asynchronous Elasticsearch clients they created
+
+    @return The coroutines' results
+    """
+    loop = asyncio.new_event_loop()
+    try:
+        tasks = [loop.create_task(coroutine) for coroutine in coroutines]
+        return loop.run_until_complete(asyncio.wait_for(asyncio.gather(*tasks), 30))
+    finally:
+        loop.run_until_complete(aio.close_elasticsearch_clients())
+        loop.close()
+
+class TestResultHandler(object):
+
+    def __init__(self):
+        self.results = []
+
+    def __call__(self, result, handler_output):
+        self.results.append(result)
+
+    def success(self):
+        return True
+
+class MockDataSource(object):
+    """Supplies pre-defined data to WeaveQ, optionally looking records up by key
+    """
+
+    def __init__(self, records, lookups = False):
+        self._records = records
+        self._lookups = lookups
+        self.plan = None
+        self.key_values = None
+
+    def prepare(self, plan):
+        self.plan = plan
+
+    def batch(self):
+        return copy.deepcopy(self._records)
+
+    def stream(self):
+        return iter(copy.deepcopy(self._records))
+
+    def stream_batches(self, batch_size):
+        return record_batches(copy.deepcopy(self._records), 3)
+
+    def lookup(self, key_values):
+        if (not self._lookups):
+            return None
+
+        self.key_values = key_values
+        return [record for record in copy.deepcopy(self._records) if (record.get("id") in key_values[0][1])]
+
+class SlowDataSource(MockDataSource):
+    """Takes a while to fetch each batch, which contains a single record
+    """
+
+    def stream_batches(self, batch_size):
+        for record in self._records:
+            time.sleep(0.2)
+            yield [record]
+
+class SlowResultHandler(TestResultHandler):
+    """Takes a while to process each result
+    """
+
+    def __call__(self, result, handler_output):
+        time.sleep(0.2)
+        super(SlowResultHandler, self).__call__(result, handler_output)
+
+@unittest.skipIf(six.PY2, "asyncio isn't available")
+class TestAsyncWeaveQ(unittest.TestCase):
+    """Tests AsyncWeaveQ and ThreadedDataSource classes
+    """
+
+    def setUp(self):
+        self._left = [{"id":index % 5, "n":index} for index in range(10)]
+        self._right = [{"id":index, "name":"n{0}".format(index)} for index in range(8)] + [{"name":"no id"}]
+
+    def _query(self, query_class, lookups = False):
+        return query_class(MockDataSource(self._left)).pivot_to(MockDataSource(self._right, lookups), F("id") == F("id")).join_to(MockDataSource(self._left), F("id") == F("id"), field="joined", array=True)
+
+    def _run(self, query, stream):
+        handler = TestResultHandler()
+        query.result_handler(handler)
+        if (isinstance(query, aio.AsyncWeaveQ)):
+            self.assertEqual(run_coroutines(query.execute(stream=stream)), [True])
+        else:
+            self.assertTrue(query.execute(stream=stream))
+
+        return handler.results
+
+    def test_same_results(self):
+        """Queries of synchronous data sources produce the same results as WeaveQ
+        """
+        for stream in [True, False]:
+            for lookups in [True, False]:
+                self.assertEqual(self._run(self._query(aio.AsyncWeaveQ, lookups), stream), self._run(self._query(WeaveQ, lookups), stream))
+
+    def test_threaded_data_source(self):
+        """Synchronous data sources are planned and looked up on executor threads
+        """
+        pivot_source = MockDataSource(self._right, True)
+        query = aio.AsyncWeaveQ(MockDataSource(self._left)).pivot_to(pivot_source, F("id") == F("id"))
+        self.assertEqual(len(self._run(query, True)), 5)
+        self.assertEqual(pivot_source.plan.output_fields, None)
+        self.assertEqual(pivot_source.key_values, [("id", set(range(5)))])
+
+    def test_concurrent_queries(self):
+        """Several queries run concurrently on the same event loop
+        """
+        queries = [self._query(aio.AsyncWeaveQ) for index in range(4)]
+        handlers = [TestResultHandler() for query in queries]
+        for query, handler in zip(queries, handlers):
+            query.result_handler(handler)
+
+        self.assertEqual(run_coroutines(*[query.execute(stream=True) for query in queries]), [True] * 4)
+        expected = self._run(self._query(WeaveQ), True)
+        self.assertTrue(all([handler.results == expected for handler in handlers]))
+
+    def test_overlapped_fetching(self):
+        """The next batch of records is fetched while the current one is being processed
+        """
+        handler = SlowResultHandler()
+        query = aio.AsyncWeaveQ(SlowDataSource([{"id":index} for index in range(3)]))
+        query.result_handler(handler)
+
+        started = time.time()
+        self.assertEqual(run_coroutines(query.execute(stream=True)), [True])
+        self.assertEqual(handler.results, [{"id":0}, {"id":1}, {"id":2}])
+
+        # Fetching and processing each batch one after the other takes 1.2 seconds, overlapping them 0.8 seconds
+        self.assertLess(time.time() - started, 1.0)
+
+@unittest.skipIf(six.PY2 or (not aio.elasticsearch_available()), "The asynchronous Elasticsearch client isn't available")
+class TestAsyncElasticsearchDataSource(unittest.TestCase):
+    """Tests AsyncElasticsearchDataSource class
+    """
+
+    def setUp(self):
+        self._server = MockElasticsearch([{"id":index % 700, "n":index} for index in range(2500)], mappings={"id":{"type":"long"}})
+
+    def tearDown(self):
+        self._server.close()
+
+    def _run(self, config, stream):
+        handler = TestResultHandler()
+        query = aio.AsyncWeaveQ(aio.AsyncElasticsearchDataSource("a", "*", config)).pivot_to(MockDataSource([{"id":index} for index in range(0, 1000, 2)]), F("id") == F("id"))
+        query.result_handler(handler)
+        self.assertEqual(run_coroutines(query.execute(stream=stream)), [True])
+
+        return handler.results
+
+    def test_stream(self):
+        """Hits are scrolled through using the asynchronous client, optionally in slices
+        """
+        for stream in [True, False]:
+            self.assertEqual(self._run({"hosts":[self._server.host]}, stream), [{"id":index} for index in range(0, 700, 2)])
+            self.assertEqual(self._run({"hosts":[self._server.host], "slices":3}, stream), [{"id":index} for index in range(0, 700, 2)])
+            self.assertEqual(len([body for path, body in self._server.requests if ("slice" in body)]), 3)
+            self._server.requests = []
+
+    def test_no_sync_client(self):
+        """Only the asynchronous client is created, and configuration is validated as for the synchronous data source
+        """
+        config = {"hosts":[self._server.host], "timeout":37}
+        subject = aio.AsyncElasticsearchDataSource("a", "*", config)
+        self.assertEqual(subject.slices, 1)
+        self.assertFalse(datasources._client_key(subject._client_config()) in datasources._elastic_clients)
+        self.assertEqual(self._run(config, True), [{"id":index} for index in range(0, 700, 2)])
+
+        with self.assertRaises(wqexception.DataSourceBuildError):
+            aio.AsyncElasticsearchDataSource("a", "*", {"hosts":[self._server.host], "slices":0})
+
+        for method in [subject.key_records, subject._aggregatable]:
+            with self.assertRaises(wqexception.DataSourceError):
+                method()
+
+    def test_aggregate_keys(self):
+        """Distinct keys are aggregated using the asynchronous client
+        """
+        self.assertEqual(self._run({"hosts":[self._server.host], "aggregate_keys":True}, True), [{"id":index} for index in range(0, 700, 2)])
+        self.assertTrue(all([("aggs" in body) for path, body in self._server.requests if (path == "/a/_search")]))
@@ -6,10 +6,23 @@ import unittest
 import tempfile
 import json
 import os
+import io
+import gzip
+import shutil
 import types
+import threading
+import time
 
-from weaveq.application import Config, App
+from weaveq.application import Config, App, FileOutputResultHandler, BufferedOutputResultHandler, ElasticsearchResultHandler, BackgroundResultHandler, byte_size
+from weaveq.datasources import ElasticsearchDataSource
+from weaveq.query import WeaveQ
+from weaveq.relations import F
 from weaveq import wqexception
+import weaveq.jsoncodec
+from weaveq import compression
+from weaveq import resultformats
+from weaveq import arrowrecord
+from tests.mockelastic import MockElasticsearch
 
 class TestConfig(unittest.TestCase):
     """Tests Config class
@@ -179,3 +192,489 @@ class TestApp(unittest.TestCase):
 
 
 
+    def test_index_command(self):
+        subject = App(mock_args=["index", "build", "jsl:/test/file", "-f", "field_a", "-f", "field_b.c"])
+        self.assertEquals(subject.command, "index")
+        self.assertEquals(subject._args["source"], "jsl:/test/file")
+        self.assertEquals(subject._args["field"], ["field_a", "field_b.c"])
+        self.assertEquals(subject._output_file, subject._stdout)
+
+    def test_index_command_source_type(self):
+        """Key indexes can only be built for json_lines data sources
+        """
+        subject = App(mock_args=["index", "build", "csv:/test/file", "-f", "field_a"])
+        with self.assertRaises(wqexception.DataSourceBuildError):
+            subject.run()
+
+    def test_json_codec(self):
+        """JSON codec selected in config
+        """
+        with open(self._config_file[1], "w") as config_file:
+            config_file.write('{"data_sources":{"elasticsearch":{"hosts":["test1"]},"csv":{"first_row_names":true}},"json_codec":"stdlib"}')
+
+        try:
+            subject = App(mock_args=["-c", self._config_file[1], "-q", "placeholder_query_string"])
+            self.assertEquals(weaveq.jsoncodec.default_codec().name, "stdlib")
+        finally:
+            weaveq.jsoncodec.set_default_codec("auto")
+
+        with open(self._config_file[1], "w") as config_file:
+            config_file.write('{"data_sources":{"elasticsearch":{"hosts":["test1"]},"csv":{"first_row_names":true}},"json_codec":"nonexistent"}')
+
+        with self.assertRaises(wqexception.ConfigurationError):
+            subject = App(mock_args=["-c", self._config_file[1], "-q", "placeholder_query_string"])
+
+    def test_csv_types(self):
+        """CSV field types validated in config
+        """
+        with open(self._config_file[1], "w") as config_file:
+            config_file.write('{"data_sources":{"elasticsearch":{"hosts":["test1"]},"csv":{"first_row_names":true,"types":{"id":"integer"},"infer_types":100}}}')
+
+        subject = App(mock_args=["-c", self._config_file[1], "-q", "placeholder_query_string"])
+        self.assertEquals(subject._config["data_sources"]["csv"]["types"], {"id":"integer"})
+
+        with open(self._config_file[1], "w") as config_file:
+            config_file.write('{"data_sources":{"elasticsearch":{"hosts":["test1"]},"csv":{"first_row_names":true,"types":{"id":"number"}}}}')
+
+        with self.assertRaises(wqexception.ConfigurationError):
+            subject = App(mock_args=["-c", self._config_file[1], "-q", "placeholder_query_string"])
+
+    def test_arrow_config(self):
+        """Parquet and Arrow data source items validated in config
+        """
+        with open(self._config_file[1], "w") as config_file:
+            config_file.write('{"data_sources":{"elasticsearch":{"hosts":["test1"]},"csv":{"first_row_names":true},"parquet":{"threads":4},"arrow":{}}}')
+
+        subject = App(mock_args=["-c", self._config_file[1], "-q", "placeholder_query_string"])
+        self.assertEquals(subject._config["data_sources"]["parquet"], {"threads":4})
+
+        for source_config in ['"parquet":{"threads":"4"}', '"arrow":[]']:
+            with open(self._config_file[1], "w") as config_file:
+                config_file.write('{"data_sources":{"elasticsearch":{"hosts":["test1"]},"csv":{"first_row_names":true},' + source_config + '}}')
+
+            with self.assertRaises(wqexception.ConfigurationError):
+                subject = App(mock_args=["-c", self._config_file[1], "-q", "placeholder_query_string"])
+
+    def test_elasticsearch_connection_items(self):
+        """Elasticsearch connection and retrieval items validated in config
+        """
+        subject = Config()
+        subject.apply_config({"data_sources":{"elasticsearch":{"hosts":["test1"], "slices":8, "pool_size":20, "keep_alive":False, "page_size":5000, "aggregate_keys":True},"csv":{"first_row_names":True}}})
+        self.assertEquals(subject.config["data_sources"]["elasticsearch"]["slices"], 8)
+        self.assertEquals(subject.config["data_sources"]["elasticsearch"]["pool_size"], 20)
+
+        subject.apply_config({"data_sources":{"elasticsearch":{"hosts":["test1"], "bulk_size":500, "bulk_bytes":1048576, "bulk_requests":2, "bulk_retries":0},"csv":{"first_row_names":True}}})
+        self.assertEquals(subject.config["data_sources"]["elasticsearch"]["bulk_requests"], 2)
+
+        for item in [{"slices":"8"}, {"pool_size":"20"}, {"keep_alive":"false"}, {"page_size":"5000"}, {"aggregate_keys":1}, {"bulk_size":"500"}, {"bulk_retries":None}]:
+            item["hosts"] = ["test1"]
+            with self.assertRaises(wqexception.ConfigurationError):
+                subject.apply_config({"data_sources":{"elasticsearch":item,"csv":{"first_row_names":True}}})
+
+    def test_elasticsearch_output(self):
+        """Results are indexed into Elasticsearch if the output is elasticsearch:index_name
+        """
+        with open(self._config_file[1], "w") as config_file:
+            config_file.write('{"data_sources":{"elasticsearch":{"hosts":["test1"], "bulk_size":50, "bulk_requests":2},"csv":{"first_row_names":true}}}')
+
+        subject = App(mock_args=["-c", self._config_file[1], "-q", "placeholder_query_string", "-o", "elasticsearch:results"])
+        handler = subject._result_handler()
+        self.assertTrue(isinstance(handler, ElasticsearchResultHandler))
+        self.assertEquals(handler._index_name, "results")
+        self.assertEquals(handler._batch_size, 50)
+        self.assertEquals(handler._requests, 2)
+
+        for args in [["-q", "placeholder_query_string", "-o", "elasticsearch:results"], ["-c", self._config_file[1], "-q", "placeholder_query_string", "-o", "elasticsearch:"]]:
+            with self.assertRaises(wqexception.ConfigurationError):
+                subject = App(mock_args=args)
+
+    def test_buffered_output_options(self):
+        """Buffer size, compression and part size options select buffered output
+        """
+        subject = App(mock_args=["-q", "placeholder_query_string"], mock_stdout=self._mock_stdout[1])
+        self.assertTrue(isinstance(subject._result_handler(), FileOutputResultHandler))
+
+        subject = App(mock_args=["-q", "placeholder_query_string", "-o", self._mock_stdout[1] + ".gz", "--compression", "gzip", "--part-size", "64M"])
+        handler = subject._result_handler()
+        self.assertTrue(isinstance(handler, BufferedOutputResultHandler))
+        self.assertEquals(handler._destination, self._mock_stdout[1] + ".gz")
+        self.assertEquals(handler._compression, "gzip")
+        self.assertEquals(handler._part_size, 64 * 1024 * 1024)
+        self.assertEquals(handler._buffer_size, BufferedOutputResultHandler.BUFFER_SIZE)
+        self.assertFalse(os.path.exists(self._mock_stdout[1] + ".gz"))
+
+        subject = App(mock_args=["-q", "placeholder_query_string", "--buffer-size", "256k"], mock_stdout=self._mock_stdout[1])
+        self.assertEquals(subject._result_handler()._buffer_size, 256 * 1024)
+
+        with self.assertRaises(wqexception.ConfigurationError):
+            subject = App(mock_args=["-q", "placeholder_query_string", "--part-size", "1M"])
+
+        subject = App(mock_args=["-q", "placeholder_query_string", "--output-encoders", "2", "--unordered-output"], mock_stdout=self._mock_stdout[1])
+        self.assertEquals(subject._args["output_encoders"], 2)
+        self.assertTrue(subject._args["unordered_output"])
+        self.assertFalse(subject._args["output_thread"])
+
+        self.assertEquals(byte_size("100"), 100)
+        self.assertEquals(byte_size("2G"), 2 * 1024 ** 3)
+        for size in ["", "M", "1.5M", "0"]:
+            with self.assertRaises(Exception):
+                byte_size(size)
+
+    def test_output_format_options(self):
+        """The output format option selects CSV, Parquet and SQLite result handlers, and rejects options that don't apply to them
+        """
+        subject = App(mock_args=["-q", "placeholder_query_string", "--output-format", "csv"], mock_stdout=self._mock_stdout[1])
+        self.assertTrue(isinstance(subject._result_handler(), resultformats.CsvResultHandler))
+
+        subject = App(mock_args=["-q", "placeholder_query_string", "-o", self._mock_stdout[1] + ".csv.gz", "--output-format", "csv", "--compression", "gzip"])
+        handler = subject._result_handler()
+        self.assertEquals(handler._destination, self._mock_stdout[1] + ".csv.gz")
+        self.assertEquals(handler._compression, "gzip")
+
+        subject = App(mock_args=["-q", "placeholder_query_string", "-o", self._mock_stdout[1] + ".db", "--output-format", "sqlite"])
+        self.assertTrue(isinstance(subject._result_handler(), resultformats.SqliteResultHandler))
+
+        if (arrowrecord.available()):
+            subject = App(mock_args=["-q", "placeholder_query_string", "-o", self._mock_stdout[1] + ".parquet", "--output-format", "parquet", "--compression", "zstd"])
+            self.assertTrue(isinstance(subject._result_handler(), resultformats.ParquetResultHandler))
+
+        for args in [["--output-format", "parquet"], ["-o", "-", "--output-format", "sqlite"], ["-o", "results.db", "--output-format", "sqlite", "--compression", "gzip"], ["-o", "results.parquet", "--output-format", "parquet", "--compression", "bz2"], ["-o", "results.csv", "--output-format", "csv", "-p"], ["-o", "results.csv", "--output-format", "csv", "--part-size", "1M"], ["-o", "elasticsearch:results", "--output-format", "csv"]]:
+            with self.assertRaises(wqexception.ConfigurationError):
+                subject = App(mock_args=["-q", "placeholder_query_string"] + args)
+
+    def test_passthrough_option(self):
+        """Passthrough output implies lazy JSON lines decoding
+        """
+        subject = App(mock_args=["-q", "placeholder_query_string", "-p"])
+        self.assertTrue(subject._args["passthrough"])
+        self.assertEquals(subject._config["data_sources"]["json_lines"], {"lazy":True})
+
+class TestFileOutputResultHandler(unittest.TestCase):
+    """Tests FileOutputResultHandler class.
+    """
+
+    def setUp(self):
+        self._output_file = tempfile.mkstemp()
+
+    def tearDown(self):
+        os.close(self._output_file[0])
+        os.unlink(self._output_file[1])
+
+    def test_passthrough(self):
+        """Unchanged records are written as read, everything else is encoded
+        """
+        decoder = weaveq.jsoncodec.LazyJsonDecoder(["id"])
+        unchanged = decoder.decode(b'{"id": 1,  "name": "a"}\n')
+        changed = decoder.decode(b'{"id": 2,  "name": "b"}\n')
+        changed["joined_data"] = {"id":3}
+
+        with open(self._output_file[1], "w") as output_file:
+            subject = FileOutputResultHandler(output_file, weaveq.jsoncodec.get_codec("stdlib"), passthrough=True)
+            subject(unchanged, None)
+            subject(changed, None)
+            subject({"id":4}, None)
+            subject.flush()
+
+        with open(self._output_file[1], "rb") as output_file:
+            self.assertEquals(output_file.read(), b'{"id": 1,  "name": "a"}\n{"id": 2, "name": "b", "joined_data": {"id": 3}}\n{"id": 4}\n')
+
+    def test_no_passthrough(self):
+        """Without passthrough, every record is encoded
+        """
+        decoder = weaveq.jsoncodec.LazyJsonDecoder(["id"])
+
+        with open(self._output_file[1], "w") as output_file:
+            subject = FileOutputResultHandler(output_file, weaveq.jsoncodec.get_codec("stdlib"))
+            subject(decoder.decode(b'{"id": 1,  "name": "a"}\n'), None)
+            subject.flush()
+
+        with open(self._output_file[1], "rb") as output_file:
+            self.assertEquals(output_file.read(), b'{"id": 1, "name": "a"}\n')
+
+    def test_text_stream(self):
+        """Results are written as text to file objects without a binary buffer
+        """
+        output_file = io.StringIO()
+        subject = FileOutputResultHandler(output_file, weaveq.jsoncodec.get_codec("stdlib"))
+        subject({"name":u"caf\u00e9"}, None)
+        subject.write_encoded([b'{"id": 2}'])
+        self.assertEquals(output_file.getvalue(), u'{"name": "caf\\u00e9"}\n{"id": 2}\n')
+
+class TestBufferedOutputResultHandler(unittest.TestCase):
+    """Tests BufferedOutputResultHandler class.
+    """
+
+    def setUp(self):
+        self._directory = tempfile.mkdtemp()
+        self._results = [{"id":index, "name":"name {0}".format(index)} for index in range(2500)]
+        codec = weaveq.jsoncodec.get_codec("stdlib")
+        self._expected = b"".join([codec.encode(result) + b"\n" for result in self._results])
+
+    def tearDown(self):
+        shutil.rmtree(self._directory)
+
+    def _write(self, destination, **kwargs):
+        subject = BufferedOutputResultHandler(destination, weaveq.jsoncodec.get_codec("stdlib"), **kwargs)
+        for result in self._results:
+            subject(result, None)
+
+        subject.flush()
+        self.assertTrue(subject.success())
+        self.assertEquals(subject.bytes_written, len(self._expected))
+
+        return subject
+
+    def test_write(self):
+        """Results are written as line-delimited JSON, whatever the buffer size
+        """
+        for buffer_size in [1, 1000, BufferedOutputResultHandler.BUFFER_SIZE]:
+            subject = self._write(os.path.join(self._directory, "results.jsonl"), buffer_size=buffer_size)
+            self.assertEquals(subject.filenames, [os.path.join(self._directory, "results.jsonl")])
+            with open(subject.filenames[0], "rb") as output_file:
+                self.assertEquals(output_file.read(), self._expected)
+
+    def test_compression(self):
+        """Output is compressed in the specified format
+        """
+        subject = self._write(os.path.join(self._directory, "results.jsonl.gz"), buffer_size=1000, compression="gzip")
+        self.assertEquals(compression.detect(subject.filenames[0]), "gzip")
+        with compression.open_file(subject.filenames[0]) as output_file:
+            self.assertEquals(output_file.read(), self._expected)
+
+    def test_file_object(self):
+        """Output is written to file objects, which are left open
+        """
+        destination = io.BytesIO()
+        subject = self._write(destination, compression="gzip")
+        self.assertEquals(subject.filenames, [])
+        self.assertFalse(destination.closed)
+        self.assertEquals(gzip.GzipFile(fileobj=io.BytesIO(destination.getvalue())).read(), self._expected)
+
+        with self.assertRaises(wqexception.OutputError):
+            BufferedOutputResultHandler(destination, part_size=1000)
+
+    def test_part_files(self):
+        """Results are divided between part files of a maximum size
+        """
+        for name in [None, "gzip"]:
+            subject = self._write(os.path.join(self._directory, "results.jsonl"), buffer_size=100, compression=name, part_size=10000)
+            self.assertEquals(subject.filenames[:2], [os.path.join(self._directory, "results-00000.jsonl"), os.path.join(self._directory, "results-00001.jsonl")])
+
+            parts = []
+            for filename in subject.filenames:
+                with compression.open_file(filename) as part_file:
+                    parts.append(part_file.read())
+
+            self.assertEquals(b"".join(parts), self._expected)
+            self.assertTrue(all([(len(part) <= 10000) and (len(part) > 9900) and part.endswith(b"\n") for part in parts[:-1]]))
+
+    def test_oversized_result(self):
+        """Results bigger than the part size are written to part files of their own
+        """
+        subject = BufferedOutputResultHandler(os.path.join(self._directory, "results"), weaveq.jsoncodec.get_codec("stdlib"), part_size=20)
+        for result in [{"id":1}, {"padding":"x" * 30}, {"id":2}]:
+            subject(result, None)
+
+        subject.flush()
+        self.assertEquals([os.path.basename(filename) for filename in subject.filenames], ["results-00000", "results-00001", "results-00002"])
+        with open(subject.filenames[1], "rb") as part_file:
+            self.assertEquals(part_file.read(), b'{"padding": "' + b"x" * 30 + b'"}\n')
+
+    def test_passthrough(self):
+        """Unchanged records are written as read
+        """
+        decoder = weaveq.jsoncodec.LazyJsonDecoder(["id"])
+        destination = io.BytesIO()
+        subject = BufferedOutputResultHandler(destination, weaveq.jsoncodec.get_codec("stdlib"), passthrough=True)
+        subject(decoder.decode(b'{"id": 1,  "name": "a"}\n'), None)
+        subject({"id":2}, None)
+        subject.flush()
+        self.assertEquals(destination.getvalue(), b'{"id": 1,  "name": "a"}\n{"id": 2}\n')
+
+class RecordingResultHandler(object):
+    """Records the results it's passed and the threads on which they're passed, optionally waiting for an event first or failing
+    """
+
+    def __init__(self, fail_after = None):
+        self.results = []
+        self.threads = set()
+        self.proceed = threading.Event()
+        self.proceed.set()
+        self._fail_after = fail_after
+
+    def __call__(self, result, handler_output):
+        self.proceed.wait()
+        if (len(self.results) == self._fail_after):
+            raise IOError("Disk full")
+
+        self.results.append(result)
+        self.threads.add(threading.current_thread())
+
+    def success(self):
+        return True
+
+class ListDataSource(object):
+    """Supplies a list of records to WeaveQ
+    """
+
+    def __init__(self, records):
+        self._records = records
+
+    def batch(self):
+        return list(self._records)
+
+    def stream(self):
+        return iter(self._records)
+
+class TestBackgroundResultHandler(unittest.TestCase):
+    """Tests BackgroundResultHandler class.
+    """
+
+    def setUp(self):
+        self._results = [{"id":index, "name":"name {0}".format(index)} for index in range(2500)]
+        codec = weaveq.jsoncodec.get_codec("stdlib")
+        self._expected = b"".join([codec.encode(result) + b"\n" for result in self._results])
+
+    def test_background_thread(self):
+        """Results are handed to the wrapped handler in order, on another thread
+        """
+        handler = RecordingResultHandler()
+        subject = BackgroundResultHandler(handler)
+        for result in self._results:
+            subject(result, None)
+
+        self.assertTrue(subject.success())
+        self.assertEquals(handler.results, self._results)
+        self.assertFalse(threading.current_thread() in handler.threads)
+
+    def test_encoders(self):
+        """Results are encoded by worker threads or processes, and written in order unless told otherwise
+        """
+        for processes in [True, False]:
+            for ordered in [True, False]:
+                destination = io.BytesIO()
+                subject = BackgroundResultHandler(BufferedOutputResultHandler(destination, weaveq.jsoncodec.get_codec("stdlib")), encoders=2, processes=processes, ordered=ordered)
+                for result in self._results:
+                    subject(result, None)
+
+                self.assertTrue(subject.success())
+                subject.flush()
+                if (ordered):
+                    self.assertEquals(destination.getvalue(), self._expected)
+                else:
+                    self.assertEquals(sorted(destination.getvalue().splitlines()), sorted(self._expected.splitlines()))
+
+        with self.assertRaises(wqexception.OutputError):
+            BackgroundResultHandler(RecordingResultHandler(), encoders=2)
+
+    def test_backpressure(self):
+        """The query waits while the queue of results is full
+        """
+        handler = RecordingResultHandler()
+        handler.proceed.clear()
+        subject = BackgroundResultHandler(handler, queue_chunks=2)
+
+        def produce():
+            for index in range(5 * BackgroundResultHandler.CHUNK_SIZE):
+                subject({"id":index}, None)
+
+        producer = threading.Thread(target=produce)
+        producer.start()
+        time.sleep(0.2)
+        self.assertTrue(producer.is_alive())
+
+        handler.proceed.set()
+        producer.join(10)
+        self.assertFalse(producer.is_alive())
+        self.assertTrue(subject.success())
+        self.assertEquals(len(handler.results), 5 * BackgroundResultHandler.CHUNK_SIZE)
+
+    def test_error_propagation(self):
+        """Errors raised by the wrapped handler are raised by WeaveQ.execute()
+        """
+        records = [{"id":index} for index in range(2000)]
+        subject = WeaveQ(ListDataSource(records)).pivot_to(ListDataSource(records), F("id") == F("id"))
+        handler = RecordingResultHandler(fail_after=1200)
+        subject.result_handler(BackgroundResultHandler(handler))
+        with self.assertRaises(IOError):
+            subject.execute(stream=True)
+
+        self.assertEquals(len(handler.results), 1200)
+
+class TestElasticsearchResultHandler(unittest.TestCase):
+    """Tests ElasticsearchResultHandler class.
+    """
+
+    def setUp(self):
+        self._server = MockElasticsearch([])
+        self._client = ElasticsearchDataSource.connect({"hosts":[self._server.host]})
+
+    def tearDown(self):
+        self._server.close()
+
+    def _bulk_requests(self):
+        return [body for path, body in self._server.requests if (path == "/results/_bulk")]
+
+    def test_batches(self):
+        """Results are indexed in batches of up to a maximum number of documents and bytes
+        """
+        subject = ElasticsearchResultHandler(self._client, "results", weaveq.jsoncodec.get_codec("stdlib"), batch_size=100)
+        for index in range(250):
+            subject({"id":index}, None)
+
+        subject.flush()
+        self.assertTrue(subject.success())
+        self.assertEquals(sorted([document["id"] for document in self._server.indexed["results"]]), list(range(250)))
+        self.assertEquals(sorted([len(body) for body in self._bulk_requests()]), [100, 200, 200])
+        self.assertEquals(subject.indexed, 250)
+        self.assertEquals(len(subject.latencies), 3)
+        self.assertTrue("Indexed 250 result(s) into Elasticsearch index 'results' using 3 bulk request(s)" in subject.report())
+
+        self._server.requests = []
+        subject = ElasticsearchResultHandler(self._client, "results", weaveq.jsoncodec.get_codec("stdlib"), batch_bytes=100)
+        for index in range(10):
+            subject({"id":index, "padding":"x" * 10}, None)
+
+        subject.flush()
+        self.assertEquals([len(body) for body in self._bulk_requests()], [4] * 5)
+
+    def test_concurrent_requests(self):
+        """Several bulk requests are in flight at once
+        """
+        self._server.latency = 0.1
+        subject = ElasticsearchResultHandler(self._client, "results", batch_size=10, requests=4)
+        for index in range(80):
+            subject({"id":index}, None)
+
+        subject.flush()
+        self.assertEquals(len(self._server.indexed["results"]), 80)
+        self.assertEquals(len(subject.latencies), 8)
+        self.assertTrue(subject.elapsed < sum(subject.latencies) / 2)
+
+    def test_retry_rejected(self):
+        """Items rejected because Elasticsearch is too busy are retried
+        """
+        self._server.bulk_rejections = 15
+        subject = ElasticsearchResultHandler(self._client, "results", batch_size=10, retry_delay=0.01)
+        for index in range(30):
+            subject({"id":index}, None)
+
+        subject.flush()
+        self.assertTrue(subject.success())
+        self.assertEquals(sorted([document["id"] for document in self._server.indexed["results"]]), list(range(30)))
+        self.assertEquals(subject.retried, 15)
+
+    def test_failures(self):
+        """Results that can't be indexed are reported when the handler is flushed
+        """
+        self._server.bulk_rejections = 1
+        subject = ElasticsearchResultHandler(self._client, "results", retries=0)
+        for index in range(5):
+            subject({"id":index, "invalid":True} if (index == 3) else {"id":index}, None)
+
+        with self.assertRaises(wqexception.OutputError):
+            subject.flush()
+
+        self.assertFalse(subject.success())
+        self.assertEquals(subject.indexed, 3)
+        self.assertEquals(subject.failed, 2)
@@ -0,0 +1,98 @@
+"""@package arrowrecord_test
+Tests for weaveq.arrowrecord
+"""
+
+import unittest
+import os
+import tempfile
+
+from weaveq import arrowrecord
+from weaveq.query import NestedField
+
+@unittest.skipUnless(arrowrecord.available(), "pyarrow isn't installed")
+class TestArrowRecord(unittest.TestCase):
+    """Tests ColumnBatch and ArrowRecord classes
+    """
+
+    def setUp(self):
+        import pyarrow
+        self._record_batch = pyarrow.record_batch([pyarrow.array([1, 2]), pyarrow.array([u"a", None]), pyarrow.array([{"ip":u"10.0.0.1"}, None])], names=["id", "name", "nested"])
+
+    def test_mapping(self):
+        """Records behave as mappings of column names to values, in column order
+        """
+        subject = arrowrecord.ColumnBatch(self._record_batch).records()
+        self.assertEqual(len(subject), 2)
+        self.assertEqual(list(subject[0].keys()), ["id", "name", "nested"])
+        self.assertEqual(subject[0], {"id":1, "name":u"a", "nested":{"ip":u"10.0.0.1"}})
+        self.assertEqual(subject[1]["name"], None)
+        self.assertEqual(len(subject[1]), 3)
+        self.assertFalse("missing" in subject[1])
+        self.assertEqual(NestedField(subject[0], "nested.ip").value(), u"10.0.0.1")
+        self.assertFalse(NestedField(subject[1], "nested.ip").exists())
+
+    def test_lazy_columns(self):
+        """Columns are only converted to Python values when they're read
+        """
+        batch = arrowrecord.ColumnBatch(self._record_batch)
+        subject = batch.records()
+        self.assertEqual(subject[1]["id"], 2)
+        self.assertEqual(batch._columns[1:], [None, None])
+
+    def test_modify(self):
+        """Fields can be set, added and deleted
+        """
+        subject = arrowrecord.ColumnBatch(self._record_batch).records()
+        subject[0]["joined_data"] = {"id":3}
+        subject[0]["id"] = 4
+        del subject[0]["name"]
+        self.assertEqual(list(subject[0].items()), [("id", 4), ("nested", {"ip":u"10.0.0.1"}), ("joined_data", {"id":3})])
+        self.assertEqual(subject[1], {"id":2, "name":None, "nested":None})
+
+        with self.assertRaises(KeyError):
+            del subject[0]["name"]
+
+        subject[0]["name"] = u"b"
+        self.assertEqual(subject[0]["name"], u"b")
+
+    def test_duplicate_names(self):
+        """Records of batches whose column names aren't unique are dicts
+        """
+        import pyarrow
+        record_batch = pyarrow.record_batch([pyarrow.array([1]), pyarrow.array([2])], names=["a", "a"])
+        self.assertEqual(arrowrecord.ColumnBatch(record_batch).records(), [{"a":2}])
+
+@unittest.skipUnless(arrowrecord.available(), "pyarrow isn't installed")
+class TestParquetRowGroups(unittest.TestCase):
+    """Tests parquet_row_groups function
+    """
+
+    def setUp(self):
+        import pyarrow
+        import pyarrow.parquet
+
+        self._tmpfile = tempfile.mkstemp(suffix=".parquet")
+        table = pyarrow.table({"id":list(range(9)), "name":[u"n{0}".format(index) for index in range(9)], "tags":[[index] for index in range(9)]})
+        pyarrow.parquet.write_table(table, self._tmpfile[1], row_group_size=3)
+        self._metadata = pyarrow.parquet.ParquetFile(self._tmpfile[1]).metadata
+
+    def tearDown(self):
+        os.close(self._tmpfile[0])
+        os.unlink(self._tmpfile[1])
+
+    def test_statistics(self):
+        """Row groups whose column statistics show they can't contain any of the values are excluded
+        """
+        self.assertEqual(arrowrecord.parquet_row_groups(self._metadata, [("id", set([4]))]), [1])
+        self.assertEqual(arrowrecord.parquet_row_groups(self._metadata, [("id", set([1, 8, 100, -1, float("nan")]))]), [0, 2])
+        self.assertEqual(arrowrecord.parquet_row_groups(self._metadata, [("id", set([4])), ("name", set([u"n7"]))]), [1, 2])
+        self.assertEqual(arrowrecord.parquet_row_groups(self._metadata, [("id", set([3.0, True]))]), [0, 1])
+        self.assertEqual(arrowrecord.parquet_row_groups(self._metadata, [("id", set())]), [])
+
+    def test_unusable_statistics(self):
+        """Row groups are never excluded on the basis of values that can't be compared with statistics, or fields without them
+        """
+        self.assertEqual(arrowrecord.parquet_row_groups(self._metadata, [("id", set([u"4"]))]), [0, 1, 2])
+        self.assertEqual(arrowrecord.parquet_row_groups(self._metadata, [("id", set([u"4", 4]))]), [0, 1, 2])
+        self.assertEqual(arrowrecord.parquet_row_groups(self._metadata, [("tags", set([1]))]), [0, 1, 2])
+        self.assertEqual(arrowrecord.parquet_row_groups(self._metadata, [("missing", set([1]))]), [0, 1, 2])
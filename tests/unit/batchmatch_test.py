@@ -0,0 +1,143 @@
+"""@package batchmatch_test
+Tests for weaveq.batchmatch
+"""
+
+import unittest
+import copy
+
+from weaveq.batchmatch import EqualityMatcher, VectorisedEqualityMatcher, qualifies, create_matcher, numpy_available
+from weaveq.query import WeaveQ, record_batches
+from weaveq.relations import F, TargetConditions
+
+class TestResultHandler(object):
+
+    def __init__(self):
+        self.results = []
+
+    def __call__(self, result, handler_output):
+        self.results.append(result)
+
+    def success(self):
+        return True
+
+class MockBatchDataSource(object):
+    """Supplies pre-defined data to WeaveQ in batches of a fixed size
+    """
+
+    def __init__(self, records, size):
+        self._records = records
+        self._size = size
+
+    def batch(self):
+        return self._records
+
+    def stream(self):
+        return self._records
+
+    def stream_batches(self, batch_size):
+        return record_batches(self._records, self._size)
+
+class FirstCharProxy(object):
+    def __call__(self, name, value):
+        return value[0]
+
+class TestEqualityMatcher(unittest.TestCase):
+    """Tests EqualityMatcher class
+    """
+
+    def setUp(self):
+        values = [1, 2.0, True, u"a", u"a\x00", None, (1, u"b")]
+        self._left = [{"id":values[index % len(values)],"n":index} for index in range(20)] + [{"n":"no id"}]
+        self._right = [{"ref":values[index % len(values)],"nested":{"ref":values[index % 3]},"n":index} for index in range(30)] + [{"n":"no ref"}, "not a record", {"ref":0}, {"ref":u"1"}, {"ref":False}]
+
+    def _run(self, rel, match_batches, join = False, exclude_empty = False, vectorise = True):
+        q1 = MockBatchDataSource(copy.deepcopy(self._left), 4)
+        q2 = MockBatchDataSource(copy.deepcopy(self._right), 7)
+        if (join):
+            s = WeaveQ(q1).join_to(q2, rel, field="joined", array=True, exclude_empty_joins=exclude_empty)
+        else:
+            s = WeaveQ(q1).pivot_to(q2, rel)
+
+        s.match_batches = match_batches
+        s.vectorise_matching = vectorise
+        r = TestResultHandler()
+        s.result_handler(r)
+        s.execute(stream=True)
+        return r.results
+
+    def test_qualifies(self):
+        """Only steps with a single equality condition using the default field proxies are matched a batch at a time"""
+        self.assertTrue(qualifies(TargetConditions((F("id") == F("ref")).tree).conjunctions))
+        self.assertFalse(qualifies(TargetConditions((F("id") != F("ref")).tree).conjunctions))
+        self.assertFalse(qualifies(TargetConditions(((F("id") == F("ref")) & (F("n") == F("n"))).tree).conjunctions))
+        self.assertFalse(qualifies(TargetConditions(((F("id") == F("ref")) | (F("n") == F("n"))).tree).conjunctions))
+        self.assertFalse(qualifies(TargetConditions((F("id", proxy=FirstCharProxy()) == F("ref")).tree).conjunctions))
+
+    def test_pivot(self):
+        """Pivoting a batch at a time selects the same records, in the same order, as the index"""
+        for rel in [F("id") == F("ref"), F("id") == F("nested.ref")]:
+            expected = self._run(rel, False)
+            self.assertTrue(len(expected) > 0)
+            self.assertEqual(self._run(rel, True), expected)
+
+    def test_join(self):
+        """Joining a batch at a time joins the same records, in the same order, as the index"""
+        for exclude_empty in [False, True]:
+            for rel in [F("id") == F("ref"), F("id") == F("nested.ref")]:
+                expected = self._run(rel, False, True, exclude_empty)
+                self.assertTrue(any(["joined" in record for record in expected]))
+                self.assertEqual(self._run(rel, True, True, exclude_empty), expected)
+
+    def test_match(self):
+        """Records are matched to the previous step's records with equal keys, and batches with unhashable keys are left to the index"""
+        cond = TargetConditions((F("id") == F("ref")).tree).conjunctions[0][0]
+        index = {((0, 1),):[{"id":1}], ((0, u"a"),):[{"id":u"a"}, {"id":u"a"}]}
+        subject = EqualityMatcher(cond, index)
+
+        batch = [{"ref":True}, {"ref":u"b"}, {}, {"ref":u"a"}]
+        self.assertEqual(subject.select(batch), [{"ref":True}, {"ref":u"a"}])
+        self.assertEqual(subject.match(batch), [[{"id":1}], (), None, [{"id":u"a"}, {"id":u"a"}]])
+
+        self.assertEqual(subject.select([{"ref":[1]}]), None)
+        self.assertEqual(subject.match([{"ref":{}}]), None)
+
+@unittest.skipUnless(numpy_available(), "NumPy isn't installed")
+class TestVectorisedEqualityMatcher(TestEqualityMatcher):
+    """Tests VectorisedEqualityMatcher class, including batches that have to be matched by EqualityMatcher
+    """
+
+    def setUp(self):
+        self._left = [{"id":index % 9 - 2,"n":index} for index in range(20)] + [{"n":"no id"}]
+        self._right = [{"ref":index % 12 - 3,"nested":{"ref":index % 4},"n":index} for index in range(28)] + [{"n":"no ref"}, "not a record", {"ref":1.0}, {"ref":u"1"}, {"ref":True}, {"ref":2 ** 70}, {"ref":None}]
+
+    def test_create(self):
+        """Vectorised matchers are only created for keys that are all integers, and only when asked for"""
+        cond = TargetConditions((F("id") == F("ref")).tree).conjunctions[0][0]
+        self.assertTrue(isinstance(create_matcher(cond, {((0, 1),):[], ((0, True),):[]}, True), VectorisedEqualityMatcher))
+        self.assertFalse(isinstance(create_matcher(cond, {((0, 1),):[]}), VectorisedEqualityMatcher))
+        for keys in [[1, 2.5], [1, u"a"], [u"a"], [2 ** 70], [True], [None], []]:
+            self.assertFalse(isinstance(create_matcher(cond, dict((((0, key),), []) for key in keys), True), VectorisedEqualityMatcher), keys)
+
+    def test_vectorised(self):
+        """Vectorised matching finds the same records as matching a batch at a time with a dict, and as the index"""
+        for join in [False, True]:
+            for rel in [F("id") == F("ref"), F("id") == F("nested.ref")]:
+                expected = self._run(rel, False, join)
+                self.assertTrue(len(expected) > 0)
+                self.assertEqual(self._run(rel, True, join), expected)
+                self.assertEqual(self._run(rel, True, join, vectorise=True), expected)
+
+    def test_vectorised_match(self):
+        """Batches of integer keys are matched in bulk, using a lookup table for dense keys and a binary search otherwise, and other batches by EqualityMatcher"""
+        cond = TargetConditions((F("id") == F("ref")).tree).conjunctions[0][0]
+        for keys in [[5, -1], [5, -1, 10 ** 12]]:
+            index = dict((((0, key),), [{"id":key}]) for key in keys)
+            subject = VectorisedEqualityMatcher(cond, index)
+            self.assertEqual(subject._lookup is None, len(keys) == 3)
+
+            batch = [{"ref":-1}, {"ref":7}, {}, {"ref":5}, {"ref":-9}, {"ref":-(2 ** 63)}, {"ref":2 ** 63 - 1}]
+            self.assertEqual(subject.select(batch), [{"ref":-1}, {"ref":5}])
+            self.assertEqual(subject.match(batch), [[{"id":-1}], (), None, [{"id":5}], (), (), ()])
+            self.assertEqual(subject.match([{"ref":5}, {"ref":-1}, {"ref":8}]), [[{"id":5}], [{"id":-1}], ()])
+            self.assertEqual(subject.match([{"ref":5.0}, {"ref":u"5"}]), [[{"id":5}], ()])
+            self.assertEqual(subject.select([{"ref":[5]}]), None)
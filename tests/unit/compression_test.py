@@ -0,0 +1,194 @@
+"""@package compression_test
+Tests for weaveq.compression
+"""
+
+import unittest
+import tempfile
+import os
+import io
+import gzip
+import bz2
+
+from weaveq import compression
+from weaveq import wqexception
+
+class FailingFile(object):
+    """A file object whose reads fail after the first
+    """
+
+    def __init__(self):
+        self.reads = 0
+
+    def read(self, size):
+        self.reads += 1
+        if (self.reads > 1):
+            raise IOError("Read failed")
+
+        return b"first"
+
+    def close(self):
+        pass
+
+class FailingOutput(io.BytesIO):
+    """A file object whose writes fail
+    """
+
+    def write(self, data):
+        raise IOError("Write failed")
+
+class TestCompression(unittest.TestCase):
+    """Tests compression detection and decompression
+    """
+
+    def setUp(self):
+        self._data = u"line one\nκόσμε\n".encode("utf-8") * 1000
+        self._files = []
+
+    def tearDown(self):
+        for filename in self._files:
+            os.unlink(filename)
+
+    def write_file(self, suffix, data):
+        tmpfile = tempfile.mkstemp(suffix=suffix)
+        os.close(tmpfile[0])
+        with open(tmpfile[1], "wb") as data_file:
+            data_file.write(data)
+
+        self._files.append(tmpfile[1])
+        return tmpfile[1]
+
+    def test_detect(self):
+        """Compression is detected from leading bytes, or from the extension of empty files
+        """
+        self.assertEqual(compression.detect(self.write_file(".jsonl", gzip.compress(self._data))), "gzip")
+        self.assertEqual(compression.detect(self.write_file(".dat", bz2.compress(self._data))), "bz2")
+        self.assertEqual(compression.detect(self.write_file(".gz", self._data)), None)
+        self.assertEqual(compression.detect(self.write_file(".csv.zst", b"")), "zstd")
+        self.assertEqual(compression.detect(self.write_file(".csv", b"")), None)
+
+    def test_open_compressed(self):
+        """Compressed files are decompressed, with or without read-ahead
+        """
+        compressors = [(".gz", gzip.compress), (".bz2", bz2.compress)]
+        try:
+            import lzma
+            compressors.append((".xz", lzma.compress))
+        except ImportError:
+            pass
+
+        for suffix, compress in compressors:
+            filename = self.write_file(suffix, compress(self._data))
+            for read_ahead in [True, False]:
+                with compression.open_file(filename, read_ahead=read_ahead) as data_file:
+                    self.assertEqual(data_file.read(), self._data)
+
+                with compression.open_file(filename, read_ahead=read_ahead) as data_file:
+                    self.assertEqual(list(data_file), self._data.splitlines(True))
+
+                with compression.open_file(filename, text=True, read_ahead=read_ahead) as data_file:
+                    self.assertEqual(data_file.read(), self._data.decode("utf-8"))
+
+    def test_open_zstd(self):
+        """zstd-compressed files are decompressed if zstandard is installed
+        """
+        try:
+            import zstandard
+        except ImportError:
+            filename = self.write_file(".zst", b"\x28\xb5\x2f\xfd\x00")
+            with self.assertRaises(wqexception.DataSourceError):
+                compression.open_file(filename)
+
+            return
+
+        filename = self.write_file(".zst", zstandard.ZstdCompressor().compress(self._data))
+        with compression.open_file(filename) as data_file:
+            self.assertEqual(data_file.read(), self._data)
+
+    def test_open_uncompressed(self):
+        """Uncompressed files are read as normal
+        """
+        filename = self.write_file(".jsonl", self._data)
+        with compression.open_file(filename) as data_file:
+            self.assertEqual(data_file.read(), self._data)
+
+        with compression.open_file(filename, text=True) as data_file:
+            self.assertEqual(data_file.read(), self._data.decode("utf-8"))
+
+    def test_read_ahead_blocks(self):
+        """Data read ahead in small blocks is delivered intact
+        """
+        subject = io.BufferedReader(compression.ReadAheadReader(io.BytesIO(self._data), block_size=7, blocks=2), 5)
+        self.assertEqual(subject.read(3), self._data[0:3])
+        self.assertEqual(subject.read(), self._data[3:])
+        subject.close()
+
+    def test_read_ahead_error(self):
+        """Errors on the read-ahead thread are raised to the reader
+        """
+        subject = compression.ReadAheadReader(FailingFile())
+        self.assertEqual(subject.read(5), b"first")
+        with self.assertRaises(IOError):
+            subject.read(5)
+
+        subject.close()
+
+    def test_close_early(self):
+        """Readers can be closed before they're finished
+        """
+        subject = compression.ReadAheadReader(io.BytesIO(self._data), block_size=1, blocks=1)
+        self.assertEqual(subject.read(1), self._data[0:1])
+        subject.close()
+        self.assertTrue(subject.closed)
+
+    def test_open_output(self):
+        """Output is compressed in each supported format, with or without write-behind, and read back intact
+        """
+        formats = ["gzip", "bz2"]
+        try:
+            import lzma
+            formats.append("xz")
+        except ImportError:
+            pass
+
+        try:
+            import zstandard
+            formats.append("zstd")
+        except ImportError:
+            pass
+
+        for name in formats:
+            for write_behind in [True, False]:
+                filename = self.write_file(".out", b"")
+                output_file = compression.open_output(filename, name, write_behind)
+                output_file.write(self._data[:100])
+                output_file.write(self._data[100:])
+                output_file.close()
+
+                self.assertEqual(compression.detect(filename), name)
+                with compression.open_file(filename) as data_file:
+                    self.assertEqual(data_file.read(), self._data)
+
+    def test_open_output_file_object(self):
+        """Output written to a file object is compressed, and the file object is left open
+        """
+        destination = io.BytesIO()
+        output_file = compression.open_output(destination, "gzip")
+        output_file.write(self._data)
+        output_file.close()
+
+        self.assertFalse(destination.closed)
+        self.assertEqual(gzip.GzipFile(fileobj=io.BytesIO(destination.getvalue())).read(), self._data)
+        self.assertTrue(compression.open_output(destination) is destination)
+
+        with self.assertRaises(wqexception.OutputError):
+            compression.open_output(destination, "lz4")
+
+    def test_write_behind_error(self):
+        """Errors on the write-behind thread are raised to the writer
+        """
+        subject = compression.WriteBehindWriter(FailingOutput(), blocks=1)
+        subject.write(b"first")
+        with self.assertRaises(IOError):
+            subject.close()
+
+        self.assertTrue(subject.closed)
@@ -0,0 +1,119 @@
+"""@package csvrecord_test
+Tests for weaveq.csvrecord
+"""
+
+import unittest
+import json
+import pickle
+
+from weaveq.csvrecord import CsvSchema, CsvRow, RowBuilder, infer_type
+from weaveq.query import NestedField
+
+class TestCsvRow(unittest.TestCase):
+    """Tests CsvSchema and CsvRow classes
+    """
+
+    def setUp(self):
+        self._schema = CsvSchema([u"a", u"b", u"c"])
+
+    def test_mapping(self):
+        """Rows behave as mappings of field names to cell values, in column order
+        """
+        subject = CsvRow(self._schema, [u"1", u"2", u"3"])
+        self.assertEqual(list(subject.keys()), [u"a", u"b", u"c"])
+        self.assertEqual(subject[u"b"], u"2")
+        self.assertEqual(len(subject), 3)
+        self.assertTrue(u"c" in subject)
+        self.assertFalse(u"d" in subject)
+        self.assertEqual(subject.get(u"d"), None)
+        self.assertEqual(subject, {u"a":u"1", u"b":u"2", u"c":u"3"})
+        self.assertEqual(NestedField(subject, u"a").value(), u"1")
+
+    def test_short_row(self):
+        """Rows with fewer cells than named columns only contain the fields present
+        """
+        subject = CsvRow(self._schema, [u"1"])
+        self.assertEqual(dict(subject), {u"a":u"1"})
+        self.assertFalse(u"b" in subject)
+        with self.assertRaises(KeyError):
+            subject[u"b"]
+
+    def test_unnamed_columns(self):
+        """Columns beyond the named columns are named automatically
+        """
+        self._schema.extend(4)
+        self.assertTrue(self._schema.unique)
+        self.assertEqual(dict(CsvRow(self._schema, [u"1", u"2", u"3", u"4"])), {u"a":u"1", u"b":u"2", u"c":u"3", u"column_4":u"4"})
+
+        schema = CsvSchema([u"column_2"])
+        schema.extend(2)
+        self.assertFalse(schema.unique)
+        self.assertFalse(CsvSchema([u"a", u"a"]).unique)
+
+    def test_modify(self):
+        """Fields can be set, added and deleted
+        """
+        subject = CsvRow(self._schema, [u"1", u"2"])
+        subject[u"a"] = u"x"
+        subject[u"joined_data"] = [{u"id":1}]
+        subject[u"c"] = u"y"
+        del subject[u"b"]
+        self.assertEqual(list(subject.items()), [(u"a", u"x"), (u"joined_data", [{u"id":1}]), (u"c", u"y")])
+        self.assertEqual(len(subject), 3)
+        with self.assertRaises(KeyError):
+            del subject[u"b"]
+
+        other = CsvRow(self._schema, [u"1", u"2"])
+        self.assertEqual(dict(other), {u"a":u"1", u"b":u"2"})
+
+    def test_encode(self):
+        """Rows are encoded as JSON objects
+        """
+        from weaveq import jsoncodec
+        subject = CsvRow(self._schema, [u"1", u"2", u"3"])
+        self.assertEqual(json.loads(jsoncodec.get_codec("stdlib").encode(subject).decode("utf-8")), {u"a":u"1", u"b":u"2", u"c":u"3"})
+        self.assertEqual(json.loads(jsoncodec.default_codec().encode({u"r":subject}).decode("utf-8")), {u"r":{u"a":u"1", u"b":u"2", u"c":u"3"}})
+
+    def test_pickle(self):
+        """Rows survive pickling
+        """
+        subject = CsvRow(self._schema, [u"1", u"2", u"3"])
+        del subject[u"b"]
+        subject[u"d"] = 4
+        self.assertEqual(list(pickle.loads(pickle.dumps(subject, pickle.HIGHEST_PROTOCOL)).items()), [(u"a", u"1"), (u"c", u"3"), (u"d", 4)])
+
+class TestRowBuilder(unittest.TestCase):
+    """Tests RowBuilder class
+    """
+
+    def test_projection(self):
+        """Only the fields required are kept
+        """
+        subject = RowBuilder([u"a", u"b", u"c"], fields=set([u"c", u"a", u"column_5"]))
+        self.assertEqual(list(subject.build([u"1", u"2", u"3"]).items()), [(u"a", u"1"), (u"c", u"3")])
+        self.assertEqual(list(subject.build([u"1", u"2"]).items()), [(u"a", u"1")])
+        self.assertEqual(list(subject.build([u"1", u"2", u"3", u"4", u"5"]).items()), [(u"a", u"1"), (u"c", u"3"), (u"column_5", u"5")])
+        self.assertEqual(list(subject.build([u"1", u"2", u"3"]).items()), [(u"a", u"1"), (u"c", u"3")])
+
+    def test_types(self):
+        """Values are converted to the types configured
+        """
+        subject = RowBuilder([u"a", u"b", u"c", u"d"], types={u"a":"integer", u"b":"float", u"c":"boolean", u"d":"string"})
+        self.assertEqual(dict(subject.build([u"1", u"2.5", u"True", u"4"])), {u"a":1, u"b":2.5, u"c":True, u"d":u"4"})
+        self.assertEqual(dict(subject.build([u"", u"", u"no", u""])), {u"a":None, u"b":None, u"c":False, u"d":u""})
+
+        with self.assertRaises(ValueError):
+            subject.build([u"x", u"2.5", u"true", u"4"])
+
+    def test_infer(self):
+        """Types are inferred from a sample of rows, and values that don't fit are left as text
+        """
+        self.assertEqual(infer_type([u"1", u"", u"-2"]), "integer")
+        self.assertEqual(infer_type([u"1", u"2.5e3"]), "float")
+        self.assertEqual(infer_type([u"1", u"x"]), "string")
+        self.assertEqual(infer_type([u""]), "string")
+
+        subject = RowBuilder([u"a", u"b", u"c"], types={u"c":"string"})
+        subject.infer([[u"1", u"x", u"3"], [u"2", u"1.5"]])
+        self.assertEqual(dict(subject.build([u"3", u"2.5", u"4"])), {u"a":3, u"b":u"2.5", u"c":u"4"})
+        self.assertEqual(dict(subject.build([u"n/a", u"2.5", u"4"])), {u"a":u"n/a", u"b":u"2.5", u"c":u"4"})
@@ -10,9 +10,31 @@ import json
 import os
 import types
 import sys
-
-from weaveq.datasources import AppDataSourceBuilder, JsonLinesDataSource, JsonDataSource, CsvDataSource, ElasticsearchDataSource
+import shutil
+import gzip
+import bz2
+import sqlite3
+
+from weaveq.datasources import AppDataSourceBuilder, JsonLinesDataSource, JsonDataSource, CsvDataSource, ElasticsearchDataSource, ParquetDataSource, ArrowDataSource, SqliteDataSource, elasticsearch_client
+from weaveq import arrowrecord
+from weaveq.keyindex import KeyIndex
+from weaveq.query import WeaveQ, StepPlan
+from weaveq.relations import F
 from weaveq import wqexception
+from tests.mockelastic import MockElasticsearch
+
+class ListResultHandler(object):
+    """Collects query results
+    """
+
+    def __init__(self):
+        self.results = []
+
+    def __call__(self, result, handler_output):
+        self.results.append(result)
+
+    def success(self):
+        return True
 
 class TestConfig(unittest.TestCase):
     """Tests Config class
@@ -21,7 +43,7 @@ class TestConfig(unittest.TestCase):
     def test_data_source_introspection(self):
         """Data sources are correctly discovered and indexed.
         """
-        expected_data_sources = ["json_lines", "jsl", "json", "js", "elasticsearch", "el", "csv"]
+        expected_data_sources = ["json_lines", "jsl", "json", "js", "elasticsearch", "el", "csv", "parquet", "arrow", "sqlite"]
         expected_data_sources.sort()
 
         subject = AppDataSourceBuilder({})
@@ -31,6 +53,9 @@ class TestConfig(unittest.TestCase):
         self.assertEquals(subject._source_type_mappings["json"], JsonDataSource)
         self.assertEquals(subject._source_type_mappings["js"], JsonDataSource)
         self.assertEquals(subject._source_type_mappings["csv"], CsvDataSource)
+        self.assertEquals(subject._source_type_mappings["parquet"], ParquetDataSource)
+        self.assertEquals(subject._source_type_mappings["arrow"], ArrowDataSource)
+        self.assertEquals(subject._source_type_mappings["sqlite"], SqliteDataSource)
 
         self.assertEquals(subject.valid_source_types, ", ".join(expected_data_sources))
 
@@ -38,39 +63,39 @@ class TestConfig(unittest.TestCase):
         """Parse a correctly formatted source type out of a URI string.
         """
         subject = AppDataSourceBuilder({})
-        self.assertEquals(subject._parse_uri("json_lines:/test/uri"), {"source_type":"json_lines", "uri":"/test/uri", "data_source_class":JsonLinesDataSource})
+        self.assertEquals(subject.parse_uri("json_lines:/test/uri"), {"source_type":"json_lines", "uri":"/test/uri", "data_source_class":JsonLinesDataSource})
 
     def test_uri_parse_case_insensitive_source_type(self):
         """Parse a correctly formatted source type out of a URI string, regardless of source type case.
         """
         subject = AppDataSourceBuilder({})
-        self.assertEquals(subject._parse_uri("JSON_lines:/test/uri"), {"source_type":"json_lines", "uri":"/test/uri", "data_source_class":JsonLinesDataSource})
+        self.assertEquals(subject.parse_uri("JSON_lines:/test/uri"), {"source_type":"json_lines", "uri":"/test/uri", "data_source_class":JsonLinesDataSource})
 
     def test_uri_parse_alternative_source_type_ident(self):
         """Parse a correctly formatted source type out of a URI string, using an alternative source type ident string.
         """
         subject = AppDataSourceBuilder({})
-        self.assertEquals(subject._parse_uri("jsl:/test/uri"), {"source_type":"json_lines", "uri":"/test/uri", "data_source_class":JsonLinesDataSource})
+        self.assertEquals(subject.parse_uri("jsl:/test/uri"), {"source_type":"json_lines", "uri":"/test/uri", "data_source_class":JsonLinesDataSource})
 
     def test_parse_uri_invalid(self):
         """Parse a missing source type from a URI string
         """
         subject = AppDataSourceBuilder({})
         with self.assertRaises(wqexception.DataSourceBuildError):
-            subject._parse_uri("/test/uri")
+            subject.parse_uri("/test/uri")
 
     def test_parse_uri_not_greedy(self):
         """Make sure the source type parsing finishes at the first colon
         """
         subject = AppDataSourceBuilder({})
-        self.assertEquals(subject._parse_uri("json_lines:not_a_type:/test/uri"), {"source_type":"json_lines", "uri":"not_a_type:/test/uri", "data_source_class":JsonLinesDataSource})
+        self.assertEquals(subject.parse_uri("json_lines:not_a_type:/test/uri"), {"source_type":"json_lines", "uri":"not_a_type:/test/uri", "data_source_class":JsonLinesDataSource})
 
     def test_parse_uri_invalid_source_type(self):
         """Parse an invalid source type from a URI string
         """
         subject = AppDataSourceBuilder({})
         with self.assertRaises(wqexception.DataSourceBuildError):
-            subject._parse_uri("invalid_source_type:/test/uri")
+            subject.parse_uri("invalid_source_type:/test/uri")
 
     def test_datasource_construction(self):
         """Construct a DataSource object correctly from a URI and filter string.
@@ -99,6 +124,7 @@ class TestConfig(unittest.TestCase):
         self.assertEquals(subject.config["ca_certs"], None)
         self.assertEquals(subject.config["client_cert"], None)
         self.assertEquals(subject.config["client_key"], None)
+        self.assertEquals(subject.slices, 1)
 
     def test_elasticds_supplied_config(self):
         """Elasticsearch datasource config applied correctly
@@ -112,6 +138,141 @@ class TestConfig(unittest.TestCase):
         self.assertEquals(subject.config["client_cert"], "/tmp/client_cert")
         self.assertEquals(subject.config["client_key"], "/tmp/client_key")
 
+    def test_elasticds_sliced_scroll(self):
+        """Elasticsearch datasource divides the scroll into the configured number of slices, each read concurrently.
+        """
+        server = MockElasticsearch([{"id":index} for index in range(2500)])
+        try:
+            subject = ElasticsearchDataSource("test_index_name", "*", {"hosts":[server.host]})
+            self.assertEqual([hit["id"] for hit in subject.stream()], list(range(2500)))
+            self.assertFalse(any(["slice" in body for path, body in server.requests]))
+
+            server.requests = []
+            subject = ElasticsearchDataSource("test_index_name", "*", {"hosts":[server.host], "slices":3})
+            self.assertEqual(sorted([hit["id"] for hit in subject.stream()]), list(range(2500)))
+            self.assertEqual(sorted([body["slice"]["id"] for path, body in server.requests if ("slice" in body)]), [0, 1, 2])
+            self.assertTrue(all([body["slice"]["max"] == 3 for path, body in server.requests if ("slice" in body)]))
+        finally:
+            server.close()
+
+        with self.assertRaises(wqexception.DataSourceBuildError):
+            ElasticsearchDataSource("test_index_name", "*", {"hosts":["127.0.0.1:5601"], "slices":0})
+
+    def test_elasticds_source_filtering(self):
+        """Elasticsearch datasource asks for only the fields of each hit that a query uses.
+        """
+        server = MockElasticsearch([{"id":index, "name":"n{0}".format(index), "body":"b" * 100} for index in range(5)])
+        try:
+            subject = ElasticsearchDataSource("a", "*", {"hosts":[server.host]})
+            subject.prepare(StepPlan(key_fields=["id"], output_fields=["name", "nested.field"]))
+            self.assertEqual(list(subject.stream())[1], {"id":1, "name":"n1"})
+            self.assertEqual([body for path, body in server.requests if (path == "/a/_search")][-1]["_source"], {"includes":["id", "name", "nested.field"]})
+
+            subject.prepare(StepPlan(key_fields=[], output_fields=[]))
+            self.assertEqual(list(subject.stream())[1], {})
+
+            subject.prepare(StepPlan())
+            self.assertEqual(list(subject.stream())[1], {"id":1, "name":"n1", "body":"b" * 100})
+            self.assertFalse("_source" in [body for path, body in server.requests if (path == "/a/_search")][-1])
+
+            query = WeaveQ(ElasticsearchDataSource("a", "*", {"hosts":[server.host]})).pivot_to(ElasticsearchDataSource("b", "*", {"hosts":[server.host]}), F("id") == F("id")).join_to(ElasticsearchDataSource("c", "*", {"hosts":[server.host]}), F("name") == F("name"), field="joined")
+            handler = ListResultHandler()
+            query.result_handler(handler)
+            server.requests = []
+            query.execute(stream=True)
+            self.assertEqual(handler.results[0], {"id":0, "name":"n0", "body":"b" * 100, "joined":{"id":0, "name":"n0", "body":"b" * 100}})
+            self.assertEqual([body.get("_source") for path, body in server.requests if (path.endswith("/_search"))], [{"includes":["id"]}, None, None])
+        finally:
+            server.close()
+
+    def test_elasticds_batch(self):
+        """Elasticsearch datasource retrieves every hit in batch mode by paging through a point in time, falling back to the scroll API if points in time aren't supported.
+        """
+        server = MockElasticsearch([{"id":index, "name":"n{0}".format(index)} for index in range(25)])
+        try:
+            subject = ElasticsearchDataSource("a", "*", {"hosts":[server.host], "page_size":10})
+            self.assertEqual(subject.batch(), server.documents)
+            self.assertEqual([path for path, body in server.requests], ["/a/_pit", "/_search", "/_search", "/_search", "/_pit"])
+            self.assertEqual([body.get("search_after") for path, body in server.requests if (path == "/_search")], [None, [9], [19]])
+            self.assertEqual(server.open_pits, set())
+
+            server.documents = server.documents[0:20]
+            subject.prepare(StepPlan(key_fields=["id"], output_fields=[]))
+            self.assertEqual(subject.batch(), [{"id":index} for index in range(20)])
+            self.assertEqual(server.open_pits, set())
+
+            server.pit = False
+            server.requests = []
+            self.assertEqual(subject.batch(), [{"id":index} for index in range(20)])
+            self.assertEqual([path for path, body in server.requests][0:2], ["/a/_pit", "/a/_search"])
+        finally:
+            server.close()
+
+        with self.assertRaises(wqexception.DataSourceBuildError):
+            ElasticsearchDataSource("a", "*", {"hosts":["127.0.0.1:5601"], "page_size":0})
+
+    def test_elasticds_aggregate_keys(self):
+        """Elasticsearch datasource retrieves only distinct key values for steps whose records are only used for their keys, if the key fields are mapped to suitable types.
+        """
+        documents = [{"id":index % 7, "host":{"ip":"10.0.0.{0}".format(index % 3)}, "name":"n{0}".format(index)} for index in range(50)] + [{"name":"x"}]
+        server = MockElasticsearch(documents, mappings={"id":{"type":"long"}, "host.ip":{"type":"ip"}, "name":{"type":"text"}, "tag":{"type":"keyword", "ignore_above":256}})
+        try:
+            subject = ElasticsearchDataSource("a", "*", {"hosts":[server.host], "aggregate_keys":True, "page_size":5})
+            subject.prepare(StepPlan(ordered=False, key_fields=["id", "host.ip"], output_fields=[]))
+            records = list(subject.stream())
+            self.assertEqual(records[0:2], [{}, {"id":0, "host":{"ip":"10.0.0.0"}}])
+            self.assertEqual(sorted([(record["id"], record["host"]["ip"]) for record in records[1:]]), sorted(set([(document["id"], document["host"]["ip"]) for document in documents[0:50]])))
+            self.assertEqual(subject.batch(), records)
+            self.assertEqual(len([body for path, body in server.requests if ("aggs" in body)]), 2 * 6)
+
+            for plan in [StepPlan(ordered=False, key_fields=["name"], output_fields=[]), StepPlan(ordered=False, key_fields=["tag"], output_fields=[]), StepPlan(ordered=False, key_fields=["missing"], output_fields=[]), StepPlan(key_fields=["id"], output_fields=None)]:
+                subject.prepare(plan)
+                self.assertEqual(len(list(subject.stream())), 51)
+
+            subject = ElasticsearchDataSource("a", "*", {"hosts":[server.host]})
+            subject.prepare(StepPlan(ordered=False, key_fields=["id"], output_fields=[]))
+            server.requests = []
+            self.assertEqual(len(list(subject.stream())), 51)
+            self.assertFalse(any(["aggs" in body for path, body in server.requests]))
+
+            query = WeaveQ(ElasticsearchDataSource("a", "*", {"hosts":[server.host], "aggregate_keys":True})).pivot_to(ElasticsearchDataSource("b", "*", {"hosts":[server.host], "aggregate_keys":True}), F("id") == F("id"))
+            handler = ListResultHandler()
+            query.result_handler(handler)
+            query.execute(stream=True)
+            self.assertEqual(handler.results, documents[0:50])
+        finally:
+            server.close()
+
+        with self.assertRaises(wqexception.DataSourceBuildError):
+            ElasticsearchDataSource("a", "*", {"hosts":["127.0.0.1:5601"], "aggregate_keys":"true"})
+
+    def test_elasticds_shared_clients(self):
+        """Elasticsearch datasources with the same connection configuration share a client and its connections.
+        """
+        subject = ElasticsearchDataSource("a", "*", {"hosts":["127.0.0.1:5601", "10.10.10.1:1280"], "slices":2})
+        self.assertTrue(subject._elastic_client is ElasticsearchDataSource("b", "*", {"hosts":["10.10.10.1:1280", "127.0.0.1:5601"]})._elastic_client)
+        self.assertFalse(subject._elastic_client is ElasticsearchDataSource("a", "*", {"hosts":["127.0.0.1:5601", "10.10.10.1:1280"], "timeout":20})._elastic_client)
+        self.assertTrue(subject._elastic_client is elasticsearch_client(subject._client_config()))
+        self.assertEqual(subject.config["pool_size"], 10)
+        self.assertEqual(ElasticsearchDataSource("a", "*", {"hosts":["127.0.0.1:5601"], "slices":16}).config["pool_size"], 16)
+
+        server = MockElasticsearch([{"id":index} for index in range(10)])
+        try:
+            for index_name in ["a", "b", "c"]:
+                self.assertEqual(len(list(ElasticsearchDataSource(index_name, "*", {"hosts":[server.host]}).stream())), 10)
+            self.assertEqual(server.connections, 1)
+
+            for index_name in ["a", "b", "c"]:
+                self.assertEqual(len(list(ElasticsearchDataSource(index_name, "*", {"hosts":[server.host], "keep_alive":False}).stream())), 10)
+            self.assertTrue(server.connections > 3)
+        finally:
+            server.close()
+
+        for config in [{"pool_size":0}, {"pool_size":"10"}, {"keep_alive":1}]:
+            config["hosts"] = ["127.0.0.1:5601"]
+            with self.assertRaises(wqexception.DataSourceBuildError):
+                ElasticsearchDataSource("a", "*", config)
+
     def test_json_lines_batch_load(self):
         """json_lines data source batch loads a file successfully.
         """
@@ -233,6 +394,43 @@ class TestConfig(unittest.TestCase):
             os.close(tmpfile[0])
             os.unlink(tmpfile[1])
 
+    def test_json_stream_progress(self):
+        """json data source reports progress through the file while streaming.
+        """
+        test_data = b'[{"id":1},{"id":2}]'
+        tmpfile = tempfile.mkstemp()
+        with open(tmpfile[1], "wb") as data_file:
+            data_file.write(test_data)
+
+        try:
+            subject = JsonDataSource(tmpfile[1], None)
+            self.assertEquals(subject.progress(), None)
+
+            progress = []
+            for record in subject.stream():
+                progress.append(subject.progress())
+
+            self.assertEquals(progress, [(9, 19), (18, 19)])
+            self.assertEquals(subject.progress(), None)
+        finally:
+            os.close(tmpfile[0])
+            os.unlink(tmpfile[1])
+
+    def test_json_non_object_elements(self):
+        """json data source ignores elements of the root array that aren't objects, when batch loading and streaming.
+        """
+        tmpfile = tempfile.mkstemp()
+        with open(tmpfile[1], "wb") as data_file:
+            data_file.write(b'[{"id":1}, 2, "three", [4], null, {"id":5}]')
+
+        try:
+            subject = JsonDataSource(tmpfile[1], None)
+            self.assertEquals(subject.batch(), [{"id":1}, {"id":5}])
+            self.assertEquals(list(subject.stream()), [{"id":1}, {"id":5}])
+        finally:
+            os.close(tmpfile[0])
+            os.unlink(tmpfile[1])
+
     def test_json_no_list_root(self):
         """json data source stream cannot load a document without a list root.
         """
@@ -248,6 +446,9 @@ class TestConfig(unittest.TestCase):
             subject = JsonDataSource(tmpfile[1], None)
             with self.assertRaises(wqexception.DataSourceError):
                 subject.batch()
+
+            with self.assertRaises(wqexception.DataSourceError):
+                list(subject.stream())
                 
         finally:
             os.close(tmpfile[0])
@@ -347,3 +548,356 @@ class TestConfig(unittest.TestCase):
             os.close(tmpfile[0])
             os.unlink(tmpfile[1])
 
+    def test_csv_irregular_rows(self):
+        """csv data source handles rows of differing lengths and repeated field names.
+        """
+        test_data = '"a","b"\n"1"\n"1","2","3"\n'
+        repeated_data = '"a","a","column_3"\n"1","2","3","4"\n'
+        tmpfiles = [tempfile.mkstemp(), tempfile.mkstemp()]
+        for tmpfile, data in zip(tmpfiles, [test_data, repeated_data]):
+            with open(tmpfile[1], "wb") as data_file:
+                data_file.write(data.encode("utf-8"))
+
+        try:
+            self.assertEqual([list(row.items()) for row in CsvDataSource(tmpfiles[0][1], None, {"first_row_names":True}).batch()], [[("a", "1")], [("a", "1"), ("b", "2"), ("column_3", "3")]])
+            self.assertEqual([list(row.items()) for row in CsvDataSource(tmpfiles[1][1], None, {"first_row_names":True}).batch()], [[("a", "2"), ("column_3", "3"), ("column_4", "4")]])
+        finally:
+            for tmpfile in tmpfiles:
+                os.close(tmpfile[0])
+                os.unlink(tmpfile[1])
+
+    def test_csv_types_and_projection(self):
+        """csv data source converts values to the configured types and reads only the fields a query uses.
+        """
+        test_data = '"id","name","size","ratio"\n"1","a","10","0.5"\n"2","b","20",""\n'
+        tmpfile = tempfile.mkstemp()
+        with open(tmpfile[1], "wb") as data_file:
+            data_file.write(test_data.encode("utf-8"))
+
+        try:
+            subject = CsvDataSource(tmpfile[1], None, {"first_row_names":True, "types":{"id":"integer"}, "infer_types":10})
+            self.assertEqual(subject.batch(), [{"id":1, "name":"a", "size":10, "ratio":0.5}, {"id":2, "name":"b", "size":20, "ratio":None}])
+
+            subject.prepare(StepPlan(key_fields=["id"], output_fields=["ratio.x"]))
+            self.assertEqual(subject.batch(), [{"id":1, "ratio":0.5}, {"id":2, "ratio":None}])
+
+            subject = CsvDataSource(tmpfile[1], None, {"first_row_names":True, "types":{"name":"integer"}})
+            with self.assertRaises(wqexception.DataSourceError):
+                subject.batch()
+
+            for config in [{"types":{"id":"number"}}, {"types":["id"]}, {"infer_types":-1}, {"infer_types":True}]:
+                config["first_row_names"] = True
+                with self.assertRaises(wqexception.DataSourceBuildError):
+                    CsvDataSource(tmpfile[1], None, config)
+        finally:
+            os.close(tmpfile[0])
+            os.unlink(tmpfile[1])
+
+    def test_csv_parallel_load(self):
+        """csv data source parses files in worker processes, with the same results as parsing them in-process.
+        """
+        tmpdir = tempfile.mkdtemp()
+        try:
+            for file_index in range(2):
+                with open(os.path.join(tmpdir, "{0}.csv".format(file_index)), "wb") as data_file:
+                    data_file.write('"id","text","file"\n'.encode("utf-8"))
+                    for index in range(200):
+                        data_file.write('{0},"a ""quoted""\nvalue {0}",{1}\n'.format(index, file_index).encode("utf-8"))
+
+            config = {"first_row_names":True, "types":{"id":"integer"}, "infer_types":5}
+            expected = CsvDataSource(tmpdir, None, dict(config)).batch()
+            self.assertEqual(len(expected), 400)
+
+            config.update({"workers":2, "chunk_size":256})
+            subject = CsvDataSource(tmpdir, None, config)
+            self.assertEqual(subject.batch(), expected)
+            self.assertEqual([stats.records for stats in subject.file_stats], [200, 200])
+
+            subject.prepare(StepPlan(ordered=False, key_fields=["id"], output_fields=[]))
+            self.assertEqual(sorted([(record["id"], len(record)) for record in subject.stream()]), sorted([(record["id"], 1) for record in expected]))
+
+            for config in [{"workers":-1}, {"chunk_size":0}]:
+                config["first_row_names"] = True
+                with self.assertRaises(wqexception.DataSourceBuildError):
+                    CsvDataSource(tmpdir, None, config)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    @unittest.skipUnless(arrowrecord.available(), "pyarrow isn't installed")
+    def test_parquet_load(self):
+        """parquet data source reads records a row group at a time, reading only the columns a query uses.
+        """
+        import pyarrow
+        import pyarrow.parquet
+
+        tmpdir = tempfile.mkdtemp()
+        try:
+            table = pyarrow.table({"id":list(range(10)), "name":["n{0}".format(index) for index in range(10)], "nested":[{"port":index % 3} for index in range(10)]})
+            pyarrow.parquet.write_table(table, os.path.join(tmpdir, "a.parquet"), row_group_size=4)
+            pyarrow.parquet.write_table(table.slice(0, 2), os.path.join(tmpdir, "b.parquet"))
+
+            subject = ParquetDataSource(tmpdir, None)
+            records = subject.batch()
+            self.assertEqual(records[0:2], [{"id":0, "name":"n0", "nested":{"port":0}}, {"id":1, "name":"n1", "nested":{"port":1}}])
+            self.assertEqual([record["id"] for record in records], list(range(10)) + [0, 1])
+            self.assertEqual([stats.records for stats in subject.file_stats], [10, 2])
+
+            subject.prepare(StepPlan(ordered=False, key_fields=["nested.port"], output_fields=[]))
+            self.assertEqual([len(batch) for batch in subject.stream_batches(3)], [3, 3, 3, 1, 2])
+            self.assertEqual(list(subject.stream())[5], {"nested":{"port":2}})
+
+            subject = ParquetDataSource(os.path.join(tmpdir, "a.parquet"), None, {"threads":2})
+            self.assertEqual([record["id"] for record in subject.lookup([("id", set([5, 100]))])], [4, 5, 6, 7])
+            self.assertEqual([record["id"] for record in subject.lookup([("id", set([100])), ("nested.port", set([2]))])], list(range(10)))
+            self.assertEqual(list(subject.lookup([("id", set())])), [])
+
+            with self.assertRaises(wqexception.DataSourceBuildError):
+                ParquetDataSource(tmpdir, None, {"threads":0})
+
+            with self.assertRaises(wqexception.DataSourceBuildError):
+                ParquetDataSource(tmpdir, "filter", None)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    @unittest.skipUnless(arrowrecord.available(), "pyarrow isn't installed")
+    def test_arrow_load(self):
+        """arrow data source reads files in both the IPC file and stream formats, reading only the columns a query uses.
+        """
+        import pyarrow
+        import pyarrow.ipc
+
+        tmpdir = tempfile.mkdtemp()
+        try:
+            table = pyarrow.table({"id":list(range(5)), "name":["n{0}".format(index) for index in range(5)]})
+            for filename, new_writer in [("a.arrow", pyarrow.ipc.new_file), ("b.arrows", pyarrow.ipc.new_stream)]:
+                with pyarrow.OSFile(os.path.join(tmpdir, filename), "wb") as arrow_file:
+                    writer = new_writer(arrow_file, table.schema)
+                    writer.write_table(table, max_chunksize=2)
+                    writer.close()
+
+            subject = ArrowDataSource(tmpdir, None)
+            self.assertEqual(subject.batch(), table.to_pylist() * 2)
+
+            subject.prepare(StepPlan(key_fields=["id"], output_fields=[]))
+            self.assertEqual(list(subject.stream()), [{"id":index} for index in range(5)] * 2)
+
+            query = WeaveQ(ArrowDataSource(os.path.join(tmpdir, "a.arrow"), None)).pivot_to(ArrowDataSource(os.path.join(tmpdir, "b.arrows"), None), F("id") == F("id")).join_to(ArrowDataSource(os.path.join(tmpdir, "a.arrow"), None), F("name") == F("name"), field="joined")
+            handler = ListResultHandler()
+            query.result_handler(handler)
+            query.execute(stream=True)
+            self.assertEqual(handler.results[1], {"id":1, "name":"n1", "joined":{"id":1, "name":"n1"}})
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_sqlite_load(self):
+        """sqlite data source reads the rows of a table that satisfy the filter, a batch at a time, reading only the columns a query uses.
+        """
+        tmpfile = tempfile.mkstemp(suffix=".sqlite")
+        try:
+            connection = sqlite3.connect(tmpfile[1])
+            connection.execute("CREATE TABLE hosts (id INTEGER PRIMARY KEY, ip TEXT, name TEXT)")
+            connection.executemany("INSERT INTO hosts VALUES (?, ?, ?)", [(index, "10.0.0.{0}".format(index), "h{0}".format(index)) for index in range(10)])
+            connection.commit()
+            connection.close()
+
+            subject = AppDataSourceBuilder({})("sqlite:{0}:hosts".format(tmpfile[1]), "id >= 8")
+            self.assertEqual(subject.batch(), [{"id":8, "ip":"10.0.0.8", "name":"h8"}, {"id":9, "ip":"10.0.0.9", "name":"h9"}])
+
+            subject = SqliteDataSource("{0}:hosts".format(tmpfile[1]), None)
+            subject.prepare(StepPlan(ordered=False, key_fields=["ip"], output_fields=["name.first"]))
+            self.assertEqual([len(batch) for batch in subject.stream_batches(4)], [4, 4, 2])
+            self.assertEqual(list(subject.stream())[3], {"ip":"10.0.0.3", "name":"h3"})
+
+            with self.assertRaises(wqexception.DataSourceError):
+                SqliteDataSource("{0}:missing".format(tmpfile[1]), None).batch()
+
+            with self.assertRaises(wqexception.DataSourceError):
+                list(SqliteDataSource("{0}:hosts".format(tmpfile[1]), "id >").stream())
+
+            with self.assertRaises(wqexception.DataSourceError):
+                SqliteDataSource("{0}.missing:hosts".format(tmpfile[1]), None).batch()
+
+            with self.assertRaises(wqexception.DataSourceBuildError):
+                SqliteDataSource(tmpfile[1], None)
+        finally:
+            os.close(tmpfile[0])
+            os.unlink(tmpfile[1])
+
+    def test_sqlite_lookup(self):
+        """sqlite data source reads only the rows containing the requested keys.
+        """
+        tmpfile = tempfile.mkstemp(suffix=".sqlite")
+        try:
+            connection = sqlite3.connect(tmpfile[1])
+            connection.execute("CREATE TABLE hosts (id INTEGER PRIMARY KEY, ip TEXT, name TEXT)")
+            connection.executemany("INSERT INTO hosts VALUES (?, ?, ?)", [(index, "10.0.0.{0}".format(index), None if (index % 3 == 0) else "h{0}".format(index)) for index in range(10)])
+            connection.commit()
+            connection.close()
+
+            subject = SqliteDataSource("{0}:hosts".format(tmpfile[1]), "id < 8")
+            subject.LOOKUP_CHUNK_SIZE = 2
+            self.assertEqual(sorted([record["id"] for record in subject.lookup([("id", set([1, 2.0, 3, 9, float("nan"), "x"]))])]), [1, 2, 3])
+            self.assertEqual(sorted([record["id"] for record in subject.lookup([("name", set([None, "h1"]))])]), [0, 1, 3, 6])
+            self.assertEqual(sorted([record["id"] for record in subject.lookup([("ip", set(["10.0.0.1", "10.0.0.9"])), ("name", set(["h1", "h2"]))])]), [1, 2])
+            self.assertEqual(list(subject.lookup([("id", set())])), [])
+
+            self.assertEqual(subject.lookup([("missing", set([1]))]), None)
+            self.assertEqual(subject.lookup([("id", set([2 ** 64]))]), None)
+
+            query = WeaveQ(SqliteDataSource("{0}:hosts".format(tmpfile[1]), "id > 6")).pivot_to(SqliteDataSource("{0}:hosts".format(tmpfile[1]), None), F("ip") == F("ip"))
+            handler = ListResultHandler()
+            query.result_handler(handler)
+            query.execute(stream=True)
+            self.assertEqual(sorted([record["id"] for record in handler.results]), [7, 8, 9])
+        finally:
+            os.close(tmpfile[0])
+            os.unlink(tmpfile[1])
+
+    def test_json_lines_lookup(self):
+        """json_lines data source reads only indexed lines containing the requested keys.
+        """
+        test_data = b'{"id":1,"name":"a"}\n{"id":2,"name":"b"}\n{"id":3,"name":"c"}\n{"id":1,"name":"d"}\n'
+        tmpfile = tempfile.mkstemp()
+        with open(tmpfile[1], "wb") as data_file:
+            data_file.write(test_data)
+
+        try:
+            subject = JsonLinesDataSource(tmpfile[1], None)
+            self.assertEquals(subject.lookup([("id", set([1, 3]))]), None) # Not indexed
+
+            KeyIndex(tmpfile[1]).build("id")
+            self.assertEquals(list(subject.lookup([("id", set([1, 3]))])), [{"id":1,"name":"a"},{"id":3,"name":"c"},{"id":1,"name":"d"}])
+            self.assertEquals(subject.lookup([("id", set([1])), ("name", set(["b"]))]), None) # Only one field indexed
+        finally:
+            os.close(tmpfile[0])
+            os.unlink(tmpfile[1])
+            os.unlink(tmpfile[1] + KeyIndex.SUFFIX)
+
+    def test_json_lines_parallel_load(self):
+        """json_lines data source loads a file using worker processes when configured to.
+        """
+        tmpfile = tempfile.mkstemp()
+        with open(tmpfile[1], "wb") as data_file:
+            for index in range(50):
+                data_file.write('{{"id":{0}}}\n'.format(index).encode("utf-8"))
+
+        try:
+            subject = AppDataSourceBuilder({"data_sources":{"json_lines":{"workers":2, "chunk_size":64}}})("jsl:{0}".format(tmpfile[1]), None)
+            self.assertEquals(subject.config, {"workers":2, "chunk_size":64, "lazy":False, "threads":1})
+            self.assertEquals(subject.batch(), [{"id":index} for index in range(50)])
+            self.assertEquals(list(subject.stream()), [{"id":index} for index in range(50)])
+        finally:
+            os.close(tmpfile[0])
+            os.unlink(tmpfile[1])
+
+    def test_json_lines_lazy_load(self):
+        """json_lines data source decodes only the key fields of each record up front when configured to.
+        """
+        tmpfile = tempfile.mkstemp()
+        with open(tmpfile[1], "wb") as data_file:
+            for index in range(50):
+                data_file.write('{{"id":{0},"name":"name{0}"}}\n'.format(index).encode("utf-8"))
+
+        try:
+            for workers in [1, 2]:
+                subject = JsonLinesDataSource(tmpfile[1], None, {"workers":workers, "chunk_size":64, "lazy":True})
+                subject.prepare(StepPlan(key_fields=["id"]))
+                records = subject.batch()
+                self.assertEquals([record["id"] for record in records], list(range(50)))
+                self.assertFalse(any([record.decoded() for record in records]))
+                self.assertEquals(records, [{"id":index, "name":"name{0}".format(index)} for index in range(50)])
+
+                results = ListResultHandler()
+                seed = JsonLinesDataSource(tmpfile[1], None)
+                query = WeaveQ(seed).pivot_to(JsonLinesDataSource(tmpfile[1], None, {"workers":workers, "chunk_size":64, "lazy":True}), F("id") == F("id"))
+                query.result_handler(results)
+                query.execute()
+                self.assertEquals(results.results, [{"id":index, "name":"name{0}".format(index)} for index in range(50)])
+        finally:
+            os.close(tmpfile[0])
+            os.unlink(tmpfile[1])
+
+    def test_compressed_files(self):
+        """File data sources decompress compressed files.
+        """
+        tmpfiles = [tempfile.mkstemp(suffix=".gz"), tempfile.mkstemp(suffix=".bz2"), tempfile.mkstemp(suffix=".gz")]
+        with open(tmpfiles[0][1], "wb") as data_file:
+            data_file.write(gzip.compress(b'{"id":1}\n{"id":2}\n'))
+
+        with open(tmpfiles[1][1], "wb") as data_file:
+            data_file.write(bz2.compress(b'[{"id":1},{"id":2}]'))
+
+        with open(tmpfiles[2][1], "wb") as data_file:
+            data_file.write(gzip.compress(u"id,name\n1,κόσμε\n2,b\n".encode("utf-8")))
+
+        try:
+            subject = JsonLinesDataSource(tmpfiles[0][1], None, {"workers":2})
+            self.assertEquals(subject.batch(), [{"id":1}, {"id":2}])
+            self.assertEquals(subject.lookup([("id", set([1]))]), None)
+
+            subject = JsonDataSource(tmpfiles[1][1], None)
+            self.assertEquals(subject.batch(), [{"id":1}, {"id":2}])
+            self.assertEquals(list(subject.stream()), [{"id":1}, {"id":2}])
+
+            subject = CsvDataSource(tmpfiles[2][1], None, {"first_row_names":True})
+            self.assertEquals(subject.batch(), [{"id":"1", "name":u"κόσμε"}, {"id":"2", "name":"b"}])
+
+            with self.assertRaises(wqexception.DataSourceError):
+                KeyIndex(tmpfiles[0][1]).build("id")
+        finally:
+            for tmpfile in tmpfiles:
+                os.close(tmpfile[0])
+                os.unlink(tmpfile[1])
+
+    def test_multiple_files(self):
+        """File data sources read every file matching a glob pattern.
+        """
+        tmpdir = tempfile.mkdtemp()
+        try:
+            for file_index in range(3):
+                with open(os.path.join(tmpdir, "{0}.jsonl".format(file_index)), "w") as data_file:
+                    data_file.write('{{"id":{0}}}\n{{"id":{1}}}\n'.format(file_index * 2, file_index * 2 + 1))
+
+                with open(os.path.join(tmpdir, "{0}.json".format(file_index)), "w") as data_file:
+                    data_file.write('[{{"id":{0}}},{{"id":{1}}}]'.format(file_index * 2, file_index * 2 + 1))
+
+                with open(os.path.join(tmpdir, "{0}.csv".format(file_index)), "w") as data_file:
+                    data_file.write('id\n{0}\n{1}\n'.format(file_index * 2, file_index * 2 + 1))
+
+            expected = [{"id":index} for index in range(6)]
+            for threads in [1, 2]:
+                for workers in [1, 2]:
+                    subject = JsonLinesDataSource(os.path.join(tmpdir, "*.jsonl"), None, {"threads":threads, "workers":workers})
+                    self.assertEquals(subject.batch(), expected)
+                    self.assertEquals([stats.records for stats in subject.file_stats], [2, 2, 2])
+
+                subject = JsonDataSource(os.path.join(tmpdir, "*.json"), None, {"threads":threads})
+                self.assertEquals(subject.batch(), expected)
+                self.assertEquals(list(subject.stream()), expected)
+                self.assertEquals([stats.records for stats in subject.file_stats], [2, 2, 2])
+
+                subject = CsvDataSource(os.path.join(tmpdir, "*.csv"), None, {"first_row_names":True, "threads":threads})
+                self.assertEquals(subject.batch(), [{"id":str(index)} for index in range(6)])
+
+            for index_file in range(3):
+                KeyIndex(os.path.join(tmpdir, "{0}.jsonl".format(index_file))).build("id")
+
+            subject = JsonLinesDataSource(os.path.join(tmpdir, "*.jsonl"), None)
+            self.assertEquals(list(subject.lookup([("id", set([1, 4]))])), [{"id":1}, {"id":4}])
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_json_lines_invalid_config(self):
+        """json_lines data source rejects invalid configuration items.
+        """
+        with self.assertRaises(wqexception.DataSourceBuildError):
+            JsonLinesDataSource("/test/file", None, {"workers":-1})
+
+        with self.assertRaises(wqexception.DataSourceBuildError):
+            JsonLinesDataSource("/test/file", None, {"chunk_size":"1MB"})
+
+        with self.assertRaises(wqexception.DataSourceBuildError):
+            JsonLinesDataSource("/test/file", None, {"lazy":"yes"})
+
+        with self.assertRaises(wqexception.DataSourceBuildError):
+            JsonLinesDataSource("/test/file", None, {"threads":0})
@@ -0,0 +1,130 @@
+"""@package filesets_test
+Tests for weaveq.filesets
+"""
+
+import unittest
+import tempfile
+import shutil
+import os
+
+from weaveq.filesets import expand, ConcurrentFileReader, merge_concurrently
+from weaveq import wqexception
+
+def read_numbers(filename):
+    """Reads one integer record per line
+    """
+    with open(filename, "r") as data_file:
+        for line in data_file:
+            if (line.strip() == "fail"):
+                raise IOError("Bad line in {0}".format(filename))
+
+            yield int(line)
+
+class TestExpand(unittest.TestCase):
+    """Tests expand function
+    """
+
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+        for name in ["b.jsonl", "a.jsonl", "c.csv", ".hidden", "a.jsonl.wqidx"]:
+            with open(os.path.join(self._dir, name), "w") as data_file:
+                data_file.write("1\n")
+
+        os.mkdir(os.path.join(self._dir, "sub"))
+
+    def tearDown(self):
+        shutil.rmtree(self._dir)
+
+    def test_single_file(self):
+        """Plain paths are returned as they are, whether or not they exist
+        """
+        self.assertEqual(expand("/test/file.jsonl"), ["/test/file.jsonl"])
+
+    def test_directory(self):
+        """Directories expand to the data files they contain
+        """
+        self.assertEqual(expand(self._dir), [os.path.join(self._dir, name) for name in ["a.jsonl", "b.jsonl", "c.csv"]])
+
+    def test_glob(self):
+        """Glob patterns expand to the matching files
+        """
+        self.assertEqual(expand(os.path.join(self._dir, "*.jsonl")), [os.path.join(self._dir, name) for name in ["a.jsonl", "b.jsonl"]])
+
+    def test_no_match(self):
+        """Glob patterns that match nothing are errors
+        """
+        with self.assertRaises(wqexception.DataSourceError):
+            expand(os.path.join(self._dir, "*.json"))
+
+class TestConcurrentFileReader(unittest.TestCase):
+    """Tests ConcurrentFileReader class
+    """
+
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+        self._filenames = []
+        for file_index in range(5):
+            filename = os.path.join(self._dir, "{0}.txt".format(file_index))
+            with open(filename, "w") as data_file:
+                for number in range(file_index * 2500, (file_index + 1) * 2500):
+                    data_file.write("{0}\n".format(number))
+
+            self._filenames.append(filename)
+
+    def tearDown(self):
+        shutil.rmtree(self._dir)
+
+    def test_ordered(self):
+        """Records are delivered in file order when required, however many threads are used
+        """
+        for threads in [1, 2, 8]:
+            stats = []
+            self.assertEqual(list(ConcurrentFileReader(threads).read(self._filenames, read_numbers, True, stats)), list(range(12500)))
+            self.assertEqual([file_stats.filename for file_stats in stats], self._filenames)
+            self.assertEqual([file_stats.records for file_stats in stats], [2500] * 5)
+            self.assertTrue(all([file_stats.seconds is not None for file_stats in stats]))
+            self.assertEqual(stats[0].size, os.path.getsize(self._filenames[0]))
+
+    def test_unordered(self):
+        """Every record is delivered when order doesn't matter
+        """
+        stats = []
+        self.assertEqual(sorted(ConcurrentFileReader(3).read(self._filenames, read_numbers, False, stats)), list(range(12500)))
+        self.assertEqual([file_stats.records for file_stats in stats], [2500] * 5)
+
+    def test_error(self):
+        """Errors reading files are raised to the consumer
+        """
+        with open(self._filenames[3], "a") as data_file:
+            data_file.write("fail\n")
+
+        for ordered in [True, False]:
+            with self.assertRaises(IOError):
+                list(ConcurrentFileReader(2).read(self._filenames, read_numbers, ordered))
+
+    def test_stop_early(self):
+        """Consumers can stop reading before every file has been read
+        """
+        records = ConcurrentFileReader(2).read(self._filenames, read_numbers, True)
+        self.assertEqual(next(records), 0)
+        records.close()
+
+class TestMergeConcurrently(unittest.TestCase):
+    """Tests merge_concurrently function
+    """
+
+    def test_merge(self):
+        """Records of sources that aren't files are merged from their threads, and errors are raised to the consumer
+        """
+        def read_source(source):
+            if (source == "fail"):
+                raise ValueError("source failed")
+
+            return range(source * 1500, (source + 1) * 1500)
+
+        self.assertEqual(sorted(merge_concurrently([0, 1, 2], read_source, 3)), list(range(4500)))
+        self.assertEqual(list(merge_concurrently([2, 0], read_source, 2, ordered=True)), list(range(3000, 4500)) + list(range(1500)))
+        self.assertEqual(list(merge_concurrently([], read_source, 2)), [])
+
+        with self.assertRaises(ValueError):
+            list(merge_concurrently([0, "fail"], read_source, 2))
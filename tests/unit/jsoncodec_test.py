@@ -0,0 +1,248 @@
+"""@package jsoncodec_test
+Tests for weaveq.jsoncodec
+"""
+
+import unittest
+import collections
+import pickle
+import datetime
+import decimal
+import math
+import six
+
+from weaveq import jsoncodec
+from weaveq import wqexception
+
+class ReadOnlyRecord(collections.abc.Mapping):
+    """A mapping that isn't a dict, as produced by some data sources
+    """
+
+    def __init__(self, fields):
+        self._fields = fields
+
+    def __getitem__(self, key):
+        return self._fields[key]
+
+    def __iter__(self):
+        return iter(self._fields)
+
+    def __len__(self):
+        return len(self._fields)
+
+class TestCodecs(unittest.TestCase):
+    """Tests each available codec
+    """
+
+    def available_codecs(self):
+        codecs = []
+        for name in jsoncodec.codec_names():
+            try:
+                codecs.append(jsoncodec.get_codec(name))
+            except wqexception.ConfigurationError:
+                pass
+
+        return codecs
+
+    def test_round_trip(self):
+        """Records survive encoding and decoding, with field order preserved
+        """
+        document = b'{"z":1,"a":[1,2.5,"three",null,true],"m":{"y":"\\u00e9","b":false}}'
+        for codec in self.available_codecs():
+            decoded = codec.decode(document)
+            self.assertEqual(list(decoded.keys()), ["z", "a", "m"], codec.name)
+            self.assertEqual(list(decoded["m"].keys()), ["y", "b"], codec.name)
+            self.assertEqual(decoded["m"]["y"], u"é", codec.name)
+            self.assertEqual(codec.decode(codec.encode(decoded)), decoded, codec.name)
+            self.assertEqual(codec.decode(document.decode("utf-8")), decoded, codec.name)
+
+    def test_encode_mapping(self):
+        """Mappings that aren't dicts are encoded as JSON objects
+        """
+        for codec in self.available_codecs():
+            self.assertEqual(codec.decode(codec.encode({"outer":ReadOnlyRecord({"b":1, "a":2})})), {"outer":{"b":1, "a":2}}, codec.name)
+
+    def test_encode_typed_values(self):
+        """Dates, times, durations, decimals and binary values are encoded as strings and numbers
+        """
+        record = {"dt":datetime.datetime(2020, 1, 2, 3, 4, 5), "d":datetime.date(2020, 1, 2), "t":datetime.time(3, 4, 5), "td":datetime.timedelta(seconds=90), "dec":decimal.Decimal("1.10"), "bin":b"\x00\x01"}
+        for codec in self.available_codecs():
+            decoded = codec.decode(codec.encode(record))
+            # Some libraries encode decimals natively, as numbers
+            self.assertEqual(decimal.Decimal(str(decoded.pop("dec"))), decimal.Decimal("1.1"), codec.name)
+            self.assertEqual(decoded, {"dt":"2020-01-02T03:04:05", "d":"2020-01-02", "t":"03:04:05", "td":90.0, "bin":"AAE="}, codec.name)
+
+    def test_invalid_json(self):
+        """Invalid documents raise ValueError
+        """
+        for codec in self.available_codecs():
+            with self.assertRaises(ValueError):
+                codec.decode(b'{"a":')
+
+    def test_orjson_fallback(self):
+        """The orjson codec reads and writes what orjson can't handle in the same way as the standard library
+        """
+        try:
+            codec = jsoncodec.get_codec("orjson")
+        except wqexception.ConfigurationError:
+            self.skipTest("orjson isn't installed")
+
+        for document in [b'{"x":123456789012345678901234567890}', b'{"x":-9223372036854775809}', u'{"x":123456789012345678901234567890}']:
+            self.assertEqual(codec.decode(document), jsoncodec.get_codec("stdlib").decode(document))
+            self.assertTrue(isinstance(codec.decode(document)["x"], six.integer_types))
+
+        self.assertTrue(math.isnan(codec.decode(b'{"x":NaN}')["x"]))
+        self.assertEqual(codec.decode(codec.encode({"x":2 ** 70})), {"x":2 ** 70})
+        self.assertEqual(codec.decode(codec.encode({1:2})), {"1":2})
+        self.assertEqual(codec.decode(b'{"x":1234}'), {"x":1234})
+        with self.assertRaises(ValueError):
+            codec.decode(b'{"x":')
+        with self.assertRaises(TypeError):
+            codec.encode({"x":object()})
+
+    def test_fallbacks(self):
+        """Every codec reads and writes big integers, NaN and Infinity literals and non-string keys as the standard library does
+        """
+        stdlib = jsoncodec.get_codec("stdlib")
+        for codec in self.available_codecs():
+            for document in [b'{"x":123456789012345678901234567890}', b'{"x":-9223372036854775809}', b'{"x":Infinity}']:
+                self.assertEqual(codec.decode(document), stdlib.decode(document), codec.name)
+
+            self.assertTrue(math.isnan(codec.decode(b'{"x":NaN}')["x"]), codec.name)
+            self.assertEqual(codec.decode(codec.encode({"x":2 ** 70})), {"x":2 ** 70}, codec.name)
+            self.assertEqual(codec.decode(codec.encode({1:2})), {"1":2}, codec.name)
+
+    def test_auto_output(self):
+        """The auto codec writes exactly what the standard library does, whichever library it decodes with, and is pickled by name
+        """
+        record = {"a":[1, 2], "path":"a/b", "nan":float("nan"), "big":2 ** 70}
+        subject = jsoncodec.get_codec("auto")
+        self.assertEqual(subject.encode(record), jsoncodec.get_codec("stdlib").encode(record))
+        expected = [codec.name for codec in self.available_codecs() if (codec.name != "auto")][0] if (jsoncodec.DICTS_ORDERED) else "stdlib"
+        self.assertEqual(subject.decoder.name, expected)
+
+        encoder = pickle.loads(pickle.dumps(jsoncodec.ResultEncoder(subject), pickle.HIGHEST_PROTOCOL))
+        self.assertTrue(encoder.codec is subject)
+
+    def test_stdlib_always_available(self):
+        """The standard library codec can always be selected, and auto selection always succeeds
+        """
+        self.assertEqual(jsoncodec.get_codec("stdlib").name, "stdlib")
+        self.assertIn(jsoncodec.get_codec("auto").name, jsoncodec.codec_names())
+
+    def test_unknown_codec(self):
+        """Unknown codec names are configuration errors
+        """
+        with self.assertRaises(wqexception.ConfigurationError):
+            jsoncodec.get_codec("nonexistent")
+
+        with self.assertRaises(wqexception.ConfigurationError):
+            jsoncodec.set_default_codec("nonexistent")
+
+    def test_default_codec(self):
+        """The default codec can be changed
+        """
+        try:
+            jsoncodec.set_default_codec("stdlib")
+            self.assertEqual(jsoncodec.default_codec().name, "stdlib")
+        finally:
+            jsoncodec.set_default_codec("auto")
+
+class TestLazyJsonRecord(unittest.TestCase):
+    """Tests LazyJsonDecoder and LazyJsonRecord classes
+    """
+
+    def setUp(self):
+        self._document = b'{"id":1,"nested":{"ip":"10.0.0.1","port":80},"name":"a","tags":["x","y"]}\n'
+
+    def test_key_fields(self):
+        """Key fields are read without decoding the whole document
+        """
+        subject = jsoncodec.LazyJsonDecoder(["id", "nested.ip", "missing"]).decode(self._document)
+        self.assertEqual(subject["id"], 1)
+        self.assertEqual(subject["nested"], {"ip":"10.0.0.1", "port":80})
+        self.assertFalse("missing" in subject)
+        self.assertEqual(subject.get("missing"), None)
+        self.assertFalse(subject.decoded())
+
+    def test_key_fields_without_simdjson(self):
+        """Key fields are extracted by the codec when pysimdjson isn't available
+        """
+        decoder = jsoncodec.LazyJsonDecoder(["id", "missing"])
+        decoder._parser = None
+        subject = decoder.decode(self._document)
+        self.assertEqual(subject["id"], 1)
+        self.assertFalse("missing" in subject)
+        self.assertFalse(subject.decoded())
+        self.assertEqual(subject["tags"], ["x", "y"])
+
+    def test_decode_on_demand(self):
+        """Accessing anything other than key fields decodes the whole document
+        """
+        subject = jsoncodec.LazyJsonDecoder(["id"]).decode(self._document)
+        self.assertEqual(subject["name"], "a")
+        self.assertTrue(subject.decoded())
+
+        subject = jsoncodec.LazyJsonDecoder(["id"]).decode(self._document)
+        self.assertEqual(list(subject.keys()), ["id", "nested", "name", "tags"])
+        self.assertEqual(len(subject), 4)
+
+        subject = jsoncodec.LazyJsonDecoder(["id"]).decode(self._document)
+        subject["joined_data"] = {"id":2}
+        self.assertEqual(subject, {"id":1, "nested":{"ip":"10.0.0.1", "port":80}, "name":"a", "tags":["x","y"], "joined_data":{"id":2}})
+
+    def test_encode(self):
+        """Lazy records are encoded as their full documents
+        """
+        subject = jsoncodec.LazyJsonDecoder(["id"]).decode(self._document)
+        codec = jsoncodec.default_codec()
+        self.assertEqual(codec.decode(codec.encode(subject)), codec.decode(self._document))
+
+    def test_not_object(self):
+        """Documents that aren't objects are decoded in full
+        """
+        self.assertEqual(jsoncodec.LazyJsonDecoder(["id"]).decode(b'[1,{"id":2}]'), [1, {"id":2}])
+
+    def test_invalid_json(self):
+        """Invalid documents raise ValueError
+        """
+        with self.assertRaises(ValueError):
+            jsoncodec.LazyJsonDecoder(["id"]).decode(b'{"id":')
+
+    def test_big_integers(self):
+        """Documents pysimdjson can't parse, such as those containing integers too big for 64 bits, are decoded by the codec
+        """
+        subject = jsoncodec.LazyJsonDecoder(["id"]).decode(b'{"id":123456789012345678901234567890,"n":NaN}')
+        self.assertEqual(subject["id"], 123456789012345678901234567890)
+        self.assertTrue(math.isnan(subject["n"]))
+
+    def test_pickle(self):
+        """Lazy records can be passed between processes
+        """
+        subject = pickle.loads(pickle.dumps(jsoncodec.LazyJsonDecoder(["id"]).decode(self._document), pickle.HIGHEST_PROTOCOL))
+        self.assertEqual(subject["id"], 1)
+        self.assertFalse(subject.decoded())
+        self.assertEqual(subject["name"], "a")
+
+    def test_raw_document(self):
+        """The raw document is available until members are set or deleted
+        """
+        subject = jsoncodec.LazyJsonDecoder(["id"]).decode(b'{"id": 1, "name": "a"}\r\n')
+        self.assertEqual(subject["name"], "a")
+        self.assertEqual(subject.raw_document(), b'{"id": 1, "name": "a"}')
+
+        subject["joined_data"] = {"id":2}
+        self.assertEqual(subject.raw_document(), None)
+
+        subject = jsoncodec.LazyJsonDecoder(["id"]).decode(b'{"id": 1, "name": "a"}\n')
+        del subject["name"]
+        self.assertEqual(subject.raw_document(), None)
+
+    def test_result_encoder(self):
+        """Result encoders encode unchanged records as their raw documents if passing them through, and can be passed between processes
+        """
+        record = jsoncodec.LazyJsonDecoder(["id"]).decode(b'{"id": 1,  "name": "a"}\n')
+        for passthrough, expected in [(True, b'{"id": 1,  "name": "a"}'), (False, b'{"id": 1, "name": "a"}')]:
+            subject = pickle.loads(pickle.dumps(jsoncodec.ResultEncoder(jsoncodec.get_codec("stdlib"), passthrough), pickle.HIGHEST_PROTOCOL))
+            self.assertEqual(subject.codec.name, "stdlib")
+            self.assertEqual(subject(record), expected)
+            self.assertEqual(subject({"id":2}), b'{"id": 2}')
@@ -0,0 +1,63 @@
+"""@package jsonstream_test
+Tests for weaveq.jsonstream
+"""
+
+import unittest
+import io
+import json
+
+from weaveq.jsonstream import JsonArrayReader
+from weaveq import wqexception
+
+class TestJsonArrayReader(unittest.TestCase):
+    """Tests JsonArrayReader class
+    """
+
+    def setUp(self):
+        self._elements = [{"a":"brackets ] and } in \"strings\" \\", "b":[1, {"c":[]}]}, [1, [2, [3]]], "text", -1.5e3, True, None, {}, u"κόσμε"]
+
+    def test_elements(self):
+        """Every element is read, whatever the block size
+        """
+        for indent in [None, 2]:
+            document = json.dumps(self._elements, indent=indent).encode("utf-8")
+            for block_size in [1, 3, 16, 1024]:
+                subject = JsonArrayReader(io.BytesIO(document), block_size=block_size)
+                self.assertEqual(list(subject), self._elements)
+                self.assertEqual(subject.offset, len(document))
+
+    def test_offsets(self):
+        """The byte offset of the end of each element is recorded
+        """
+        subject = JsonArrayReader(io.BytesIO(b'\xef\xbb\xbf [{"id":1}, {"id":2} ]\n'), block_size=4)
+        self.assertEqual(next(subject), {"id":1})
+        self.assertEqual(subject.offset, 13)
+        self.assertEqual(next(subject), {"id":2})
+        self.assertEqual(subject.offset, 23)
+        self.assertEqual(list(subject), [])
+        self.assertEqual(subject.offset, 25)
+
+    def test_empty_array(self):
+        """An empty array has no elements
+        """
+        self.assertEqual(list(JsonArrayReader(io.BytesIO(b" [ ] "))), [])
+
+    def test_not_array(self):
+        """Documents whose root element isn't an array are rejected
+        """
+        for document in [b'{"a":[1]}', b"", b"   "]:
+            with self.assertRaises(wqexception.DataSourceError):
+                list(JsonArrayReader(io.BytesIO(document)))
+
+    def test_truncated(self):
+        """Truncated documents are rejected
+        """
+        for document in [b'[{"a":1}', b'[{"a":1}, {"b":', b'[{"a":"1']:
+            with self.assertRaises(wqexception.DataSourceError):
+                list(JsonArrayReader(io.BytesIO(document), block_size=2))
+
+    def test_invalid_element(self):
+        """Invalid elements raise ValueError
+        """
+        with self.assertRaises(ValueError):
+            list(JsonArrayReader(io.BytesIO(b'[{"a":1,}]')))
@@ -0,0 +1,71 @@
+"""@package keyindex_test
+Tests for weaveq.keyindex
+"""
+
+import unittest
+import tempfile
+import os
+
+from weaveq.keyindex import KeyIndex
+
+class TestKeyIndex(unittest.TestCase):
+    """Tests KeyIndex class
+    """
+
+    def setUp(self):
+        self._source_file = tempfile.mkstemp()
+        with open(self._source_file[1], "wb") as source_file:
+            source_file.write(b'{"id":1,"name":"a","nested":{"ip":"10.0.0.1"}}\n{"id":2,"name":"b"}\n\n{"id":1,"name":"c","nested":{"ip":"10.0.0.2"}}\n')
+
+    def tearDown(self):
+        os.close(self._source_file[0])
+        os.unlink(self._source_file[1])
+        if (os.path.exists(self._source_file[1] + KeyIndex.SUFFIX)):
+            os.unlink(self._source_file[1] + KeyIndex.SUFFIX)
+
+    def test_encode_key(self):
+        """Values that Python considers equal are encoded identically.
+        """
+        self.assertEqual(KeyIndex.encode_key(1), KeyIndex.encode_key(1.0))
+        self.assertEqual(KeyIndex.encode_key(1), KeyIndex.encode_key(True))
+        self.assertNotEqual(KeyIndex.encode_key(1), KeyIndex.encode_key("1"))
+        self.assertNotEqual(KeyIndex.encode_key(1.5), KeyIndex.encode_key(1))
+
+    def test_build_and_lookup(self):
+        """Offsets of lines containing the requested values are found.
+        """
+        subject = KeyIndex(self._source_file[1])
+        self.assertFalse(subject.valid("id"))
+        self.assertEqual(subject.build("id"), 3)
+        self.assertTrue(subject.valid("id"))
+        self.assertFalse(subject.valid("name"))
+
+        self.assertEqual(subject.offsets([("id", set([1]))]), [0, 68])
+        self.assertEqual(subject.offsets([("id", set([2, 3]))]), [47])
+        self.assertEqual(subject.offsets([("id", set())]), [])
+
+    def test_nested_field(self):
+        """Nested fields are indexed; lines without the field are not.
+        """
+        subject = KeyIndex(self._source_file[1])
+        self.assertEqual(subject.build("nested.ip"), 2)
+        self.assertEqual(subject.offsets([("nested.ip", set(["10.0.0.2"]))]), [68])
+
+    def test_rebuild(self):
+        """Rebuilding a field replaces its entries.
+        """
+        subject = KeyIndex(self._source_file[1])
+        subject.build("id")
+        subject.build("id")
+        self.assertEqual(subject.offsets([("id", set([1]))]), [0, 68])
+
+    def test_invalidated_by_source_change(self):
+        """The index is invalid once the source file changes.
+        """
+        subject = KeyIndex(self._source_file[1])
+        subject.build("id")
+
+        with open(self._source_file[1], "ab") as source_file:
+            source_file.write(b'{"id":3,"name":"d"}\n')
+
+        self.assertFalse(subject.valid("id"))
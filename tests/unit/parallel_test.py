@@ -0,0 +1,125 @@
+"""@package parallel_test
+Tests for weaveq.parallel
+"""
+
+import unittest
+import tempfile
+import os
+
+from weaveq.parallel import line_chunks, csv_chunks, decode_json_lines_chunk, decode_csv_chunk, ChunkReader
+from weaveq.csvrecord import RowBuilder
+
+class TestChunking(unittest.TestCase):
+    """Tests file chunking and chunk decoding
+    """
+
+    def setUp(self):
+        self._data_file = tempfile.mkstemp()
+        with open(self._data_file[1], "wb") as data_file:
+            for index in range(100):
+                data_file.write('{{"id":{0},"name":"name{0}"}}\n'.format(index).encode("utf-8"))
+
+    def tearDown(self):
+        os.close(self._data_file[0])
+        os.unlink(self._data_file[1])
+
+    def test_chunks_end_on_line_boundaries(self):
+        """Chunks are contiguous, cover the whole file and end on line boundaries
+        """
+        chunks = line_chunks(self._data_file[1], 100)
+        self.assertTrue(len(chunks) > 1)
+        self.assertEqual(chunks[0][1], 0)
+        self.assertEqual(chunks[-1][2], os.path.getsize(self._data_file[1]))
+
+        with open(self._data_file[1], "rb") as data_file:
+            data = data_file.read()
+
+        for index in range(len(chunks)):
+            self.assertEqual(data[chunks[index][2] - 1:chunks[index][2]], b"\n")
+            if (index > 0):
+                self.assertEqual(chunks[index][1], chunks[index - 1][2])
+
+    def test_single_chunk(self):
+        """A chunk size larger than the file produces a single chunk
+        """
+        self.assertEqual(line_chunks(self._data_file[1], 1024 * 1024), [(self._data_file[1], 0, os.path.getsize(self._data_file[1]))])
+
+    def test_empty_file(self):
+        """An empty file has no chunks
+        """
+        empty_file = tempfile.mkstemp()
+        try:
+            self.assertEqual(line_chunks(empty_file[1], 100), [])
+        finally:
+            os.close(empty_file[0])
+            os.unlink(empty_file[1])
+
+    def test_decode_chunks(self):
+        """Decoding every chunk produces every record exactly once
+        """
+        records = []
+        for chunk in line_chunks(self._data_file[1], 64):
+            records.extend(decode_json_lines_chunk(chunk + ("stdlib",)))
+
+        self.assertEqual([record["id"] for record in records], list(range(100)))
+
+    def test_parallel_read(self):
+        """Worker processes decode chunks, delivering them in order when required
+        """
+        subject = ChunkReader(2, 128)
+
+        ordered_ids = []
+        for batch in subject.read_batches([self._data_file[1], self._data_file[1]], decode_json_lines_chunk, ("stdlib",), ordered=True):
+            ordered_ids.extend([record["id"] for record in batch])
+
+        self.assertEqual(ordered_ids, list(range(100)) * 2)
+
+        unordered_ids = []
+        for batch in subject.read_batches([self._data_file[1]], decode_json_lines_chunk, ("stdlib",), ordered=False):
+            unordered_ids.extend([record["id"] for record in batch])
+
+        self.assertEqual(sorted(unordered_ids), list(range(100)))
+
+class TestCsvChunking(unittest.TestCase):
+    """Tests CSV file chunking and chunk parsing
+    """
+
+    def setUp(self):
+        self._data_file = tempfile.mkstemp()
+        with open(self._data_file[1], "wb") as data_file:
+            data_file.write(b'"id","text"\r\n')
+            for index in range(100):
+                data_file.write('{0},"line one\nline ""two""\n,{0}"\r\n'.format(index).encode("utf-8"))
+
+    def tearDown(self):
+        os.close(self._data_file[0])
+        os.unlink(self._data_file[1])
+
+    def test_chunks_end_on_record_boundaries(self):
+        """Chunks are contiguous, skip the header and don't split quoted cells containing line breaks
+        """
+        chunks = csv_chunks(self._data_file[1], 50, skip_first_record=True)
+        self.assertTrue(len(chunks) > 1)
+        self.assertEqual(chunks[0][1], len(b'"id","text"\r\n'))
+        self.assertEqual(chunks[-1][2], os.path.getsize(self._data_file[1]))
+
+        builder = RowBuilder([u"id", u"text"], types={u"id":"integer"})
+        records = []
+        for index in range(len(chunks)):
+            if (index > 0):
+                self.assertEqual(chunks[index][1], chunks[index - 1][2])
+
+            records.extend(decode_csv_chunk(chunks[index] + (builder,)))
+
+        self.assertEqual([record[u"id"] for record in records], list(range(100)))
+        self.assertEqual(records[7][u"text"], u'line one\nline "two"\n,7')
+
+    def test_parallel_read(self):
+        """Worker processes parse chunks
+        """
+        builder = RowBuilder([u"id", u"text"], fields=set([u"id"]))
+        ids = []
+        for batch in ChunkReader(2, 200).read_batches([self._data_file[1]], decode_csv_chunk, (builder,), chunker=lambda filename, chunk_size: csv_chunks(filename, chunk_size, True)):
+            ids.extend([list(record.items()) for record in batch])
+
+        self.assertEqual(ids, [[(u"id", str(index))] for index in range(100)])
@@ -73,6 +73,20 @@ class TestTextQuery(unittest.TestCase):
 
         self.assertEquals(str(result), "<pos=0, op=SEED, q={0}>,<pos=1, op=JOIN, q={1}, rels=[[field1 == field2]], exclude_empty=False, field_name=None, array=False>".format("<uri=source1, filter=filter1>", "<uri=source2, filter=filter2>"))
 
+    def test_select(self):
+        """Source specs with select clauses
+        """
+        data_source_builder = TestDataSourceBuilder()
+        subject = TextQuery(data_source_builder)
+
+        result = subject.compile_query('#from "source1" #as a1 #filter |filter1| #select field1, field2.sub #pivot-to "source2" #as a2 #where a1.field1 = a2.field2 #join-to "source3" #as a3 #select field3 #where a2.field2 = a3.field3')
+
+        self.assertEquals(str(result), "<pos=0, op=SEED, q={0}>,<pos=1, op=PIVOT, q={1}, rels=[[field1 == field2]]>,<pos=2, op=JOIN, q={2}, rels=[[field2 == field3]], exclude_empty=False, field_name=None, array=False>".format("<uri=source1, filter=filter1>", "<uri=source2, filter=None>", "<uri=source3, filter=None>"))
+        self.assertEquals([instr.get("select") for instr in result._instructions], [["field1", "field2.sub"], None, ["field3"]])
+
+        with self.assertRaises(TextQueryCompileError):
+            subject.compile_query('#from "source1" #as a1 #select #pivot-to "source2" #as a2 #where a1.field1 = a2.field2')
+
     def test_join_exclude_empty(self):
         """Join clause, exclude empty option
         """
@@ -9,8 +9,10 @@ import operator
 from weaveq.query import IndexResultHandler
 from weaveq.query import NestedField
 from weaveq.query import WeaveQ
+from weaveq.query import record_batches
 from weaveq.relations import F
 from weaveq.relations import ConditionNode
+from weaveq.relations import TargetConditions
 
 class FirstCharProxy(object):
     """Applies proxy logic that represents values as their first character only.
@@ -74,6 +76,47 @@ class MockDataSource(object):
 
         return return_val
 
+class MockLookupDataSource(MockDataSource):
+    """Supplies pre-defined data to WeaveQ, recording key lookup requests and serving them from a separate set of pre-defined data
+    """
+
+    def __init__(self, obj_array, lookup_data):
+        super(MockLookupDataSource, self).__init__(obj_array)
+        self.lookup_data = lookup_data
+        self.lookup_requests = []
+
+    def lookup(self, key_values):
+        """Services a WeaveQ key lookup request if lookup data has been supplied"""
+        self.lookup_requests.append(key_values)
+        return self.lookup_data
+
+class MockPlannedDataSource(MockDataSource):
+    """Supplies pre-defined data to WeaveQ, recording the step plans it's given
+    """
+
+    def __init__(self, obj_array):
+        super(MockPlannedDataSource, self).__init__(obj_array)
+        self.plans = []
+
+    def prepare(self, plan):
+        self.plans.append(plan)
+
+class MockBatchDataSource(MockDataSource):
+    """Supplies pre-defined data to WeaveQ in batches of a fixed size, recording the batch sizes requested
+    """
+
+    def __init__(self, obj_array, size):
+        super(MockBatchDataSource, self).__init__(obj_array)
+        self._size = size
+        self.requested_sizes = []
+
+    def stream(self):
+        return self.batch()
+
+    def stream_batches(self, batch_size):
+        self.requested_sizes.append(batch_size)
+        return record_batches(self.batch(), self._size)
+
 class TestNestedField(unittest.TestCase):
     """Tests NestedField class
     """
@@ -728,3 +771,130 @@ class TestWeaveQ(unittest.TestCase):
 
         self.assertEqual(str(s), "<pos=0, op=SEED, q={0}>,<pos=1, op=JOIN, q={1}, rels=[[id == name_id]], exclude_empty=True, field_name=step1, array=False>,<pos=2, op=PIVOT, q={2}, rels=[[step1.id == id]]>".format(str(q1), str(q2), str(q3))) 
 
+    def test_pivot_lookup(self):
+        """Pivot steps request the previous step's keys from data sources that support lookups"""
+        r = TestResultHandler()
+        q1 = MockDataSource([[{"id":1,"name":"record_a"},{"id":2,"name":"record_b"},{"id":4,"name":"record_b"}]])
+        q2 = MockLookupDataSource([[{"name_id":7,"count":10}]], [{"name_id":1,"count":10},{"name_id":3,"count":11},{"name_id":4,"count":13}])
+        s = WeaveQ(q1).pivot_to(q2, ((F("id") == F("name_id")) & (F("name") != F("count"))) | (F("name") == F("label")))
+        s.result_handler(r)
+        s.execute(stream=False)
+
+        self.assertEqual(q2.lookup_requests, [[("name_id", set([1, 2, 4])), ("label", set(["record_a", "record_b"]))]])
+        self.assertEqual(r.results, [{"name_id":1,"count":10},{"name_id":4,"count":13}]) # The lookup superset is filtered as normal
+
+    def test_pivot_lookup_unsupported(self):
+        """Data sources can decline lookups, in which case all their data is requested"""
+        r = TestResultHandler()
+        q1 = MockDataSource([[{"id":1,"name":"record_a"},{"id":4,"name":"record_b"}]])
+        q2 = MockLookupDataSource([[{"name_id":1,"count":10},{"name_id":6,"count":11},{"name_id":4,"count":13}]], None)
+        s = WeaveQ(q1).pivot_to(q2, F("id") == F("name_id"))
+        s.result_handler(r)
+        s.execute(stream=False)
+
+        self.assertEqual(len(q2.lookup_requests), 1)
+        self.assertEqual(r.results, [{"name_id":1,"count":10},{"name_id":4,"count":13}])
+
+    def test_no_lookup(self):
+        """Lookups aren't requested for joins that output all records or for conditions without equality relationships"""
+        q1 = MockDataSource([[{"id":1,"name":"record_a"},{"id":4,"name":"record_b"}]])
+        q2 = MockLookupDataSource([[{"name_id":1,"count":10},{"name_id":6,"count":11}]], [])
+        s = WeaveQ(q1).join_to(q2, F("id") == F("name_id"))
+        s.result_handler(TestResultHandler())
+        s.execute(stream=False)
+        self.assertEqual(len(q2.lookup_requests), 0)
+
+        q1.rewind()
+        q3 = MockLookupDataSource([[{"name_id":1,"count":10},{"name_id":6,"count":11}]], [])
+        s = WeaveQ(q1).pivot_to(q3, F("id") != F("name_id"))
+        s.result_handler(TestResultHandler())
+        s.execute(stream=False)
+        self.assertEqual(len(q3.lookup_requests), 0)
+
+    def test_step_plans(self):
+        """Data sources are told when their records needn't be delivered in order"""
+        q1 = MockPlannedDataSource([[{"id":1}]])
+        q2 = MockPlannedDataSource([[{"id":1}]])
+        q3 = MockPlannedDataSource([[{"id":1}]])
+        q4 = MockPlannedDataSource([[{"id":1}]])
+        s = WeaveQ(q1).pivot_to(q2, F("id") == F("id")).join_to(q3, F("id") == F("id")).pivot_to(q4, F("id") == F("id"))
+        s.result_handler(TestResultHandler())
+        s.execute(stream=False)
+
+        self.assertEqual([plan.ordered for plan in q1.plans + q2.plans + q3.plans + q4.plans], [False, True, False, True])
+
+    def test_step_plan_key_fields(self):
+        """Data sources are told which fields are used to filter and index their records"""
+        q1 = MockPlannedDataSource([[{"id":1, "name":"x"}]])
+        q2 = MockPlannedDataSource([[{"a":{"id":1}, "name":"y", "b":2, "c":{"d":3}}]])
+        q3 = MockPlannedDataSource([[{"e":3}]])
+        s = WeaveQ(q1).pivot_to(q2, (F("id") == F("a.id")) & (F("name") != F("name")) | (F("id") == F("b"))).join_to(q3, F("c.d") == F("e"))
+        s.result_handler(TestResultHandler())
+        s.execute(stream=False)
+
+        self.assertEqual(q1.plans[0].key_fields, ["id", "name"])
+        self.assertEqual(q2.plans[0].key_fields, ["a.id", "name", "b", "c.d"])
+        self.assertEqual(q3.plans[0].key_fields, ["e"])
+
+    def test_step_plan_output_fields(self):
+        """Data sources are told which fields of their records are output or joined"""
+        q1 = MockPlannedDataSource([[{"id":1, "name":"x"}]])
+        q2 = MockPlannedDataSource([[{"id":1, "name":"y", "b":2}]])
+        q3 = MockPlannedDataSource([[{"b":2, "f":3}]])
+        s = WeaveQ(q1).pivot_to(q2, F("id") == F("id")).select(["name"]).join_to(q3, F("b") == F("b")).select(["f.g"])
+        s.result_handler(TestResultHandler())
+        s.execute(stream=False)
+
+        self.assertEqual(q1.plans[0].output_fields, [])
+        self.assertEqual(q1.plans[0].fields(), ["id"])
+        self.assertEqual(q2.plans[0].output_fields, ["name"])
+        self.assertEqual(q2.plans[0].fields(), ["id", "b", "name"])
+        self.assertEqual(q3.plans[0].fields(), ["b", "f.g"])
+
+        q1 = MockPlannedDataSource([[{"id":1}]])
+        q2 = MockPlannedDataSource([[{"id":1}]])
+        s = WeaveQ(q1).pivot_to(q2, F("id") == F("id"))
+        s.result_handler(TestResultHandler())
+        s.execute(stream=False)
+
+        self.assertEqual(q2.plans[0].output_fields, None)
+        self.assertEqual(q2.plans[0].fields(), None)
+
+    def test_stream_batches(self):
+        """Records delivered in batches are filtered and indexed with the same results as records delivered one at a time"""
+        p = FirstCharProxy({"type_l":None,"type_r":None})
+        left = [{"id":index,"name":"n{0}".format(index % 3),"nested":{"type_l":"t{0}".format(index % 4)}} for index in range(10)] + [{"name":"missing id"}, "not a record"]
+        right = [{"name_id":index % 12,"letter":"n{0}".format(index % 2),"type_r":"t{0}".format(index % 5)} for index in range(30)] + [{"letter":"n0"}]
+        rel = ((F("id") == F("name_id")) & (F("name") == F("letter"))) | (F("nested.type_l", proxy=p) == F("type_r", proxy=p))
+
+        r = TestResultHandler()
+        q1 = MockBatchDataSource([left], 4)
+        q2 = MockBatchDataSource([right], 7)
+        s = WeaveQ(q1).pivot_to(q2, rel)
+        s.result_handler(r)
+        s.execute(stream=True)
+
+        self.assertEqual(q1.requested_sizes, [1000])
+        expected = [record for record in right if (("name_id" in record) and ((any([(l.get("id") == record["name_id"]) and (l["name"] == record["letter"]) for l in left[0:11]])) or (any([l["nested"]["type_l"][0] == record["type_r"][0] for l in left[0:10]]))))]
+        self.assertEqual(r.results, expected)
+        self.assertTrue(len(expected) > 0)
+
+    def test_index_batch(self):
+        """Indexing a batch of results produces the same index as indexing them one at a time"""
+        results = [{"id":index % 3,"name":"n{0}".format(index % 2),"nested":{"value":index % 4}} for index in range(12)] + [{"id":1}, {"nested":[1]}]
+        rel = ((F("id") == F("x")) & (F("name") == F("y"))) | (F("nested.value") == F("z")) | ((F("id") != F("x")) & (F("nested.value") == F("z")))
+        conditions = TargetConditions(rel.tree).conjunctions
+
+        expected = []
+        subject = IndexResultHandler(conditions)
+        for result in results:
+            subject(result, expected)
+
+        actual = []
+        batch_subject = IndexResultHandler(conditions)
+        batch_subject.handle_batch(results[0:5], actual)
+        batch_subject.handle_batch(results[5:], actual)
+
+        self.assertEqual(actual, expected)
+        self.assertEqual(batch_subject._hit_group_count, subject._hit_group_count)
+        self.assertTrue(batch_subject.success())
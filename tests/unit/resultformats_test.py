@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+
+"""@package resultformats_test
+Tests for weaveq.resultformats
+"""
+
+import unittest
+import tempfile
+import shutil
+import os
+import io
+import csv
+import gzip
+import pickle
+import sqlite3
+import datetime
+import collections
+
+from weaveq import resultformats
+from weaveq import arrowrecord
+from weaveq import jsoncodec
+from weaveq import wqexception
+
+class TabularTestCase(unittest.TestCase):
+    """Writes results with nested objects, joined arrays and a field that first appears after the first batch
+    """
+
+    def setUp(self):
+        self._directory = tempfile.mkdtemp()
+        self._results = []
+        for index in range(7):
+            result = collections.OrderedDict([("id", index), ("name", u"café {0}".format(index)), ("valid", (index % 2) == 0)])
+            result["joined"] = collections.OrderedDict([("host", "h{0}".format(index)), ("port", None)])
+            result["flows"] = [{"port":80}]
+            self._results.append(result)
+
+        self._results.append({"id":7, "late":"x"})
+
+    def tearDown(self):
+        shutil.rmtree(self._directory)
+
+    def _write(self, subject):
+        for result in self._results:
+            subject(result, None)
+
+        subject.flush()
+        self.assertEqual(subject.rows_written, len(self._results))
+
+        return subject
+
+class TestRowFlattener(unittest.TestCase):
+    """Tests RowFlattener class
+    """
+
+    def test_flatten(self):
+        """Nested objects are flattened into columns named in dot notation, and lists are encoded as JSON
+        """
+        subject = resultformats.RowFlattener(jsoncodec.get_codec("stdlib"))
+        result = collections.OrderedDict([("a", 1), ("b", collections.OrderedDict([("c", "x"), ("d", {"e":None})])), ("f", [1, 2])])
+        self.assertEqual(subject(result), (("a", "b.c", "b.d.e", "f"), (1, "x", None, u"[1, 2]")))
+        self.assertEqual(subject(5), (("value",), (5,)))
+
+        subject = pickle.loads(pickle.dumps(subject, pickle.HIGHEST_PROTOCOL))
+        self.assertEqual(subject.codec.name, "stdlib")
+
+class TestCsvResultHandler(TabularTestCase):
+    """Tests CsvResultHandler class
+    """
+
+    def _read(self, data):
+        return list(csv.reader(io.StringIO(data.decode("utf-8"), newline="")))
+
+    def test_write(self):
+        """Results are written as CSV with a header row, in batches
+        """
+        destination = io.BytesIO()
+        subject = self._write(resultformats.CsvResultHandler(destination, jsoncodec.get_codec("stdlib"), batch_size=3))
+        rows = self._read(destination.getvalue())
+        self.assertEqual(rows[0], ["id", "name", "valid", "joined.host", "joined.port", "flows"])
+        self.assertEqual(rows[1], ["0", u"café 0", "true", "h0", "", "[{\"port\": 80}]"])
+        self.assertEqual(rows[2][2], "false")
+        self.assertEqual(rows[8], ["7", "", "", "", "", ""])
+        self.assertEqual(subject.ignored_fields, set(["late"]))
+
+    def test_columns(self):
+        """Columns can be specified up front, and values are formatted for CSV
+        """
+        destination = io.BytesIO()
+        subject = resultformats.CsvResultHandler(destination, columns=["when", "id"])
+        subject({"id":1, "when":datetime.date(2017, 1, 2)}, None)
+        subject.flush()
+        self.assertEqual(self._read(destination.getvalue()), [["when", "id"], ["2017-01-02", "1"]])
+
+    def test_compression(self):
+        """Output files can be compressed
+        """
+        filename = os.path.join(self._directory, "results.csv.gz")
+        self._write(resultformats.CsvResultHandler(filename, compression="gzip"))
+        with gzip.open(filename, "rb") as compressed_file:
+            rows = self._read(compressed_file.read())
+
+        self.assertEqual(len(rows), 9)
+        self.assertEqual(rows[7][0], "6")
+
+@unittest.skipUnless(arrowrecord.available(), "pyarrow isn't installed")
+class TestParquetResultHandler(TabularTestCase):
+    """Tests ParquetResultHandler class
+    """
+
+    def test_write(self):
+        """Results are written a row group per batch, with column types inferred from the first batch
+        """
+        filename = os.path.join(self._directory, "results.parquet")
+        subject = self._write(resultformats.ParquetResultHandler(filename, batch_size=3, compression="zstd"))
+        parquet_file = arrowrecord.pyarrow.parquet.ParquetFile(filename)
+        self.assertEqual(parquet_file.num_row_groups, 3)
+        self.assertEqual([str(field.type) for field in parquet_file.schema_arrow], ["int64", "string", "bool", "string", "string", "string"])
+
+        rows = parquet_file.read().to_pylist()
+        self.assertEqual(rows[0]["joined.host"], "h0")
+        self.assertEqual(rows[0]["joined.port"], None)
+        self.assertEqual(rows[7]["id"], 7)
+        self.assertEqual(subject.ignored_fields, set(["late"]))
+
+    def test_errors(self):
+        """Values that don't match their column's type and unsupported compression formats raise OutputError
+        """
+        subject = resultformats.ParquetResultHandler(os.path.join(self._directory, "results.parquet"), batch_size=1)
+        subject({"id":1}, None)
+        with self.assertRaises(wqexception.OutputError):
+            subject({"id":"one"}, None)
+
+        with self.assertRaises(wqexception.OutputError):
+            resultformats.ParquetResultHandler(os.path.join(self._directory, "results.parquet"), compression="bz2")
+
+class TestSqliteResultHandler(TabularTestCase):
+    """Tests SqliteResultHandler class
+    """
+
+    def _rows(self, filename, table = "results"):
+        connection = sqlite3.connect(filename)
+        try:
+            columns = [row[1] for row in connection.execute("PRAGMA table_info({0})".format(table))]
+            return columns, connection.execute("SELECT * FROM {0}".format(table)).fetchall()
+        finally:
+            connection.close()
+
+    def test_write(self):
+        """Results are inserted in batches, and columns are added for fields that appear later
+        """
+        filename = os.path.join(self._directory, "results.db")
+        subject = self._write(resultformats.SqliteResultHandler(filename, codec=jsoncodec.get_codec("stdlib"), batch_size=3))
+        columns, rows = self._rows(filename)
+        self.assertEqual(columns, ["id", "name", "valid", "joined.host", "joined.port", "flows", "late"])
+        self.assertEqual(len(rows), 8)
+        self.assertEqual(rows[1], (1, u"café 1", 0, "h1", None, "[{\"port\": 80}]", None))
+        self.assertEqual(rows[7], (7, None, None, None, None, None, "x"))
+        self.assertEqual(subject.ignored_fields, set())
+
+    def test_existing_table(self):
+        """Results are appended to an existing table
+        """
+        filename = os.path.join(self._directory, "results.db")
+        connection = sqlite3.connect(filename)
+        connection.execute("CREATE TABLE hosts (id INTEGER, comment TEXT)")
+        connection.execute("INSERT INTO hosts VALUES (100, 'existing')")
+        connection.commit()
+        connection.close()
+
+        subject = resultformats.SqliteResultHandler(filename, table="hosts")
+        subject({"id":1, "when":datetime.datetime(2017, 1, 2, 3, 4, 5)}, None)
+        subject.flush()
+        self.assertEqual(self._rows(filename, "hosts"), (["id", "comment", "when"], [(100, "existing", None), (1, None, "2017-01-02T03:04:05")]))
+
+    def test_empty_first_batch(self):
+        """The table is created when the first column appears, if the first batch has no fields
+        """
+        filename = os.path.join(self._directory, "results.db")
+        subject = resultformats.SqliteResultHandler(filename, batch_size=1)
+        subject({}, None)
+        subject({"id":1}, None)
+        subject({"id":2, "name":"b"}, None)
+        subject.flush()
+        self.assertEqual(self._rows(filename), (["id", "name"], [(1, None), (2, "b")]))
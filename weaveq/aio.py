@@ -0,0 +1,447 @@
+# -*- coding: utf-8 -*-
+
+"""!
+@package weaveq.aio Runs queries on an asyncio event loop, using asynchronous data sources. Requires Python 3.7 or later.
+"""
+
+# Copyright 2017 James Mistry.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+from __future__ import print_function, absolute_import
+import abc
+import asyncio
+import functools
+import weakref
+
+import elasticsearch
+import elasticsearch.helpers
+
+import weaveq.query
+import weaveq.datasources
+import weaveq.filesets
+import weaveq.wqexception
+
+# The asynchronous Elasticsearch client is only available if aiohttp is installed
+_AsyncElasticsearch = getattr(elasticsearch, "AsyncElasticsearch", None)
+
+def elasticsearch_available():
+    """!
+    Determines whether or not AsyncElasticsearchDataSource can be used.
+
+    @return @c True if the asynchronous Elasticsearch client is available
+    """
+    return (_AsyncElasticsearch is not None)
+
+## Marks the end of an iterator advanced on an executor thread
+_END = object()
+
+async def _record_batches(records, batch_size = weaveq.query.BATCH_SIZE):
+    """!
+    Groups the records of an asynchronous iterable into lists.
+
+    @param records object: asynchronous iterable producing records
+    @param batch_size int: maximum number of records in each list
+
+    @return an asynchronous generator iterator producing lists of records
+    """
+    batch = []
+    async for record in records:
+        batch.append(record)
+        if (len(batch) >= batch_size):
+            yield batch
+            batch = []
+
+    if (len(batch) > 0):
+        yield batch
+
+async def _prefetch(batches):
+    """!
+    Requests each item of an asynchronous iterator before the previous one is processed, so that waiting for the next page of a data source's records overlaps with processing the current one. The request only makes progress while the event loop runs, so the consumer must process items without blocking the loop (AsyncWeaveQ filters them on an executor thread).
+
+    @param batches object: asynchronous iterator
+
+    @return an asynchronous generator iterator producing the iterator's items
+    """
+    next_batch = asyncio.ensure_future(batches.__anext__())
+    try:
+        while True:
+            try:
+                batch = await next_batch
+            except StopAsyncIteration:
+                return
+
+            next_batch = asyncio.ensure_future(batches.__anext__())
+            yield batch
+    finally:
+        next_batch.cancel()
+
+class AsyncDataSource(object):
+    """!
+    Abstract asynchronous data source. The asynchronous counterpart of weaveq.query.DataSource, for use with AsyncWeaveQ.
+
+    Like weaveq.query.DataSource, asynchronous data sources may also implement @c prepare(plan), which is called synchronously. They may implement the coroutine @c lookup(key_values), which returns an asynchronous iterable of the records containing the key values, or @c None, and the asynchronous generator @c stream_batches(batch_size), which produces lists of records.
+    """
+
+    __metaclass__ = abc.ABCMeta
+
+    @abc.abstractmethod
+    async def batch(self):
+        """!
+        Loads all relevant data in one go.
+
+        @return a list of records
+        """
+        pass
+
+    @abc.abstractmethod
+    def stream(self):
+        """!
+        Delivers data a record at a time, typically implemented as an asynchronous generator (@c async @c def with @c yield).
+
+        @return an asynchronous iterator producing records
+        """
+        pass
+
+class ThreadedDataSource(AsyncDataSource):
+    """!
+    Adapts a synchronous weaveq.query.DataSource (such as a file data source from weaveq.datasources) for use with AsyncWeaveQ. Each of its blocking calls, including each advance of its iterators, is run on an executor thread, so the event loop is never blocked.
+    """
+
+    def __init__(self, data_source, executor = None):
+        """!
+        Constructor.
+
+        @param data_source weaveq.query.DataSource: the data source to adapt
+        @param executor concurrent.futures.Executor: executor on which to run the data source's calls, or @c None for the event loop's default executor
+        """
+
+        ## @var data_source
+        # The adapted data source
+        self.data_source = data_source
+
+        ## @var executor
+        # Executor on which to run the data source's calls, or @c None for the event loop's default executor
+        self.executor = executor
+
+    async def _call(self, function, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, functools.partial(function, *args))
+
+    async def _iterate(self, iterator):
+        while True:
+            item = await self._call(next, iterator, _END)
+            if (item is _END):
+                return
+
+            yield item
+
+    async def _records(self, iterator):
+        async for batch in self._iterate(weaveq.query.record_batches(iterator)):
+            for record in batch:
+                yield record
+
+    def prepare(self, plan):
+        """!
+        @see weaveq.query.DataSource
+        """
+        if (hasattr(self.data_source, "prepare")):
+            self.data_source.prepare(plan)
+
+    async def lookup(self, key_values):
+        """!
+        @see weaveq.query.DataSource
+        """
+        if (not hasattr(self.data_source, "lookup")):
+            return None
+
+        records = await self._call(self.data_source.lookup, key_values)
+        if (records is None):
+            return None
+
+        return self._records(iter(records))
+
+    async def batch(self):
+        """!
+        @see AsyncDataSource
+        """
+        return await self._call(self.data_source.batch)
+
+    async def stream(self):
+        """!
+        @see AsyncDataSource
+        """
+        async for batch in self.stream_batches(weaveq.query.BATCH_SIZE):
+            for record in batch:
+                yield record
+
+    async def stream_batches(self, batch_size):
+        """!
+        @see weaveq.query.DataSource
+        """
+        if (hasattr(self.data_source, "stream_batches")):
+            batches = self.data_source.stream_batches(batch_size)
+        else:
+            batches = weaveq.query.record_batches(self.data_source.stream(), batch_size)
+
+        async for batch in self._iterate(iter(batches)):
+            yield batch
+
+## Asynchronous Elasticsearch clients shared by data sources, for each event loop, keyed by normalised connection configuration
+_elastic_clients = weakref.WeakKeyDictionary()
+
+def _elasticsearch_client(client_config):
+    """!
+    Gets the asynchronous Elasticsearch client for a connection configuration on the running event loop, creating it if it doesn't already exist (see weaveq.datasources.elasticsearch_client()).
+
+    @param client_config dict: keyword arguments to pass to the elasticsearch.AsyncElasticsearch constructor
+
+    @return the elasticsearch.AsyncElasticsearch object
+    """
+    clients = _elastic_clients.setdefault(asyncio.get_running_loop(), {})
+    key = weaveq.datasources._client_key(client_config)
+    if (key not in clients):
+        clients[key] = _AsyncElasticsearch(**client_config)
+
+    return clients[key]
+
+async def close_elasticsearch_clients():
+    """!
+    Closes the asynchronous Elasticsearch clients created on the running event loop. Call this before the loop is closed.
+    """
+    clients = _elastic_clients.pop(asyncio.get_running_loop(), {})
+    for client in clients.values():
+        await client.close()
+
+class AsyncElasticsearchDataSource(weaveq.datasources.ElasticsearchDataSource, AsyncDataSource):
+    """!
+    Asynchronous data source for resultsets from Elasticsearch queries expressed in Query String Query syntax, using the asynchronous Elasticsearch client. Requires the @c aiohttp Python package.
+
+    Configuration is the same as for weaveq.datasources.ElasticsearchDataSource. Data sources with the same connection configuration share a client on each event loop; close them with close_elasticsearch_clients().
+    """
+
+    def __init__(self, index_name, filter_string = "*", config = None):
+        """!
+        Constructor.
+
+        @see weaveq.datasources.ElasticsearchDataSource
+        """
+        if (not elasticsearch_available()):
+            raise weaveq.wqexception.DataSourceBuildError("The asynchronous Elasticsearch data source requires the aiohttp Python package.")
+
+        # Skip the weaveq.datasources.ElasticsearchDataSource constructor, which creates a synchronous client
+        weaveq.query.DataSource.__init__(self, index_name, filter_string)
+
+        self._configure(index_name, filter_string, config)
+
+    def _sync_only(self, *args):
+        """!
+        Replaces the methods inherited from weaveq.datasources.ElasticsearchDataSource that use its synchronous client, which isn't created.
+        """
+        raise weaveq.wqexception.DataSourceError("The asynchronous Elasticsearch data source can only be queried using AsyncWeaveQ.")
+
+    _aggregatable = _sync_only
+    key_records = _sync_only
+    _pit_pages = _sync_only
+
+    async def lookup(self, key_values):
+        """!
+        Records can't be looked up by key.
+
+        @return @c None
+        """
+        return None
+
+    async def _async_aggregatable(self, client):
+        """!
+        @see weaveq.datasources.ElasticsearchDataSource._aggregatable()
+        """
+        if (self._key_fields is None):
+            return False
+
+        try:
+            indices = await client.indices.get_field_mapping(fields=",".join(self._key_fields), index=self.index_name)
+        except elasticsearch.TransportError:
+            return False
+
+        return self._aggregatable_mappings(indices)
+
+    async def _async_key_records(self, client):
+        """!
+        @see weaveq.datasources.ElasticsearchDataSource.key_records()
+        """
+        after = None
+
+        while True:
+            aggregation = (await client.search(index=self.index_name, body=self._key_search(after)))["aggregations"]["keys"]
+            for bucket in aggregation["buckets"]:
+                yield self._key_record(bucket)
+
+            after = aggregation.get("after_key")
+            if ((len(aggregation["buckets"]) == 0) or (after is None)):
+                return
+
+    async def _scan_slice(self, client, slice_id):
+        search = self._elastic_source
+        if (slice_id is not None):
+            search = search.extra(slice={"id":slice_id, "max":self.slices})
+
+        async for hit in elasticsearch.helpers.async_scan(client, query=search.to_dict(), index=self.index_name):
+            yield hit.get("_source", {})
+
+    async def _scan_slices(self, client, batch_size):
+        """!
+        Reads every slice of the scroll concurrently, delivering batches of hits through a bounded queue as each slice produces them.
+        """
+        batches = asyncio.Queue(weaveq.filesets.QUEUE_BATCHES * self.slices)
+
+        async def read_slice(slice_id):
+            try:
+                async for batch in _record_batches(self._scan_slice(client, slice_id), batch_size):
+                    await batches.put(batch)
+
+                await batches.put(None)
+            except Exception as e:
+                await batches.put(e)
+
+        tasks = [asyncio.ensure_future(read_slice(slice_id)) for slice_id in range(self.slices)]
+        try:
+            finished_count = 0
+            while (finished_count < self.slices):
+                batch = await batches.get()
+                if (batch is None):
+                    finished_count += 1
+                elif (isinstance(batch, Exception)):
+                    raise batch
+                else:
+                    yield batch
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def stream_batches(self, batch_size):
+        """!
+        @see weaveq.datasources.ElasticsearchDataSource.stream()
+        """
+        client = _elasticsearch_client(self._client_config())
+
+        if (await self._async_aggregatable(client)):
+            batches = _record_batches(self._async_key_records(client), batch_size)
+        elif (self.slices <= 1):
+            batches = _record_batches(self._scan_slice(client, None), batch_size)
+        else:
+            batches = self._scan_slices(client, batch_size)
+
+        async for batch in batches:
+            yield batch
+
+    async def stream(self):
+        """!
+        @see weaveq.datasources.ElasticsearchDataSource.stream()
+        """
+        async for batch in self.stream_batches(weaveq.query.BATCH_SIZE):
+            for record in batch:
+                yield record
+
+    async def batch(self):
+        """!
+        Retrieves every hit of the Elasticsearch query using the scroll API.
+
+        @see AsyncDataSource
+        """
+        records = []
+        async for batch in self.stream_batches(weaveq.query.BATCH_SIZE):
+            records.extend(batch)
+
+        return records
+
+class AsyncWeaveQ(weaveq.query.WeaveQ):
+    """!
+    Runs a query on an asyncio event loop. Queries are built in the same way as weaveq.query.WeaveQ queries, and their steps may use AsyncDataSource objects or synchronous weaveq.query.DataSource objects, which are run on executor threads (see ThreadedDataSource).
+
+    Each batch of a step's records is filtered and indexed on an executor thread. Meanwhile, the next batch of records is already being requested, and other tasks on the event loop (including other queries) carry on running.
+    """
+
+    def __init__(self, search):
+        """!
+        @see weaveq.query.WeaveQ
+        """
+        super(AsyncWeaveQ, self).__init__(search)
+
+        ## @var executor
+        # Executor on which to filter batches of records and run the calls of synchronous data sources, or @c None for the event loop's default executor
+        self.executor = None
+
+    def _async_source(self, data_source):
+        if (isinstance(data_source, AsyncDataSource)):
+            return data_source
+
+        return ThreadedDataSource(data_source, self.executor)
+
+    async def _execute_instruction_async(self, instr, data_source):
+        """!
+        @see weaveq.query.WeaveQ._execute_instruction()
+        """
+        batches = None
+        key_values = self._lookup_keys(instr)
+        if ((key_values is not None) and (hasattr(data_source, "lookup"))):
+            records = await data_source.lookup(key_values)
+            if (records is not None):
+                batches = _record_batches(records)
+
+        if (batches is not None):
+            pass
+        elif (instr["scroll"] and (hasattr(data_source, "stream_batches"))):
+            batches = data_source.stream_batches(weaveq.query.BATCH_SIZE)
+        elif (instr["scroll"]):
+            batches = _record_batches(data_source.stream())
+        else:
+            batches = self._list_batches(await data_source.batch())
+
+        handler = self._step_result_handler([] if (instr["conjunctions"] is None) else instr["conjunctions"])
+        filter_batch = self._batch_filter(instr, [] if (instr["conditions"] is None) else instr["conditions"].conjunctions, handler)
+        loop = asyncio.get_running_loop()
+        async for batch in _prefetch(batches):
+            # Filter on an executor thread, so that the event loop carries on requesting the next batch meanwhile
+            await loop.run_in_executor(self.executor, filter_batch, batch)
+
+        return handler.success()
+
+    async def _list_batches(self, records):
+        for batch in weaveq.query.record_batches(records):
+            yield batch
+
+    async def execute(self, stream=False):
+        """!
+        Execute the query. Runs each query step from left to right.
+
+        @param stream boolean: If @c True, the data source's @c stream() (or @c stream_batches()) method will be used to retrieve results. If @c False, the data source's @c batch() method will be used instead.
+
+        @return @c True if the query executed successfully, @c False otherwise
+        """
+        self.result = {}
+        stage_index = 0
+        for instr in self._instructions:
+            instr["scroll"] = stream
+            data_source = self._async_source(instr["q"])
+            if (hasattr(data_source, "prepare")):
+                data_source.prepare(self._plan_step(stage_index))
+
+            if (not await self._execute_instruction_async(instr, data_source)):
+                return False
+            else:
+                after_event = self._instruction_set[instr["op"]]["after"]
+                if (after_event is not None):
+                    after_event(instr)
+
+            stage_index += 1
+
+        return True
@@ -18,33 +18,670 @@
 # DEALINGS IN THE SOFTWARE.
 
 from __future__ import print_function, absolute_import
+import os
+import io
 import json
 import argparse
 import types
 import sys
+import time
+import threading
+import collections
+import multiprocessing
+import multiprocessing.pool
 import six
+import elasticsearch
 
 import weaveq.build_constants
 import weaveq.wqexception
 import weaveq.parser
 import weaveq.query
 import weaveq.datasources
+import weaveq.keyindex
+import weaveq.jsoncodec
+import weaveq.csvrecord
+import weaveq.filesets
+import weaveq.compression
+import weaveq.arrowrecord
+import weaveq.resultformats
 
 class FileOutputResultHandler(weaveq.query.ResultHandler):
-    def __init__(self, file_object):
+    def __init__(self, file_object, codec = None, passthrough = False):
         """!
         Constructor.
 
-        @param file_object string: open file object to which results should be written
+        @param file_object string: open file object to which results should be written. Results are written to its underlying binary buffer, if it has one, so that encoded results needn't be decoded to text again.
+        @param codec weaveq.jsoncodec.JsonCodec: codec with which to encode results. If @c None, the default codec is used.
+        @param passthrough boolean: if @c True, results that carry the raw JSON document from which they were decoded (such as weaveq.jsoncodec.LazyJsonRecord objects) and haven't been changed since are written as that document, without being encoded again
         """
-        self._destination = file_object
-    
+        self._codec = weaveq.jsoncodec.default_codec() if (codec is None) else codec
+        self._passthrough = passthrough
+
+        file_object.flush()
+        self._destination = getattr(file_object, "buffer", file_object)
+        self._text = isinstance(self._destination, io.TextIOBase)
+
+    def _write(self, data):
+        self._destination.write(data.decode("utf-8") if (self._text) else data)
+
     def __call__(self, result, handler_output):
-        print(json.dumps(result), file=self._destination)
+        document = None
+        if (self._passthrough and hasattr(result, "raw_document")):
+            document = result.raw_document()
+
+        if (document is None):
+            document = self._codec.encode(result)
+
+        self._write(document)
+        self._write(b"\n")
+
+    def encoder(self):
+        """!
+        @return a weaveq.jsoncodec.ResultEncoder that encodes results as this handler does, for use with write_encoded()
+        """
+        return weaveq.jsoncodec.ResultEncoder(self._codec, self._passthrough)
+
+    def write_encoded(self, documents):
+        """!
+        Writes results that have already been encoded.
+
+        @param documents list: the encoded results, as produced by the handler's encoder()
+        """
+        if (len(documents) == 0):
+            return
+
+        self._write(b"\n".join(documents) + b"\n")
+
+    def flush(self):
+        """!
+        Flushes results buffered by the output file object.
+        """
+        self._destination.flush()
 
     def success(self):
         return True
 
+class BufferedOutputResultHandler(weaveq.query.ResultHandler):
+    """!
+    Result handler that writes results as line-delimited JSON, for throughput. Results are encoded a batch at a time and written through a large buffer. Optionally, output is compressed on a background thread and divided between part files of a maximum size. Each part file is finished on its own thread while the next is being written.
+    """
+
+    ## Default number of bytes of encoded results held before they're written
+    BUFFER_SIZE = 4 * 1024 * 1024
+
+    ## Number of results encoded at a time
+    BATCH_SIZE = 1000
+
+    def __init__(self, destination, codec = None, passthrough = False, buffer_size = BUFFER_SIZE, compression = None, part_size = None):
+        """!
+        Constructor.
+
+        @param destination string or file: path to the file to write, or an open file object to which results should be written. Results are written to the file object's underlying binary buffer, if it has one.
+        @param codec weaveq.jsoncodec.JsonCodec: codec with which to encode results. If @c None, the default codec is used.
+        @param passthrough boolean: if @c True, results that carry the raw JSON document from which they were decoded are written as that document (see FileOutputResultHandler)
+        @param buffer_size int: number of bytes of encoded results to hold before writing them
+        @param compression string: name of the format in which to compress the output ("gzip", "bz2", "xz" or "zstd"), or @c None not to compress it
+        @param part_size int: if not @c None, results are written to a series of part files, each holding at most this many bytes of results before compression (unless a single result is bigger). Part files are named by inserting a hyphen and a part number before the extensions of the destination path, for example results-00000.jsonl.gz. Requires the destination to be a path.
+        """
+        if ((part_size is not None) and (not isinstance(destination, six.string_types))):
+            raise weaveq.wqexception.OutputError("Output can only be divided between part files if it's written to a file")
+
+        if (not isinstance(destination, six.string_types)):
+            destination.flush()
+            destination = getattr(destination, "buffer", destination)
+
+        self._destination = destination
+        self._codec = weaveq.jsoncodec.default_codec() if (codec is None) else codec
+        self._passthrough = passthrough
+        self._encoder = weaveq.jsoncodec.ResultEncoder(self._codec, passthrough)
+        self._buffer_size = buffer_size
+        self._compression = compression
+        self._part_size = part_size
+
+        self._batch = []
+        self._pending = []
+        self._pending_length = 0
+        self._part_length = 0
+        self._output = None
+        self._finishing = []
+
+        ## @var filenames
+        # Paths of the files written, in order
+        self.filenames = []
+
+        ## @var bytes_written
+        # Number of bytes of encoded results written, before compression
+        self.bytes_written = 0
+
+    def __call__(self, result, handler_output):
+        self._batch.append(result)
+        if (len(self._batch) >= self.BATCH_SIZE):
+            self._encode_batch()
+
+    def encoder(self):
+        """!
+        @see FileOutputResultHandler.encoder()
+        """
+        return self._encoder
+
+    def write_encoded(self, documents):
+        """!
+        @see FileOutputResultHandler.write_encoded()
+        """
+        if (len(self._batch) > 0):
+            self._encode_batch()
+
+        self._write_documents(documents)
+
+    def _encode_batch(self):
+        encode = self._encoder if (self._passthrough) else self._codec.encode
+        documents = [encode(result) for result in self._batch]
+        self._batch = []
+        self._write_documents(documents)
+
+    def _write_documents(self, documents):
+        while (len(documents) > 0):
+            data = b"\n".join(documents) + b"\n"
+            if ((self._part_size is None) or (self._part_length + len(data) <= self._part_size)):
+                self._add(data)
+                return
+
+            # Fill the current part with as many results as fit, and start another
+            room = self._part_size - self._part_length
+            count = 0
+            length = 0
+            for document in documents:
+                length += len(document) + 1
+                if (length > room):
+                    break
+
+                count += 1
+
+            if ((count == 0) and (self._part_length == 0)):
+                count = 1
+
+            if (count > 0):
+                self._add(b"\n".join(documents[:count]) + b"\n")
+
+            self._next_part()
+            documents = documents[count:]
+
+    def _add(self, data):
+        self._pending.append(data)
+        self._pending_length += len(data)
+        self._part_length += len(data)
+        if (self._pending_length >= self._buffer_size):
+            self._write_pending()
+
+    def _write_pending(self):
+        if (self._output is None):
+            self._open_output()
+
+        if (self._pending_length > 0):
+            self._output.write(b"".join(self._pending))
+            self.bytes_written += self._pending_length
+
+        self._pending = []
+        self._pending_length = 0
+
+    def _part_filename(self, part):
+        directory, filename = os.path.split(self._destination)
+        name, dot, extensions = filename.partition(".")
+
+        return os.path.join(directory, "{0}-{1:05d}{2}{3}".format(name, part, dot, extensions))
+
+    def _open_output(self):
+        destination = self._destination
+        if (self._part_size is not None):
+            destination = self._part_filename(len(self.filenames))
+
+        if (isinstance(destination, six.string_types)):
+            self.filenames.append(destination)
+
+        try:
+            self._output = weaveq.compression.open_output(destination, self._compression)
+        except (OSError, IOError) as e:
+            raise weaveq.wqexception.OutputError("Couldn't open output file '{0}': {1}".format(destination, str(e)))
+
+    def _next_part(self):
+        """!
+        Writes the results waiting to be written to the current part file, and starts finishing it on its own thread.
+        """
+        self._write_pending()
+        if (hasattr(self._output, "finish")):
+            self._output.finish()
+            self._finishing.append(self._output)
+        else:
+            self._output.close()
+
+        self._output = None
+        self._part_length = 0
+
+    def flush(self):
+        """!
+        Writes all the results handled so far and finishes the output: compressed output is finalised and files opened by the handler are closed. Call this once all results have been handled.
+        """
+        if (len(self._batch) > 0):
+            self._encode_batch()
+
+        self._write_pending()
+        if (self._output is not self._destination):
+            self._output.close()
+
+        if (not isinstance(self._destination, six.string_types)):
+            self._destination.flush()
+
+        self._output = None
+        for output in self._finishing:
+            output.close()
+
+        self._finishing = []
+
+    def success(self):
+        return True
+
+class ElasticsearchResultHandler(weaveq.query.ResultHandler):
+    """!
+    Result handler that indexes results into an Elasticsearch index using bulk requests. Results are batched into requests of up to a maximum number of documents and bytes, several of which are made at once by worker threads. Items that Elasticsearch rejects because it's too busy are retried with exponential backoff.
+    """
+
+    ## HTTP status with which Elasticsearch rejects requests and items when it's too busy
+    REJECTED_STATUS = 429
+
+    ## Action line preceding each document in a bulk request body
+    INDEX_ACTION = b"{\"index\":{}}\n"
+
+    def __init__(self, client, index_name, codec = None, passthrough = False, batch_size = 1000, batch_bytes = 5242880, requests = 4, retries = 3, retry_delay = 0.5):
+        """!
+        Constructor.
+
+        @param client elasticsearch.Elasticsearch: client with which to make bulk requests
+        @param index_name string: name of the index into which results are indexed
+        @param codec weaveq.jsoncodec.JsonCodec: codec with which to encode results. If @c None, the default codec is used.
+        @param passthrough boolean: if @c True, results that carry the raw JSON document from which they were decoded are indexed as that document (see FileOutputResultHandler)
+        @param batch_size int: maximum number of results in each bulk request
+        @param batch_bytes int: maximum size of each bulk request body, in bytes. A request contains at least one result, however large.
+        @param requests int: maximum number of bulk requests in flight at once
+        @param retries int: number of times to retry rejected items (or rejected requests, or requests that couldn't be made) before giving up
+        @param retry_delay float: seconds to wait before the first retry. The delay doubles with each retry.
+        """
+        self._client = client
+        self._index_name = index_name
+        self._encoder = weaveq.jsoncodec.ResultEncoder(codec, passthrough)
+        self._batch_size = batch_size
+        self._batch_bytes = batch_bytes
+        self._requests = requests
+        self._retries = retries
+        self._retry_delay = retry_delay
+
+        self._batch = []
+        self._batch_length = 0
+        self._queue = six.moves.queue.Queue(requests)
+        self._workers = []
+        self._lock = threading.Lock()
+        self._error = None
+        self._item_error = None
+        self._started = None
+
+        ## @var indexed
+        # Number of results indexed
+        self.indexed = 0
+
+        ## @var failed
+        # Number of results that couldn't be indexed
+        self.failed = 0
+
+        ## @var retried
+        # Number of times results have been retried
+        self.retried = 0
+
+        ## @var bytes_sent
+        # Total size of the bulk request bodies sent, in bytes
+        self.bytes_sent = 0
+
+        ## @var latencies
+        # Duration of each bulk request made, in seconds
+        self.latencies = []
+
+        ## @var elapsed
+        # Seconds between the first result being handled and the last bulk request finishing
+        self.elapsed = 0.0
+
+    def __call__(self, result, handler_output):
+        self._add_document(self._encoder(result))
+
+    def encoder(self):
+        """!
+        @see FileOutputResultHandler.encoder()
+        """
+        return self._encoder
+
+    def write_encoded(self, documents):
+        """!
+        @see FileOutputResultHandler.write_encoded()
+        """
+        for document in documents:
+            self._add_document(document)
+
+    def _add_document(self, document):
+        if (self._error is not None):
+            self._raise_error()
+
+        if (self._started is None):
+            self._started = time.time()
+
+        length = len(self.INDEX_ACTION) + len(document) + 1
+        if ((len(self._batch) > 0) and (self._batch_length + length > self._batch_bytes)):
+            self._submit()
+
+        self._batch.append(document)
+        self._batch_length += length
+        if (len(self._batch) >= self._batch_size):
+            self._submit()
+
+    def _submit(self):
+        """!
+        Queues the current batch of results for a worker thread to send, starting the workers if they aren't running. Blocks while the maximum number of requests are in flight.
+        """
+        if (len(self._workers) == 0):
+            for index in range(self._requests):
+                worker = threading.Thread(target=self._send_batches)
+                worker.daemon = True
+                worker.start()
+                self._workers.append(worker)
+
+        self._queue.put(self._batch)
+        self._batch = []
+        self._batch_length = 0
+
+    def _send_batches(self):
+        while (True):
+            batch = self._queue.get()
+            try:
+                if (batch is None):
+                    return
+
+                if (self._error is None):
+                    self._send(batch)
+            except Exception as e:
+                with self._lock:
+                    if (self._error is None):
+                        self._error = e
+            finally:
+                self._queue.task_done()
+
+    def _send(self, batch):
+        """!
+        Indexes a batch of results, retrying those that are rejected.
+
+        @param batch list: encoded results
+        """
+        attempt = 0
+        while (len(batch) > 0):
+            body = b"".join([self.INDEX_ACTION + document + b"\n" for document in batch])
+            rejected = []
+            failed = 0
+            item_error = None
+
+            start = time.time()
+            try:
+                response = self._client.bulk(body=body, index=self._index_name)
+            except elasticsearch.TransportError as e:
+                if ((attempt >= self._retries) or ((not isinstance(e, elasticsearch.ConnectionError)) and (e.status_code != self.REJECTED_STATUS))):
+                    raise
+
+                rejected = batch
+            else:
+                for document, item in zip(batch, response["items"]):
+                    status = list(item.values())[0]
+                    if (status["status"] == self.REJECTED_STATUS):
+                        rejected.append(document)
+                    elif (status["status"] >= 300):
+                        failed += 1
+                        item_error = status.get("error")
+
+            latency = time.time() - start
+
+            if ((len(rejected) > 0) and (attempt >= self._retries)):
+                failed += len(rejected)
+                item_error = "rejected {0} time(s)".format(attempt + 1)
+                rejected = []
+
+            with self._lock:
+                self.latencies.append(latency)
+                self.bytes_sent += len(body)
+                self.indexed += len(batch) - len(rejected) - failed
+                self.failed += failed
+                self.retried += len(rejected)
+                if ((self._item_error is None) and (item_error is not None)):
+                    self._item_error = item_error
+
+            if (len(rejected) > 0):
+                time.sleep(self._retry_delay * (2 ** attempt))
+                attempt += 1
+
+            batch = rejected
+
+    def _raise_error(self):
+        if (self._error is not None):
+            raise weaveq.wqexception.OutputError("Couldn't index results into Elasticsearch index '{0}': {1}".format(self._index_name, str(self._error)))
+
+        if (self.failed > 0):
+            raise weaveq.wqexception.OutputError("{0} result(s) couldn't be indexed into Elasticsearch index '{1}'. First error: {2}".format(self.failed, self._index_name, json.dumps(self._item_error)))
+
+    def flush(self):
+        """!
+        Sends any results that haven't been sent yet, waits for all bulk requests to finish and stops the worker threads.
+
+        @exception weaveq.wqexception.OutputError if a bulk request failed, or results couldn't be indexed
+        """
+        if (len(self._batch) > 0):
+            self._submit()
+
+        for worker in self._workers:
+            self._queue.put(None)
+
+        for worker in self._workers:
+            worker.join()
+
+        self._workers = []
+        if (self._started is not None):
+            self.elapsed = time.time() - self._started
+
+        self._raise_error()
+
+    def report(self):
+        """!
+        Summarises the bulk requests made so far.
+
+        @return a string describing the number of results indexed and the throughput and latency of the bulk requests
+        """
+        latencies = sorted(self.latencies)
+        summary = "Indexed {0} result(s) into Elasticsearch index '{1}' using {2} bulk request(s)".format(self.indexed, self._index_name, len(latencies))
+        if (len(latencies) == 0):
+            return summary
+
+        elapsed = max(self.elapsed, 1e-6)
+        summary += " in {0:.2f}s ({1:.0f} result(s)/s, {2:.2f} MB/s). Request latency: mean {3:.0f} ms, median {4:.0f} ms, 95th percentile {5:.0f} ms, max {6:.0f} ms".format(elapsed, self.indexed / elapsed, self.bytes_sent / elapsed / 1048576.0, 1000.0 * sum(latencies) / len(latencies), 1000.0 * latencies[len(latencies) // 2], 1000.0 * latencies[min(len(latencies) - 1, (95 * len(latencies)) // 100)], 1000.0 * latencies[-1])
+        if ((self.retried > 0) or (self.failed > 0)):
+            summary += ". {0} result(s) retried, {1} failed".format(self.retried, self.failed)
+
+        return summary
+
+    def success(self):
+        return ((self._error is None) and (self.failed == 0))
+
+def _encode_chunk(encoder, chunk):
+    """!
+    Encodes a chunk of results. Run by BackgroundResultHandler's encoder workers.
+
+    @param encoder weaveq.jsoncodec.ResultEncoder: the encoder
+    @param chunk list: the results
+
+    @return a list of encoded results
+    """
+    return [encoder(result) for result in chunk]
+
+class BackgroundResultHandler(weaveq.query.ResultHandler):
+    """!
+    @brief Result handler that hands results to another result handler on a background thread.
+
+    Encoding and writing results then doesn't hold up the query, unless it falls too far behind: results are queued in chunks, and the query waits while the queue is full. Optionally, results are encoded by a pool of worker threads or processes before they're written, either in their original order or in the order in which they're encoded.
+
+    Errors raised on the background thread are raised by the next call to the handler or, at the latest, by success(), which WeaveQ calls when the query's last step has finished. They're therefore raised by WeaveQ.execute().
+    """
+
+    ## Number of results queued at a time
+    CHUNK_SIZE = 500
+
+    ## Default maximum number of chunks of results waiting to be handled
+    QUEUE_CHUNKS = 8
+
+    def __init__(self, handler, encoders = 0, processes = True, ordered = True, queue_chunks = QUEUE_CHUNKS):
+        """!
+        Constructor.
+
+        @param handler weaveq.query.ResultHandler: handler to which results are handed. To use encoder workers, it must provide encoder() and write_encoded() methods, as FileOutputResultHandler, BufferedOutputResultHandler, ElasticsearchResultHandler and the handlers in weaveq.resultformats do.
+        @param encoders int: number of workers that encode results before they're written. If 0, results are handed to the handler as they are, and it encodes them itself on the background thread.
+        @param processes boolean: if @c True, encoder workers are processes, which don't share the GIL with the query. Otherwise, they're threads.
+        @param ordered boolean: if @c False, chunks of results encoded by workers are written in the order in which they're encoded rather than the order in which the query produced them
+        @param queue_chunks int: maximum number of chunks of results waiting to be handled
+        """
+        if ((encoders > 0) and ((not hasattr(handler, "encoder")) or (not hasattr(handler, "write_encoded")))):
+            raise weaveq.wqexception.OutputError("Results can only be encoded by workers if the result handler accepts encoded results")
+
+        self._handler = handler
+        self._encoders = encoders
+        self._processes = processes
+        self._ordered = ordered
+
+        self._chunk = []
+        self._handler_output = None
+        self._queue = six.moves.queue.Queue(queue_chunks)
+        self._thread = None
+        self._pool = None
+        self._error = None
+        self._failed = False
+
+    def __call__(self, result, handler_output):
+        if (self._error is not None):
+            self._raise_error()
+
+        self._handler_output = handler_output
+        self._chunk.append(result)
+        if (len(self._chunk) >= self.CHUNK_SIZE):
+            self._put_chunk()
+
+    def _put_chunk(self):
+        if (self._thread is None):
+            if (self._encoders > 0):
+                # Worker processes are started from the query's thread, rather than forked from the background thread
+                self._pool = multiprocessing.Pool(self._encoders) if (self._processes) else multiprocessing.pool.ThreadPool(self._encoders)
+
+            self._thread = threading.Thread(target=self._handle_chunks)
+            self._thread.daemon = True
+            self._thread.start()
+
+        self._queue.put(self._chunk)
+        self._chunk = []
+
+    def _next_encoded(self, pending):
+        """!
+        Waits for a chunk of results being encoded by the workers: the oldest if results are ordered, otherwise the first to finish.
+
+        @param pending collections.deque: multiprocessing.pool.AsyncResult objects for the chunks being encoded, oldest first
+
+        @return the list of encoded results
+        """
+        if (self._ordered):
+            return pending.popleft().get()
+
+        while (True):
+            for encoded in pending:
+                if (encoded.ready()):
+                    pending.remove(encoded)
+                    return encoded.get()
+
+            pending[0].wait(0.01)
+
+    def _handle_chunks(self):
+        finished = False
+        pending = collections.deque()
+        try:
+            encoder = self._handler.encoder() if (self._pool is not None) else None
+            while (True):
+                chunk = self._queue.get()
+                if (chunk is None):
+                    finished = True
+                    break
+
+                if (self._pool is None):
+                    for result in chunk:
+                        self._handler(result, self._handler_output)
+
+                    continue
+
+                pending.append(self._pool.apply_async(_encode_chunk, (encoder, chunk)))
+                while (len(pending) >= 2 * self._encoders):
+                    self._handler.write_encoded(self._next_encoded(pending))
+
+            while (len(pending) > 0):
+                self._handler.write_encoded(self._next_encoded(pending))
+        except Exception as e:
+            self._error = e
+            # Keep taking chunks so that the query isn't blocked
+            while (not finished):
+                finished = (self._queue.get() is None)
+
+    def _finish(self):
+        """!
+        Hands the remaining results to the handler and waits for the background thread to finish.
+        """
+        if (len(self._chunk) > 0):
+            self._put_chunk()
+
+        if (self._thread is not None):
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+
+        if (self._pool is not None):
+            if (self._error is None):
+                self._pool.close()
+            else:
+                self._pool.terminate()
+
+            self._pool.join()
+            self._pool = None
+
+    def _raise_error(self):
+        error, self._error = self._error, None
+        self._failed = True
+        raise error
+
+    def flush(self):
+        """!
+        Hands the remaining results to the handler, waits for it to handle them and then flushes it, if it can be flushed.
+        """
+        self._finish()
+        if (self._error is not None):
+            self._raise_error()
+
+        if (hasattr(self._handler, "flush")):
+            self._handler.flush()
+
+    def success(self):
+        """!
+        Waits for all the results to be handled.
+
+        @return @c True if the handler has handled the results without error, @c False otherwise. Errors raised while handling results are raised.
+        """
+        self._finish()
+        if (self._error is not None):
+            self._raise_error()
+
+        return ((not self._failed) and (self._handler.success()))
+
 class Config(object):
     """!
     Loads, parses and validates an application configuration.
@@ -94,7 +731,7 @@ class Config(object):
                 raise weaveq.wqexception.ConfigurationError("'{0}' configuration item must contain a maximum of {1} element(s), but there are {2} specified (configuration file format is documented at {3})".format(item_path, max_len, len(cur_obj), weaveq.build_constants.config_doc_url))
 
     def apply_config(self, config_data):
-        self._validate_item(config_data, "data_sources", dict, 2, 2)
+        self._validate_item(config_data, "data_sources", dict, 2)
         self._validate_item(config_data, "data_sources/elasticsearch", dict)
         self._validate_item(config_data, "data_sources/elasticsearch/hosts", list, 1)
 
@@ -132,11 +769,105 @@ class Config(object):
         else:
             self._validate_item(config_data, "data_sources/elasticsearch/client_key", six.string_types)
 
+        if ("slices" in config_data["data_sources"]["elasticsearch"]):
+            self._validate_item(config_data, "data_sources/elasticsearch/slices", int)
+
+        if ("pool_size" in config_data["data_sources"]["elasticsearch"]):
+            self._validate_item(config_data, "data_sources/elasticsearch/pool_size", int)
+
+        if ("keep_alive" in config_data["data_sources"]["elasticsearch"]):
+            self._validate_item(config_data, "data_sources/elasticsearch/keep_alive", bool)
+
+        if ("page_size" in config_data["data_sources"]["elasticsearch"]):
+            self._validate_item(config_data, "data_sources/elasticsearch/page_size", int)
+
+        if ("aggregate_keys" in config_data["data_sources"]["elasticsearch"]):
+            self._validate_item(config_data, "data_sources/elasticsearch/aggregate_keys", bool)
+
+        for bulk_item in ["bulk_size", "bulk_bytes", "bulk_requests", "bulk_retries"]:
+            if (bulk_item in config_data["data_sources"]["elasticsearch"]):
+                self._validate_item(config_data, "data_sources/elasticsearch/{0}".format(bulk_item), int)
+
         self._validate_item(config_data, "data_sources/csv", dict)
         self._validate_item(config_data, "data_sources/csv/first_row_names", bool)
 
+        if ("threads" in config_data["data_sources"]["csv"]):
+            self._validate_item(config_data, "data_sources/csv/threads", int)
+
+        if ("types" in config_data["data_sources"]["csv"]):
+            self._validate_item(config_data, "data_sources/csv/types", dict)
+            for field_name, type_name in six.iteritems(config_data["data_sources"]["csv"]["types"]):
+                if (type_name not in weaveq.csvrecord.TYPE_NAMES):
+                    raise weaveq.wqexception.ConfigurationError("'data_sources/csv/types/{0}' configuration item must be one of: {1} (configuration file format is documented at {2})".format(field_name, ", ".join(weaveq.csvrecord.TYPE_NAMES), weaveq.build_constants.config_doc_url))
+
+        if ("infer_types" in config_data["data_sources"]["csv"]):
+            self._validate_item(config_data, "data_sources/csv/infer_types", int)
+
+        if ("workers" in config_data["data_sources"]["csv"]):
+            self._validate_item(config_data, "data_sources/csv/workers", int)
+
+        if ("chunk_size" in config_data["data_sources"]["csv"]):
+            self._validate_item(config_data, "data_sources/csv/chunk_size", int)
+
+        if ("json" in config_data["data_sources"]):
+            self._validate_item(config_data, "data_sources/json", dict)
+
+            if ("threads" in config_data["data_sources"]["json"]):
+                self._validate_item(config_data, "data_sources/json/threads", int)
+
+        for source_type in ["parquet", "arrow"]:
+            if (source_type in config_data["data_sources"]):
+                self._validate_item(config_data, "data_sources/{0}".format(source_type), dict)
+
+                if ("threads" in config_data["data_sources"][source_type]):
+                    self._validate_item(config_data, "data_sources/{0}/threads".format(source_type), int)
+
+        if ("json_codec" in config_data):
+            self._validate_item(config_data, "json_codec", six.string_types)
+            if (config_data["json_codec"] not in weaveq.jsoncodec.codec_names()):
+                raise weaveq.wqexception.ConfigurationError("'json_codec' configuration item must be one of: {0} (configuration file format is documented at {1})".format(", ".join(weaveq.jsoncodec.codec_names()), weaveq.build_constants.config_doc_url))
+
+        if ("json_lines" in config_data["data_sources"]):
+            self._validate_item(config_data, "data_sources/json_lines", dict)
+
+            if ("workers" in config_data["data_sources"]["json_lines"]):
+                self._validate_item(config_data, "data_sources/json_lines/workers", int)
+
+            if ("chunk_size" in config_data["data_sources"]["json_lines"]):
+                self._validate_item(config_data, "data_sources/json_lines/chunk_size", int)
+
+            if ("lazy" in config_data["data_sources"]["json_lines"]):
+                self._validate_item(config_data, "data_sources/json_lines/lazy", bool)
+
+            if ("threads" in config_data["data_sources"]["json_lines"]):
+                self._validate_item(config_data, "data_sources/json_lines/threads", int)
+
         self.config = config_data
 
+def byte_size(text):
+    """!
+    Parses a size in bytes, optionally followed by the suffix K, M or G to multiply it by 1024, 1024^2 or 1024^3. Used as an argparse argument type.
+
+    @param text string: the size
+
+    @return the number of bytes
+    """
+    multiplier = 1
+    suffixes = {"K":1024, "M":1024 ** 2, "G":1024 ** 3}
+    if ((len(text) > 0) and (text[-1].upper() in suffixes)):
+        multiplier = suffixes[text[-1].upper()]
+        text = text[:-1]
+
+    try:
+        size = int(text) * multiplier
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid size: '{0}'".format(text))
+
+    if (size < 1):
+        raise argparse.ArgumentTypeError("size must be at least 1 byte")
+
+    return size
+
 class App(object):
     """!
     Application entry point and global state.
@@ -147,6 +878,8 @@ class App(object):
         Constructor. Parses and stores application arguments, and loads the supplied configuration file.
         """
         self._output_file = None
+        self._output_index = None
+        self._output_path = None
 
         if (mock_stdin is not None):
             self._stdin = open(mock_stdin)
@@ -158,17 +891,38 @@ class App(object):
         else:
             self._stdout = sys.stdout
 
-        arg_parser = argparse.ArgumentParser(prog="weaveq", description="Runs pivot and join queries across collections of data with support for various data sources, including Elasticsearch and JSON")
-        arg_parser.add_argument("-c", "--config", help="path to the configuration file. Required if using an Elasticsearch data source. Its format is documented at {0}".format(weaveq.build_constants.config_doc_url), required=False)
-        arg_parser.add_argument("-q", "--query", help="query string to be executed", required=True)
-        arg_parser.add_argument("-o", "--output", help="path to the output file containing line-delimitted JSON query results. Omit this argument or specify - (dash) to write to stdout", required=False)
-        arg_parser.add_argument("--version", action="version", version="WeaveQ {0}".format(weaveq.build_constants.version_string))
-        
-        self._args = {}
-        if (mock_args is None):
-            self._args = vars(arg_parser.parse_args())
+        cmd_args = sys.argv[1:] if (mock_args is None) else mock_args
+
+        ## @var command
+        # The command to run: either "query" to run a query or "index" to manage sidecar key indexes
+        self.command = "query"
+        if ((len(cmd_args) > 0) and (cmd_args[0] == "index")):
+            self.command = "index"
+            cmd_args = cmd_args[1:]
+
+        arg_parser = None
+        if (self.command == "index"):
+            arg_parser = argparse.ArgumentParser(prog="weaveq index", description="Manages the sidecar key index files that allow WeaveQ to read only the relevant lines of JSON lines data sources")
+            arg_parser.add_argument("action", choices=["build"], help="index action to perform. build: (re)builds the index for the specified field(s)")
+            arg_parser.add_argument("source", help="JSON lines data source to index, in the form json_lines:/path/to/file. The path may name a directory or contain wildcards, in which case each matching file is indexed")
+            arg_parser.add_argument("-f", "--field", help="name of a field to index, in dot notation for nested fields. Specify more than once to index multiple fields", action="append", required=True)
+            arg_parser.set_defaults(config=None, query=None, output=None, passthrough=False, buffer_size=None, compression=None, part_size=None, output_thread=False, output_encoders=0, unordered_output=False, output_format="json_lines")
         else:
-            self._args = vars(arg_parser.parse_args(mock_args))
+            arg_parser = argparse.ArgumentParser(prog="weaveq", description="Runs pivot and join queries across collections of data with support for various data sources, including Elasticsearch and JSON. Run 'weaveq index --help' for help managing key indexes")
+            arg_parser.add_argument("-c", "--config", help="path to the configuration file. Required if using an Elasticsearch data source. Its format is documented at {0}".format(weaveq.build_constants.config_doc_url), required=False)
+            arg_parser.add_argument("-q", "--query", help="query string to be executed", required=True)
+            arg_parser.add_argument("-o", "--output", help="path to the output file containing line-delimitted JSON query results. Omit this argument or specify - (dash) to write to stdout. Specify elasticsearch:index_name to index the results into an Elasticsearch index instead", required=False)
+            arg_parser.add_argument("--output-format", help="format in which to write results. json_lines: line-delimited JSON. csv: CSV with a header row, flattening nested fields into columns named in dot notation. parquet: a Parquet file (requires the pyarrow package). sqlite: a table named 'results' in a SQLite database. Default = json_lines", choices=weaveq.resultformats.FORMATS, default="json_lines")
+            arg_parser.add_argument("-p", "--passthrough", help="write results read from json_lines data sources exactly as they were read, rather than encoding them again, unless they were changed by a join. Implies lazy decoding of json_lines data sources", action="store_true")
+            arg_parser.add_argument("--buffer-size", help="write results through a buffer of this many bytes, encoding them in batches. A K, M or G suffix multiplies the size by 1024, 1024^2 or 1024^3. Default = 4M if --compression or --part-size is specified", type=byte_size)
+            arg_parser.add_argument("--compression", help="compress the output file in the specified format, on a background thread", choices=sorted(weaveq.compression.WRITE_LEVELS.keys()))
+            arg_parser.add_argument("--part-size", help="divide results between part files named after the output file (for example, results-00000.jsonl), each holding at most this many bytes of results before compression. Accepts the same suffixes as --buffer-size", type=byte_size)
+            arg_parser.add_argument("--output-thread", help="encode and write results on a background thread, so that slow output doesn't hold up the query", action="store_true")
+            arg_parser.add_argument("--output-encoders", help="number of worker processes that encode results before they're written. Implies --output-thread. Default = 0", type=int, default=0)
+            arg_parser.add_argument("--unordered-output", help="write results encoded by --output-encoders workers in the order in which they're encoded, rather than the order in which the query produced them", action="store_true")
+            arg_parser.add_argument("--version", action="version", version="WeaveQ {0}".format(weaveq.build_constants.version_string))
+
+        self._args = vars(arg_parser.parse_args(cmd_args))
 
         self._config = None
         if (self._args["config"] is None):
@@ -181,7 +935,40 @@ class App(object):
                 print("Couldn't load configuration file. {1}".format(self._args["config"], str(e)), file=sys.stderr)
                 raise
 
-        if (self._args["output"] is not None):
+        if ("json_codec" in self._config):
+            weaveq.jsoncodec.set_default_codec(self._config["json_codec"])
+
+        if (self._args["passthrough"]):
+            # Only lazily-decoded records carry their raw documents
+            if (self._config["data_sources"].get("json_lines") is None):
+                self._config["data_sources"]["json_lines"] = {}
+
+            self._config["data_sources"]["json_lines"]["lazy"] = True
+
+        if ((self._args["output"] is not None) and (self._args["output"].startswith("elasticsearch:"))):
+            self._output_index = self._args["output"][len("elasticsearch:"):]
+            if (len(self._output_index) == 0):
+                raise weaveq.wqexception.ConfigurationError("No Elasticsearch index specified to write results to")
+            if (self._args["output_format"] != "json_lines"):
+                raise weaveq.wqexception.ConfigurationError("Results are indexed into Elasticsearch as JSON documents, not {0}".format(self._args["output_format"]))
+            if (self._config["data_sources"].get("elasticsearch") is None):
+                raise weaveq.wqexception.ConfigurationError("Writing results to Elasticsearch requires a configuration file containing an 'elasticsearch' data source configuration (configuration file format is documented at {0})".format(weaveq.build_constants.config_doc_url))
+        elif (self._args["output_format"] != "json_lines"):
+            self._check_table_output()
+            if ((self._args["output"] is None) or (self._args["output"] == "-")):
+                self._output_file = self._stdout
+            else:
+                # Opened by the result handler
+                self._output_path = self._args["output"]
+        elif ((self._args["part_size"] is not None) and ((self._args["output"] is None) or (self._args["output"] == "-"))):
+            raise weaveq.wqexception.ConfigurationError("Results can only be divided between part files if they're written to a file")
+        elif ((self._args["output"] is not None) and (self._buffered_output())):
+            if (self._args["output"] == "-"):
+                self._output_file = self._stdout
+            else:
+                # Opened, in binary mode, by the result handler
+                self._output_path = self._args["output"]
+        elif (self._args["output"] is not None):
             if (self._args["output"] == "-"):
                 self._output_file = self._stdout
             else:
@@ -205,7 +992,76 @@ class App(object):
         if (self._stdout is not None):
             self._stdout.close()
 
+    def _check_table_output(self):
+        """!
+        Checks that the output arguments can be used with the CSV, Parquet or SQLite output format specified, raising weaveq.wqexception.ConfigurationError if they can't.
+        """
+        output_format = self._args["output_format"]
+        for option in ["passthrough", "buffer_size", "part_size"]:
+            if (self._args[option]):
+                raise weaveq.wqexception.ConfigurationError("The --{0} option only applies to json_lines output".format(option.replace("_", "-")))
+
+        if ((output_format != "csv") and ((self._args["output"] is None) or (self._args["output"] == "-"))):
+            raise weaveq.wqexception.ConfigurationError("Results can only be written in {0} format to a file".format(output_format))
+        if ((output_format == "sqlite") and (self._args["compression"] is not None)):
+            raise weaveq.wqexception.ConfigurationError("SQLite databases can't be compressed")
+        if ((output_format == "parquet") and (self._args["compression"] is not None) and (self._args["compression"] not in weaveq.resultformats.PARQUET_COMPRESSION)):
+            raise weaveq.wqexception.ConfigurationError("Parquet files can only be compressed in {0} format".format(" or ".join(sorted(weaveq.resultformats.PARQUET_COMPRESSION.keys()))))
+        if ((output_format == "parquet") and (not weaveq.arrowrecord.available())):
+            raise weaveq.wqexception.ConfigurationError("Writing results in parquet format requires the pyarrow package")
+
+    def _buffered_output(self):
+        """!
+        @return @c True if results are to be written using a BufferedOutputResultHandler, @c False otherwise
+        """
+        return ((self._args["buffer_size"] is not None) or (self._args["compression"] is not None) or (self._args["part_size"] is not None))
+
+    def _result_handler(self):
+        """!
+        Builds the handler for the query's results, as specified by the output arguments.
+
+        @return the result handler
+        """
+        output_format = self._args["output_format"]
+        if (output_format == "csv"):
+            return weaveq.resultformats.CsvResultHandler(self._output_file if (self._output_path is None) else self._output_path, compression=self._args["compression"])
+        elif (output_format == "parquet"):
+            return weaveq.resultformats.ParquetResultHandler(self._output_path, compression=self._args["compression"])
+        elif (output_format == "sqlite"):
+            return weaveq.resultformats.SqliteResultHandler(self._output_path)
+        elif ((self._output_index is None) and (self._buffered_output())):
+            buffer_size = BufferedOutputResultHandler.BUFFER_SIZE if (self._args["buffer_size"] is None) else self._args["buffer_size"]
+            return BufferedOutputResultHandler(self._output_file if (self._output_path is None) else self._output_path, passthrough=self._args["passthrough"], buffer_size=buffer_size, compression=self._args["compression"], part_size=self._args["part_size"])
+        elif (self._output_index is None):
+            return FileOutputResultHandler(self._output_file, passthrough=self._args["passthrough"])
+
+        config = dict(self._config["data_sources"]["elasticsearch"])
+        client = weaveq.datasources.ElasticsearchDataSource.connect(config)
+
+        return ElasticsearchResultHandler(client, self._output_index, passthrough=self._args["passthrough"], batch_size=config["bulk_size"], batch_bytes=config["bulk_bytes"], requests=config["bulk_requests"], retries=config["bulk_retries"])
+
+    def _build_index(self):
+        builder = weaveq.datasources.AppDataSourceBuilder(self._config)
+        source = builder.parse_uri(self._args["source"])
+        if (source["data_source_class"] is not weaveq.datasources.JsonLinesDataSource):
+            raise weaveq.wqexception.DataSourceBuildError("Key indexes can only be built for json_lines data sources, not {0}".format(source["source_type"]))
+
+        for filename in weaveq.filesets.expand(source["uri"]):
+            index = weaveq.keyindex.KeyIndex(filename)
+            for field in self._args["field"]:
+                indexed_count = index.build(field)
+                print("Indexed field '{0}' in {1} line(s) of {2}".format(field, indexed_count, filename), file=sys.stderr)
+
     def run(self):
+        if (self.command == "index"):
+            try:
+                self._build_index()
+            except Exception as e:
+                print("Error building index. {0}".format(str(e)), file=sys.stderr)
+                raise
+
+            return
+
         builder = weaveq.datasources.AppDataSourceBuilder(self._config)
         query_compiler = weaveq.parser.TextQuery(builder)
 
@@ -215,12 +1071,24 @@ class App(object):
             print("Error compiling query. {0}".format(str(e)), file=sys.stderr)
             raise
 
-        result_handler = FileOutputResultHandler(self._output_file)
-        compiled_query.result_handler(result_handler)
+        result_handler = self._result_handler()
+        query_handler = result_handler
+        if ((self._args["output_thread"]) or (self._args["output_encoders"] > 0)):
+            query_handler = BackgroundResultHandler(result_handler, encoders=self._args["output_encoders"], ordered=(not self._args["unordered_output"]))
+
+        compiled_query.result_handler(query_handler)
 
         try:
             compiled_query.execute(stream=True)
         except Exception as e:
             print("Error running query. {0}".format(str(e)), file=sys.stderr)
             raise
+        finally:
+            try:
+                query_handler.flush()
+            finally:
+                if (self._output_index is not None):
+                    print(result_handler.report(), file=sys.stderr)
+                elif (len(getattr(result_handler, "ignored_fields", [])) > 0):
+                    print("Warning: field(s) {0} first appeared after the output's columns were chosen and weren't written".format(", ".join(sorted(result_handler.ignored_fields))), file=sys.stderr)
 
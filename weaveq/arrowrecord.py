@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+
+"""!
+@package weaveq.arrowrecord Records backed by Apache Arrow record batches, read from Parquet and Arrow IPC files.
+"""
+
+# Copyright 2017 James Mistry.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+from __future__ import print_function, absolute_import
+import bisect
+import collections
+import six
+
+try:
+    from collections.abc import MutableMapping
+except ImportError:
+    from collections import MutableMapping
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+def available():
+    """!
+    Is the pyarrow package installed?
+
+    @return @c True if it is, @c False otherwise
+    """
+    return (pyarrow is not None)
+
+class ColumnBatch(object):
+    """!
+    @brief An Arrow record batch whose columns are converted to Python values a column at a time, the first time a value in the column is read.
+
+    Columns are converted in bulk by Arrow, which costs far less per value than converting cells one at a time. Columns that are never read (such as those only needed by records that are discarded) are never converted.
+    """
+
+    def __init__(self, record_batch):
+        """!
+        Constructor.
+
+        @param record_batch pyarrow.RecordBatch: the batch
+        """
+
+        ## @var names
+        # Name of each column, in column order
+        self.names = list(record_batch.schema.names)
+
+        ## @var indexes
+        # Column index of each field, keyed by field name
+        self.indexes = dict((name, index) for index, name in enumerate(self.names))
+
+        ## @var unique
+        # Are the column names all different? Rows can only be represented by ArrowRecord objects if they are.
+        self.unique = (len(self.indexes) == len(self.names))
+
+        self._record_batch = record_batch
+        self._columns = [None] * len(self.names)
+
+    def column(self, index):
+        """!
+        Reads the values of a column.
+
+        @param index int: the column's index
+
+        @return a list of the column's values, one per row
+        """
+        values = self._columns[index]
+        if (values is None):
+            values = self._record_batch.column(index).to_pylist()
+            self._columns[index] = values
+
+        return values
+
+    def records(self):
+        """!
+        Creates a record for each row of the batch.
+
+        @return a list of ArrowRecord objects, or of dicts if column names aren't unique
+        """
+        if (not self.unique):
+            return [collections.OrderedDict(zip(self.names, [self.column(index)[row] for index in six.moves.range(len(self.names))])) for row in six.moves.range(self._record_batch.num_rows)]
+
+        return [ArrowRecord(self, row) for row in six.moves.range(self._record_batch.num_rows)]
+
+class ArrowRecord(MutableMapping):
+    """!
+    @brief A record read from a row of an Arrow record batch.
+
+    Records hold only their batch and row number, and read field values from the batch's columns (see ColumnBatch). Fields are ordered by column, and fields added to a record (such as by join steps) follow its columns in the order in which they're added.
+    """
+
+    __slots__ = ("_batch", "_row", "_extra", "_deleted")
+
+    def __init__(self, batch, row):
+        """!
+        Constructor.
+
+        @param batch ColumnBatch: the batch containing the record
+        @param row int: the record's row number within the batch
+        """
+        self._batch = batch
+        self._row = row
+        self._extra = None
+        self._deleted = None
+
+    def __getitem__(self, key):
+        if ((self._extra is not None) and (key in self._extra)):
+            return self._extra[key]
+
+        index = self._batch.indexes.get(key)
+        if ((index is None) or ((self._deleted is not None) and (key in self._deleted))):
+            raise KeyError(key)
+
+        return self._batch.column(index)[self._row]
+
+    def __contains__(self, key):
+        if ((self._extra is not None) and (key in self._extra)):
+            return True
+
+        return ((key in self._batch.indexes) and ((self._deleted is None) or (key not in self._deleted)))
+
+    def __setitem__(self, key, value):
+        if (self._extra is None):
+            self._extra = collections.OrderedDict()
+
+        self._extra[key] = value
+        if (self._deleted is not None):
+            self._deleted.discard(key)
+
+    def __delitem__(self, key):
+        if (key not in self):
+            raise KeyError(key)
+
+        if (self._extra is not None):
+            self._extra.pop(key, None)
+
+        if (key in self._batch.indexes):
+            if (self._deleted is None):
+                self._deleted = set()
+
+            self._deleted.add(key)
+
+    def __iter__(self):
+        for name in self._batch.names:
+            if ((self._deleted is None) or (name not in self._deleted)):
+                yield name
+
+        if (self._extra is not None):
+            for key in self._extra:
+                if (key not in self._batch.indexes):
+                    yield key
+
+    def __len__(self):
+        return len(list(iter(self)))
+
+    def __repr__(self):
+        return "{0}({1})".format(type(self).__name__, repr(dict(self)))
+
+def _may_contain(statistics, values):
+    """!
+    Could a Parquet column chunk contain any of a set of values, according to its statistics?
+
+    @param statistics pyarrow.parquet.Statistics: the column chunk's statistics, or @c None if it doesn't have any
+    @param values list: the values, sorted, or @c None if they can't be sorted
+
+    @return @c False if the chunk can't contain any of the values, @c True otherwise
+    """
+    if ((values is None) or (statistics is None) or (not statistics.has_min_max)):
+        return True
+
+    try:
+        position = bisect.bisect_left(values, statistics.min)
+        return ((position < len(values)) and (not (values[position] > statistics.max)))
+    except TypeError:
+        # Values of a different type to the column's can't be compared with its statistics
+        return True
+
+def parquet_row_groups(metadata, key_values):
+    """!
+    Works out which row groups of a Parquet file could contain records with any of a set of field values, using the minimum and maximum values of each column chunk recorded in the file.
+
+    @param metadata pyarrow.parquet.FileMetaData: the file's metadata
+    @param key_values list: (field name in dot notation, set of values) tuples, as passed to weaveq.query.DataSource.lookup()
+
+    @return a list of row group indexes
+    """
+    sorted_values = []
+    for field, values in key_values:
+        try:
+            # NaNs can't be sorted, and never equal the values in columns
+            sorted_values.append((field, sorted([value for value in values if (value == value)])))
+        except TypeError:
+            sorted_values.append((field, None))
+
+    row_groups = []
+    for row_group_index in six.moves.range(metadata.num_row_groups):
+        row_group = metadata.row_group(row_group_index)
+        chunks = dict((row_group.column(index).path_in_schema, row_group.column(index)) for index in six.moves.range(row_group.num_columns))
+
+        for field, values in sorted_values:
+            chunk = chunks.get(field)
+            if ((chunk is None) or _may_contain(chunk.statistics if (chunk.is_stats_set) else None, values)):
+                # Fields that aren't columns with statistics (such as lists) can't be used to rule row groups out
+                row_groups.append(row_group_index)
+                break
+
+    return row_groups
@@ -0,0 +1,287 @@
+# -*- coding: utf-8 -*-
+
+"""!
+@package weaveq.batchmatch Matching of query step records on a single equality condition, a batch of records at a time, optionally using NumPy.
+"""
+
+# Copyright 2017 James Mistry.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+from __future__ import print_function, absolute_import
+import operator
+import itertools
+import six
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+import weaveq.relations
+
+def numpy_available():
+    """!
+    Can VectorisedEqualityMatcher be used? It requires NumPy.
+
+    @return @c True if NumPy is installed, @c False otherwise
+    """
+    return (numpy is not None)
+
+def qualifies(filter_conditions):
+    """!
+    Can a step's records be matched by EqualityMatcher? Steps qualify if their conditions consist of a single equality condition whose fields use the default field proxies.
+
+    @param filter_conditions list: the step's condition groups
+
+    @return @c True if they can, @c False otherwise
+    """
+    if ((len(filter_conditions) != 1) or (len(filter_conditions[0]) != 1)):
+        return False
+
+    cond = filter_conditions[0][0]
+    return ((cond.op == weaveq.relations.F.OP_EQ) and (type(cond.lhs_proxy) is weaveq.relations.DefaultFieldProxy) and (type(cond.rhs_proxy) is weaveq.relations.DefaultFieldProxy))
+
+class EqualityMatcher(object):
+    """!
+    @brief Matches batches of a step's records against the previous step's index.
+
+    Used for steps whose conditions consist of a single equality condition (see qualifies()). The previous step's records are grouped by their key values once, in a dict. The key values of each batch of records are then read in one pass and looked up in it, without building the index keys or NestedField objects that matching a record at a time requires. Keys are compared with Python equality, exactly as they are when looked up in the index.
+    """
+
+    def __init__(self, cond, index):
+        """!
+        Constructor.
+
+        @param cond weaveq.relations.Condition: the step's equality condition
+        @param index dict: the previous step's equality index for the condition, mapping keys of the form ((0, value),) to lists of records
+        """
+        self._path = cond.right_field.split(".")
+        self._get_values = operator.itemgetter(self._path[0]) if (len(self._path) == 1) else None
+        self._groups = dict((key[0][1], records) for key, records in six.iteritems(index))
+
+    def _values(self, batch):
+        """!
+        Reads the key values of a batch of records.
+
+        @return a (positions, values) tuple: the positions in the batch of the records containing the key field, or @c None if every record contains it, and their key values
+        """
+        if (self._get_values is not None):
+            try:
+                return (None, list(map(self._get_values, batch)))
+            except (KeyError, TypeError):
+                pass
+
+        positions = []
+        values = []
+        for position in six.moves.range(len(batch)):
+            value = batch[position]
+            try:
+                for name in self._path:
+                    value = value[name]
+            except (KeyError, TypeError):
+                continue
+
+            positions.append(position)
+            values.append(value)
+
+        return (positions, values)
+
+    def select(self, batch):
+        """!
+        Selects the records in a batch whose keys match one of the previous step's keys.
+
+        @param batch list: the records
+
+        @return a list of the records selected, in their original order, or @c None if the batch can't be matched because it contains unhashable keys
+        """
+        positions, values = self._values(batch)
+        return self._select_values(batch, positions, values)
+
+    def _select_values(self, batch, positions, values):
+        """!
+        @see select()
+
+        @param positions list: as returned by @c _values()
+        @param values list: as returned by @c _values()
+        """
+        groups = self._groups
+        try:
+            if (positions is None):
+                return [record for record, value in zip(batch, values) if (value in groups)]
+
+            return [batch[position] for position, value in zip(positions, values) if (value in groups)]
+        except TypeError:
+            return None
+
+    def match(self, batch):
+        """!
+        Finds the previous step's records that match each record in a batch.
+
+        @param batch list: the records
+
+        @return a list with an element for each record: @c None if the record doesn't contain the key field, otherwise a list (possibly empty) of the previous step's matching records. Returns @c None if the batch can't be matched because it contains unhashable keys.
+        """
+        positions, values = self._values(batch)
+        return self._match_values(batch, positions, values)
+
+    def _match_values(self, batch, positions, values):
+        """!
+        @see match()
+
+        @param positions list: as returned by @c _values()
+        @param values list: as returned by @c _values()
+        """
+        get_group = self._groups.get
+        try:
+            if (positions is None):
+                return [get_group(value, ()) for value in values]
+
+            matches = [None] * len(batch)
+            for position, value in zip(positions, values):
+                matches[position] = get_group(value, ())
+
+            return matches
+        except TypeError:
+            return None
+
+class VectorisedEqualityMatcher(EqualityMatcher):
+    """!
+    @brief Matches batches of a step's records against the previous step's index using vectorised NumPy operations. Requires NumPy.
+
+    Used instead of EqualityMatcher, if asked for, when the previous step's keys are all integers that fit in 64 bits (see create_matcher()). The distinct keys are sorted into a NumPy array once, and numbered in that order. If they're dense enough, a lookup table mapping each key in their range to its number (or -1) is built too. The key values of each batch are converted to a NumPy array and their numbers found in bulk, from the lookup table or by binary search of the sorted keys with searchsorted(), which finds the matching group of every record at once.
+
+    Batches whose key values aren't all integers that fit in 64 bits are matched by EqualityMatcher instead, so the results are always the same as matching a record at a time.
+    """
+
+    ## A lookup table is built if the range of the keys is no more than this many times the number of keys, or LOOKUP_MIN_SIZE, whichever is greater
+    LOOKUP_DENSITY = 8
+
+    ## See LOOKUP_DENSITY
+    LOOKUP_MIN_SIZE = 65536
+
+    def __init__(self, cond, index):
+        """!
+        Constructor. Raises ValueError if the previous step's keys can't be matched using NumPy.
+
+        @see EqualityMatcher
+        """
+        super(VectorisedEqualityMatcher, self).__init__(cond, index)
+
+        keys = self.integer_keys(list(self._groups.keys()))
+        if (keys is None):
+            raise ValueError("The previous step's keys aren't all integers that fit in 64 bits")
+
+        keys.sort()
+        self._keys = keys
+        self._sorted_groups = [self._groups[key] for key in keys.tolist()]
+
+        self._low = keys[0]
+        self._high = keys[-1]
+        self._lookup = None
+        if ((int(self._high) - int(self._low)) < max(self.LOOKUP_DENSITY * len(keys), self.LOOKUP_MIN_SIZE)):
+            self._lookup = numpy.full(int(self._high) - int(self._low) + 1, -1, dtype=numpy.intp)
+            self._lookup[keys - self._low] = numpy.arange(len(keys))
+
+    @staticmethod
+    def integer_keys(values):
+        """!
+        Converts key values to a NumPy array of integers.
+
+        @param values list: the key values
+
+        @return the array, or @c None if the values aren't all integers that fit in 64 bits (or there aren't any)
+        """
+        if (len(values) == 0):
+            return None
+
+        try:
+            values = numpy.array(values)
+        except (OverflowError, ValueError):
+            return None
+
+        if ((values.dtype.kind != "i") or (values.ndim != 1)):
+            return None
+
+        return values
+
+    def _locate(self, values):
+        """!
+        Locates key values among the previous step's keys.
+
+        @param values list: the key values
+
+        @return an array holding, for each value, the index of the matching group in @c _sorted_groups, or -1 if there isn't one. Returns @c None if the values aren't all integers that fit in 64 bits.
+        """
+        values = self.integer_keys(values)
+        if (values is None):
+            return None
+
+        in_range = (values >= self._low) & (values <= self._high)
+        if (self._lookup is not None):
+            codes = numpy.full(len(values), -1, dtype=numpy.intp)
+            codes[in_range] = self._lookup[values[in_range] - self._low]
+            return codes
+
+        codes = numpy.searchsorted(self._keys, values)
+        codes[~in_range] = 0
+        codes[self._keys[codes] != values] = -1
+
+        return codes
+
+    def _select_values(self, batch, positions, values):
+        codes = self._locate(values)
+        if (codes is None):
+            return super(VectorisedEqualityMatcher, self)._select_values(batch, positions, values)
+
+        found = (codes >= 0)
+        if (positions is None):
+            return list(itertools.compress(batch, found.tolist()))
+
+        return [batch[positions[index]] for index in numpy.flatnonzero(found).tolist()]
+
+    def _match_values(self, batch, positions, values):
+        codes = self._locate(values)
+        if (codes is None):
+            return super(VectorisedEqualityMatcher, self)._match_values(batch, positions, values)
+
+        if (positions is None):
+            matches = [()] * len(batch)
+        else:
+            matches = [None] * len(batch)
+            for position in positions:
+                matches[position] = ()
+
+        groups = self._sorted_groups
+        found = numpy.flatnonzero(codes >= 0)
+        for index, code in zip(found.tolist(), codes[found].tolist()):
+            matches[index if (positions is None) else positions[index]] = groups[code]
+
+        return matches
+
+def create_matcher(cond, index, vectorise = False):
+    """!
+    Creates the matcher for a step that qualifies for batch matching (see qualifies()).
+
+    @param cond weaveq.relations.Condition: the step's equality condition
+    @param index dict: the previous step's equality index for the condition (see EqualityMatcher)
+    @param vectorise boolean: if @c True, a VectorisedEqualityMatcher is created if NumPy is installed and the previous step's keys are all integers that fit in 64 bits
+
+    @return an EqualityMatcher or VectorisedEqualityMatcher object
+    """
+    if ((vectorise) and (numpy_available())):
+        try:
+            return VectorisedEqualityMatcher(cond, index)
+        except ValueError:
+            pass
+
+    return EqualityMatcher(cond, index)
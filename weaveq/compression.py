@@ -0,0 +1,358 @@
+# -*- coding: utf-8 -*-
+
+"""!
+@package weaveq.compression Transparent, streaming decompression of data source files, and compression of output files.
+"""
+
+# Copyright 2017 James Mistry.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+from __future__ import print_function, absolute_import
+import io
+import sys
+import gzip
+import bz2
+import threading
+import six
+
+import weaveq.wqexception
+
+## Size of the blocks read from files and decompressed ahead of the reader
+BLOCK_SIZE = 1024 * 1024
+
+## Maximum number of decompressed blocks to hold ahead of the reader
+READ_AHEAD_BLOCKS = 4
+
+## Maximum number of blocks to hold behind the writer, waiting to be compressed
+WRITE_BEHIND_BLOCKS = 4
+
+## Compression level used by each supported compression format when writing
+WRITE_LEVELS = {"gzip":6, "bz2":9, "xz":6, "zstd":3}
+
+## Leading bytes identifying each supported compression format
+MAGIC_BYTES = [("gzip", b"\x1f\x8b"), ("bz2", b"BZh"), ("xz", b"\xfd7zXZ\x00"), ("zstd", b"\x28\xb5\x2f\xfd")]
+
+## File extensions identifying each supported compression format
+EXTENSIONS = [("gzip", ".gz"), ("bz2", ".bz2"), ("xz", ".xz"), ("zstd", ".zst")]
+
+def detect(filename):
+    """!
+    Works out how a file is compressed, from its leading bytes or, failing that, its extension.
+
+    @param filename string: path to the file
+
+    @return the name of the compression format ("gzip", "bz2", "xz" or "zstd"), or @c None if the file isn't compressed
+    """
+    with open(filename, "rb") as source_file:
+        leading_bytes = source_file.read(6)
+
+    for name, magic in MAGIC_BYTES:
+        if (leading_bytes.startswith(magic)):
+            return name
+
+    if (len(leading_bytes) == 0):
+        # Empty files can't be identified by content
+        for name, extension in EXTENSIONS:
+            if (filename.lower().endswith(extension)):
+                return name
+
+    return None
+
+def _open_decompressor(filename, compression):
+    if (compression == "gzip"):
+        return gzip.open(filename, "rb")
+    elif (compression == "bz2"):
+        return bz2.BZ2File(filename, "rb")
+    elif (compression == "xz"):
+        try:
+            import lzma
+        except ImportError:
+            raise weaveq.wqexception.DataSourceError("Can't read {0}: xz decompression requires Python 3.3 or later".format(filename))
+
+        return lzma.open(filename, "rb")
+    elif (compression == "zstd"):
+        try:
+            import zstandard
+        except ImportError:
+            raise weaveq.wqexception.DataSourceError("Can't read {0}: zstd decompression requires the zstandard package".format(filename))
+
+        return zstandard.ZstdDecompressor().stream_reader(open(filename, "rb"), read_size=BLOCK_SIZE, closefd=True)
+
+    raise weaveq.wqexception.DataSourceError("Can't read {0}: unsupported compression format {1}".format(filename, compression))
+
+class ReadAheadReader(io.RawIOBase):
+    """!
+    @brief Reads blocks from a file object on a background thread, ahead of the reader.
+
+    Used to decompress files while the data already decompressed is being parsed. The decompression libraries release the GIL while they work, so the two genuinely overlap.
+    """
+
+    def __init__(self, source, block_size = BLOCK_SIZE, blocks = READ_AHEAD_BLOCKS):
+        """!
+        Constructor. Starts the background thread.
+
+        @param source file: binary file object to read from. It's closed when the reader is closed.
+        @param block_size int: number of bytes to read from the source at a time
+        @param blocks int: maximum number of blocks to hold ahead of the reader
+        """
+        super(ReadAheadReader, self).__init__()
+
+        self._source = source
+        self._block_size = block_size
+        self._blocks = six.moves.queue.Queue(blocks)
+        self._current = b""
+        self._current_offset = 0
+        self._finished = False
+        self._stopping = threading.Event()
+
+        self._thread = threading.Thread(target=self._read_ahead)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _put(self, item):
+        # Give up if the reader is closed while the queue is full
+        while (not self._stopping.is_set()):
+            try:
+                self._blocks.put(item, timeout=0.1)
+                return True
+            except six.moves.queue.Full:
+                pass
+
+        return False
+
+    def _read_ahead(self):
+        try:
+            while (not self._stopping.is_set()):
+                block = self._source.read(self._block_size)
+                if (not self._put(block)):
+                    return
+
+                if (len(block) == 0):
+                    return
+        except Exception as e:
+            self._put(e)
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer_object):
+        """!
+        Reads decompressed data into a buffer.
+
+        @param buffer_object bytearray: the buffer to fill
+
+        @return the number of bytes read, which is 0 at the end of the file
+        """
+        while (self._current_offset >= len(self._current)):
+            if (self._finished):
+                return 0
+
+            block = self._blocks.get()
+            if (isinstance(block, Exception)):
+                self._finished = True
+                raise block
+
+            if (len(block) == 0):
+                self._finished = True
+                return 0
+
+            self._current = block
+            self._current_offset = 0
+
+        count = min(len(buffer_object), len(self._current) - self._current_offset)
+        buffer_object[0:count] = self._current[self._current_offset:self._current_offset + count]
+        self._current_offset += count
+
+        return count
+
+    def close(self):
+        """!
+        Stops the background thread and closes the source file object.
+        """
+        if (not self.closed):
+            self._stopping.set()
+            self._thread.join()
+            self._source.close()
+
+        super(ReadAheadReader, self).close()
+
+def open_file(filename, text = False, read_ahead = True):
+    """!
+    Opens a data source file for reading, decompressing it if it's compressed.
+
+    @param filename string: path to the file
+    @param text boolean: if @c True, the file is opened for reading UTF-8 text in a form suitable for the csv module. Otherwise, it's opened for reading bytes.
+    @param read_ahead boolean: if @c True, compressed files are decompressed on a background thread, ahead of the reader
+
+    @return a file object
+    """
+    compression = detect(filename)
+    if (compression is None):
+        if (text and (sys.version_info.major >= 3)):
+            return io.open(filename, "r", encoding="utf-8", newline="")
+
+        return io.open(filename, "rb", buffering=BLOCK_SIZE)
+
+    binary_file = _open_decompressor(filename, compression)
+    if (read_ahead):
+        binary_file = io.BufferedReader(ReadAheadReader(binary_file), BLOCK_SIZE)
+
+    if (text and (sys.version_info.major >= 3)):
+        return io.TextIOWrapper(binary_file, encoding="utf-8", newline="")
+
+    return binary_file
+
+def _open_compressor(destination, compression):
+    """!
+    Opens a compressing file object.
+
+    @param destination string or file: path to the file to write, or a binary file object to write to. File objects aren't closed when the compressing file object is closed.
+    @param compression string: name of the compression format
+
+    @return a binary file object
+    """
+    description = destination if (isinstance(destination, six.string_types)) else "output"
+    level = WRITE_LEVELS.get(compression)
+    if (compression == "gzip"):
+        if (isinstance(destination, six.string_types)):
+            return gzip.GzipFile(destination, "wb", compresslevel=level)
+
+        return gzip.GzipFile(fileobj=destination, mode="wb", compresslevel=level)
+    elif (compression == "bz2"):
+        if ((not isinstance(destination, six.string_types)) and (sys.version_info.major < 3)):
+            raise weaveq.wqexception.OutputError("Can't write {0}: bz2 compression of file objects requires Python 3".format(description))
+
+        return bz2.BZ2File(destination, "wb", compresslevel=level)
+    elif (compression == "xz"):
+        try:
+            import lzma
+        except ImportError:
+            raise weaveq.wqexception.OutputError("Can't write {0}: xz compression requires Python 3.3 or later".format(description))
+
+        return lzma.LZMAFile(destination, "wb", preset=level)
+    elif (compression == "zstd"):
+        try:
+            import zstandard
+        except ImportError:
+            raise weaveq.wqexception.OutputError("Can't write {0}: zstd compression requires the zstandard package".format(description))
+
+        if (isinstance(destination, six.string_types)):
+            return zstandard.ZstdCompressor(level=level).stream_writer(open(destination, "wb"), write_size=BLOCK_SIZE, closefd=True)
+
+        return zstandard.ZstdCompressor(level=level).stream_writer(destination, write_size=BLOCK_SIZE, closefd=False)
+
+    raise weaveq.wqexception.OutputError("Can't write {0}: unsupported compression format {1}".format(description, compression))
+
+class WriteBehindWriter(io.RawIOBase):
+    """!
+    @brief Writes blocks to a file object on a background thread, behind the writer.
+
+    Used to compress output while the next block of output is being encoded. The compression libraries release the GIL while they work, so the two genuinely overlap. The counterpart of ReadAheadReader.
+    """
+
+    def __init__(self, destination, blocks = WRITE_BEHIND_BLOCKS):
+        """!
+        Constructor. Starts the background thread.
+
+        @param destination file: binary file object to write to. It's closed when the writer is closed.
+        @param blocks int: maximum number of blocks to hold behind the writer
+        """
+        super(WriteBehindWriter, self).__init__()
+
+        self._destination = destination
+        self._blocks = six.moves.queue.Queue(blocks)
+        self._error = None
+        self._finishing = False
+
+        self._thread = threading.Thread(target=self._write_behind)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _write_behind(self):
+        try:
+            while (True):
+                block = self._blocks.get()
+                if (block is None):
+                    break
+
+                if (self._error is None):
+                    self._destination.write(block)
+
+            self._destination.close()
+        except Exception as e:
+            self._error = e
+            # Keep taking blocks so that the writer isn't blocked
+            while (block is not None):
+                block = self._blocks.get()
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        """!
+        Queues data to be written, blocking while the maximum number of blocks are waiting to be written.
+
+        @param data bytes: the data to write
+
+        @return the number of bytes queued
+        """
+        if (self._error is not None):
+            raise self._error
+
+        self._blocks.put(bytes(data))
+
+        return len(data)
+
+    def finish(self):
+        """!
+        Starts closing the writer: the background thread writes the blocks still waiting and closes the destination file object, without the caller waiting for it. Call close() to wait.
+        """
+        if (not self._finishing):
+            self._finishing = True
+            self._blocks.put(None)
+
+    def close(self):
+        """!
+        Waits for the blocks still waiting to be written, and closes the destination file object.
+        """
+        if (not self.closed):
+            self.finish()
+            self._thread.join()
+
+        super(WriteBehindWriter, self).close()
+
+        error, self._error = self._error, None
+        if (error is not None):
+            raise error
+
+def open_output(destination, compression = None, write_behind = True):
+    """!
+    Opens an output file for writing, compressing what's written to it if a compression format is specified.
+
+    @param destination string or file: path to the file to write, or a binary file object to write to. File objects aren't closed when the returned file object is closed.
+    @param compression string: name of the compression format ("gzip", "bz2", "xz" or "zstd"), or @c None not to compress the output
+    @param write_behind boolean: if @c True, output is compressed on a background thread, behind the writer
+
+    @return a binary file object
+    """
+    if (compression is None):
+        if (isinstance(destination, six.string_types)):
+            return io.open(destination, "wb", buffering=BLOCK_SIZE)
+
+        return destination
+
+    binary_file = _open_compressor(destination, compression)
+    if (write_behind):
+        binary_file = WriteBehindWriter(binary_file)
+
+    return binary_file
@@ -0,0 +1,314 @@
+# -*- coding: utf-8 -*-
+
+"""!
+@package weaveq.csvrecord Compact records for rows read from CSV files.
+"""
+
+# Copyright 2017 James Mistry.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+from __future__ import print_function, absolute_import
+import collections
+import six
+
+try:
+    from collections.abc import MutableMapping
+except ImportError:
+    from collections import MutableMapping
+
+## Stands in for the values of columns that have been deleted from a row
+_DELETED = object()
+
+## Names of the types to which column values can be converted
+TYPE_NAMES = ["string", "integer", "float", "boolean"]
+
+## Cell text representing each boolean value
+_BOOLEAN_TEXT = {u"true":True, u"yes":True, u"1":True, u"false":False, u"no":False, u"0":False}
+
+def _to_boolean(text):
+    try:
+        return _BOOLEAN_TEXT[text.strip().lower()]
+    except KeyError:
+        raise ValueError("invalid boolean: {0}".format(text))
+
+## Function converting cell text to each type, or @c None if no conversion is required
+_CONVERTERS = {"string":None, "integer":int, "float":float, "boolean":_to_boolean}
+
+def infer_type(cells):
+    """!
+    Works out the most specific type that can represent a sample of the values of a column.
+
+    Booleans are never inferred, since columns of 1s and 0s are more likely to be numbers.
+
+    @param cells list: cell text sampled from the column. Empty cells are ignored.
+
+    @return the name of the type: "integer", "float" or "string"
+    """
+    cells = [cell for cell in cells if (len(cell) > 0)]
+    if (len(cells) == 0):
+        return "string"
+
+    for type_name in ["integer", "float"]:
+        try:
+            for cell in cells:
+                _CONVERTERS[type_name](cell)
+        except ValueError:
+            continue
+
+        return type_name
+
+    return "string"
+
+class CsvSchema(object):
+    """!
+    @brief The field names of the columns of a CSV file, shared by all the rows read from it.
+    """
+
+    def __init__(self, field_names):
+        """!
+        Constructor.
+
+        @param field_names list: names of the fields represented by each column, in column order. Columns beyond the last named column are named automatically (see field_name()).
+        """
+
+        ## @var names
+        # Field name of each column, in column order
+        self.names = list(field_names)
+
+        ## @var indexes
+        # Column index of each field, keyed by field name
+        self.indexes = dict((name, index) for index, name in enumerate(self.names))
+
+        ## @var unique
+        # Are the field names all different? Rows can only be represented by CsvRow objects if they are.
+        self.unique = (len(self.indexes) == len(self.names))
+
+    @staticmethod
+    def field_name(column_index):
+        """!
+        Generates the name of an unnamed column.
+
+        @param column_index int: 0-based index of the column
+
+        @return the field name, in the form column_N where N is the 1-based index of the column
+        """
+        return u"column_{0}".format(column_index + 1)
+
+    def extend(self, column_count):
+        """!
+        Names any columns up to a given count that aren't yet named.
+
+        @param column_count int: number of columns that must be named
+        """
+        while (len(self.names) < column_count):
+            name = self.field_name(len(self.names))
+            if (name in self.indexes):
+                self.unique = False
+            else:
+                self.indexes[name] = len(self.names)
+
+            self.names.append(name)
+
+class CsvRow(MutableMapping):
+    """!
+    @brief A record read from a row of a CSV file.
+
+    Rows hold only their cell values. Field names are looked up in a CsvSchema shared by every row read from the same file, which takes a fraction of the memory of a dict per row. Fields are ordered by column, and fields added to a row (such as by join steps) follow its columns in the order in which they're added.
+    """
+
+    __slots__ = ("_schema", "_values", "_extra")
+
+    def __init__(self, schema, values):
+        """!
+        Constructor.
+
+        @param schema CsvSchema: names of the row's columns, which must include a name for every value
+        @param values list: the cell values of the row, in column order. The list is used by the row, not copied.
+        """
+        self._schema = schema
+        self._values = values
+        self._extra = None
+
+    def __getitem__(self, key):
+        index = self._schema.indexes.get(key)
+        if ((index is not None) and (index < len(self._values))):
+            value = self._values[index]
+            if (value is not _DELETED):
+                return value
+        elif (self._extra is not None):
+            return self._extra[key]
+
+        raise KeyError(key)
+
+    def __contains__(self, key):
+        index = self._schema.indexes.get(key)
+        if ((index is not None) and (index < len(self._values))):
+            return (self._values[index] is not _DELETED)
+
+        return ((self._extra is not None) and (key in self._extra))
+
+    def __setitem__(self, key, value):
+        index = self._schema.indexes.get(key)
+        if ((index is not None) and (index < len(self._values))):
+            self._values[index] = value
+        else:
+            if (self._extra is None):
+                self._extra = collections.OrderedDict()
+
+            self._extra[key] = value
+
+    def __delitem__(self, key):
+        if (key not in self):
+            raise KeyError(key)
+
+        index = self._schema.indexes.get(key)
+        if ((index is not None) and (index < len(self._values))):
+            self._values[index] = _DELETED
+        else:
+            del self._extra[key]
+
+    def __iter__(self):
+        names = self._schema.names
+        for index in six.moves.range(len(self._values)):
+            if (self._values[index] is not _DELETED):
+                yield names[index]
+
+        if (self._extra is not None):
+            for key in self._extra:
+                yield key
+
+    def __len__(self):
+        count = len(self._values) - self._values.count(_DELETED)
+        if (self._extra is not None):
+            count += len(self._extra)
+
+        return count
+
+    def __reduce__(self):
+        if (self._values.count(_DELETED) == 0):
+            # Rows pickled together share their schema
+            return (_unpickle_row, (self._schema, self._values, self._extra))
+
+        columns = [index for index in six.moves.range(len(self._values)) if (self._values[index] is not _DELETED)]
+        return (_unpickle_row, (CsvSchema([self._schema.names[index] for index in columns]), [self._values[index] for index in columns], self._extra))
+
+    def __repr__(self):
+        return "{0}({1})".format(type(self).__name__, repr(dict(self)))
+
+def _unpickle_row(schema, values, extra):
+    row = CsvRow(schema, values)
+    row._extra = extra
+    return row
+
+class RowBuilder(object):
+    """!
+    @brief Builds records from the rows of a CSV file, keeping only the fields required and converting their values to the types configured.
+
+    Cells of columns that aren't kept are discarded as soon as the row has been parsed, so the records read from wide files only hold the fields used. Empty cells in columns that are converted to a type other than "string" become @c None.
+    """
+
+    def __init__(self, field_names, fields = None, types = None):
+        """!
+        Constructor.
+
+        @param field_names list: names of the fields represented by each column, in column order. Columns beyond the last named column are named automatically (see CsvSchema.field_name()).
+        @param fields set: names of the fields to keep, or @c None to keep them all
+        @param types dict: name of the type (see TYPE_NAMES) of each field to convert, keyed by field name. Cells that can't be converted raise a ValueError.
+        """
+        self._schema = CsvSchema(field_names)
+        self._fields = fields
+        self._types = {} if (types is None) else dict(types)
+        self._lenient = set()
+        self._update()
+
+    def infer(self, rows):
+        """!
+        Converts the values of fields that don't have configured types to the types inferred from a sample of rows (see infer_type()). Cells that can't be converted to an inferred type, such as those in rows after the sample, are left as text.
+
+        @param rows list: rows from the file, as lists of cell text
+        """
+        for row in rows:
+            if (len(row) > len(self._schema.names)):
+                self._schema.extend(len(row))
+
+        for column_index in self._columns():
+            name = self._schema.names[column_index]
+            if (name not in self._types):
+                type_name = infer_type([row[column_index] for row in rows if (column_index < len(row))])
+                if (type_name != "string"):
+                    self._types[name] = type_name
+                    self._lenient.add(name)
+
+        self._update()
+
+    def _columns(self):
+        if (self._fields is None):
+            return list(six.moves.range(len(self._schema.names)))
+
+        return [column_index for column_index in six.moves.range(len(self._schema.names)) if (self._schema.names[column_index] in self._fields)]
+
+    def _update(self):
+        # Works out which columns to keep and how to convert them, following a change to the columns or types
+        self._column_count = len(self._schema.names)
+        if (self._fields is None):
+            self._kept = None
+            self._record_schema = self._schema
+        else:
+            self._kept = self._columns()
+            self._record_schema = CsvSchema([self._schema.names[column_index] for column_index in self._kept])
+
+        self._converters = []
+        position = 0
+        for name in self._record_schema.names:
+            converter = _CONVERTERS[self._types.get(name, "string")]
+            if (converter is not None):
+                self._converters.append((position, name, converter, (name in self._lenient)))
+
+            position += 1
+
+    def build(self, row):
+        """!
+        Builds a record from a row.
+
+        @param row list: the row's cell text, in column order. The list may be modified.
+
+        @return a CsvRow object, or an OrderedDict if field names aren't unique
+        """
+        if (len(row) > self._column_count):
+            self._schema.extend(len(row))
+            self._update()
+
+        if (self._kept is None):
+            values = row
+        elif (len(row) == self._column_count):
+            values = [row[column_index] for column_index in self._kept]
+        else:
+            values = [row[column_index] for column_index in self._kept if (column_index < len(row))]
+
+        for position, name, converter, lenient in self._converters:
+            if (position < len(values)):
+                cell = values[position]
+                if (len(cell) == 0):
+                    values[position] = None
+                else:
+                    try:
+                        values[position] = converter(cell)
+                    except ValueError:
+                        if (not lenient):
+                            raise ValueError("The value of field {0} isn't of type {1}: {2}".format(name, self._types[name], cell))
+
+        if (self._record_schema.unique):
+            return CsvRow(self._record_schema, values)
+
+        # Rows can't share field names that aren't unique, so represent them as they would be if each cell was added to a dict in turn
+        return collections.OrderedDict(zip(self._record_schema.names, values))
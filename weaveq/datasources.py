@@ -19,17 +19,34 @@
 
 from __future__ import print_function, absolute_import
 import inspect
+import os
 import sys
 import abc
-import json
 import csv
+import sqlite3
+import threading
+import itertools
 import collections
 import elasticsearch
+import elasticsearch.helpers
 import elasticsearch_dsl
 import six
 
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+
 import weaveq.parser
 import weaveq.query
+import weaveq.keyindex
+import weaveq.parallel
+import weaveq.jsoncodec
+import weaveq.jsonstream
+import weaveq.compression
+import weaveq.csvrecord
+import weaveq.arrowrecord
+import weaveq.filesets
 import weaveq.wqexception
 
 class DiscoverableDataSource(object):
@@ -38,27 +55,150 @@ class DiscoverableDataSource(object):
     """
     pass
 
+def _validate_threads_config(source_type, config):
+    """!
+    Validates the threads configuration item common to file data sources, applying its default.
+
+    @param source_type string: data source type ident, for use in error messages
+    @param config dict: the data source configuration
+    """
+    if ("threads" not in config):
+        config["threads"] = 1
+    elif ((not isinstance(config["threads"], six.integer_types)) or (isinstance(config["threads"], bool)) or (config["threads"] < 1)):
+        raise weaveq.wqexception.DataSourceBuildError("The {0} data source 'threads' configuration item must be an integer >= 1.".format(source_type))
+
+def _validate_chunks_config(source_type, config):
+    """!
+    Validates the configuration items common to file data sources that can split files into chunks for worker processes to decode, applying their defaults.
+
+    @param source_type string: data source type ident, for use in error messages
+    @param config dict: the data source configuration
+    """
+    if ("workers" not in config):
+        config["workers"] = 1
+    elif ((not isinstance(config["workers"], six.integer_types)) or (config["workers"] < 0)):
+        raise weaveq.wqexception.DataSourceBuildError("The {0} data source 'workers' configuration item must be an integer >= 0.".format(source_type))
+
+    if ("chunk_size" not in config):
+        config["chunk_size"] = 16 * 1024 * 1024
+    elif ((not isinstance(config["chunk_size"], six.integer_types)) or (config["chunk_size"] < 1)):
+        raise weaveq.wqexception.DataSourceBuildError("The {0} data source 'chunk_size' configuration item must be an integer >= 1.".format(source_type))
+
+## Elasticsearch clients shared by data sources, keyed by normalised connection configuration (see elasticsearch_client())
+_elastic_clients = {}
+_elastic_clients_lock = threading.Lock()
+
+def _freeze_config(value):
+    """!
+    Converts a configuration value into a hashable equivalent, for use in a registry key.
+    """
+    if (isinstance(value, dict)):
+        return tuple(sorted([(key, _freeze_config(item)) for key, item in six.iteritems(value)]))
+    elif (isinstance(value, (list, tuple))):
+        return tuple([_freeze_config(item) for item in value])
+
+    return value
+
+def _client_key(client_config):
+    """!
+    Normalises an Elasticsearch client configuration for use as a registry key. Configurations are the same if they differ only in the order of their hosts.
+
+    @param client_config dict: keyword arguments to pass to the client constructor
+
+    @return a hashable key
+    """
+    key = dict(client_config)
+    if ("hosts" in key):
+        key["hosts"] = sorted(key["hosts"], key=str)
+
+    return _freeze_config(key)
+
+def elasticsearch_client(client_config):
+    """!
+    Gets the Elasticsearch client for a connection configuration, creating it if it doesn't already exist. Data sources with the same connection configuration share a client, and therefore a pool of connections to each node, for the life of the process. Configurations are the same if they differ only in the order of their hosts.
+
+    @param client_config dict: keyword arguments to pass to the elasticsearch.Elasticsearch constructor
+
+    @return the elasticsearch.Elasticsearch object
+    """
+    key = _client_key(client_config)
+    with _elastic_clients_lock:
+        if (key not in _elastic_clients):
+            _elastic_clients[key] = elasticsearch.Elasticsearch(**client_config)
+
+        return _elastic_clients[key]
+
+def _prefetch(iterator):
+    """!
+    Runs an iterator on a background thread, so that each item is produced while the previous one is being processed.
+
+    @param iterator iterator: the iterator
+
+    @return a generator iterator producing the iterator's items. Exceptions raised by the iterator are raised by the generator.
+    """
+    stopping = threading.Event()
+    items = six.moves.queue.Queue(1)
+
+    def put(item):
+        # Give up if the consumer stops while the queue is full
+        while (not stopping.is_set()):
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except six.moves.queue.Full:
+                pass
+
+        return False
+
+    def producer():
+        try:
+            for item in iterator:
+                if (not put((True, item))):
+                    return
+
+            put((False, None))
+        except Exception as e:
+            put((False, e))
+
+    thread = threading.Thread(target=producer)
+    thread.daemon = True
+    thread.start()
+
+    try:
+        while True:
+            more, item = items.get()
+            if (not more):
+                if (item is not None):
+                    raise item
+
+                return
+
+            yield item
+    finally:
+        stopping.set()
+
 class JsonLinesDataSource(weaveq.query.DataSource, DiscoverableDataSource):
     """!
     @brief Data source for files containing records in "JSON lines" format.
 
     JSON lines consists of line-delimitted JSON documents that are to be treated as separate from one another. These documents may not contain newline sequences (these should be escaped if required).
+
+    The filename may name a directory or contain glob wildcards, in which case every matching file is read (see weaveq.filesets.expand()), optionally using several threads at once. Files compressed with gzip, bzip2, xz or zstd are decompressed transparently (see weaveq.compression). Objects of this class can be configured to decode large uncompressed files in parallel: each file is memory-mapped, split into chunks at line boundaries and the chunks are decoded by a pool of worker processes (see weaveq.parallel.ChunkReader).
+
+    They can also be configured to decode records lazily: only the fields that WeaveQ needs to filter and index each record are extracted up front, and the rest of the record is only decoded if it's output or joined (see weaveq.jsoncodec.LazyJsonRecord). This saves a lot of work when most records don't satisfy a step's conditions.
     """
 
     def __init__(self, filename, filter_string, config = None):
         """!
         Constructor.
 
-        @param filename string: path to the JSON lines file from which to read the data
+        @param filename string: path to the JSON lines file from which to read the data, or a directory or glob pattern naming several files
         @param filter_string string: not applicable to this data source - must be @c None or an exception will be raised
-        @param config dict: not applicable to this data source - must be @c None or an exception will be raised
+        @param config dict: optional dictionary containing the elements workers (integer number of worker processes to decode uncompressed files with: 1 to decode them in-process, 0 for one worker per CPU; default 1), chunk_size (integer target size in bytes of the chunks decoded by each worker; default 16 MiB), lazy (boolean indicating whether or not to decode records lazily; default false) and threads (integer maximum number of files to read at once when not using worker processes; default 1)
         """
         # Only call the query.DataSource constructor
         super(JsonLinesDataSource, self).__init__(filename, filter_string)
 
-        if (config is not None):
-            raise weaveq.wqexception.DataSourceBuildError("The json_lines data source type does not currently support any configuration parameters.")
-
         if (filter_string is not None):
             raise weaveq.wqexception.DataSourceBuildError("The json_lines data source type does not currently support the #filter statement.")
 
@@ -66,6 +206,29 @@ class JsonLinesDataSource(weaveq.query.DataSource, DiscoverableDataSource):
         # Filename of the data source file
         self.filename = filename
 
+        ## @var config
+        # Data source configuration, with defaults applied
+        self.config = self._validate_config({} if (config is None) else config)
+
+        ## @var file_stats
+        # weaveq.filesets.FileStats objects describing the reading of each file during the most recent call to @c batch() or @c stream()
+        self.file_stats = []
+
+        self._plan = weaveq.query.StepPlan()
+        self._codec = weaveq.jsoncodec.default_codec()
+
+    def _validate_config(self, config):
+        _validate_threads_config("json_lines", config)
+
+        _validate_chunks_config("json_lines", config)
+
+        if ("lazy" not in config):
+            config["lazy"] = False
+        elif (not isinstance(config["lazy"], bool)):
+            raise weaveq.wqexception.DataSourceBuildError("The json_lines data source 'lazy' configuration item must be a boolean.")
+
+        return config
+
     @staticmethod
     def string_idents():
         """!
@@ -75,12 +238,59 @@ class JsonLinesDataSource(weaveq.query.DataSource, DiscoverableDataSource):
         """
         return ["json_lines", "jsl"]
 
-    def _load_json_lines(self):
-        with open(self.filename) as json_file:
+    def prepare(self, plan):
+        """!
+        @see weaveq.query.DataSource
+        """
+        self._plan = plan
+
+    def _key_fields(self):
+        if (not self.config["lazy"]):
+            return None
+
+        return [] if (self._plan.key_fields is None) else self._plan.key_fields
+
+    def _decoder(self):
+        key_fields = self._key_fields()
+        if (key_fields is None):
+            return self._codec
+
+        return weaveq.jsoncodec.LazyJsonDecoder(key_fields, self._codec)
+
+    def _read_file(self, filename):
+        decoder = self._decoder()
+        with weaveq.compression.open_file(filename) as json_file:
             for json_line in json_file:
-                json_record = json.loads(json_line, object_pairs_hook=collections.OrderedDict)
+                json_record = decoder.decode(json_line)
                 yield json_record
 
+    def _load_json_lines(self):
+        for batch in self._load_json_lines_batches(weaveq.query.BATCH_SIZE):
+            for json_record in batch:
+                yield json_record
+
+    def _load_json_lines_batches(self, batch_size):
+        filenames = weaveq.filesets.expand(self.filename)
+        self.file_stats = []
+
+        # Compressed files can't be split into chunks without decompressing them first
+        if ((self.config["workers"] != 1) and (all([weaveq.compression.detect(filename) is None for filename in filenames]))):
+            self.file_stats = [weaveq.filesets.FileStats(filename) for filename in filenames]
+            stats_by_filename = dict([(stats.filename, stats) for stats in self.file_stats])
+
+            reader = weaveq.parallel.ChunkReader(self.config["workers"], self.config["chunk_size"])
+            for filename, batch in reader.read_batches(filenames, weaveq.parallel.decode_json_lines_chunk, (self._codec.name, self._key_fields()), self._plan.ordered, with_filenames=True):
+                stats_by_filename[filename].start()
+                stats_by_filename[filename].records += len(batch)
+                yield batch
+
+            for stats in self.file_stats:
+                stats.finish()
+        else:
+            reader = weaveq.filesets.ConcurrentFileReader(self.config["threads"])
+            for batch in weaveq.query.record_batches(reader.read(filenames, self._read_file, self._plan.ordered, self.file_stats), batch_size):
+                yield batch
+
     def batch(self):
         """!
         @see weaveq.query.DataSource
@@ -99,27 +309,65 @@ class JsonLinesDataSource(weaveq.query.DataSource, DiscoverableDataSource):
         for record in self._load_json_lines():
             yield record
 
+    def stream_batches(self, batch_size):
+        """!
+        Delivers the batches decoded by worker processes as they are, when using them.
+
+        @see weaveq.query.DataSource
+        """
+        return self._load_json_lines_batches(batch_size)
+
+    def _load_json_lines_at(self, indexes, key_values):
+        decoder = self._decoder()
+        for index in indexes:
+            with open(index.source_filename, "rb") as json_file:
+                for offset in index.offsets(key_values):
+                    json_file.seek(offset)
+                    json_record = decoder.decode(json_file.readline())
+                    yield json_record
+
+    def lookup(self, key_values):
+        """!
+        Reads only the lines containing the requested field values, using each file's sidecar key index (see weaveq.keyindex.KeyIndex). Lookups are only possible if every requested field has a valid index in every file, and never for compressed files.
+
+        @see weaveq.query.DataSource
+        """
+        indexes = []
+        for filename in weaveq.filesets.expand(self.filename):
+            if (weaveq.compression.detect(filename) is not None):
+                return None
+
+            index = weaveq.keyindex.KeyIndex(filename)
+            for field, values in key_values:
+                if (not index.valid(field)):
+                    return None
+
+            indexes.append(index)
+
+        return self._load_json_lines_at(indexes, key_values)
+
 class JsonDataSource(weaveq.query.DataSource, DiscoverableDataSource):
     """!
     @brief Data source for files containing records in JSON format.
 
     JSON files must consist of a root-level array in object hierarchy which contains JSON objects. Non-object elements of the array are silently ignored by this data source.
+
+    When streaming, the elements of the root array are read incrementally (see weaveq.jsonstream.JsonArrayReader), so memory use is bounded by the size of the largest element rather than that of the whole file. Compressed files are decompressed transparently (see weaveq.compression).
+
+    The filename may name a directory or contain glob wildcards, in which case every matching file is read (see weaveq.filesets.expand()), optionally using several threads at once.
     """
 
     def __init__(self, filename, filter_string, config = None):
         """!
         Constructor.
 
-        @param filename string: path to the JSON file from which to read the data
+        @param filename string: path to the JSON file from which to read the data, or a directory or glob pattern naming several files
         @param filter_string string: not applicable to this data source - must be @c None or an exception will be raised
-        @param config dict: not applicable to this data source - must be @c None or an exception will be raised
+        @param config dict: optional dictionary containing the element threads (integer maximum number of files to read at once; default 1)
         """
         # Only call the query.DataSource constructor
         super(JsonDataSource, self).__init__(filename, filter_string)
 
-        if (config is not None):
-            raise weaveq.wqexception.DataSourceBuildError("The json data source type does not currently support any configuration parameters.")
-
         if (filter_string is not None):
             raise weaveq.wqexception.DataSourceBuildError("The json data source type does not currently support the #filter statement.")
 
@@ -127,6 +375,20 @@ class JsonDataSource(weaveq.query.DataSource, DiscoverableDataSource):
         # Filename of the data source file
         self.filename = filename
 
+        ## @var config
+        # Data source configuration, with defaults applied
+        self.config = {} if (config is None) else config
+        _validate_threads_config("json", self.config)
+
+        ## @var file_stats
+        # weaveq.filesets.FileStats objects describing the reading of each file during the most recent call to @c batch() or @c stream()
+        self.file_stats = []
+
+        self._plan = weaveq.query.StepPlan()
+        self._codec = weaveq.jsoncodec.default_codec()
+        self._readers = None
+        self._file_size = None
+
     @staticmethod
     def string_idents():
         """!
@@ -136,36 +398,90 @@ class JsonDataSource(weaveq.query.DataSource, DiscoverableDataSource):
         """
         return ["json", "js"]
 
-    def _load_json(self):
+    def prepare(self, plan):
+        """!
+        @see weaveq.query.DataSource
+        """
+        self._plan = plan
+
+    def progress(self):
+        """!
+        Reports how much of the data has been read by the current call to @c stream().
+
+        @return a (bytes read, total size in bytes) tuple, or @c None if the data isn't being streamed. If any of the files are compressed, the bytes read are counted after decompression and the total size is @c None.
+        """
+        if (self._readers is None):
+            return None
+
+        bytes_read = 0
+        for reader in list(self._readers.values()):
+            bytes_read += reader if isinstance(reader, six.integer_types) else reader.offset
+
+        return (bytes_read, self._file_size)
+
+    def _load_json(self, filename):
         json_doc = None
-        with open(self.filename) as json_file:
-            json_doc = json.load(json_file, object_pairs_hook=collections.OrderedDict)
+        with weaveq.compression.open_file(filename) as json_file:
+            json_doc = self._codec.decode(json_file.read())
 
         if (not isinstance(json_doc, list)):
             raise weaveq.wqexception.DataSourceError("The json data source requires that JSON documents contain lists as their root elements")
 
-        return json_doc
+        return [el for el in json_doc if (isinstance(el, Mapping))]
 
     def batch(self):
         """!
         @see weaveq.query.DataSource
         """
-        return self._load_json()
+        filenames = weaveq.filesets.expand(self.filename)
+        self.file_stats = []
+
+        if (len(filenames) == 1):
+            self.file_stats = [weaveq.filesets.FileStats(filenames[0])]
+            self.file_stats[0].start()
+            json_doc = self._load_json(filenames[0])
+            self.file_stats[0].records = len(json_doc)
+            self.file_stats[0].finish()
+            return json_doc
+
+        reader = weaveq.filesets.ConcurrentFileReader(self.config["threads"])
+        return list(reader.read(filenames, self._load_json, self._plan.ordered, self.file_stats))
+
+    def _stream_file(self, filename):
+        with weaveq.compression.open_file(filename) as json_file:
+            reader = weaveq.jsonstream.JsonArrayReader(json_file, self._codec)
+            self._readers[filename] = reader
+            for el in reader:
+                if (isinstance(el, Mapping)):
+                    yield el
+
+            self._readers[filename] = reader.offset
 
     def stream(self):
         """!
         @see weaveq.query.DataSource
         """
-        json_doc = self._load_json()
-        for el in json_doc:
-            if (isinstance(el, object)):
+        filenames = weaveq.filesets.expand(self.filename)
+        self.file_stats = []
+        self._file_size = None
+        if (all([weaveq.compression.detect(filename) is None for filename in filenames])):
+            self._file_size = sum([os.path.getsize(filename) for filename in filenames])
+
+        self._readers = {}
+        try:
+            reader = weaveq.filesets.ConcurrentFileReader(self.config["threads"])
+            for el in reader.read(filenames, self._stream_file, self._plan.ordered, self.file_stats):
                 yield el
+        finally:
+            self._readers = None
 
 class CsvDataSource(weaveq.query.DataSource, DiscoverableDataSource):
     """!
     @brief Data source for files containing records in CSV format.
 
-    CSV files must contain line-delimitted rows consisting of comma-separated cells which either (a) must not contain double-quote characters or (b) must enclose cell values in double-quote characters and escape double-quote characters contained within the cells with a sequence consisting of two double-quotes. All CSV data must be valid UTF-8.
+    CSV files must contain line-delimitted rows consisting of comma-separated cells which either (a) must not contain double-quote characters or (b) must enclose cell values in double-quote characters and escape double-quote characters contained within the cells with a sequence consisting of two double-quotes. All CSV data must be valid UTF-8. Compressed files are decompressed transparently (see weaveq.compression).
+
+    The filename may name a directory or contain glob wildcards, in which case every matching file is read (see weaveq.filesets.expand()), optionally using several threads at once. Field names are taken from the first row of each file. Objects of this class can be configured to parse large uncompressed files in parallel: each file is memory-mapped, split into chunks at record boundaries and the chunks are parsed by a pool of worker processes (see weaveq.parallel.csv_chunks()).
 
     Objects of this class can be configured to use the first row of a CSV document to define the names of the fields in resulting objects produced by the data source. If not configured this way, the field names are generated automatically in the form column_N where N is the 1-based index of the column of the CSV cell from which the field was generated.
     """
@@ -173,9 +489,9 @@ class CsvDataSource(weaveq.query.DataSource, DiscoverableDataSource):
         """!
         Constructor.
 
-        @param filename string: path to the CSV file from which to read the data
+        @param filename string: path to the CSV file from which to read the data, or a directory or glob pattern naming several files
         @param filter_string string: not applicable to this data source - must be @c None or an exception will be raised
-        @param config dict: a dictionary containing a single boolean element called first_row_names that determines whether or not the first CSV row should be used to define the field names of parsed objects
+        @param config dict: a dictionary containing a boolean element called first_row_names that determines whether or not the first CSV row should be used to define the field names of parsed objects, and optionally elements called threads (integer maximum number of files to read at once; default 1), types (dict mapping field names to the names of the types to which their values are converted - see weaveq.csvrecord.TYPE_NAMES) and infer_types (integer number of rows from the start of each file from which to infer the types of fields not listed in types; default 0, meaning that values are left as text), workers (integer number of worker processes to parse uncompressed files with: 1 to parse them in-process, 0 for one worker per CPU; default 1) and chunk_size (integer target size in bytes of the chunks parsed by each worker; default 16 MiB)
         """
         # Only call the query.DataSource constructor
         super(CsvDataSource, self).__init__(filename, filter_string)
@@ -194,6 +510,46 @@ class CsvDataSource(weaveq.query.DataSource, DiscoverableDataSource):
         # Does the first row of the CSV file contain field names?
         self.first_row_field_names = config["first_row_names"]
 
+        _validate_threads_config("csv", config)
+
+        ## @var threads
+        # Maximum number of files to read at once
+        self.threads = config["threads"]
+
+        if ("types" not in config):
+            config["types"] = {}
+        elif ((not isinstance(config["types"], dict)) or (not all([type_name in weaveq.csvrecord.TYPE_NAMES for type_name in config["types"].values()]))):
+            raise weaveq.wqexception.DataSourceBuildError("The csv data source 'types' configuration item must map field names to one of: {0}.".format(", ".join(weaveq.csvrecord.TYPE_NAMES)))
+
+        ## @var types
+        # Names of the types to which the values of fields are converted, keyed by field name
+        self.types = config["types"]
+
+        if ("infer_types" not in config):
+            config["infer_types"] = 0
+        elif ((not isinstance(config["infer_types"], six.integer_types)) or (isinstance(config["infer_types"], bool)) or (config["infer_types"] < 0)):
+            raise weaveq.wqexception.DataSourceBuildError("The csv data source 'infer_types' configuration item must be an integer >= 0.")
+
+        ## @var infer_types
+        # Number of rows from the start of each file from which to infer the types of fields without configured types, or 0 if types aren't inferred
+        self.infer_types = config["infer_types"]
+
+        _validate_chunks_config("csv", config)
+
+        ## @var workers
+        # Number of worker processes with which to parse uncompressed files (1 to parse them in-process, 0 for one worker per CPU)
+        self.workers = config["workers"]
+
+        ## @var chunk_size
+        # Target size in bytes of the chunks parsed by each worker process
+        self.chunk_size = config["chunk_size"]
+
+        ## @var file_stats
+        # weaveq.filesets.FileStats objects describing the reading of each file during the most recent call to @c batch() or @c stream()
+        self.file_stats = []
+
+        self._plan = weaveq.query.StepPlan()
+
     @staticmethod
     def string_idents():
         """!
@@ -203,35 +559,106 @@ class CsvDataSource(weaveq.query.DataSource, DiscoverableDataSource):
         """
         return ["csv"]
 
+    def _fields(self):
+        """!
+        Works out which fields the query uses, from the plan passed to @c prepare().
+
+        @return a set of top-level field names, or @c None if all fields are to be read
+        """
+        fields = self._plan.fields()
+        if (fields is None):
+            return None
+
+        return set([field.split(".")[0] for field in fields])
+
+    def prepare(self, plan):
+        """!
+        @see weaveq.query.DataSource
+        """
+        self._plan = plan
+
     def _load_csv(self):
-        csv_doc = None
-        with open(self.filename, "r") as csv_file:
-            csv_doc = csv.reader(csv_file)
-            row_index = 0
-            field_names = []
-            for row in csv_doc:
-                if ((self.first_row_field_names) and (row_index == 0)):
-                    for column in row:
-                        field_names.append(six.text_type(column) if sys.version_info.major >= 3 else unicode(column, encoding="utf-8"))
-                else:
-                    column_index = 0
-                    record = collections.OrderedDict()
-                    for column in row:
-                        column_name = None
-                        if (len(field_names) >= column_index + 1):
-                            column_name = field_names[column_index]
-                        else:
-                            column_name = u"column_{0}".format(column_index + 1)
-
-                        if (sys.version_info.major >= 3):
-                            record[column_name] = six.text_type(column)
-                        else:
-                            record[column_name] = unicode(column, encoding="utf-8")
-                        column_index += 1
-
-                    yield record
-
-                row_index += 1
+        for batch in self._load_csv_batches(weaveq.query.BATCH_SIZE):
+            for record in batch:
+                yield record
+
+    def _load_csv_batches(self, batch_size):
+        filenames = weaveq.filesets.expand(self.filename)
+        self.file_stats = []
+
+        # Compressed files can't be split into chunks without decompressing them first
+        if ((self.workers != 1) and (all([weaveq.compression.detect(filename) is None for filename in filenames]))):
+            self.file_stats = [weaveq.filesets.FileStats(filename) for filename in filenames]
+            stats_by_filename = dict([(stats.filename, stats) for stats in self.file_stats])
+
+            reader = weaveq.parallel.ChunkReader(self.workers, self.chunk_size)
+            for filename, batch in reader.read_batches(filenames, weaveq.parallel.decode_csv_chunk, (), self._plan.ordered, with_filenames=True, chunker=self._chunks):
+                stats_by_filename[filename].start()
+                stats_by_filename[filename].records += len(batch)
+                yield batch
+
+            for stats in self.file_stats:
+                stats.finish()
+        else:
+            reader = weaveq.filesets.ConcurrentFileReader(self.threads)
+            for batch in weaveq.query.record_batches(reader.read(filenames, self._read_file, self._plan.ordered, self.file_stats), batch_size):
+                yield batch
+
+    def _rows(self, csv_file):
+        rows = csv.reader(csv_file)
+        if (sys.version_info.major < 3):
+            rows = ([unicode(column, encoding="utf-8") for column in row] for row in rows)
+
+        return rows
+
+    def _builder(self, rows):
+        """!
+        Creates the weaveq.csvrecord.RowBuilder for a file, reading the file's field names and the sample of rows from which to infer types, if required.
+
+        @param rows iterator: the file's rows
+
+        @return a (row builder, list of sampled rows) tuple
+        """
+        field_names = []
+        if (self.first_row_field_names):
+            for row in rows:
+                field_names = row
+                break
+
+        builder = weaveq.csvrecord.RowBuilder(field_names, self._fields(), self.types)
+
+        sample = []
+        if (self.infer_types > 0):
+            for row in rows:
+                sample.append(row)
+                if (len(sample) >= self.infer_types):
+                    break
+
+            builder.infer(sample)
+
+        return (builder, sample)
+
+    def _chunks(self, filename, chunk_size):
+        # Field names and types are worked out once, here, and shared with the worker processes
+        with weaveq.compression.open_file(filename, text=True) as csv_file:
+            builder, sample = self._builder(self._rows(csv_file))
+
+        return [chunk + (builder,) for chunk in weaveq.parallel.csv_chunks(filename, chunk_size, self.first_row_field_names)]
+
+    def _read_file(self, filename):
+        with weaveq.compression.open_file(filename, text=True) as csv_file:
+            rows = self._rows(csv_file)
+            builder, sample = self._builder(rows)
+            row_number = 2 if (self.first_row_field_names) else 1
+
+            for row in itertools.chain(sample, rows):
+                try:
+                    record = builder.build(row)
+                except ValueError as e:
+                    raise weaveq.wqexception.DataSourceError("Can't read row {0} of {1}: {2}".format(row_number, filename, str(e)))
+
+                yield record
+                row_number += 1
 
     def batch(self):
         """!
@@ -251,21 +678,488 @@ class CsvDataSource(weaveq.query.DataSource, DiscoverableDataSource):
         for row in self._load_csv():
             yield row
 
+    def stream_batches(self, batch_size):
+        """!
+        Delivers the batches parsed by worker processes as they are, when using them.
+
+        @see weaveq.query.DataSource
+        """
+        return self._load_csv_batches(batch_size)
+
+class ArrowFileDataSource(weaveq.query.DataSource):
+    """!
+    @brief Base class of data sources for files read using Apache Arrow (see weaveq.arrowrecord), which requires the pyarrow package.
+
+    The filename may name a directory or contain glob wildcards, in which case every matching file is read (see weaveq.filesets.expand()), optionally using several threads at once. Only the columns of fields the query uses are read (see weaveq.query.StepPlan). Records are ArrowRecord objects reading their values from the record batches in which they were read, so values are converted to Python objects a column at a time and only when needed.
+    """
+
+    __metaclass__ = abc.ABCMeta
+
+    def __init__(self, filename, filter_string, config = None):
+        """!
+        Constructor.
+
+        @param filename string: path to the file from which to read the data, or a directory or glob pattern naming several files
+        @param filter_string string: not applicable to this data source - must be @c None or an exception will be raised
+        @param config dict: optional dictionary containing the element threads (integer maximum number of files to read at once; default 1)
+        """
+        # Only call the query.DataSource constructor
+        super(ArrowFileDataSource, self).__init__(filename, filter_string)
+
+        source_type = self.string_idents()[0]
+        if (not weaveq.arrowrecord.available()):
+            raise weaveq.wqexception.DataSourceBuildError("The {0} data source type requires the pyarrow package.".format(source_type))
+
+        if (filter_string is not None):
+            raise weaveq.wqexception.DataSourceBuildError("The {0} data source type does not currently support the #filter statement.".format(source_type))
+
+        ## @var filename
+        # Filename of the data source file
+        self.filename = filename
+
+        config = {} if (config is None) else config
+        _validate_threads_config(source_type, config)
+
+        ## @var threads
+        # Maximum number of files to read at once
+        self.threads = config["threads"]
+
+        ## @var file_stats
+        # weaveq.filesets.FileStats objects describing the reading of each file during the most recent call to @c batch(), @c stream() or @c lookup()
+        self.file_stats = []
+
+        self._plan = weaveq.query.StepPlan()
+
+    def prepare(self, plan):
+        """!
+        @see weaveq.query.DataSource
+        """
+        self._plan = plan
+
+    def _columns(self, schema):
+        """!
+        Works out which columns of a file to read, from the plan passed to @c prepare().
+
+        @param schema pyarrow.Schema: the file's schema
+
+        @return a list of column names, or @c None if all columns are to be read
+        """
+        fields = self._plan.fields()
+        if (fields is None):
+            return None
+
+        names = set([field.split(".")[0] for field in fields])
+        return [name for name in schema.names if (name in names)]
+
+    @abc.abstractmethod
+    def _record_batches(self, filename, batch_size, row_groups = None):
+        """!
+        Reads the record batches of a file.
+
+        @param filename string: path to the file
+        @param batch_size int: maximum number of rows in each batch
+        @param row_groups list: indexes of the row groups to read, if the file format has them, or @c None to read them all
+
+        @return an iterable producing pyarrow.RecordBatch objects
+        """
+        pass
+
+    def _read_file(self, filename, row_groups = None):
+        for record_batch in self._record_batches(filename, weaveq.query.BATCH_SIZE, row_groups):
+            for record in weaveq.arrowrecord.ColumnBatch(record_batch).records():
+                yield record
+
+    def _load_batches(self, batch_size, row_groups_by_file = None):
+        filenames = weaveq.filesets.expand(self.filename)
+        if (row_groups_by_file is not None):
+            filenames = [filename for filename in filenames if (len(row_groups_by_file[filename]) > 0)]
+
+        self.file_stats = []
+
+        if ((self.threads > 1) and (len(filenames) > 1)):
+            reader = weaveq.filesets.ConcurrentFileReader(self.threads)
+            read_file = self._read_file if (row_groups_by_file is None) else (lambda filename: self._read_file(filename, row_groups_by_file[filename]))
+            for batch in weaveq.query.record_batches(reader.read(filenames, read_file, self._plan.ordered, self.file_stats), batch_size):
+                yield batch
+        else:
+            # Record batches are delivered as they're read, without regrouping their records
+            for filename in filenames:
+                stats = weaveq.filesets.FileStats(filename)
+                self.file_stats.append(stats)
+                stats.start()
+                for record_batch in self._record_batches(filename, batch_size, None if (row_groups_by_file is None) else row_groups_by_file[filename]):
+                    batch = weaveq.arrowrecord.ColumnBatch(record_batch).records()
+                    stats.records += len(batch)
+                    yield batch
+
+                stats.finish()
+
+    def batch(self):
+        """!
+        @see weaveq.query.DataSource
+        """
+        return_val = []
+
+        for batch in self._load_batches(weaveq.query.BATCH_SIZE):
+            return_val.extend(batch)
+
+        return return_val
+
+    def stream(self):
+        """!
+        @see weaveq.query.DataSource
+        """
+        for batch in self._load_batches(weaveq.query.BATCH_SIZE):
+            for record in batch:
+                yield record
+
+    def stream_batches(self, batch_size):
+        """!
+        Delivers the record batches read from each file as they are.
+
+        @see weaveq.query.DataSource
+        """
+        return self._load_batches(batch_size)
+
+class ParquetDataSource(ArrowFileDataSource, DiscoverableDataSource):
+    """!
+    @brief Data source for Apache Parquet files.
+
+    Files are read a row group at a time. When WeaveQ looks records up by field value, row groups are skipped if the minimum and maximum values recorded in the file for the fields' columns show that they can't contain any of the values (see weaveq.arrowrecord.parquet_row_groups()).
+
+    @see ArrowFileDataSource
+    """
+
+    @staticmethod
+    def string_idents():
+        """!
+        Provides strings that are to be used to identify this data source.
+
+        @return a list containing the strings that may identify this data source
+        """
+        return ["parquet"]
+
+    def _record_batches(self, filename, batch_size, row_groups = None):
+        parquet_file = weaveq.arrowrecord.pyarrow.parquet.ParquetFile(filename)
+        return parquet_file.iter_batches(batch_size=batch_size, row_groups=row_groups, columns=self._columns(parquet_file.schema_arrow))
+
+    def lookup(self, key_values):
+        """!
+        Reads only the row groups that could contain the requested field values, according to the statistics recorded in each file.
+
+        @see weaveq.query.DataSource
+        """
+        row_groups_by_file = {}
+        for filename in weaveq.filesets.expand(self.filename):
+            row_groups_by_file[filename] = weaveq.arrowrecord.parquet_row_groups(weaveq.arrowrecord.pyarrow.parquet.ParquetFile(filename).metadata, key_values)
+
+        return itertools.chain.from_iterable(self._load_batches(weaveq.query.BATCH_SIZE, row_groups_by_file))
+
+class ArrowDataSource(ArrowFileDataSource, DiscoverableDataSource):
+    """!
+    @brief Data source for Apache Arrow IPC files, in either the file (random access) or stream format.
+
+    Files are memory-mapped, so the columns that aren't read are never loaded from disk.
+
+    @see ArrowFileDataSource
+    """
+
+    @staticmethod
+    def string_idents():
+        """!
+        Provides strings that are to be used to identify this data source.
+
+        @return a list containing the strings that may identify this data source
+        """
+        return ["arrow"]
+
+    def _record_batches(self, filename, batch_size, row_groups = None):
+        pyarrow = weaveq.arrowrecord.pyarrow
+        with pyarrow.memory_map(filename) as source:
+            try:
+                reader = pyarrow.ipc.open_file(source)
+                record_batches = (reader.get_batch(index) for index in six.moves.range(reader.num_record_batches))
+            except pyarrow.ArrowInvalid:
+                source.seek(0)
+                reader = pyarrow.ipc.open_stream(source)
+                record_batches = iter(reader)
+
+            columns = self._columns(reader.schema)
+            for record_batch in record_batches:
+                if (columns is not None):
+                    record_batch = record_batch.select(columns)
+
+                for offset in six.moves.range(0, record_batch.num_rows, batch_size):
+                    yield record_batch.slice(offset, batch_size)
+
+class SqliteDataSource(weaveq.query.DataSource, DiscoverableDataSource):
+    """!
+    @brief Data source for the rows of a table in an SQLite database file.
+
+    The filter string, if any, is used as the WHERE clause of the query that reads the table. Only the columns of fields the query uses are read (see weaveq.query.StepPlan), and rows are fetched a batch at a time. Records share their field names in the same way as those read from CSV files (see weaveq.csvrecord.CsvRow).
+
+    When WeaveQ looks records up by field value, the values are pushed down to SQLite, which can then use the table's indexes to find the rows containing them rather than scanning the whole table.
+    """
+
+    ## Maximum number of values bound to a single IN (...) list
+    LOOKUP_CHUNK_SIZE = 500
+
+    def __init__(self, uri, filter_string, config = None):
+        """!
+        Constructor.
+
+        @param uri string: path to the database file and name of the table, in the form /path/to/db.sqlite:table
+        @param filter_string string: SQL expression used as the WHERE clause when reading the table, or @c None to read every row
+        @param config dict: not used by this data source
+        """
+        # Only call the query.DataSource constructor
+        super(SqliteDataSource, self).__init__(uri, filter_string)
+
+        filename, delim, table = uri.rpartition(":")
+        if ((len(filename) == 0) or (len(table) == 0) or ("/" in table) or ("\\" in table)):
+            raise weaveq.wqexception.DataSourceBuildError("The sqlite data source URI must be in the form /path/to/db.sqlite:table")
+
+        ## @var filename
+        # Path to the database file
+        self.filename = filename
+
+        ## @var table
+        # Name of the table to read
+        self.table = table
+
+        ## @var filter_string
+        # SQL expression used as the WHERE clause when reading the table, or @c None
+        self.filter_string = filter_string
+
+        self._plan = weaveq.query.StepPlan()
+
+    @staticmethod
+    def string_idents():
+        """!
+        Provides strings that are to be used to identify this data source.
+
+        @return a list containing the strings that may identify this data source
+        """
+        return ["sqlite"]
+
+    @staticmethod
+    def _quote(identifier):
+        return u'"{0}"'.format(identifier.replace(u'"', u'""'))
+
+    def prepare(self, plan):
+        """!
+        @see weaveq.query.DataSource
+        """
+        self._plan = plan
+
+    def _connect(self):
+        """!
+        Opens the database and works out which of the table's columns to read.
+
+        @return a (connection, table column names, names of the columns to read) tuple
+        """
+        # Connecting to a file that doesn't exist would create it
+        if (not os.path.isfile(self.filename)):
+            raise weaveq.wqexception.DataSourceError("Can't read sqlite database {0}: file not found".format(self.filename))
+
+        connection = sqlite3.connect(self.filename)
+        try:
+            table_columns = [row[1] for row in connection.execute(u"PRAGMA table_info({0})".format(self._quote(self.table)))]
+        except sqlite3.Error as e:
+            connection.close()
+            raise weaveq.wqexception.DataSourceError("Can't read sqlite database {0}: {1}".format(self.filename, str(e)))
+
+        if (len(table_columns) == 0):
+            connection.close()
+            raise weaveq.wqexception.DataSourceError("Can't read sqlite database {0}: no such table: {1}".format(self.filename, self.table))
+
+        columns = table_columns
+        fields = self._plan.fields()
+        if (fields is not None):
+            names = set([field.split(".")[0] for field in fields])
+            columns = [column for column in table_columns if (column in names)]
+            if (len(columns) == 0):
+                columns = table_columns
+
+        return (connection, table_columns, columns)
+
+    def _select(self, connection, columns, conditions, params, batch_size):
+        """!
+        Reads rows from the table a batch at a time, closing the connection once they've all been read.
+
+        @param connection sqlite3.Connection: the database connection
+        @param columns list: names of the columns to read
+        @param conditions list: SQL expressions that rows must all satisfy, in addition to the filter string
+        @param params list: values bound to the parameters in the conditions
+        @param batch_size int: number of rows to fetch at a time
+
+        @return a generator iterator producing lists of records
+        """
+        if (self.filter_string is not None):
+            conditions = [self.filter_string] + conditions
+
+        sql = u"SELECT {0} FROM {1}".format(u", ".join([self._quote(column) for column in columns]), self._quote(self.table))
+        if (len(conditions) > 0):
+            sql += u" WHERE " + u" AND ".join([u"({0})".format(condition) for condition in conditions])
+
+        schema = weaveq.csvrecord.CsvSchema(columns)
+        try:
+            cursor = connection.cursor()
+            cursor.arraysize = batch_size
+            cursor.execute(sql, params)
+            while True:
+                rows = cursor.fetchmany()
+                if (len(rows) == 0):
+                    break
+
+                yield [weaveq.csvrecord.CsvRow(schema, list(row)) for row in rows]
+        except sqlite3.Error as e:
+            raise weaveq.wqexception.DataSourceError("Can't read sqlite database {0}: {1}".format(self.filename, str(e)))
+        finally:
+            connection.close()
+
+    def _load_batches(self, batch_size):
+        connection, table_columns, columns = self._connect()
+        return self._select(connection, columns, [], [], batch_size)
+
+    def batch(self):
+        """!
+        @see weaveq.query.DataSource
+        """
+        return_val = []
+
+        for batch in self._load_batches(weaveq.query.BATCH_SIZE):
+            return_val.extend(batch)
+
+        return return_val
+
+    def stream(self):
+        """!
+        @see weaveq.query.DataSource
+        """
+        for batch in self._load_batches(weaveq.query.BATCH_SIZE):
+            for record in batch:
+                yield record
+
+    def stream_batches(self, batch_size):
+        """!
+        Delivers rows in the batches fetched from the database.
+
+        @see weaveq.query.DataSource
+        """
+        return self._load_batches(batch_size)
+
+    def _bindable(self, values):
+        """!
+        Works out which of a set of key values can be bound to SQL parameters. Other values (such as lists and dicts) can never equal the value of a column, so are left out.
+
+        @param values set: the values
+
+        @return a (list of values, boolean indicating whether or not None is one of them) tuple, or @c None if any of the values can't be represented faithfully in SQL
+        """
+        bindable = []
+        for value in values:
+            if (isinstance(value, six.integer_types)):
+                if ((value < -(2 ** 63)) or (value >= 2 ** 63)):
+                    return None
+
+                bindable.append(value)
+            elif (isinstance(value, float)):
+                # NaNs never equal the values of columns
+                if (value == value):
+                    bindable.append(value)
+            elif (isinstance(value, (six.string_types, bytes))):
+                bindable.append(value)
+
+        return (bindable, (None in values))
+
+    def lookup(self, key_values):
+        """!
+        Reads only the rows containing the requested field values. Values of a single field are looked up using IN (...) lists of up to LOOKUP_CHUNK_SIZE values at a time. Values of several fields are loaded into temporary tables and looked up in a single query, so that rows containing values of more than one of the fields are only read once. Lookups are only possible if every field is a column of the table.
+
+        @see weaveq.query.DataSource
+        """
+        connection, table_columns, columns = self._connect()
+
+        lookups = []
+        for field, values in key_values:
+            bindable = self._bindable(values) if (field in table_columns) else None
+            if (bindable is None):
+                connection.close()
+                return None
+
+            lookups.append((self._quote(field), bindable[0], bindable[1]))
+
+        if (len(lookups) == 1):
+            return itertools.chain.from_iterable(self._lookup_chunks(connection, columns, lookups[0]))
+
+        try:
+            conditions = []
+            for lookup_index in six.moves.range(len(lookups)):
+                column, values, null = lookups[lookup_index]
+                temp_table = u"temp.weaveq_keys_{0}".format(lookup_index)
+                connection.execute(u"CREATE TEMP TABLE {0} (value)".format(temp_table))
+                connection.executemany(u"INSERT INTO {0} (value) VALUES (?)".format(temp_table), [(value,) for value in values])
+
+                conditions.append(u"{0} IN (SELECT value FROM {1})".format(column, temp_table))
+                if (null):
+                    conditions.append(u"{0} IS NULL".format(column))
+        except sqlite3.Error as e:
+            connection.close()
+            raise weaveq.wqexception.DataSourceError("Can't read sqlite database {0}: {1}".format(self.filename, str(e)))
+
+        return itertools.chain.from_iterable(self._select(connection, columns, [u" OR ".join(conditions)], [], weaveq.query.BATCH_SIZE))
+
+    def _lookup_chunks(self, connection, columns, lookup):
+        column, values, null = lookup
+        try:
+            for offset in six.moves.range(0, len(values), self.LOOKUP_CHUNK_SIZE):
+                chunk = values[offset:offset + self.LOOKUP_CHUNK_SIZE]
+                # Rows are read from one chunk at a time, each on a connection of its own
+                for batch in self._select(sqlite3.connect(self.filename), columns, [u"{0} IN ({1})".format(column, u", ".join([u"?"] * len(chunk)))], chunk, weaveq.query.BATCH_SIZE):
+                    yield batch
+
+            if (null):
+                for batch in self._select(sqlite3.connect(self.filename), columns, [u"{0} IS NULL".format(column)], [], weaveq.query.BATCH_SIZE):
+                    yield batch
+        finally:
+            connection.close()
+
 class ElasticsearchDataSource(weaveq.query.DataSource, DiscoverableDataSource):
     """!
     Data source for resultsets from Elasticsearch queries expressed in Query String Query syntax.
     """
+
+    ## Configuration items used by the data source itself, rather than by the Elasticsearch client
+    WEAVEQ_CONFIG = frozenset(["slices", "pool_size", "keep_alive", "page_size", "aggregate_keys", "bulk_size", "bulk_bytes", "bulk_requests", "bulk_retries"])
+
+    ## Field types whose values are aggregated exactly as they appear in documents' _source
+    AGGREGATABLE_TYPES = frozenset(["keyword", "long", "integer", "short", "byte", "boolean", "ip"])
+
+    ## How long points in time opened by batch() are kept open between pages
+    PIT_KEEP_ALIVE = "2m"
+
     def __init__(self, index_name, filter_string = "*", config = None):
         """!
         Constructor.
 
         @param index_name string: name of the Elasticsearch index to query
         @param filter_string string: Query String Query to search for using Elasticsearch
-        @param config dict: an dictionary containing multiple elements to be used for configuring the connection to Elasticsearch. These are: hosts (list of strings in the form host:port), timeout (integer), use_ssl (boolean), verify_certs (boolean), ca_certs (list of strings), client_cert (string) and client_key (string)
+        @param config dict: an dictionary containing multiple elements to be used for configuring the connection to Elasticsearch. These are: hosts (list of strings in the form host:port), timeout (integer), use_ssl (boolean), verify_certs (boolean), ca_certs (list of strings), client_cert (string) and client_key (string). Optionally, it may also contain slices (integer number of slices into which stream() divides the scroll, each read by its own thread; default 1), pool_size (integer maximum number of connections kept open to each node; default 10, or the number of slices or bulk_requests if greater), keep_alive (boolean indicating whether or not connections are reused for later requests; default true), page_size (integer number of hits or keys requested at a time by batch(); default 10000) and aggregate_keys (boolean indicating whether or not steps whose records are only used for their keys retrieve just the distinct key values, using composite aggregations; default false). The bulk_size, bulk_bytes, bulk_requests and bulk_retries items configure weaveq.application.ElasticsearchResultHandler. Data sources with the same connection configuration share a client (see elasticsearch_client()).
         """
         # Only call the query.DataSource constructor
         super(ElasticsearchDataSource, self).__init__(index_name, filter_string)
 
+        self._configure(index_name, filter_string, config)
+
+        self._elastic_client = elasticsearch_client(self._client_config())
+
+    def _configure(self, index_name, filter_string, config):
+        """!
+        Validates the data source's configuration and prepares its query, without connecting to Elasticsearch. Shared with weaveq.aio.AsyncElasticsearchDataSource, which uses its own client.
+
+        @see __init__()
+        """
         if (config is None):
             raise weaveq.wqexception.DataSourceBuildError("The elasticsearch data source type requires configuration parameters to be supplied.")
 
@@ -279,10 +1173,25 @@ class ElasticsearchDataSource(weaveq.query.DataSource, DiscoverableDataSource):
 
         self.config = self._validate_config(config)
 
-        elastic_client = elasticsearch.Elasticsearch(**self.config)
-        self._elastic_source = elasticsearch_dsl.Search(using=elastic_client, index=index_name).query("query_string", query=filter_string)
+        ## @var slices
+        # Number of slices into which stream() divides the scroll
+        self.slices = self.config["slices"]
 
-    def _validate_config(self, config):
+        ## @var page_size
+        # Number of hits requested at a time by batch()
+        self.page_size = self.config["page_size"]
+
+        ## @var aggregate_keys
+        # Retrieve only the distinct key values of steps whose records are only used for their keys?
+        self.aggregate_keys = self.config["aggregate_keys"]
+
+        self._key_fields = None
+
+        self._elastic_search = elasticsearch_dsl.Search(index=index_name).query("query_string", query=filter_string)
+        self._elastic_source = self._elastic_search
+
+    @staticmethod
+    def _validate_config(config):
         if ("hosts" not in config):
             raise weaveq.wqexception.DataSourceBuildError("'hosts' is a required element in the Elasticsearch data source configuration.")
         if ("timeout" not in config):
@@ -297,9 +1206,66 @@ class ElasticsearchDataSource(weaveq.query.DataSource, DiscoverableDataSource):
             config["client_cert"] = None
         if ("client_key" not in config):
             config["client_key"] = None
+        if ("slices" not in config):
+            config["slices"] = 1
+        elif ((not isinstance(config["slices"], six.integer_types)) or (isinstance(config["slices"], bool)) or (config["slices"] < 1)):
+            raise weaveq.wqexception.DataSourceBuildError("The Elasticsearch data source 'slices' configuration item must be an integer >= 1.")
+        # Bulk requests are made by weaveq.application.ElasticsearchResultHandler
+        for name, default in [("bulk_size", 1000), ("bulk_bytes", 5242880), ("bulk_requests", 4), ("bulk_retries", 3)]:
+            if (name not in config):
+                config[name] = default
+            elif ((not isinstance(config[name], six.integer_types)) or (isinstance(config[name], bool)) or (config[name] < (0 if (name == "bulk_retries") else 1))):
+                raise weaveq.wqexception.DataSourceBuildError("The Elasticsearch data source '{0}' configuration item must be an integer >= {1}.".format(name, 0 if (name == "bulk_retries") else 1))
+        if ("pool_size" not in config):
+            config["pool_size"] = max(10, config["slices"], config["bulk_requests"])
+        elif ((not isinstance(config["pool_size"], six.integer_types)) or (isinstance(config["pool_size"], bool)) or (config["pool_size"] < 1)):
+            raise weaveq.wqexception.DataSourceBuildError("The Elasticsearch data source 'pool_size' configuration item must be an integer >= 1.")
+        if ("page_size" not in config):
+            config["page_size"] = 10000
+        elif ((not isinstance(config["page_size"], six.integer_types)) or (isinstance(config["page_size"], bool)) or (config["page_size"] < 1)):
+            raise weaveq.wqexception.DataSourceBuildError("The Elasticsearch data source 'page_size' configuration item must be an integer >= 1.")
+        if ("aggregate_keys" not in config):
+            config["aggregate_keys"] = False
+        elif (not isinstance(config["aggregate_keys"], bool)):
+            raise weaveq.wqexception.DataSourceBuildError("The Elasticsearch data source 'aggregate_keys' configuration item must be a boolean.")
+        if ("keep_alive" not in config):
+            config["keep_alive"] = True
+        elif (not isinstance(config["keep_alive"], bool)):
+            raise weaveq.wqexception.DataSourceBuildError("The Elasticsearch data source 'keep_alive' configuration item must be a boolean.")
 
         return config
 
+    def _client_config(self):
+        """!
+        @return the configuration items that are passed to the Elasticsearch client
+        """
+        return self._connection_config(self.config)
+
+    @classmethod
+    def _connection_config(cls, config):
+        """!
+        @param config dict: validated data source configuration
+
+        @return the configuration items that are passed to the Elasticsearch client
+        """
+        client_config = dict([(key, value) for key, value in six.iteritems(config) if (key not in cls.WEAVEQ_CONFIG)])
+        client_config["maxsize"] = config["pool_size"]
+        if (not config["keep_alive"]):
+            client_config["headers"] = {"connection":"close"}
+
+        return client_config
+
+    @classmethod
+    def connect(cls, config):
+        """!
+        Gets the Elasticsearch client for a configuration, for components other than data sources that use it (such as weaveq.application.ElasticsearchResultHandler).
+
+        @param config dict: configuration in the form passed to the constructor. Defaults are filled in for any items it doesn't contain.
+
+        @return the elasticsearch.Elasticsearch object (see elasticsearch_client())
+        """
+        return elasticsearch_client(cls._connection_config(cls._validate_config(config)))
+
     @staticmethod
     def string_idents():
         """!
@@ -309,23 +1275,214 @@ class ElasticsearchDataSource(weaveq.query.DataSource, DiscoverableDataSource):
         """
         return ["elasticsearch", "el"]
 
+    def prepare(self, plan):
+        """!
+        Asks Elasticsearch to return only the fields of each hit's @c _source that the query uses, reducing the amount of data transferred and decoded.
+
+        If the data source is configured to aggregate keys and the step's records are only used for their key fields (such as those of a step followed by a pivot step), only the distinct combinations of key field values are retrieved (see key_records()).
+
+        @see weaveq.query.DataSource
+        """
+        self._key_fields = None
+        if (self.aggregate_keys and (plan.output_fields == []) and (plan.key_fields is not None) and (len(plan.key_fields) > 0)):
+            self._key_fields = list(plan.key_fields)
+
+        fields = plan.fields()
+        if (fields is None):
+            self._elastic_source = self._elastic_search
+        elif (len(fields) == 0):
+            self._elastic_source = self._elastic_search.source(False)
+        else:
+            self._elastic_source = self._elastic_search.source(includes=fields)
+
     def batch(self):
         """!
-        Runs the Elasticsearch query using the Elasticsearch DSL @c execute() method, returning the results as a dict.
+        Retrieves every hit of the Elasticsearch query, paging through them in a point in time with @c search_after. Each page is requested while the previous one is being processed. If the Elasticsearch cluster doesn't support points in time (or sorting by @c _shard_doc within them), the hits are read using the scroll API instead (see stream()).
 
         @see weaveq.query.DataSource
         """
-        result_val = self._elastic_source.execute()
-        return result_val.to_dict()
+        if (self._aggregatable()):
+            return list(self.key_records())
+
+        try:
+            pit_id = self._elastic_client.open_point_in_time(index=self.index_name, keep_alive=self.PIT_KEEP_ALIVE)["id"]
+        except elasticsearch.RequestError:
+            return list(self.stream())
+
+        # Holds the ID of the point in time, which may change with each page
+        pit = [pit_id]
+        try:
+            pages = self._pit_pages(pit)
+            try:
+                return_val = next(pages)
+            except elasticsearch.RequestError:
+                return list(self.stream())
+
+            for page in _prefetch(pages):
+                return_val.extend(page)
+
+            return return_val
+        finally:
+            try:
+                self._elastic_client.close_point_in_time(body={"id":pit[0]})
+            except elasticsearch.TransportError:
+                # The point in time will expire anyway
+                pass
+
+    def _aggregatable(self):
+        """!
+        Works out whether or not the records of the step can be replaced by the distinct combinations of their key field values. This is only possible if the data source is configured to aggregate keys, the step's records are only used for their key fields, and every index maps every key field to a type whose values are aggregated exactly as they appear in documents (see AGGREGATABLE_TYPES).
+
+        @return @c True if key_records() can be used
+        """
+        if (self._key_fields is None):
+            return False
+
+        try:
+            indices = self._elastic_client.indices.get_field_mapping(fields=",".join(self._key_fields), index=self.index_name)
+        except elasticsearch.TransportError:
+            return False
+
+        return self._aggregatable_mappings(indices)
+
+    def _aggregatable_mappings(self, indices):
+        """!
+        Checks that every index maps every key field to one of AGGREGATABLE_TYPES.
+
+        @param indices dict: the key fields' mappings, as returned by the get field mapping API
+
+        @return @c True if the key fields can be aggregated
+        """
+        if (len(indices) == 0):
+            return False
+
+        for index in indices.values():
+            mappings = index.get("mappings", {})
+            for field in self._key_fields:
+                if (field not in mappings):
+                    return False
+
+                mapping = list(mappings[field]["mapping"].values())[0]
+                if ((mapping.get("type") not in self.AGGREGATABLE_TYPES) or ("normalizer" in mapping) or ("ignore_above" in mapping)):
+                    return False
+
+        return True
+
+    def key_records(self):
+        """!
+        Retrieves the distinct combinations of the values of the step's key fields in documents matching the query, using a composite aggregation paged through @c page_size keys at a time. Each is delivered as a record containing only the key fields. Fields that documents don't contain (or that are @c null) are left out of records.
+
+        @return a generator iterator producing records
+        """
+        after = None
+
+        while True:
+            aggregation = self._elastic_client.search(index=self.index_name, body=self._key_search(after))["aggregations"]["keys"]
+            for bucket in aggregation["buckets"]:
+                yield self._key_record(bucket)
+
+            after = aggregation.get("after_key")
+            if ((len(aggregation["buckets"]) == 0) or (after is None)):
+                return
+
+    def _key_search(self, after):
+        """!
+        Builds the body of a search request for a page of key field value combinations.
+
+        @param after dict: the key after which the page starts, or @c None for the first page
+
+        @return the request body
+        """
+        composite = {"size":self.page_size, "sources":[{"f{0}".format(field_index):{"terms":{"field":self._key_fields[field_index], "missing_bucket":True}}} for field_index in six.moves.range(len(self._key_fields))]}
+        if (after is not None):
+            composite["after"] = after
+
+        body = self._elastic_search.to_dict()
+        body["size"] = 0
+        body["aggs"] = {"keys":{"composite":composite}}
+
+        return body
+
+    def _key_record(self, bucket):
+        """!
+        Converts a composite aggregation bucket into a record containing the key fields.
+
+        @param bucket dict: the bucket
+
+        @return the record
+        """
+        record = {}
+        for field_index in six.moves.range(len(self._key_fields)):
+            value = bucket["key"]["f{0}".format(field_index)]
+            if (value is not None):
+                names = self._key_fields[field_index].split(".")
+                target = record
+                for name in names[:-1]:
+                    target = target.setdefault(name, {})
+
+                target[names[-1]] = value
+
+        return record
+
+    def _pit_pages(self, pit):
+        """!
+        Pages through the hits of the query in a point in time.
+
+        @param pit list: containing the ID of the point in time, which is replaced by the ID returned with each page
+
+        @return a generator iterator producing lists of hits
+        """
+        search = self._elastic_source.index().extra(size=self.page_size).sort("_shard_doc")
+        search_after = None
+
+        while True:
+            body = search.to_dict()
+            body["pit"] = {"id":pit[0], "keep_alive":self.PIT_KEEP_ALIVE}
+            if (search_after is not None):
+                body["search_after"] = search_after
+
+            response = self._elastic_client.search(body=body)
+            pit[0] = response.get("pit_id", pit[0])
+            hits = response["hits"]["hits"]
+            if (len(hits) > 0):
+                yield [hit.get("_source", {}) for hit in hits]
+
+            if (len(hits) < self.page_size):
+                return
+
+            search_after = hits[-1]["sort"]
 
     def stream(self):
         """!
-        Runs the Elasticsearch query using the Elasticsearch DSL @c scan() method, and therefore the scroll API, returning a generator to allow iteration over the resultset.
+        Runs the Elasticsearch query using the scroll API, returning a generator to allow iteration over the resultset.
+
+        If the data source is configured with more than one slice, the scroll is divided into that many sliced scrolls, each read by its own thread. Hits are delivered in the order in which they arrive from each slice, through a bounded queue, so slices are paused while WeaveQ catches up.
 
         @see weaveq.query.DataSource
         """
-        for hit in self._elastic_source.scan():
-            yield hit.to_dict()
+        if (self._aggregatable()):
+            return self.key_records()
+
+        if (self.slices <= 1):
+            return self._scan_slice(None)
+
+        return weaveq.filesets.merge_concurrently(list(six.moves.range(self.slices)), self._scan_slice, self.slices)
+
+    def _scan_slice(self, slice_id):
+        """!
+        Scrolls through the hits of one slice of the query.
+
+        @param slice_id int: ID of the slice to scroll through, or @c None to scroll through every hit
+
+        @return a generator iterator producing hits
+        """
+        search = self._elastic_source
+        if (slice_id is not None):
+            search = search.extra(slice={"id":slice_id, "max":self.slices})
+
+        # Hits are read as they're returned, without wrapping them in Elasticsearch DSL objects. Hits have no _source if no fields were requested.
+        for hit in elasticsearch.helpers.scan(self._elastic_client, query=search.to_dict(), index=self.index_name):
+            yield hit.get("_source", {})
 
 class AppDataSourceBuilder(weaveq.parser.DataSourceBuilder):
     """!
@@ -360,7 +1517,14 @@ class AppDataSourceBuilder(weaveq.parser.DataSourceBuilder):
         ident_list.sort()
         self.valid_source_types = ", ".join(ident_list)
 
-    def _parse_uri(self, source_uri):
+    def parse_uri(self, source_uri):
+        """!
+        Parses a data source URI without building the data source.
+
+        @param source_uri string: the URI, in the form TYPE:LOCATION (see __call__())
+
+        @return a dict containing the elements source_type (the data source type's normalised ident string), uri (the LOCATION part of the URI, such as a file path) and data_source_class (the weaveq.query.DataSource subclass for the type)
+        """
         return_val = {"source_type":None, "uri":None, "data_source_class":None}
 
         type_delim = source_uri.find(":")
@@ -389,7 +1553,7 @@ class AppDataSourceBuilder(weaveq.parser.DataSourceBuilder):
 
         @return the build weaveq.query.DataSource object
         """
-        source = self._parse_uri(source_uri)
+        source = self.parse_uri(source_uri)
 
         data_source_config = None
         try:
@@ -0,0 +1,266 @@
+# -*- coding: utf-8 -*-
+
+"""!
+@package weaveq.filesets Data source URIs naming multiple files, and reading them concurrently.
+"""
+
+# Copyright 2017 James Mistry.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+from __future__ import print_function, absolute_import
+import os
+import glob
+import time
+import threading
+import six
+
+import weaveq.wqexception
+
+## Number of records passed from a reader thread to the consumer at a time
+BATCH_SIZE = 1000
+
+## Maximum number of batches held for the consumer per file (when delivering in order) or per thread (otherwise)
+QUEUE_BATCHES = 4
+
+def expand(path):
+    """!
+    Expands a data source file path that may name a directory or contain glob wildcards (*, ? and [...]) into the files it refers to.
+
+    Directories are expanded to the regular files they contain, excluding hidden files and WeaveQ key index sidecar files, but not the contents of sub-directories. Paths that are neither directories nor contain wildcards are returned as they are, whether or not they exist, so that the usual error is raised when the file is opened.
+
+    @param path string: the path to expand
+
+    @return a sorted list of file paths
+    """
+    if (os.path.isdir(path)):
+        filenames = [os.path.join(path, name) for name in os.listdir(path) if ((not name.startswith(".")) and (not name.endswith(".wqidx")))]
+    elif (glob.has_magic(path)):
+        filenames = glob.glob(path)
+    else:
+        return [path]
+
+    filenames = sorted([filename for filename in filenames if os.path.isfile(filename)])
+    if (len(filenames) == 0):
+        raise weaveq.wqexception.DataSourceError("No files match {0}".format(path))
+
+    return filenames
+
+class FileStats(object):
+    """!
+    Statistics describing the reading of a single file.
+    """
+
+    def __init__(self, filename):
+        """!
+        Constructor.
+
+        @param filename string: path to the file
+        """
+
+        ## @var filename
+        # Path to the file
+        self.filename = filename
+
+        ## @var size
+        # Size of the file in bytes
+        self.size = os.path.getsize(filename) if (os.path.exists(filename)) else None
+
+        ## @var records
+        # Number of records read from the file so far
+        self.records = 0
+
+        ## @var seconds
+        # Time taken to read the file, or @c None if it hasn't been read in full yet
+        self.seconds = None
+
+        self._started = None
+
+    def start(self):
+        """!
+        Records the time at which reading started, unless it's already been recorded.
+        """
+        if (self._started is None):
+            self._started = time.time()
+
+    def finish(self):
+        """!
+        Records the time taken to read the file.
+        """
+        self.start()
+        self.seconds = time.time() - self._started
+
+    def __repr__(self):
+        return "<{0}: size={1}, records={2}, seconds={3}>".format(self.filename, self.size, self.records, self.seconds)
+
+class _Finished(object):
+    """!
+    Marks the end of the records of a source in a queue.
+    """
+    def __init__(self, source_index):
+        self.source_index = source_index
+
+class _Failed(object):
+    """!
+    Carries an exception raised while reading a source to the consumer.
+    """
+    def __init__(self, error):
+        self.error = error
+
+def merge_concurrently(sources, read_source, threads, ordered = False, source_stats = None):
+    """!
+    Reads the records of several sources (such as files, or the slices of an Elasticsearch scroll) using a bounded pool of threads, merging them into a single stream.
+
+    Records are passed from each thread to the consumer in batches, through bounded queues, so threads pause while the consumer catches up.
+
+    @param sources list: the sources to read
+    @param read_source function: called on a reader thread with a source, returns an iterable of the source's records
+    @param threads int: maximum number of sources to read at once
+    @param ordered boolean: if @c True, records are delivered in source order. Otherwise, they're delivered as soon as they've been read.
+    @param source_stats list: if not @c None, a FileStats object for each source, updated as it's read
+
+    @return a generator iterator producing records. Exceptions raised while reading a source are raised by the generator.
+    """
+    stopping = threading.Event()
+    next_source = [0]
+    next_source_lock = threading.Lock()
+
+    if (ordered):
+        queues = [six.moves.queue.Queue(QUEUE_BATCHES) for source in sources]
+    else:
+        shared_queue = six.moves.queue.Queue(QUEUE_BATCHES * max(threads, 1))
+        queues = [shared_queue] * len(sources)
+
+    def put(target_queue, item):
+        # Give up if the consumer stops while the queue is full
+        while (not stopping.is_set()):
+            try:
+                target_queue.put(item, timeout=0.1)
+                return True
+            except six.moves.queue.Full:
+                pass
+
+        return False
+
+    def reader_thread():
+        while (not stopping.is_set()):
+            with next_source_lock:
+                source_index = next_source[0]
+                next_source[0] += 1
+
+            if (source_index >= len(sources)):
+                return
+
+            stats = None if (source_stats is None) else source_stats[source_index]
+            try:
+                if (stats is not None):
+                    stats.start()
+
+                batch = []
+                for record in read_source(sources[source_index]):
+                    batch.append(record)
+                    if (len(batch) >= BATCH_SIZE):
+                        if (stats is not None):
+                            stats.records += len(batch)
+
+                        if (not put(queues[source_index], batch)):
+                            return
+
+                        batch = []
+
+                if (stats is not None):
+                    stats.records += len(batch)
+                    stats.finish()
+
+                if ((len(batch) > 0) and (not put(queues[source_index], batch))):
+                    return
+
+                put(queues[source_index], _Finished(source_index))
+            except Exception as e:
+                put(queues[source_index], _Failed(e))
+                return
+
+    reader_threads = []
+    for thread_index in six.moves.range(min(threads, len(sources))):
+        thread = threading.Thread(target=reader_thread)
+        thread.daemon = True
+        thread.start()
+        reader_threads.append(thread)
+
+    try:
+        finished_count = 0
+        current_source = 0
+        while (finished_count < len(sources)):
+            item = queues[current_source].get()
+            if (isinstance(item, _Failed)):
+                raise item.error
+            elif (isinstance(item, _Finished)):
+                finished_count += 1
+                if (ordered):
+                    current_source += 1
+            else:
+                for record in item:
+                    yield record
+    finally:
+        stopping.set()
+        for thread in reader_threads:
+            thread.join()
+
+class ConcurrentFileReader(object):
+    """!
+    @brief Reads the records of multiple files using a bounded pool of threads.
+
+    Threads overlap file I/O and decompression (which release the GIL) with the processing of records already read. Records can either be delivered in file order, or interleaved in the order in which they're read.
+    """
+
+    def __init__(self, threads):
+        """!
+        Constructor.
+
+        @param threads int: maximum number of files to read at once. If 1, files are read one at a time on the calling thread.
+        """
+
+        ## @var threads
+        # Maximum number of files read at once
+        self.threads = threads
+
+    def read(self, filenames, read_file, ordered = True, stats = None):
+        """!
+        Reads the records of a set of files.
+
+        @param filenames list: paths to the files to read
+        @param read_file function: called with a file path, returns an iterable of the file's records. Called on a reader thread when reading concurrently.
+        @param ordered boolean: if @c True, records are delivered in file order. Otherwise, they're delivered as soon as they've been read.
+        @param stats list: if not @c None, a FileStats object for each file is appended to it
+
+        @return a generator iterator producing records
+        """
+        file_stats = [FileStats(filename) for filename in filenames]
+        if (stats is not None):
+            stats.extend(file_stats)
+
+        if ((self.threads <= 1) or (len(filenames) <= 1)):
+            return self._read_sequentially(filenames, read_file, file_stats)
+
+        return self._read_concurrently(filenames, read_file, ordered, file_stats)
+
+    def _read_sequentially(self, filenames, read_file, file_stats):
+        for file_index in six.moves.range(len(filenames)):
+            file_stats[file_index].start()
+            for record in read_file(filenames[file_index]):
+                file_stats[file_index].records += 1
+                yield record
+
+            file_stats[file_index].finish()
+
+    def _read_concurrently(self, filenames, read_file, ordered, file_stats):
+        return merge_concurrently(filenames, read_file, self.threads, ordered, file_stats)
@@ -0,0 +1,552 @@
+# -*- coding: utf-8 -*-
+
+"""!
+@package weaveq.jsoncodec Pluggable JSON encoding and decoding, using the fastest JSON library available.
+"""
+
+# Copyright 2017 James Mistry.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+from __future__ import print_function, absolute_import
+import sys
+import re
+import abc
+import string
+import json
+import base64
+import datetime
+import decimal
+import collections
+import six
+
+try:
+    from collections.abc import Mapping, MutableMapping
+except ImportError:
+    from collections import Mapping, MutableMapping
+
+import weaveq.wqexception
+
+## Do built-in dicts preserve insertion order? If so, there's no need to decode JSON objects to OrderedDicts to preserve field order
+DICTS_ORDERED = (sys.version_info >= (3, 7))
+
+def _encode_default(obj):
+    """!
+    Converts objects that JSON libraries can't encode natively to objects that they can. Used to encode mappings that aren't dicts, such as records produced by some data sources, and the values of typed columns read from Parquet and Arrow files: dates and times are encoded in ISO 8601 format, durations as a number of seconds, decimals as strings (to preserve their precision) and binary values in base64.
+    """
+    if (isinstance(obj, Mapping)):
+        return collections.OrderedDict(six.iteritems(obj))
+    elif (isinstance(obj, (datetime.datetime, datetime.date, datetime.time))):
+        return obj.isoformat()
+    elif (isinstance(obj, datetime.timedelta)):
+        return obj.total_seconds()
+    elif (isinstance(obj, decimal.Decimal)):
+        return str(obj)
+    elif (isinstance(obj, (bytes, bytearray))):
+        return base64.b64encode(obj).decode("ascii")
+
+    raise TypeError("Object of type {0} is not JSON serializable".format(type(obj).__name__))
+
+class JsonCodec(object):
+    """!
+    Abstract JSON codec. Decodes JSON documents to Python objects whose JSON objects preserve field order, and encodes Python objects to UTF-8 JSON.
+    """
+
+    __metaclass__ = abc.ABCMeta
+
+    ## Name that identifies the codec in configuration
+    name = None
+
+    @abc.abstractmethod
+    def decode(self, data):
+        """!
+        Decodes a JSON document.
+
+        @param data bytes: UTF-8 encoded JSON document. Text strings are also accepted.
+
+        @return the decoded object
+        """
+        pass
+
+    @abc.abstractmethod
+    def encode(self, obj):
+        """!
+        Encodes an object as a JSON document.
+
+        @param obj object: the object to encode
+
+        @return the UTF-8 encoded JSON document as bytes
+        """
+        pass
+
+class StdlibJsonCodec(JsonCodec):
+    """!
+    JSON codec using the Python standard library json module. Always available.
+    """
+
+    name = "stdlib"
+
+    def __init__(self):
+        """!
+        Constructor.
+        """
+        self._decoder = json.JSONDecoder() if DICTS_ORDERED else json.JSONDecoder(object_pairs_hook=collections.OrderedDict)
+
+    def decode(self, data):
+        """!
+        @see JsonCodec
+        """
+        if (isinstance(data, six.binary_type)):
+            data = data.decode("utf-8")
+
+        return self._decoder.decode(data)
+
+    def encode(self, obj):
+        """!
+        @see JsonCodec
+        """
+        return json.dumps(obj, default=_encode_default).encode("utf-8")
+
+class OrjsonCodec(JsonCodec):
+    """!
+    @brief JSON codec using the orjson library.
+
+    Documents and objects that orjson handles differently from the standard library fall back to StdlibJsonCodec: integers too big for 64 bits, which orjson would decode as floats or refuse to encode, the non-standard NaN and Infinity literals and objects with keys that aren't strings. Output still differs in that it's compact (no spaces after separators) and NaN and infinite floats are encoded as null, so orjson is only used to encode when this codec is selected by name (see AutoJsonCodec).
+    """
+
+    name = "orjson"
+
+    ## Length of the shortest run of digits that could be an integer orjson can't decode exactly. Documents containing such a run (even in a string) are decoded by the standard library.
+    LONG_DIGITS = 19
+
+    ## Translation table mapping every digit to 0, so that runs of digits can be found with a substring search, which is much cheaper than a regular expression
+    DIGITS_TO_ZERO = (bytes.maketrans if (six.PY3) else string.maketrans)(b"123456789", b"000000000")
+
+    ## Text equivalent of LONG_DIGITS, for documents that aren't bytes
+    LONG_DIGITS_TEXT = re.compile(u"[0-9]{{{0}}}".format(LONG_DIGITS))
+
+    def __init__(self):
+        """!
+        Constructor. Raises ImportError if orjson isn't installed.
+        """
+        import orjson
+        self._orjson = orjson
+        self._fallback = StdlibJsonCodec()
+        self._zeros = b"0" * self.LONG_DIGITS
+
+    def decode(self, data):
+        """!
+        @see JsonCodec
+        """
+        if (isinstance(data, six.binary_type)):
+            long_digits = (self._zeros in data.translate(self.DIGITS_TO_ZERO))
+        else:
+            long_digits = (self.LONG_DIGITS_TEXT.search(data) is not None)
+
+        if (long_digits):
+            return self._fallback.decode(data)
+
+        try:
+            return self._orjson.loads(data)
+        except self._orjson.JSONDecodeError:
+            # The standard library accepts some documents orjson doesn't, and raises its own error for the rest
+            return self._fallback.decode(data)
+
+    def encode(self, obj):
+        """!
+        @see JsonCodec
+        """
+        try:
+            return self._orjson.dumps(obj, default=_encode_default)
+        except TypeError:
+            return self._fallback.encode(obj)
+
+class SimdjsonCodec(JsonCodec):
+    """!
+    JSON codec using the pysimdjson library for decoding. pysimdjson doesn't provide its own encoder, so encoding uses the standard library.
+
+    Documents that pysimdjson can't decode, such as those containing integers too big for 64 bits or the non-standard NaN and Infinity literals, fall back to the standard library, which raises its own error if the document isn't valid.
+    """
+
+    name = "simdjson"
+
+    def __init__(self):
+        """!
+        Constructor. Raises ImportError if pysimdjson isn't installed.
+        """
+        import simdjson
+        self._simdjson = simdjson
+        self._encoder = StdlibJsonCodec()
+
+    def decode(self, data):
+        """!
+        @see JsonCodec
+        """
+        try:
+            return self._simdjson.loads(data)
+        except (ValueError, RuntimeError):
+            return self._encoder.decode(data)
+
+    def encode(self, obj):
+        """!
+        @see JsonCodec
+        """
+        return self._encoder.encode(obj)
+
+class UjsonCodec(JsonCodec):
+    """!
+    @brief JSON codec using the ujson library.
+
+    Documents and objects that ujson can't handle (such as integers too big for 64 bits, in versions of ujson before 2.0) fall back to StdlibJsonCodec. Forward slashes aren't escaped, as they aren't by the standard library, but output is compact (no spaces after separators).
+    """
+
+    name = "ujson"
+
+    def __init__(self):
+        """!
+        Constructor. Raises ImportError if ujson isn't installed.
+        """
+        import ujson
+        self._ujson = ujson
+        self._fallback = StdlibJsonCodec()
+
+    def decode(self, data):
+        """!
+        @see JsonCodec
+        """
+        try:
+            return self._ujson.loads(data)
+        except ValueError:
+            # The standard library raises its own error if the document isn't valid
+            return self._fallback.decode(data)
+
+    def encode(self, obj):
+        """!
+        @see JsonCodec
+        """
+        try:
+            return self._ujson.dumps(obj, default=_encode_default, escape_forward_slashes=False).encode("utf-8")
+        except (OverflowError, TypeError):
+            return self._fallback.encode(obj)
+
+class AutoJsonCodec(JsonCodec):
+    """!
+    @brief The codec named "auto". Decodes using the first available codec in CODEC_CLASSES order, and encodes using StdlibJsonCodec.
+
+    Installing a faster JSON library therefore speeds up reading without changing what's written. Select a codec by name to encode using its library too.
+    """
+
+    name = "auto"
+
+    def __init__(self, decoder):
+        """!
+        Constructor.
+
+        @param decoder JsonCodec: the codec with which to decode documents
+        """
+
+        ## @var decoder
+        # The codec with which documents are decoded
+        self.decoder = decoder
+
+        self._encoder = StdlibJsonCodec()
+
+    def decode(self, data):
+        """!
+        @see JsonCodec
+        """
+        return self.decoder.decode(data)
+
+    def encode(self, obj):
+        """!
+        @see JsonCodec
+        """
+        return self._encoder.encode(obj)
+
+## Codec classes in order of preference when automatically selecting a codec with which to decode
+CODEC_CLASSES = [OrjsonCodec, SimdjsonCodec, UjsonCodec, StdlibJsonCodec]
+
+_codecs = {}
+_default_codec_name = "auto"
+
+def codec_names():
+    """!
+    Provides the names of all supported codecs, whether or not they're available.
+
+    @return a list of codec names, including "auto"
+    """
+    return ["auto"] + [codec_class.name for codec_class in CODEC_CLASSES]
+
+def get_codec(name = "auto"):
+    """!
+    Gets a codec by name. Codecs are created once per process and shared.
+
+    @param name string: name of the codec, or "auto" for an AutoJsonCodec, which decodes using the first available codec in CODEC_CLASSES order and encodes using the standard library. Codecs that aren't natively order-preserving are never selected automatically on Python versions whose dicts don't preserve insertion order.
+
+    @return the JsonCodec object
+    """
+    if (name in _codecs):
+        return _codecs[name]
+
+    codec = None
+    if (name == "auto"):
+        for codec_class in CODEC_CLASSES:
+            if ((codec_class is not StdlibJsonCodec) and (not DICTS_ORDERED)):
+                continue
+
+            try:
+                codec = AutoJsonCodec(get_codec(codec_class.name))
+                break
+            except weaveq.wqexception.ConfigurationError:
+                pass
+    else:
+        codec_class = None
+        for candidate_class in CODEC_CLASSES:
+            if (candidate_class.name == name):
+                codec_class = candidate_class
+
+        if (codec_class is None):
+            raise weaveq.wqexception.ConfigurationError("Unknown JSON codec '{0}'. Valid codecs are: {1}".format(name, ", ".join(codec_names())))
+
+        try:
+            codec = codec_class()
+        except ImportError:
+            raise weaveq.wqexception.ConfigurationError("The JSON codec '{0}' isn't available because its library isn't installed".format(name))
+
+    _codecs[name] = codec
+    return codec
+
+def set_default_codec(name):
+    """!
+    Sets the codec returned by default_codec().
+
+    @param name string: name of the codec, or "auto"
+    """
+    global _default_codec_name
+
+    # Fail early if the codec isn't available
+    get_codec(name)
+    _default_codec_name = name
+
+def default_codec():
+    """!
+    Gets the codec that data sources and result handlers should use unless told otherwise.
+
+    @return the JsonCodec object
+    """
+    return get_codec(_default_codec_name)
+
+class ResultEncoder(object):
+    """!
+    Encodes query results as JSON documents for output. Encoders can be pickled, so that results can be encoded by worker processes.
+    """
+
+    def __init__(self, codec = None, passthrough = False):
+        """!
+        Constructor.
+
+        @param codec JsonCodec: codec with which to encode results. If @c None, the default codec is used.
+        @param passthrough boolean: if @c True, results that carry the raw JSON document from which they were decoded (such as LazyJsonRecord objects) and haven't been changed since are encoded as that document
+        """
+
+        ## @var codec
+        # Codec used to encode results
+        self.codec = default_codec() if (codec is None) else codec
+
+        ## @var passthrough
+        # Are unchanged results encoded as their raw documents?
+        self.passthrough = passthrough
+
+    def __getstate__(self):
+        return {"codec_name":self.codec.name, "passthrough":self.passthrough}
+
+    def __setstate__(self, state):
+        self.__init__(get_codec(state["codec_name"]), state["passthrough"])
+
+    def __call__(self, result):
+        """!
+        Encodes a result.
+
+        @param result object: the result to encode
+
+        @return the UTF-8 encoded JSON document as bytes, without a line terminator
+        """
+        if (self.passthrough):
+            document = result.raw_document() if (hasattr(result, "raw_document")) else None
+            if (document is not None):
+                return document
+
+        return self.codec.encode(result)
+
+class LazyJsonDecoder(object):
+    """!
+    @brief Decodes JSON objects to LazyJsonRecord objects, extracting only a set of key fields up front.
+
+    When pysimdjson is installed (and dicts preserve insertion order), key fields are extracted without building Python objects for the rest of the document, which is substantially cheaper than decoding it in full. Otherwise, the document is decoded in full with the codec and everything other than the key fields is discarded, which saves memory but not time.
+
+    Documents that aren't JSON objects are decoded in full and returned as is.
+    """
+
+    def __init__(self, key_fields, codec = None):
+        """!
+        Constructor.
+
+        @param key_fields list: names of the fields to extract up front, in dot notation for nested fields. The whole of the top-level member containing each field is extracted.
+        @param codec JsonCodec: codec with which to decode records in full. If @c None, the default codec is used.
+        """
+
+        ## @var key_roots
+        # Names of the top-level members extracted up front
+        self.key_roots = frozenset([field.split(".")[0] for field in key_fields])
+
+        ## @var codec
+        # Codec used to decode records in full
+        self.codec = default_codec() if (codec is None) else codec
+
+        self._parser = None
+        if (DICTS_ORDERED):
+            try:
+                import simdjson
+                self._parser = simdjson.Parser()
+            except ImportError:
+                pass
+
+    def __getstate__(self):
+        return {"key_roots":self.key_roots, "codec_name":self.codec.name}
+
+    def __setstate__(self, state):
+        self.__init__(state["key_roots"], get_codec(state["codec_name"]))
+
+    @staticmethod
+    def _to_python(value):
+        if (hasattr(value, "as_dict")):
+            return value.as_dict()
+        elif (hasattr(value, "as_list")):
+            return value.as_list()
+
+        return value
+
+    def decode(self, data):
+        """!
+        Decodes a JSON document.
+
+        @param data bytes: UTF-8 encoded JSON document
+
+        @return a LazyJsonRecord object if the document is a JSON object, otherwise the decoded value
+        """
+        keys = {}
+
+        document = None
+        if (self._parser is not None):
+            try:
+                document = self._parser.parse(data)
+            except (ValueError, RuntimeError):
+                # Such as integers too big for 64 bits, which the codec handles
+                document = None
+
+        if (document is not None):
+            if (not hasattr(document, "as_dict")):
+                return self._to_python(document)
+
+            for root in self.key_roots:
+                try:
+                    keys[root] = self._to_python(document[root])
+                except KeyError:
+                    pass
+        else:
+            document = self.codec.decode(data)
+            if (not isinstance(document, Mapping)):
+                return document
+
+            for root in self.key_roots:
+                if (root in document):
+                    keys[root] = document[root]
+
+        return LazyJsonRecord(data, self, keys)
+
+class LazyJsonRecord(MutableMapping):
+    """!
+    @brief A JSON object that is only decoded in full when something other than its key fields is accessed.
+
+    Records keep the raw JSON document from which they were decoded. Reading a key field (see LazyJsonDecoder) is served from the values extracted when the record was created. Anything else - reading or writing other members, iterating over the record or taking its length - decodes the document in full first.
+
+    Records track whether members have been set or deleted since they were decoded, so that unchanged records can be output as their raw documents (see raw_document()). Changes made to the values of members in place (such as appending to a list) aren't tracked.
+    """
+
+    __slots__ = ("raw", "_decoder", "_keys", "_record", "_modified")
+
+    def __init__(self, raw, decoder, keys):
+        """!
+        Constructor. Records are normally created by LazyJsonDecoder.decode().
+
+        @param raw bytes: the raw JSON document
+        @param decoder LazyJsonDecoder: the decoder that created the record
+        @param keys dict: values of the key fields present in the document, keyed by top-level member name
+        """
+
+        ## @var raw
+        # The raw JSON document
+        self.raw = raw
+
+        self._decoder = decoder
+        self._keys = keys
+        self._record = None
+        self._modified = False
+
+    def decoded(self):
+        """!
+        Has the document been decoded in full?
+
+        @return @c True if it has, @c False otherwise
+        """
+        return (self._record is not None)
+
+    def raw_document(self):
+        """!
+        Provides the raw JSON document, if it still represents the record.
+
+        @return the raw document as bytes, without a line terminator, or @c None if members of the record have been set or deleted
+        """
+        if (self._modified):
+            return None
+
+        return self.raw.rstrip(b"\r\n")
+
+    def _materialise(self):
+        if (self._record is None):
+            self._record = self._decoder.codec.decode(self.raw)
+            self._keys = None
+
+        return self._record
+
+    def __getitem__(self, key):
+        if ((self._record is None) and (key in self._decoder.key_roots)):
+            return self._keys[key]
+
+        return self._materialise()[key]
+
+    def __setitem__(self, key, value):
+        self._materialise()[key] = value
+        self._modified = True
+
+    def __delitem__(self, key):
+        del self._materialise()[key]
+        self._modified = True
+
+    def __iter__(self):
+        return iter(self._materialise())
+
+    def __len__(self):
+        return len(self._materialise())
+
+    def __repr__(self):
+        return repr(self._materialise())
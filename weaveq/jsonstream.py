@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+
+"""!
+@package weaveq.jsonstream Incremental reading of the elements of large root-level JSON arrays.
+"""
+
+# Copyright 2017 James Mistry.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+from __future__ import print_function, absolute_import
+import re
+import six
+
+import weaveq.jsoncodec
+import weaveq.wqexception
+
+## Whitespace
+_WHITESPACE = re.compile(br"\s*")
+
+## Whitespace and element separators
+_SEPARATORS = re.compile(br"[\s,]*")
+
+## A complete string. Patterns are written in "unrolled loop" form, so that there's only ever one way to match and failed matches don't backtrack exponentially.
+_STRING_PATTERN = br'"[^"\\]*(?:\\.[^"\\]*)*"'
+
+## Anything other than brackets and strings
+_OTHER_PATTERN = br'[^"\[\]{}]*'
+
+## Everything up to the next bracket or unterminated string, skipping complete strings
+_CONTENT = re.compile(_OTHER_PATTERN + br"(?:" + _STRING_PATTERN + _OTHER_PATTERN + br")*")
+
+## A complete string
+_STRING = re.compile(_STRING_PATTERN)
+
+## A number, boolean or null
+_SCALAR = re.compile(br"[^\s,\]]+")
+
+def _nested_pattern(depth):
+    # Matches a complete object or array nested no more than depth levels deep. Mismatched brackets are left for the codec to reject.
+    pattern = br"[\[{]" + _OTHER_PATTERN + br"(?:" + _STRING_PATTERN + _OTHER_PATTERN + br")*[\]}]"
+    for level in six.moves.range(depth - 1):
+        pattern = br"[\[{]" + _OTHER_PATTERN + br"(?:(?:" + _STRING_PATTERN + br"|" + pattern + br")" + _OTHER_PATTERN + br")*[\]}]"
+
+    return re.compile(pattern)
+
+## A complete object or array, unless deeply nested. Matching common elements in one go is much faster than scanning them a bracket at a time.
+_SHALLOW_CONTAINER = _nested_pattern(4)
+
+class JsonArrayReader(object):
+    """!
+    @brief Iterates over the elements of a JSON document whose root element is an array, without reading the whole document into memory.
+
+    The document is read in fixed-size blocks. Element boundaries are found by scanning the raw bytes for brackets outside strings, and each element is decoded on its own with a weaveq.jsoncodec.JsonCodec. Memory use is therefore bounded by the size of the largest element plus the block size, rather than by the size of the document.
+
+    The reader records the byte offset reached in the document, which can be used to report progress.
+    """
+
+    def __init__(self, file_object, codec = None, block_size = 1024 * 1024):
+        """!
+        Constructor.
+
+        @param file_object file: file object, opened in binary mode, from which to read the document
+        @param codec weaveq.jsoncodec.JsonCodec: codec with which to decode elements. If @c None, the default codec is used.
+        @param block_size int: number of bytes to read from the file at a time
+        """
+        self._file = file_object
+        self._codec = weaveq.jsoncodec.default_codec() if (codec is None) else codec
+        self._block_size = block_size
+
+        self._buffer = b""
+        self._buffer_offset = 0
+        self._position = 0
+        self._eof = False
+        self._started = False
+        self._finished = False
+
+        ## @var offset
+        # Byte offset in the document of the end of the last element read
+        self.offset = 0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return self.next()
+
+    def _read(self):
+        """!
+        Appends another block to the buffer.
+
+        @return @c False if the end of the file has been reached, @c True otherwise
+        """
+        if (self._eof):
+            return False
+
+        block = self._file.read(self._block_size)
+        if (len(block) == 0):
+            self._eof = True
+            return False
+
+        self._buffer += block
+        return True
+
+    def _compact(self):
+        # Only discard consumed data once there's a reasonable amount of it, to avoid copying the buffer for every element
+        if (self._position >= self._block_size):
+            self._buffer = self._buffer[self._position:]
+            self._buffer_offset += self._position
+            self._position = 0
+
+    def _skip(self, pattern):
+        """!
+        Skips past whitespace or separators, reading more of the file as necessary.
+
+        @return @c False if the end of the file was reached before anything else, @c True otherwise
+        """
+        while (True):
+            self._position = pattern.match(self._buffer, self._position).end()
+            if (self._position < len(self._buffer)):
+                return True
+
+            if (not self._read()):
+                return False
+
+    def _unexpected_end(self):
+        raise weaveq.wqexception.DataSourceError("Unexpected end of JSON document at byte offset {0}: the root array isn't terminated".format(self._buffer_offset + len(self._buffer)))
+
+    def _start(self):
+        self._read()
+        if (self._buffer.startswith(b"\xef\xbb\xbf")):
+            self._position = 3
+
+        if ((not self._skip(_WHITESPACE)) or (self._buffer[self._position:self._position + 1] != b"[")):
+            raise weaveq.wqexception.DataSourceError("The json data source requires that JSON documents contain lists as their root elements")
+
+        self._position += 1
+        self._started = True
+
+    def _element_end(self, start):
+        """!
+        Finds the end of the element starting at a position in the buffer, reading more of the file as necessary.
+
+        @param start int: position of the first byte of the element
+
+        @return the position in the buffer immediately after the element
+        """
+        first = self._buffer[start:start + 1]
+        if ((first == b"{") or (first == b"[")):
+            match = _SHALLOW_CONTAINER.match(self._buffer, start)
+            if (match is not None):
+                return match.end()
+
+            depth = 0
+            position = start
+            while (True):
+                position = _CONTENT.match(self._buffer, position).end()
+                if ((position >= len(self._buffer)) or (self._buffer[position:position + 1] == b'"')):
+                    # The buffer ends part way through the element
+                    if (not self._read()):
+                        self._unexpected_end()
+
+                    continue
+
+                if (self._buffer[position:position + 1] in (b"{", b"[")):
+                    depth += 1
+                else:
+                    depth -= 1
+
+                position += 1
+                if (depth == 0):
+                    return position
+
+        pattern = _STRING if (first == b'"') else _SCALAR
+        while (True):
+            match = pattern.match(self._buffer, start)
+            if ((match is not None) and (match.end() < len(self._buffer))):
+                return match.end()
+
+            if (not self._read()):
+                if (match is None):
+                    self._unexpected_end()
+
+                return match.end()
+
+    def next(self):
+        """!
+        Reads the next element of the root array.
+
+        @return the decoded element
+        """
+        if (self._finished):
+            raise StopIteration
+
+        if (not self._started):
+            self._start()
+
+        self._compact()
+        if (not self._skip(_SEPARATORS)):
+            self._unexpected_end()
+
+        start = self._position
+        if (self._buffer[start:start + 1] == b"]"):
+            self._finished = True
+            self._position += 1
+            self.offset = self._buffer_offset + self._position
+            raise StopIteration
+
+        end = self._element_end(start)
+        element = self._codec.decode(self._buffer[start:end])
+
+        self._position = end
+        self.offset = self._buffer_offset + end
+
+        return element
@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+
+"""!
+@package weaveq.keyindex Sidecar key index files for random-access lookups into JSON lines files.
+"""
+
+# Copyright 2017 James Mistry.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+from __future__ import print_function, absolute_import
+import os
+import json
+import sqlite3
+import six
+
+import weaveq.query
+import weaveq.jsoncodec
+import weaveq.compression
+import weaveq.wqexception
+
+class KeyIndex(object):
+    """!
+    @brief A sidecar file mapping the values of one or more fields in a JSON lines file to the byte offsets of the lines containing them.
+
+    The sidecar is an SQLite database stored alongside the source file. Each indexed field records the size and modification time of the source file at the time it was indexed, and an index is only considered valid while these are unchanged. Invalid indexes are never used for lookups; they must be rebuilt.
+    """
+
+    ## Suffix appended to the source filename to form the sidecar filename
+    SUFFIX = ".wqidx"
+
+    ## Maximum number of values to include in a single lookup statement
+    LOOKUP_CHUNK_SIZE = 500
+
+    def __init__(self, source_filename):
+        """!
+        Constructor.
+
+        @param source_filename string: path to the JSON lines file that is (or is to be) indexed
+        """
+
+        ## @var source_filename
+        # Path to the indexed JSON lines file
+        self.source_filename = source_filename
+
+        ## @var index_filename
+        # Path to the sidecar index file
+        self.index_filename = "{0}{1}".format(source_filename, KeyIndex.SUFFIX)
+
+    @staticmethod
+    def encode_key(value):
+        """!
+        Converts a field value to the string under which it is stored in the index.
+
+        Values that compare equal in Python (and are therefore treated as equal by WeaveQ indexes) are encoded identically, so booleans and integral floats are encoded as integers.
+
+        @param value object: the field value to encode
+
+        @return the encoded key string
+        """
+        if (isinstance(value, bool)):
+            value = int(value)
+        elif ((isinstance(value, float)) and (value.is_integer())):
+            value = int(value)
+
+        return json.dumps(value, sort_keys=True, separators=(",", ":"))
+
+    def _source_signature(self):
+        stat = os.stat(self.source_filename)
+        mtime = stat.st_mtime_ns if hasattr(stat, "st_mtime_ns") else int(stat.st_mtime * 1000000000)
+        return (stat.st_size, mtime)
+
+    def _connect(self):
+        connection = sqlite3.connect(self.index_filename)
+        connection.execute("CREATE TABLE IF NOT EXISTS fields (name TEXT PRIMARY KEY, source_size INTEGER, source_mtime INTEGER)")
+        connection.execute("CREATE TABLE IF NOT EXISTS entries (field TEXT, key TEXT, offset INTEGER)")
+        connection.execute("CREATE INDEX IF NOT EXISTS entries_by_key ON entries (field, key)")
+        return connection
+
+    def build(self, field):
+        """!
+        Indexes a field, replacing any existing index entries for it.
+
+        Lines that don't contain the field are not indexed, and so can never be returned by a lookup on it.
+
+        @param field string: name of the field to index, in dot notation for nested fields
+
+        @return the number of lines indexed
+        """
+        if (weaveq.compression.detect(self.source_filename) is not None):
+            raise weaveq.wqexception.DataSourceError("Couldn't index {0}: compressed files can't be indexed".format(self.source_filename))
+
+        signature = self._source_signature()
+        indexed_count = 0
+        codec = weaveq.jsoncodec.default_codec()
+
+        connection = self._connect()
+        try:
+            with connection:
+                connection.execute("DELETE FROM entries WHERE field = ?", (field,))
+                connection.execute("DELETE FROM fields WHERE name = ?", (field,))
+
+                entries = []
+                with open(self.source_filename, "rb") as source_file:
+                    offset = 0
+                    for line in source_file:
+                        line_offset = offset
+                        offset += len(line)
+
+                        if (len(line.strip()) == 0):
+                            continue
+
+                        try:
+                            record = codec.decode(line)
+                        except ValueError as e:
+                            raise weaveq.wqexception.DataSourceError("Couldn't index {0}: invalid JSON at byte offset {1}: {2}".format(self.source_filename, line_offset, str(e)))
+
+                        value = weaveq.query.NestedField(record, field)
+                        if (value.exists()):
+                            entries.append((field, KeyIndex.encode_key(value.value()), line_offset))
+                            indexed_count += 1
+
+                        if (len(entries) >= 10000):
+                            connection.executemany("INSERT INTO entries VALUES (?, ?, ?)", entries)
+                            entries = []
+
+                if (len(entries) > 0):
+                    connection.executemany("INSERT INTO entries VALUES (?, ?, ?)", entries)
+
+                connection.execute("INSERT INTO fields VALUES (?, ?, ?)", (field, signature[0], signature[1]))
+        finally:
+            connection.close()
+
+        return indexed_count
+
+    def valid(self, field):
+        """!
+        Is there an up-to-date index of a field?
+
+        @param field string: name of the field
+
+        @return @c True if the field is indexed and the source file hasn't changed since it was, @c False otherwise
+        """
+        if (not os.path.exists(self.index_filename)):
+            return False
+
+        connection = self._connect()
+        try:
+            row = connection.execute("SELECT source_size, source_mtime FROM fields WHERE name = ?", (field,)).fetchone()
+        finally:
+            connection.close()
+
+        if (row is None):
+            return False
+
+        return (tuple(row) == self._source_signature())
+
+    def offsets(self, key_values):
+        """!
+        Finds the byte offsets of the lines containing any of a set of field values.
+
+        The caller is responsible for checking the validity of the index for each field first.
+
+        @param key_values list: (field name, iterable of values) tuples
+
+        @return a sorted list of unique line offsets
+        """
+        result = set()
+
+        connection = self._connect()
+        try:
+            for field, values in key_values:
+                keys = [KeyIndex.encode_key(value) for value in values]
+                for chunk_start in six.moves.range(0, len(keys), KeyIndex.LOOKUP_CHUNK_SIZE):
+                    chunk = keys[chunk_start:chunk_start + KeyIndex.LOOKUP_CHUNK_SIZE]
+                    statement = "SELECT offset FROM entries WHERE field = ? AND key IN ({0})".format(",".join(["?"] * len(chunk)))
+                    for row in connection.execute(statement, [field] + chunk):
+                        result.add(row[0])
+        finally:
+            connection.close()
+
+        return sorted(result)
@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+
+"""!
+@package weaveq.parallel Memory-mapped, parallel readers for files of line-delimitted records.
+"""
+
+# Copyright 2017 James Mistry.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+from __future__ import print_function, absolute_import
+import io
+import os
+import sys
+import csv
+import mmap
+import multiprocessing
+
+import weaveq.jsoncodec
+import weaveq.wqexception
+
+def line_chunks(filename, chunk_size):
+    """!
+    Splits a file into byte ranges of approximately equal size that start and end on line boundaries.
+
+    @param filename string: path to the file to split
+    @param chunk_size int: target size of each byte range, in bytes. Ranges are extended to the end of the line in which they would otherwise end.
+
+    @return a list of (filename, start offset, end offset) tuples, where the end offset is exclusive
+    """
+    chunks = []
+    file_size = os.path.getsize(filename)
+    if (file_size == 0):
+        return chunks
+
+    with open(filename, "rb") as source_file:
+        mapped_file = mmap.mmap(source_file.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            start = 0
+            while (start < file_size):
+                end = mapped_file.find(b"\n", min(start + chunk_size, file_size) - 1)
+                end = file_size if (end == -1) else end + 1
+                chunks.append((filename, start, end))
+                start = end
+        finally:
+            mapped_file.close()
+
+    return chunks
+
+def _csv_record_boundary(mapped_file, start, target, file_size):
+    """!
+    Finds the first CSV record boundary at or after a target offset.
+
+    A line break ends a record unless it's inside a quoted cell. Quotes inside quoted cells are escaped by doubling them, so a line break is outside quoted cells if, and only if, an even number of quote characters precede it.
+
+    @param mapped_file mmap: the memory-mapped file
+    @param start int: offset of a record boundary before the target
+    @param target int: offset at or after which to find a record boundary
+    @param file_size int: size of the file in bytes
+
+    @return the offset of the start of the first record to start at or after the target, or the file size if there isn't one
+    """
+    position = max(target - 1, start)
+    quotes = mapped_file[start:position].count(b'"')
+    while (True):
+        newline = mapped_file.find(b"\n", position)
+        if (newline == -1):
+            return file_size
+
+        quotes += mapped_file[position:newline].count(b'"')
+        if ((quotes % 2) == 0):
+            return newline + 1
+
+        position = newline + 1
+
+def csv_chunks(filename, chunk_size, skip_first_record = False):
+    """!
+    Splits a CSV file into byte ranges of approximately equal size that start and end on record boundaries, taking account of line breaks inside quoted cells.
+
+    Files must follow the quoting rules described by weaveq.datasources.CsvDataSource: quote characters may only appear at the start and end of quoted cells, or doubled inside them.
+
+    @param filename string: path to the file to split
+    @param chunk_size int: target size of each byte range, in bytes. Ranges are extended to the end of the record in which they would otherwise end.
+    @param skip_first_record boolean: if @c True, the first record (such as a row of field names) isn't included in any range
+
+    @return a list of (filename, start offset, end offset) tuples, where the end offset is exclusive
+    """
+    chunks = []
+    file_size = os.path.getsize(filename)
+    if (file_size == 0):
+        return chunks
+
+    with open(filename, "rb") as source_file:
+        mapped_file = mmap.mmap(source_file.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            start = _csv_record_boundary(mapped_file, 0, 1, file_size) if (skip_first_record) else 0
+            while (start < file_size):
+                end = _csv_record_boundary(mapped_file, start, min(start + chunk_size, file_size), file_size)
+                chunks.append((filename, start, end))
+                start = end
+        finally:
+            mapped_file.close()
+
+    return chunks
+
+def decode_csv_chunk(chunk):
+    """!
+    Parses the CSV records in a byte range of a file. Intended to be run in a worker process.
+
+    @param chunk tuple: (filename, start offset, end offset, row builder), where the first three elements are as produced by csv_chunks() and the row builder is a weaveq.csvrecord.RowBuilder configured for the file
+
+    @return a list of the records built, in the order they appear in the file
+    """
+    filename, start, end, builder = chunk[0:4]
+
+    with open(filename, "rb") as source_file:
+        mapped_file = mmap.mmap(source_file.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            data = mapped_file[start:end]
+        finally:
+            mapped_file.close()
+
+    if (sys.version_info.major >= 3):
+        rows = csv.reader(io.StringIO(data.decode("utf-8"), newline=""))
+    else:
+        rows = ([unicode(column, encoding="utf-8") for column in row] for row in csv.reader(io.BytesIO(data)))
+
+    records = []
+    try:
+        for row in rows:
+            records.append(builder.build(row))
+    except ValueError as e:
+        raise weaveq.wqexception.DataSourceError("Can't read a row between byte offsets {0} and {1} of {2}: {3}".format(start, end, filename, str(e)))
+
+    return records
+
+def decode_json_lines_chunk(chunk):
+    """!
+    Decodes the JSON lines in a byte range of a file. Intended to be run in a worker process.
+
+    Lines containing only whitespace are ignored.
+
+    @param chunk tuple: (filename, start offset, end offset, JSON codec name, key fields), where the first three elements are as produced by line_chunks(). If key fields is a list rather than @c None, records are decoded lazily using a weaveq.jsoncodec.LazyJsonDecoder that extracts them up front. The key fields element may be omitted.
+
+    @return a list of the decoded records, in the order they appear in the file
+    """
+    filename, start, end, codec_name = chunk[0:4]
+    key_fields = chunk[4] if (len(chunk) > 4) else None
+
+    codec = weaveq.jsoncodec.get_codec(codec_name)
+    if (key_fields is not None):
+        codec = weaveq.jsoncodec.LazyJsonDecoder(key_fields, codec)
+    records = []
+
+    with open(filename, "rb") as source_file:
+        mapped_file = mmap.mmap(source_file.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            data = mapped_file[start:end]
+        finally:
+            mapped_file.close()
+
+    for line in data.split(b"\n"):
+        if (len(line.strip()) > 0):
+            records.append(codec.decode(line))
+
+    return records
+
+def _decode_tagged_chunk(decoder_and_chunk):
+    """!
+    Decodes a chunk, tagging the resulting batch with the name of the file from which it was decoded.
+
+    @param decoder_and_chunk tuple: (decoder function, chunk tuple)
+
+    @return a (filename, list of records) tuple
+    """
+    decoder, chunk = decoder_and_chunk
+    return (chunk[0], decoder(chunk))
+
+class ChunkReader(object):
+    """!
+    @brief Reads chunks of one or more files in parallel using a pool of worker processes.
+
+    Each chunk is decoded into a batch (list) of records by a worker process. Batches can either be delivered in file order, or in the order in which workers finish decoding them.
+    """
+
+    def __init__(self, workers, chunk_size):
+        """!
+        Constructor.
+
+        @param workers int: number of worker processes to use. If 0, one worker per CPU is used.
+        @param chunk_size int: target size of each chunk, in bytes
+        """
+
+        ## @var workers
+        # Number of worker processes
+        self.workers = workers if (workers > 0) else multiprocessing.cpu_count()
+
+        ## @var chunk_size
+        # Target chunk size in bytes
+        self.chunk_size = chunk_size
+
+    def read_batches(self, filenames, decoder, decoder_args=(), ordered=True, with_filenames=False, chunker=line_chunks):
+        """!
+        Decodes the records in a set of files.
+
+        @param filenames list: paths to the files to read. Files are read in the order given when @p ordered is @c True.
+        @param decoder function: module-level function that decodes a chunk, such as decode_json_lines_chunk()
+        @param decoder_args tuple: additional arguments for the decoder, appended to each chunk tuple passed to it
+        @param chunker function: called in this process with a file path and the chunk size, returns the file's chunk tuples, such as line_chunks() (the default) or csv_chunks()
+        @param ordered boolean: if @c True, batches are delivered in file order. If @c False, they're delivered as soon as they've been decoded.
+        @param with_filenames boolean: if @c True, each batch is delivered as a (filename, list of records) tuple identifying the file from which it was decoded
+
+        @return a generator iterator producing lists of records
+        """
+        chunks = []
+        for filename in filenames:
+            for chunk in chunker(filename, self.chunk_size):
+                chunks.append(chunk + tuple(decoder_args))
+
+        if (len(chunks) == 0):
+            return
+
+        if (with_filenames):
+            chunks = [(decoder, chunk) for chunk in chunks]
+            decoder = _decode_tagged_chunk
+
+        pool = multiprocessing.Pool(min(self.workers, len(chunks)))
+        try:
+            batches = pool.imap(decoder, chunks) if ordered else pool.imap_unordered(decoder, chunks)
+            for batch in batches:
+                yield batch
+
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
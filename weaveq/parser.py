@@ -79,7 +79,7 @@ class TextQuery(object):
         self._field_expr = pyparsing.infixNotation(self._field_relationship, [(pyparsing.Keyword("and"), 2, pyparsing.opAssoc.LEFT), (pyparsing.Keyword("or"), 2, pyparsing.opAssoc.LEFT),]).setResultsName("field_relations")
         self._where_clause = pyparsing.Keyword("#where") - self._field_expr
         self._filter_expr = pyparsing.QuotedString(quoteChar="|", escChar="\\")
-        self._source_spec = self._string_literal.setResultsName("source_uri") - pyparsing.Keyword("#as") - self._identifier.setResultsName("source_alias") - pyparsing.Optional(pyparsing.Keyword("#filter") - self._filter_expr.setResultsName("source_filter_string"))
+        self._source_spec = self._string_literal.setResultsName("source_uri") - pyparsing.Keyword("#as") - self._identifier.setResultsName("source_alias") - pyparsing.Optional(pyparsing.Keyword("#filter") - self._filter_expr.setResultsName("source_filter_string")) - pyparsing.Optional(pyparsing.Keyword("#select") - pyparsing.Group(pyparsing.delimitedList(self._identifier)).setResultsName("source_select"))
         self._pivot_clause = pyparsing.Keyword("#pivot-to").setResultsName("step_action") - self._source_spec - self._where_clause
         self._join_options = (pyparsing.Keyword("#field-name") - self._identifier.setResultsName("field_name")) | pyparsing.Keyword("#exclude-empty").setResultsName("exclude_empty") | pyparsing.Keyword("#array").setResultsName("array")
         self._join_clause = pyparsing.Keyword("#join-to").setResultsName("step_action") - self._source_spec - self._where_clause - pyparsing.ZeroOrMore(self._join_options)
@@ -256,6 +256,7 @@ class TextQuery(object):
         self._parsed_query[-1]["source_uri"] = tokens.source_uri
         self._parsed_query[-1]["source_filter_string"] = filter_string
         self._parsed_query[-1]["source_alias"] = tokens.source_alias
+        self._parsed_query[-1]["source_select"] = list(tokens.source_select) if (len(tokens.source_select) > 0) else None
         self._source_by_alias[tokens.source_alias] = len(self._parsed_query) - 1
         self._parsed_query[-1]["data_source"] = data_source
 
@@ -306,6 +307,9 @@ class TextQuery(object):
                 elif (parse_result["type"] == TextQuery.STEP_TYPE_JOIN):
                     result = result.join_to(parse_result["data_source"], parse_result["field_expression"], field=parse_result["field_name"], array=parse_result["array"], exclude_empty_joins=parse_result["exclude_empty"])
 
+            if (parse_result["source_select"] is not None):
+                result = result.select(parse_result["source_select"])
+
         return result
 
     def _parse(self, query_string):
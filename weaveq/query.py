@@ -25,6 +25,144 @@ import sys
 import abc
 
 import weaveq.relations
+import weaveq.batchmatch
+
+## Target number of records in the batches that WeaveQ filters and indexes at a time
+BATCH_SIZE = 1000
+
+## Returned by field getters for fields that don't exist
+_MISSING = object()
+
+def record_batches(records, batch_size = BATCH_SIZE):
+    """!
+    Groups the records produced by an iterable into batches.
+
+    @param records iterable: the records to group
+    @param batch_size int: number of records in each batch, other than the last
+
+    @return a generator iterator producing lists of records
+    """
+    batch = []
+    for record in records:
+        batch.append(record)
+        if (len(batch) >= batch_size):
+            yield batch
+            batch = []
+
+    if (len(batch) > 0):
+        yield batch
+
+def _field_getter(field):
+    """!
+    Creates a function that reads a field from a record, in the same way as NestedField but without the overhead of creating an object per record.
+
+    @param field string: the field name in dot notation
+
+    @return a function taking a record and returning the field's value, or _MISSING if the field doesn't exist
+    """
+    path = field.split(".")
+    if (len(path) == 1):
+        name = path[0]
+        def get_field(record):
+            try:
+                return record[name]
+            except (KeyError, TypeError):
+                return _MISSING
+    else:
+        def get_field(record):
+            try:
+                for name in path:
+                    record = record[name]
+
+                return record
+            except (KeyError, TypeError):
+                return _MISSING
+
+    return get_field
+
+def _key_getter(cond_group, left):
+    """!
+    Creates a function that works out the keys of a batch of records for an equality-only condition group. Keys take the same form as those used by IndexResultHandler and WeaveQ._filter_records().
+
+    @param cond_group list: the group's conditions, which must all be equality conditions
+    @param left boolean: @c True to read the conditions' left-hand fields, @c False to read their right-hand fields
+
+    @return a function taking a list of records and returning a list of their keys, with @c None for records that don't contain every field
+    """
+    getters = []
+    for position in six.moves.range(len(cond_group)):
+        cond = cond_group[position]
+        field = cond.left_field if (left) else cond.right_field
+        proxy = cond.lhs_proxy if (left) else cond.rhs_proxy
+        getters.append((position, field, _field_getter(field), None if (type(proxy) is weaveq.relations.DefaultFieldProxy) else proxy))
+
+    if ((len(getters) == 1) and (getters[0][3] is None)):
+        # The usual case: a single field whose values are used as they are
+        get_field = getters[0][2]
+        def batch_keys(records):
+            keys = []
+            for record in records:
+                value = get_field(record)
+                keys.append(None if (value is _MISSING) else ((0, value),))
+
+            return keys
+    else:
+        def batch_keys(records):
+            keys = []
+            for record in records:
+                key = []
+                for position, field, get_field, proxy in getters:
+                    value = get_field(record)
+                    if (value is _MISSING):
+                        key = None
+                        break
+
+                    key.append((position, value if (proxy is None) else proxy(field, value)))
+
+                keys.append(None if (key is None) else tuple(key))
+
+            return keys
+
+    return batch_keys
+
+class StepPlan(object):
+    """!
+    Describes how WeaveQ will use the records a data source delivers for a query step, allowing the data source to avoid work whose results won't be used.
+    """
+    def __init__(self, ordered = True, key_fields = None, output_fields = None):
+        """!
+        Constructor.
+
+        @param ordered boolean: whether or not the step's records must be delivered in the order in which the data source would normally deliver them
+        @param key_fields list: names of the fields, in dot notation, that WeaveQ reads from every record to filter and index it. If @c None, the fields aren't known.
+        @param output_fields list: names of the fields, in dot notation, other than key fields, that are required of records that are output or joined. If @c None, all fields are required.
+        """
+
+        ## @var ordered
+        # Must the records be delivered in their natural order? Order doesn't matter for records that are only used to select the records of a subsequent pivot step.
+        self.ordered = ordered
+
+        ## @var key_fields
+        # Fields read from every record, or @c None if unknown. Other fields are only read from records that satisfy the step's conditions and are output or joined.
+        self.key_fields = key_fields
+
+        ## @var output_fields
+        # Fields other than key fields required of the records that are output or joined, or @c None if all fields are required. Empty if the step's records are only used to select the records of a subsequent pivot step.
+        self.output_fields = output_fields
+
+    def fields(self):
+        """!
+        Works out which fields of the step's records are used.
+
+        @return a list of field names in dot notation, or @c None if all fields may be used
+        """
+        if ((self.key_fields is None) or (self.output_fields is None)):
+            return None
+
+        return self.key_fields + [field for field in self.output_fields if (field not in self.key_fields)]
+
+    def __repr__(self):
+        return "<ordered={0}, key_fields={1}, output_fields={2}>".format(self.ordered, self.key_fields, self.output_fields)
 
 class DataSource(object):
     """!
@@ -64,6 +202,38 @@ class DataSource(object):
         """
         pass
 
+    def stream_batches(self, batch_size):
+        """!
+        Called instead of @c stream(), if the data source defines it, to incrementally load relevant data a batch of records at a time. WeaveQ filters and indexes whole batches at once, which costs less per record than handling records one at a time. Data sources that read records in batches anyway (for example, from worker processes) should override this method. WeaveQ groups the records produced by data sources that don't into batches itself (see record_batches()).
+
+        Data sources that don't inherit from this class needn't define this method.
+
+        @param batch_size int: the number of records WeaveQ would prefer in each batch. Data sources may deliver batches of other sizes.
+
+        @return A generator iterator that provides access to lists of result objects from the data source.
+        """
+        return record_batches(self.stream(), batch_size)
+
+    def prepare(self, plan):
+        """!
+        Called by WeaveQ before any records are requested from the data source, to describe how the records will be used. Data sources may use this information to deliver records more efficiently, but aren't required to.
+
+        @param plan StepPlan: how the records will be used
+        """
+        pass
+
+    def lookup(self, key_values):
+        """!
+        Called instead of @c batch() or @c stream() when WeaveQ knows which field values a step's records must contain to be able to satisfy the step's conditions. Data sources that can retrieve records by field value more efficiently than reading all of their data (for example, using an index) should override this method.
+
+        The records returned may be a superset of those containing the requested values: WeaveQ applies the step's conditions to them as normal.
+
+        @param key_values list: (field name, set of values) tuples. Records are required if they contain any of the values in the set for any one of the fields.
+
+        @return An iterable object that provides access to the individual result objects from the data source, or @c None if the data source can't perform the lookup (in which case WeaveQ falls back to calling @c batch() or @c stream()).
+        """
+        return None
+
 class ResultHandler(object):
     """!
     Abstract step result handler.
@@ -229,6 +399,8 @@ class IndexResultHandler(object):
         ## The number of AND'ed field conditions that are satisfied 
         self._hit_group_count = 0
 
+        self._batch_keys = None
+
     def __call__(self, result, handler_output):
         """!
         Performs the indexing. Each condition group within the index conditions specifies the name of fields that must be indexed together as AND'ed sub-expressions.
@@ -242,36 +414,86 @@ class IndexResultHandler(object):
 
         cond_group_index = 0
         for cond_group in self.index_conditions:
-            result_keys = {weaveq.relations.F.OP_EQ : [], weaveq.relations.F.OP_NE : []}
-            cond_count = 0
-            for cond in cond_group:
-                field = NestedField(result, cond.left_field)
-                if (field.exists()):
+            self._index_group(cond_group_index, cond_group, result, handler_output)
+            cond_group_index += 1
 
-                    result_key = (cond_count, cond.lhs_proxy(cond.left_field, field.value()))
-                    result_keys[cond.op].append(result_key)
+    def _index_group(self, cond_group_index, cond_group, result, handler_output):
+        """!
+        Indexes a single result according to one condition group.
 
-                    cond_count += 1
-                else:
-                    break
+        @param cond_group_index int: Index of the condition group
+        @param cond_group list: The group's conditions
+        @param result object: The result to index
+        @param handler_output object: The object index
+        """
+        result_keys = {weaveq.relations.F.OP_EQ : [], weaveq.relations.F.OP_NE : []}
+        cond_count = 0
+        for cond in cond_group:
+            field = NestedField(result, cond.left_field)
+            if (field.exists()):
 
-            if (cond_count == len(cond_group)):
-                self._hit_group_count += 1 # The object satisfies the condition group field dependencies
-                index_key_eq = tuple(result_keys[weaveq.relations.F.OP_EQ])
+                result_key = (cond_count, cond.lhs_proxy(cond.left_field, field.value()))
+                result_keys[cond.op].append(result_key)
 
-                if (len(index_key_eq) > 0):
-                    if (index_key_eq not in handler_output[cond_group_index][weaveq.relations.F.OP_EQ]):
-                        handler_output[cond_group_index][weaveq.relations.F.OP_EQ][index_key_eq] = []
+                cond_count += 1
+            else:
+                break
 
-                    handler_output[cond_group_index][weaveq.relations.F.OP_EQ][index_key_eq].append(result)
+        if (cond_count == len(cond_group)):
+            self._hit_group_count += 1 # The object satisfies the condition group field dependencies
+            index_key_eq = tuple(result_keys[weaveq.relations.F.OP_EQ])
 
-                index_keys_ne = result_keys[weaveq.relations.F.OP_NE]
-                for index_key_ne in index_keys_ne:
-                    if (index_key_ne not in handler_output[cond_group_index][weaveq.relations.F.OP_NE]):
-                        handler_output[cond_group_index][weaveq.relations.F.OP_NE][index_key_ne] = []
+            if (len(index_key_eq) > 0):
+                if (index_key_eq not in handler_output[cond_group_index][weaveq.relations.F.OP_EQ]):
+                    handler_output[cond_group_index][weaveq.relations.F.OP_EQ][index_key_eq] = []
+
+                handler_output[cond_group_index][weaveq.relations.F.OP_EQ][index_key_eq].append(result)
+
+            index_keys_ne = result_keys[weaveq.relations.F.OP_NE]
+            for index_key_ne in index_keys_ne:
+                if (index_key_ne not in handler_output[cond_group_index][weaveq.relations.F.OP_NE]):
+                    handler_output[cond_group_index][weaveq.relations.F.OP_NE][index_key_ne] = []
+
+                handler_output[cond_group_index][weaveq.relations.F.OP_NE][index_key_ne].append(result)
+
+    def handle_batch(self, results, handler_output):
+        """!
+        Indexes a batch of results, in the same way as calling the handler for each of them in turn.
+
+        @param results list: The results to index
+        @param handler_output object: The object index
+        """
+        if (len(handler_output) == 0):
+            for cond_group_index in six.moves.range(len(self.index_conditions)):
+                handler_output.append({weaveq.relations.F.OP_EQ : {}, weaveq.relations.F.OP_NE : {}})
+
+        if (self._batch_keys is None):
+            self._batch_keys = []
+            for cond_group in self.index_conditions:
+                equality_only = all([cond.op == weaveq.relations.F.OP_EQ for cond in cond_group])
+                self._batch_keys.append(_key_getter(cond_group, True) if (equality_only) else None)
+
+        cond_group_index = 0
+        for cond_group in self.index_conditions:
+            batch_keys = self._batch_keys[cond_group_index]
+            if (batch_keys is None):
+                # Groups with inequality conditions are indexed a result at a time
+                for result in results:
+                    self._index_group(cond_group_index, cond_group, result, handler_output)
+            else:
+                index = handler_output[cond_group_index][weaveq.relations.F.OP_EQ]
+                hit_count = 0
+                for result, key in zip(results, batch_keys(results)):
+                    if (key is not None):
+                        hit_count += 1
+                        matches = index.get(key)
+                        if (matches is None):
+                            index[key] = [result]
+                        else:
+                            matches.append(result)
+
+                self._hit_group_count += hit_count
 
-                    handler_output[cond_group_index][weaveq.relations.F.OP_NE][index_key_ne].append(result)
-                
             cond_group_index += 1
 
     def success(self):
@@ -347,6 +569,14 @@ class WeaveQ(object):
         # Records resulting from the final query step
         self.result = None
 
+        ## @var match_batches
+        # Whether or not to match the records of steps with a single equality condition a batch at a time (see weaveq.batchmatch)
+        self.match_batches = True
+
+        ## @var vectorise_matching
+        # Whether or not to match batches using NumPy, when it's installed and the previous step's keys are all integers (see weaveq.batchmatch.VectorisedEqualityMatcher). Off by default, because converting records' key values to NumPy arrays costs about as much as matching them with a dict.
+        self.vectorise_matching = False
+
     def result_handler(self, handler):
         """!
         Sets the query's result handler.
@@ -356,6 +586,17 @@ class WeaveQ(object):
         self._result_handler = handler
 
 
+    def select(self, fields):
+        """!
+        Specifies the fields of the most recently added step's records that are to be output or joined. Data sources that support it deliver only these fields and the fields used by the query's relationship conditions, rather than every field of their records.
+
+        @param fields list: field names in dot notation
+
+        @return A WeaveQ object representing the query so far
+        """
+        self._instructions[-1]["select"] = list(fields)
+        return self
+
     def join_to(self, data_source, rel, field=None, array=False, exclude_empty_joins=False):
         """!
         Adds a new step to the query that joins the results of the previous step with the results of the added step's data source, when the field relationships specified hold.
@@ -387,7 +628,7 @@ class WeaveQ(object):
         self._instructions.append({"op":WeaveQ.OP_PIVOT, "conditions":target_conds, "q":data_source, "conjunctions":[]})
         return self
 
-    def _filter_and_store(self, instr, response, filter_conditions, result_handler):
+    def _filter_and_store(self, instr, batches, filter_conditions, result_handler):
         """!
         Uses the previous query step's index to filter results and discard those that don't satisfy the filter conditions.
 
@@ -399,13 +640,124 @@ class WeaveQ(object):
 
         Once a right-hand result is known to match the filter conditions, it is passed to @c result_handler. This will either index the result ahead of the next query step, or if there are no further query steps, will pass the result to the client-supplied result handler.
 
+        Results are processed a batch at a time. Batches of pivot and seed step results whose filter conditions are all equality conditions (the most common case) are filtered and indexed in bulk, avoiding most of the per-result overhead of the general method. Batches of pivot and join step results with a single equality condition are instead matched against the previous step's keys in one pass (see weaveq.batchmatch.EqualityMatcher and weaveq.batchmatch.VectorisedEqualityMatcher). Everything else is processed a result at a time by @c _filter_records().
+
+        @param instr object: Current query instruction
+        @param batches object: Iterable producing lists of results from the data source
+        @param filter_conditions object: The conditions - field names and relationships - that must be used to filter the results
+        @param result_handler object: The handler that is to process the filtered results
+        """
+        filter_batch = self._batch_filter(instr, filter_conditions, result_handler)
+        for batch in batches:
+            filter_batch(batch)
+
+    def _batch_filter(self, instr, filter_conditions, result_handler):
+        """!
+        Prepares to filter and store a query step's results (see _filter_and_store()), allowing the results to be supplied a batch at a time by the caller.
+
         @param instr object: Current query instruction
-        @param response object: Data source response object/result set
         @param filter_conditions object: The conditions - field names and relationships - that must be used to filter the results
         @param result_handler object: The handler that is to process the filtered results
+
+        @return a function to call with each batch of results
         """
         self._results.append([])
 
+        batch_keys = None
+        if ((self._instruction_set[instr["op"]]["match_callback"] is None) and (all([all([cond.op == weaveq.relations.F.OP_EQ for cond in cond_group]) for cond_group in filter_conditions]))):
+            batch_keys = [_key_getter(cond_group, False) for cond_group in filter_conditions]
+
+        matcher = None
+        if ((self.match_batches) and (weaveq.batchmatch.qualifies(filter_conditions))):
+            matcher = weaveq.batchmatch.create_matcher(filter_conditions[0][0], self._results[-2][0][weaveq.relations.F.OP_EQ], self.vectorise_matching)
+
+        handle_batch = getattr(result_handler, "handle_batch", None)
+        results = self._results[-1]
+
+        def filter_batch(batch):
+            selected = None
+            if (len(filter_conditions) == 0):
+                selected = batch
+            elif ((matcher is not None) and (self._instruction_set[instr["op"]]["match_callback"] is None)):
+                selected = matcher.select(batch)
+            elif (matcher is not None):
+                matches = matcher.match(batch)
+                if (matches is not None):
+                    self._join_batch(instr, batch, matches, result_handler)
+                    return
+
+            if (selected is None):
+                if (batch_keys is not None):
+                    selected = self._select_batch(batch, batch_keys)
+                else:
+                    self._filter_records(instr, batch, filter_conditions, result_handler)
+                    return
+
+            # Index or finalise
+            if (handle_batch is not None):
+                handle_batch(selected, results)
+            else:
+                for result in selected:
+                    result_handler(result, results)
+
+        return filter_batch
+
+    def _select_batch(self, batch, batch_keys):
+        """!
+        Selects the results in a batch that satisfy at least one of a set of equality-only condition groups, by looking their keys up in the previous step's index.
+
+        @param batch list: The results to filter
+        @param batch_keys list: For each condition group, a function that works out the keys of a batch of results (see _key_getter())
+
+        @return a list of the results selected, in their original order
+        """
+        indexes = [cond_group_index[weaveq.relations.F.OP_EQ] for cond_group_index in self._results[-2]]
+
+        if (len(batch_keys) == 1):
+            index = indexes[0]
+            return [result for result, key in zip(batch, batch_keys[0](batch)) if ((key is not None) and (key in index))]
+
+        keys_by_group = [get_keys(batch) for get_keys in batch_keys]
+        selected = []
+        for position in six.moves.range(len(batch)):
+            for cond_group_index in six.moves.range(len(batch_keys)):
+                key = keys_by_group[cond_group_index][position]
+                if ((key is not None) and (key in indexes[cond_group_index])):
+                    selected.append(batch[position])
+                    break
+
+        return selected
+
+    def _join_batch(self, instr, batch, matches, result_handler):
+        """!
+        Passes the results in a batch to the match callback with each of the previous step's results they match, then to the result handler if they satisfy the step's single equality condition. Equivalent to @c _filter_records() for steps with a single equality condition, given the matches found by weaveq.batchmatch.EqualityMatcher.
+
+        @param instr object: Current query instruction
+        @param batch list: The results to filter
+        @param matches list: For each result, @c None if it doesn't contain the condition's field, otherwise the previous step's results it matches
+        @param result_handler object: The handler that is to process the filtered results
+        """
+        match_callback = self._instruction_set[instr["op"]]["match_callback"]
+        exclude_empty_matches = instr["exclude_empty_matches"]
+        for result, eq_matches in zip(batch, matches):
+            if (eq_matches is None):
+                continue
+
+            for eq_match in eq_matches:
+                match_callback(instr, result, eq_match)
+
+            if ((not exclude_empty_matches) or (len(eq_matches) > 0)):
+                result_handler(result, self._results[-1])
+
+    def _filter_records(self, instr, response, filter_conditions, result_handler):
+        """!
+        Filters results a result at a time, passing those that satisfy the filter conditions to the result handler. Used for the batches that @c _filter_and_store() can't filter in bulk.
+
+        @param instr object: Current query instruction
+        @param response object: Iterable producing results
+        @param filter_conditions object: The conditions - field names and relationships - that must be used to filter the results
+        @param result_handler object: The handler that is to process the filtered results
+        """
         for result in response:
             # Filter
 
@@ -519,18 +871,13 @@ class WeaveQ(object):
         Applies appropriate logic to a data source response based on the query step and success of the data source request.
 
         @param instr object: Current instruction object
-        @param response object: The data source's response
+        @param response object: The data source's response, as an iterable producing lists of results
         @param index_conditions: Conditions against which the response should be indexed
         @param filter_conditions: Conditions against which the response should be filtered
 
         @return @c response if successful or @c None otherwise 
         """
-        handler = None
-        if (len(index_conditions) > 0):
-            handler = IndexResultHandler(index_conditions)
-        else:
-            handler = self._result_handler
-                    
+        handler = self._step_result_handler(index_conditions)
         self._filter_and_store(instr, response, filter_conditions, handler)
 
         if (handler.success()):
@@ -539,6 +886,19 @@ class WeaveQ(object):
             return None
 
 
+    def _step_result_handler(self, index_conditions):
+        """!
+        Chooses the handler for the results of a query step that satisfy its filter conditions.
+
+        @param index_conditions: Conditions against which the results should be indexed for the next step, if any
+
+        @return an IndexResultHandler if there's a next step, otherwise the client-supplied result handler
+        """
+        if (len(index_conditions) > 0):
+            return IndexResultHandler(index_conditions)
+
+        return self._result_handler
+
     def _stage_after(self, instr):
         """!
         Deletes the previous query step's results. Used to discard data that's no longer needed. Important for multi-step queries that yield large result sets.
@@ -572,23 +932,116 @@ class WeaveQ(object):
             if (field_name not in subject):
                 subject[field_name] = match
 
+    def _lookup_keys(self, instr):
+        """!
+        Determines the right-hand field values that a step's records must contain to be able to satisfy the step's conditions, from the previous step's index.
+
+        Keys can only be determined for pivot steps and for join steps that exclude empty matches, and only if every condition group contains an equality condition whose right-hand field uses the default field proxy. Only one such condition is used per condition group, so records with the keys are a superset of those that satisfy the conditions.
+
+        @param instr object: Current instruction object
+
+        @return A list of (right-hand field name, set of values) tuples, or @c None if the keys can't be determined
+        """
+        if ((instr["conditions"] is None) or (len(self._results) == 0)):
+            return None
+
+        if ((instr["op"] == WeaveQ.OP_JOIN) and (not instr["exclude_empty_matches"])):
+            # Records are output whether or not anything is joined to them
+            return None
+
+        previous_index = self._results[-1]
+        key_values = []
+
+        cond_group_index = 0
+        for cond_group in instr["conditions"].conjunctions:
+            key_cond_index = None
+            cond_index = 0
+            for cond in cond_group:
+                if ((cond.op == weaveq.relations.F.OP_EQ) and (type(cond.rhs_proxy) is weaveq.relations.DefaultFieldProxy)):
+                    key_cond_index = cond_index
+                    break
+
+                cond_index += 1
+
+            if (key_cond_index is None):
+                return None
+
+            values = set()
+            if (cond_group_index < len(previous_index)):
+                for index_key in previous_index[cond_group_index][weaveq.relations.F.OP_EQ]:
+                    for key_cond_position, key_value in index_key:
+                        if (key_cond_position == key_cond_index):
+                            values.add(key_value)
+
+            key_values.append((cond_group[key_cond_index].right_field, values))
+            cond_group_index += 1
+
+        return key_values
+
     def _execute_instruction(self, instr):
         """!
         Request data from the data source associated with the instruction and process the response.
 
+        If the step's keys can be determined from the previous step's results and the data source supports lookups, only the records containing those keys are requested.
+
         @param instr object: Current instruction object.
 
         @return @c True if the instruction executed successfully, @c False otherwise
         """
         response = None
 
-        response = self._process_response(instr, instr["q"].stream() if instr["scroll"] else instr["q"].batch(), [] if (instr["conjunctions"] is None) else instr["conjunctions"], [] if (instr["conditions"] is None) else instr["conditions"].conjunctions)
+        source_response = None
+        key_values = self._lookup_keys(instr)
+        if ((key_values is not None) and (hasattr(instr["q"], "lookup"))):
+            source_response = instr["q"].lookup(key_values)
+
+        if (source_response is not None):
+            source_response = record_batches(source_response)
+        elif (instr["scroll"] and (hasattr(instr["q"], "stream_batches"))):
+            source_response = instr["q"].stream_batches(BATCH_SIZE)
+        else:
+            source_response = record_batches(instr["q"].stream() if instr["scroll"] else instr["q"].batch())
+
+        response = self._process_response(instr, source_response, [] if (instr["conjunctions"] is None) else instr["conjunctions"], [] if (instr["conditions"] is None) else instr["conditions"].conjunctions)
 
         if (response is None):
             return False
         else:
             return True
 
+    def _plan_step(self, stage_index):
+        """!
+        Works out how the records of a query step will be used.
+
+        @param stage_index int: Index of the step's instruction
+
+        @return a StepPlan object describing the step
+        """
+        instr = self._instructions[stage_index]
+        final_step = (stage_index == len(self._instructions) - 1)
+        joined_to_next_step = (not final_step) and (self._instructions[stage_index + 1]["op"] == WeaveQ.OP_JOIN)
+
+        # Records are filtered on the right-hand fields of the step's own conditions and indexed on the left-hand fields of the next step's conditions
+        key_fields = []
+        filter_conditions = [] if (instr["conditions"] is None) else instr["conditions"].conjunctions
+        index_conditions = [] if (instr["conjunctions"] is None) else instr["conjunctions"]
+        for cond_group in filter_conditions:
+            for cond in cond_group:
+                if (cond.right_field not in key_fields):
+                    key_fields.append(cond.right_field)
+
+        for cond_group in index_conditions:
+            for cond in cond_group:
+                if (cond.left_field not in key_fields):
+                    key_fields.append(cond.left_field)
+
+        # Only the final step's records are output and only join steps use the previous step's records for anything other than selecting their own records
+        output_fields = []
+        if (final_step or joined_to_next_step):
+            output_fields = instr.get("select")
+
+        return StepPlan(ordered=(final_step or joined_to_next_step), key_fields=key_fields, output_fields=output_fields)
+
     def execute(self, stream=False):
         """!
         Execute the query. Runs each query step from left to right.
@@ -601,6 +1054,9 @@ class WeaveQ(object):
         stage_index = 0
         for instr in self._instructions:
             instr["scroll"] = stream
+            if (hasattr(instr["q"], "prepare")):
+                instr["q"].prepare(self._plan_step(stage_index))
+
             if (not self._execute_instruction(instr)):
                 return False
             else:
@@ -0,0 +1,526 @@
+# -*- coding: utf-8 -*-
+
+"""!
+@package weaveq.resultformats Result handlers writing query results as tables: CSV, Parquet and SQLite.
+"""
+
+# Copyright 2017 James Mistry.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+from __future__ import print_function, absolute_import
+import abc
+import io
+import csv
+import base64
+import datetime
+import decimal
+import sqlite3
+import six
+
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+
+import weaveq.wqexception
+import weaveq.query
+import weaveq.jsoncodec
+import weaveq.compression
+import weaveq.arrowrecord
+
+## Names of the supported output formats, including line-delimited JSON, which is written by the handlers in weaveq.application
+FORMATS = ["json_lines", "csv", "parquet", "sqlite"]
+
+## Types of the values that are written to a column as they are, without being flattened or encoded
+_SCALAR_TYPES = frozenset([type(None), bool, int, float, six.text_type, six.binary_type] + list(six.integer_types))
+
+## Types of the values that the csv module writes as they should appear in cells
+_CSV_TYPES = frozenset([int, float, six.text_type] + list(six.integer_types) + ([six.binary_type] if (six.PY2) else []))
+
+## Compression formats that Parquet files can be compressed in, by the name of the equivalent output compression format
+PARQUET_COMPRESSION = {"gzip":"gzip", "zstd":"zstd"}
+
+class RowFlattener(object):
+    """!
+    @brief Flattens query results into rows of columns. Flatteners can be pickled, so that results can be flattened by worker processes.
+
+    Nested objects, such as joined records, are flattened into a column per field, named in dot notation (for example, "joined.name"). Lists, such as the records joined to array fields, are encoded as JSON text in a single column.
+    """
+
+    def __init__(self, codec = None):
+        """!
+        Constructor.
+
+        @param codec weaveq.jsoncodec.JsonCodec: codec with which to encode lists. If @c None, the default codec is used.
+        """
+
+        ## @var codec
+        # Codec used to encode lists
+        self.codec = weaveq.jsoncodec.default_codec() if (codec is None) else codec
+
+    def __getstate__(self):
+        return {"codec_name":self.codec.name}
+
+    def __setstate__(self, state):
+        self.__init__(weaveq.jsoncodec.get_codec(state["codec_name"]))
+
+    def _flatten(self, obj, prefix, names, values):
+        for name, value in obj.items():
+            if (type(value) not in _SCALAR_TYPES):
+                if (isinstance(value, Mapping)):
+                    self._flatten(value, prefix + name + ".", names, values)
+                    continue
+                elif (isinstance(value, (list, tuple))):
+                    value = self.codec.encode(value).decode("utf-8")
+
+            names.append(prefix + name)
+            values.append(value)
+
+    def __call__(self, result):
+        """!
+        Flattens a result.
+
+        @param result object: the result. Results that aren't objects are flattened into a single column named "value".
+
+        @return a tuple of the column names, in field order, and a tuple of the corresponding values
+        """
+        if (not isinstance(result, Mapping)):
+            result = {"value":result}
+
+        names = []
+        values = []
+        self._flatten(result, "", names, values)
+
+        # Tuples of plain values aren't tracked by the garbage collector, which keeps batches of results cheap to hold
+        return (tuple(names), tuple(values))
+
+class TabularResultHandler(weaveq.query.ResultHandler):
+    """!
+    @brief Abstract result handler that writes results as rows of a table, a batch at a time.
+
+    Results are flattened by a RowFlattener. Unless they're specified up front, the table's columns are those of the results in the first batch, in the order in which they first appear. Fields that first appear in later results become new columns if the format allows it; otherwise they're left out and listed in ignored_fields.
+    """
+
+    __metaclass__ = abc.ABCMeta
+
+    ## Default number of results written at a time
+    BATCH_SIZE = 10000
+
+    def __init__(self, codec = None, columns = None, batch_size = None):
+        """!
+        Constructor.
+
+        @param codec weaveq.jsoncodec.JsonCodec: codec with which to encode lists. If @c None, the default codec is used.
+        @param columns list: names of the table's columns, in dot notation. If @c None, they're taken from the first batch of results.
+        @param batch_size int: number of results written at a time. If @c None, the handler's BATCH_SIZE is used.
+        """
+        self._flattener = RowFlattener(codec)
+        self._batch_size = self.BATCH_SIZE if (batch_size is None) else batch_size
+        self._batch = []
+        self._column_indexes = None
+        self._layouts = {}
+
+        ## @var columns
+        # Names of the table's columns, in order, or @c None if they aren't known yet
+        self.columns = None if (columns is None) else list(columns)
+
+        ## @var ignored_fields
+        # Names of the fields left out of the table because they first appeared after the columns were fixed
+        self.ignored_fields = set()
+
+        ## @var rows_written
+        # Number of rows written so far
+        self.rows_written = 0
+
+    def __call__(self, result, handler_output):
+        self._batch.append(self._flattener(result))
+        if (len(self._batch) >= self._batch_size):
+            self._write_batch()
+
+    def encoder(self):
+        """!
+        @return the handler's RowFlattener, for use with write_encoded()
+
+        @see weaveq.application.FileOutputResultHandler.encoder()
+        """
+        return self._flattener
+
+    def write_encoded(self, rows):
+        """!
+        Writes results that have already been flattened.
+
+        @param rows list: the flattened results, as produced by the handler's encoder()
+        """
+        self._batch.extend(rows)
+        if (len(self._batch) >= self._batch_size):
+            self._write_batch()
+
+    def _write_batch(self):
+        batch, self._batch = self._batch, []
+        if (self._column_indexes is None):
+            if (self.columns is None):
+                self.columns = []
+                known = set()
+                for names, values in batch:
+                    for name in names:
+                        if (name not in known):
+                            self.columns.append(name)
+                            known.add(name)
+
+            self._column_indexes = dict((name, index) for index, name in enumerate(self.columns))
+            self._start()
+
+        rows = []
+        for names, values in batch:
+            layout = self._layouts.get(names)
+            if (layout is None):
+                layout = self._layout(names)
+
+            if (layout is True):
+                rows.append(values)
+                continue
+
+            row = [None] * len(self.columns)
+            for index, value in zip(layout, values):
+                if (index is not None):
+                    row[index] = value
+
+            rows.append(row)
+
+        # Rows built before a column was added are shorter than the rest
+        column_count = len(self.columns)
+        rows = [(row if (len(row) == column_count) else tuple(row) + ((None,) * (column_count - len(row)))) for row in rows]
+
+        self._write_rows(rows)
+        self.rows_written += len(rows)
+
+    def _layout(self, names):
+        """!
+        Works out which column each of a set of fields is written to, adding columns for new fields if the format allows it. Results usually share a handful of sets of fields, so layouts are worked out once per set and reused.
+
+        @param names tuple: the fields' names, in field order
+
+        @return a list of the fields' column indexes (@c None for fields that are left out), or @c True if the fields are the table's columns, in order
+        """
+        layout = []
+        for name in names:
+            if ((name not in self._column_indexes) and (name not in self.ignored_fields)):
+                self._add_column(name)
+
+            layout.append(self._column_indexes.get(name))
+
+        if (layout == list(range(len(self.columns)))):
+            layout = True
+
+        self._layouts[names] = layout
+
+        return layout
+
+    def _add_column(self, name):
+        """!
+        Handles a field that first appears after the table's columns are fixed. By default, the field is ignored; formats that can add columns override this to add one.
+
+        @param name string: the field's name
+        """
+        self.ignored_fields.add(name)
+
+    def _append_column(self, name):
+        """!
+        Adds a column to the end of the table's columns. Called by implementations of _add_column() that add columns.
+
+        @param name string: the column's name
+        """
+        self._column_indexes[name] = len(self.columns)
+        self.columns.append(name)
+
+    @abc.abstractmethod
+    def _start(self):
+        """!
+        Prepares the output, once the table's columns are known.
+        """
+        pass
+
+    @abc.abstractmethod
+    def _write_rows(self, rows):
+        """!
+        Writes a batch of rows.
+
+        @param rows list: the rows, each a list or tuple of values in column order. Missing values are @c None.
+        """
+        pass
+
+    @abc.abstractmethod
+    def _finish(self):
+        """!
+        Finishes the output, once all rows have been written.
+        """
+        pass
+
+    def flush(self):
+        """!
+        Writes all the results handled so far and finishes the output. Call this once all results have been handled.
+        """
+        if ((len(self._batch) > 0) or (self._column_indexes is None)):
+            self._write_batch()
+
+        self._finish()
+
+    def success(self):
+        return True
+
+def _csv_cell(value):
+    if (value is None):
+        return u""
+    elif (value is True):
+        return u"true"
+    elif (value is False):
+        return u"false"
+    elif (isinstance(value, (datetime.datetime, datetime.date, datetime.time))):
+        return value.isoformat()
+    elif (isinstance(value, decimal.Decimal)):
+        return str(value)
+    elif (isinstance(value, bytearray) or (isinstance(value, bytes) and six.PY3)):
+        return base64.b64encode(value).decode("ascii")
+
+    return value
+
+class CsvResultHandler(TabularResultHandler):
+    """!
+    Result handler that writes results as CSV, with a header row of column names. Each batch of rows is formatted in memory and written in one go, optionally compressed on a background thread.
+
+    Missing values are written as empty cells and booleans as "true" or "false", which the csv data source reads back as the same values.
+    """
+
+    ## Default number of results written at a time. Writes are buffered, so batches only need to be big enough to make formatting them efficient.
+    BATCH_SIZE = 1000
+
+    def __init__(self, destination, codec = None, columns = None, batch_size = None, compression = None):
+        """!
+        Constructor.
+
+        @param destination string or file: path to the file to write, or an open file object to which results should be written. Results are written to the file object's underlying binary buffer, if it has one.
+        @param codec weaveq.jsoncodec.JsonCodec: codec with which to encode lists. If @c None, the default codec is used.
+        @param columns list: see TabularResultHandler
+        @param batch_size int: see TabularResultHandler
+        @param compression string: name of the format in which to compress the output ("gzip", "bz2", "xz" or "zstd"), or @c None not to compress it
+        """
+        super(CsvResultHandler, self).__init__(codec, columns, batch_size)
+
+        if (not isinstance(destination, six.string_types)):
+            destination.flush()
+            destination = getattr(destination, "buffer", destination)
+
+        self._destination = destination
+        self._compression = compression
+        self._output = None
+
+    def _format(self, rows):
+        if (six.PY2):
+            text = io.BytesIO()
+            rows = [[(cell.encode("utf-8") if (isinstance(cell, six.text_type)) else cell) for cell in row] for row in rows]
+        else:
+            text = io.StringIO()
+
+        csv.writer(text).writerows(rows)
+        data = text.getvalue()
+
+        return data if (six.PY2) else data.encode("utf-8")
+
+    def _start(self):
+        try:
+            self._output = weaveq.compression.open_output(self._destination, self._compression)
+        except (OSError, IOError) as e:
+            raise weaveq.wqexception.OutputError("Couldn't open output file '{0}': {1}".format(self._destination, str(e)))
+
+        if (len(self.columns) > 0):
+            self._output.write(self._format([self.columns]))
+
+    def _write_rows(self, rows):
+        if (len(rows) > 0):
+            self._output.write(self._format([[(value if (value.__class__ in _CSV_TYPES) else _csv_cell(value)) for value in row] for row in rows]))
+
+    def _finish(self):
+        if (self._output is not self._destination):
+            self._output.close()
+
+        if (not isinstance(self._destination, six.string_types)):
+            self._destination.flush()
+
+class ParquetResultHandler(TabularResultHandler):
+    """!
+    @brief Result handler that writes results to a Parquet file, a row group per batch. Requires the pyarrow package.
+
+    Column types are inferred from the first batch of results. Columns with no values in the first batch are written as strings.
+    """
+
+    ## Default number of results written at a time, and so the number of rows in each row group
+    BATCH_SIZE = 65536
+
+    def __init__(self, filename, codec = None, columns = None, batch_size = None, compression = None):
+        """!
+        Constructor.
+
+        @param filename string: path to the file to write
+        @param codec weaveq.jsoncodec.JsonCodec: codec with which to encode lists. If @c None, the default codec is used.
+        @param columns list: see TabularResultHandler
+        @param batch_size int: see TabularResultHandler
+        @param compression string: name of the format in which to compress the file's columns ("gzip" or "zstd"), or @c None to use Parquet's default (Snappy)
+        """
+        if (not weaveq.arrowrecord.available()):
+            raise weaveq.wqexception.OutputError("Can't write {0}: Parquet output requires the pyarrow package".format(filename))
+        if ((compression is not None) and (compression not in PARQUET_COMPRESSION)):
+            raise weaveq.wqexception.OutputError("Can't write {0}: Parquet files can't be compressed in {1} format".format(filename, compression))
+
+        super(ParquetResultHandler, self).__init__(codec, columns, batch_size)
+
+        self._filename = filename
+        self._compression = "snappy" if (compression is None) else PARQUET_COMPRESSION[compression]
+        self._schema = None
+        self._writer = None
+
+    def _column_array(self, values, index):
+        pyarrow = weaveq.arrowrecord.pyarrow
+        field = self._schema.field(index)
+        if (pyarrow.types.is_string(field.type)):
+            values = [(value if ((value is None) or (isinstance(value, six.text_type))) else six.text_type(_csv_cell(value))) for value in values]
+
+        try:
+            return pyarrow.array(values, type=field.type)
+        except (pyarrow.ArrowInvalid, pyarrow.ArrowTypeError, TypeError, ValueError, OverflowError) as e:
+            raise weaveq.wqexception.OutputError("Can't write column '{0}' of {1} as {2}: {3}".format(field.name, self._filename, field.type, str(e)))
+
+    def _start(self):
+        pass
+
+    def _write_rows(self, rows):
+        pyarrow = weaveq.arrowrecord.pyarrow
+        columns = [list(values) for values in zip(*rows)] if (len(rows) > 0) else [[] for name in self.columns]
+
+        if (self._schema is None):
+            fields = []
+            for name, values in zip(self.columns, columns):
+                try:
+                    column_type = pyarrow.array(values).type
+                except (pyarrow.ArrowInvalid, pyarrow.ArrowTypeError, TypeError, ValueError, OverflowError):
+                    column_type = pyarrow.string()
+
+                fields.append(pyarrow.field(name, pyarrow.string() if (pyarrow.types.is_null(column_type)) else column_type))
+
+            self._schema = pyarrow.schema(fields)
+            try:
+                self._writer = weaveq.arrowrecord.pyarrow.parquet.ParquetWriter(self._filename, self._schema, compression=self._compression)
+            except (OSError, IOError) as e:
+                raise weaveq.wqexception.OutputError("Couldn't open output file '{0}': {1}".format(self._filename, str(e)))
+
+        table = pyarrow.Table.from_arrays([self._column_array(values, index) for index, values in enumerate(columns)], schema=self._schema)
+        self._writer.write_table(table, row_group_size=max(1, len(rows)))
+
+    def _finish(self):
+        if (self._writer is not None):
+            self._writer.close()
+            self._writer = None
+
+class SqliteResultHandler(TabularResultHandler):
+    """!
+    @brief Result handler that inserts results into a table in a SQLite database, a batch at a time, each in its own transaction.
+
+    The table is created if it doesn't exist, and columns are added to it as new fields appear in results. Values that SQLite can't store (such as dates and times) are stored as text, as they're encoded in JSON.
+    """
+
+    def __init__(self, filename, table = "results", codec = None, columns = None, batch_size = None):
+        """!
+        Constructor.
+
+        @param filename string: path to the database file, which is created if it doesn't exist
+        @param table string: name of the table into which results are inserted
+        @param codec weaveq.jsoncodec.JsonCodec: codec with which to encode lists. If @c None, the default codec is used.
+        @param columns list: see TabularResultHandler
+        @param batch_size int: see TabularResultHandler
+        """
+        super(SqliteResultHandler, self).__init__(codec, columns, batch_size)
+
+        self._filename = filename
+        self._table = table
+        self._connection = None
+        self._insert = None
+
+    @staticmethod
+    def _quote(name):
+        return "\"{0}\"".format(name.replace("\"", "\"\""))
+
+    def _execute(self, statement, parameters = None):
+        try:
+            if (parameters is None):
+                self._connection.execute(statement)
+            else:
+                self._connection.executemany(statement, parameters)
+        except sqlite3.Error as e:
+            raise weaveq.wqexception.OutputError("Couldn't write results to table {0} of {1}: {2}".format(self._table, self._filename, str(e)))
+
+    def _existing_columns(self):
+        return [row[1] for row in self._connection.execute("PRAGMA table_info({0})".format(self._quote(self._table)))]
+
+    def _start(self):
+        try:
+            # Calls are serialised, but may come from a BackgroundResultHandler's thread
+            self._connection = sqlite3.connect(self._filename, check_same_thread=False)
+        except sqlite3.Error as e:
+            raise weaveq.wqexception.OutputError("Couldn't open output file '{0}': {1}".format(self._filename, str(e)))
+
+        existing = self._existing_columns()
+        with self._connection:
+            if (len(self.columns) == 0):
+                # There's nothing to create a table from
+                pass
+            elif (len(existing) == 0):
+                self._execute("CREATE TABLE IF NOT EXISTS {0} ({1})".format(self._quote(self._table), ", ".join([self._quote(name) for name in self.columns])))
+            else:
+                for name in self.columns:
+                    if (name not in existing):
+                        self._execute("ALTER TABLE {0} ADD COLUMN {1}".format(self._quote(self._table), self._quote(name)))
+
+        self._prepare_insert()
+
+    def _prepare_insert(self):
+        self._insert = "INSERT INTO {0} ({1}) VALUES ({2})".format(self._quote(self._table), ", ".join([self._quote(name) for name in self.columns]), ", ".join(["?"] * len(self.columns)))
+
+    def _add_column(self, name):
+        existing = self._existing_columns()
+        with self._connection:
+            if (len(existing) == 0):
+                # The first batch had no columns, so the table hasn't been created yet
+                self._execute("CREATE TABLE IF NOT EXISTS {0} ({1})".format(self._quote(self._table), self._quote(name)))
+            elif (name not in existing):
+                self._execute("ALTER TABLE {0} ADD COLUMN {1}".format(self._quote(self._table), self._quote(name)))
+
+        self._append_column(name)
+        self._prepare_insert()
+
+    @staticmethod
+    def _value(value):
+        if (isinstance(value, (six.integer_types, float, six.text_type, bytes))):
+            return value
+        elif (isinstance(value, decimal.Decimal)):
+            return str(value)
+
+        return _csv_cell(value)
+
+    def _write_rows(self, rows):
+        if ((len(rows) > 0) and (len(self.columns) > 0)):
+            with self._connection:
+                self._execute(self._insert, [[(value if (value.__class__ in _SCALAR_TYPES) else self._value(value)) for value in row] for row in rows])
+
+    def _finish(self):
+        if (self._connection is not None):
+            self._connection.close()
+            self._connection = None
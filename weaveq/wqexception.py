@@ -82,3 +82,17 @@ class DataSourceError(WeaveQError):
         @param message string: Error description
         """
         super(DataSourceError, self).__init__(message)
+
+class OutputError(WeaveQError):
+    """!
+    Exception thrown when query results can't be written to their destination.
+
+    @param message string: Error description
+    """
+    def __init__(self, message):
+        """!
+        Constructor.
+        
+        @param message string: Error description
+        """
+        super(OutputError, self).__init__(message)